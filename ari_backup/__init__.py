@@ -1,10 +1,38 @@
-"""Initialize the ari_backup package."""
-from ari_backup import lvm
-from ari_backup import rdiff_backup_wrapper
-from ari_backup import zfs
+"""Initialize the ari_backup package.
 
+The main backup classes are put in this namespace for convenience. They are
+loaded on first access, so that a job only pays for importing the workflow
+modules (and their flag definitions) it actually uses.
+"""
+import importlib
 
-# Put the main backup classes in this namespace for convenience.
-RdiffBackup = rdiff_backup_wrapper.RdiffBackup
-RdiffLVMBackup = lvm.RdiffLVMBackup
-ZFSLVMBackup = zfs.ZFSLVMBackup
+
+# Maps the convenience names to the modules defining them.
+_LAZY_ATTRIBUTES = {
+    'RdiffBackup': 'rdiff_backup_wrapper',
+    'RdiffLVMBackup': 'lvm',
+    'ShardedRdiffBackup': 'sharded',
+    'ZFSLVMBackup': 'zfs',
+}
+# Submodules which used to be imported along with the package.
+_LAZY_SUBMODULES = frozenset(['lvm', 'rdiff_backup_wrapper', 'sharded', 'zfs'])
+
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    try:
+        module_name = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name))
+    module = importlib.import_module('.' + module_name, __name__)
+    value = getattr(module, name)
+    # Cache the value so that later lookups don't come through here.
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(
+        set(globals()) | set(_LAZY_ATTRIBUTES) | _LAZY_SUBMODULES)
@@ -0,0 +1,367 @@
+"""Adapts how many jobs run at once to how busy the hosts involved are.
+
+The limits given to ari-backup-run become ceilings. Every few seconds the
+utilization of the local disks behind each backup destination is sampled
+from /proc/diskstats, and the CPU iowait from /proc/stat:
+
+* A destination whose disks are below the target utilization while it runs
+  as many jobs as it may gets one more job slot. One above the target gives
+  one up. Destinations start with a single slot.
+* While iowait is above its limit, the total number of jobs is lowered, and
+  it's raised again once iowait drops.
+
+Before a job is started against a source host, the load average of that host
+is fetched with a single SSH command, and the job is held back while the
+load per CPU is above its limit, or while the load is being fetched on a
+thread of its own. A job is never held back while nothing else
+is running, so that a busy host delays its backup rather than skipping it.
+
+Destinations on other hosts, e.g. remote ZFS pools, can't be sampled and keep
+their fixed limit.
+"""
+from typing import Callable, Optional
+
+import functools
+import os
+import socket
+import subprocess
+import threading
+import time
+
+
+# Utilization band around the target in which a destination's slots are left
+# alone, so that the limits don't flap.
+_HYSTERESIS = 0.1
+# Seconds to wait for a source host to report its load.
+_LOAD_TIMEOUT = 10
+
+
+def read_io_ticks(path: str = '/proc/diskstats') -> dict[str, int]:
+    """Returns the milliseconds each block device has spent doing I/O."""
+    io_ticks = dict()
+    with open(path) as diskstats:
+        for line in diskstats:
+            fields = line.split()
+            if len(fields) >= 13:
+                io_ticks[fields[2]] = int(fields[12])
+    return io_ticks
+
+
+def read_cpu_times(path: str = '/proc/stat') -> tuple[int, int]:
+    """Returns the CPU time spent in iowait and in total, in jiffies."""
+    with open(path) as stat:
+        for line in stat:
+            fields = line.split()
+            if fields and fields[0] == 'cpu':
+                times = [int(field) for field in fields[1:]]
+                return times[4], sum(times)
+    raise ValueError('{} has no cpu line.'.format(path))
+
+
+def get_block_device(path: str) -> Optional[str]:
+    """Returns the name of the block device holding path (e.g. dm-0).
+
+    Returns:
+        The device name as used in /proc/diskstats, or None if path doesn't
+        live on a block device (e.g. it's on NFS or tmpfs).
+    """
+    try:
+        st_dev = os.stat(path).st_dev
+    except OSError:
+        return None
+    sys_path = '/sys/dev/block/{}:{}'.format(
+        os.major(st_dev), os.minor(st_dev))
+    if not os.path.exists(sys_path):
+        return None
+    return os.path.basename(os.path.realpath(sys_path))
+
+
+def get_pool_devices(pool: str) -> list[str]:
+    """Returns the block devices of a local ZFS pool.
+
+    Returns:
+        The names of the devices, or an empty list if the pool can't be
+        listed.
+    """
+    try:
+        output = subprocess.run(
+            ['zpool', 'list', '-v', '-H', '-P', pool], capture_output=True,
+            text=True, timeout=_LOAD_TIMEOUT).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return list()
+    devices = list()
+    for line in output.splitlines():
+        name = line.split('\t')[0].strip() if line.strip() else ''
+        if name.startswith('/dev/'):
+            devices.append(os.path.basename(os.path.realpath(name)))
+    return devices
+
+
+def is_local_host(host: str) -> bool:
+    """Whether host names the machine ari-backup runs on."""
+    return host in ('localhost', socket.gethostname(), socket.getfqdn())
+
+
+def get_destination_devices(destination: str) -> list[str]:
+    """Returns the local block devices a destination writes to.
+
+    Args:
+        destination: a job destination, i.e. host:path for rdiff-backup
+            stores and host:pool for ZFS pools.
+    """
+    host, _, location = destination.partition(':')
+    if not location or not is_local_host(host):
+        return list()
+    if location.startswith('/'):
+        device = get_block_device(location)
+        return [device] if device else list()
+    return get_pool_devices(location)
+
+
+def parse_load(output: str) -> Optional[float]:
+    """Returns the 1 minute load average per CPU.
+
+    Args:
+        output: the contents of /proc/loadavg followed by the number of CPUs
+            on the next line.
+    """
+    lines = output.split('\n')
+    try:
+        load = float(lines[0].split()[0])
+        cpus = int(lines[1].strip())
+    except (IndexError, ValueError):
+        return None
+    return load / max(1, cpus)
+
+
+class SourceLoad:
+    """Fetches and caches the load of source hosts. Thread-safe."""
+
+    def __init__(self,
+                 ssh_args: Callable[[str], list[str]],
+                 max_age: float = 60):
+        """Initializes SourceLoad.
+
+        Args:
+            ssh_args: returns the ssh command line prefix for a host.
+            max_age: seconds for which a host's load is reused.
+        """
+        self._ssh_args = ssh_args
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._cache: dict[str, tuple[float, Optional[float]]] = dict()
+        # Hosts with a fetch claimed by start_refresh() which hasn't finished.
+        self._refreshing: set[str] = set()
+
+    def _fetch(self, host: str) -> Optional[float]:
+        if host == 'localhost':
+            return os.getloadavg()[0] / max(1, os.cpu_count() or 1)
+        args = self._ssh_args(host) + [
+            'cat /proc/loadavg && getconf _NPROCESSORS_ONLN']
+        try:
+            result = subprocess.run(
+                args, stdin=subprocess.DEVNULL, capture_output=True,
+                text=True, timeout=_LOAD_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        if result.returncode != 0:
+            return None
+        return parse_load(result.stdout)
+
+    def _get_fresh(self, host: str) -> Optional[tuple[float, Optional[float]]]:
+        cached = self._cache.get(host)
+        if cached is None or time.monotonic() - cached[0] > self._max_age:
+            return None
+        return cached
+
+    def is_known(self, host: str) -> bool:
+        """Whether the load of host was fetched less than max_age ago."""
+        with self._lock:
+            return self._get_fresh(host) is not None
+
+    def get(self, host: str) -> Optional[float]:
+        """Returns the last load per CPU of host, or None if it's unknown.
+
+        Never fetches it. See start_refresh().
+        """
+        with self._lock:
+            cached = self._get_fresh(host)
+        return None if cached is None else cached[1]
+
+    def start_refresh(self, host: str) -> bool:
+        """Claims the next fetch of the load of host, if it's due.
+
+        A caller which gets True must call refresh() for host, typically
+        from another thread so as not to wait for the host.
+        """
+        with self._lock:
+            if self._get_fresh(host) is not None or host in self._refreshing:
+                return False
+            self._refreshing.add(host)
+            return True
+
+    def refresh(self, host: str) -> Optional[float]:
+        """Fetches the load per CPU of host, or None if it can't be had."""
+        load = self._fetch(host)
+        with self._lock:
+            self._cache[host] = (time.monotonic(), load)
+            self._refreshing.discard(host)
+        return load
+
+
+class AdaptiveLimits:
+    """Job limits which follow the load of the hosts involved."""
+
+    def __init__(self,
+                 max_jobs: int,
+                 max_jobs_per_destination: int,
+                 destination_devices: dict[str, list[str]],
+                 target_utilization: float = 0.8,
+                 max_iowait: float = 0.3,
+                 max_source_load: Optional[float] = None,
+                 source_load: Optional[SourceLoad] = None,
+                 interval: float = 15,
+                 diskstats_path: str = '/proc/diskstats',
+                 stat_path: str = '/proc/stat'):
+        """Initializes AdaptiveLimits.
+
+        Args:
+            max_jobs: the ceiling of the total number of jobs.
+            max_jobs_per_destination: the ceiling of the number of jobs per
+                destination.
+            destination_devices: the local block devices of each
+                destination. Destinations with none keep the ceiling as
+                their limit.
+            target_utilization: the fraction of time the disks of a
+                destination should be busy.
+            max_iowait: the fraction of CPU time in iowait above which fewer
+                jobs are run.
+            max_source_load: the 1 minute load average per CPU of a source
+                host above which no more jobs are started against it. None
+                disables the check.
+            source_load: fetches the load of source hosts. Required when
+                max_source_load is set.
+            interval: seconds between samples.
+            diskstats_path: the diskstats file, overridden for testing.
+            stat_path: the stat file, overridden for testing.
+        """
+        self.interval = interval
+        self._max_jobs = max(1, max_jobs)
+        self._max_jobs_per_destination = max(1, max_jobs_per_destination)
+        self._devices = {destination: devices for destination, devices
+                         in destination_devices.items() if devices}
+        self._target_utilization = target_utilization
+        self._max_iowait = max_iowait
+        self._max_source_load = max_source_load
+        self._source_load = source_load
+        self._diskstats_path = diskstats_path
+        self._stat_path = stat_path
+
+        self.max_jobs = self._max_jobs
+        self._destination_limits = {destination: 1
+                                    for destination in self._devices}
+        self._last_sample: Optional[float] = None
+        self._io_ticks: dict[str, int] = dict()
+        self._cpu_times: Optional[tuple[int, int]] = None
+
+    def get_destination_limit(self, destination: Optional[str]) -> int:
+        """Returns how many jobs may write to destination at once."""
+        return self._destination_limits.get(
+            destination, self._max_jobs_per_destination)
+
+    def allows_source(self, source: Optional[str]) -> bool:
+        """Whether the load of a source host allows another job against it.
+
+        The load is never fetched here, and a job is held back until it has
+        been. See start_source_refresh().
+        """
+        if source is None or self._max_source_load is None or (
+                self._source_load is None):
+            return True
+        if not self._source_load.is_known(source):
+            return False
+        load = self._source_load.get(source)
+        return load is None or load <= self._max_source_load
+
+    def start_source_refresh(
+            self, source: Optional[str]) -> Optional[Callable[[], object]]:
+        """Claims the next fetch of the load of a source host, if it's due.
+
+        Returns:
+            A function which fetches the load, to be called where nothing
+            waits on it, or None when no fetch is due.
+        """
+        if source is None or self._max_source_load is None or (
+                self._source_load is None):
+            return None
+        if not self._source_load.start_refresh(source):
+            return None
+        return functools.partial(self._source_load.refresh, source)
+
+    def _read(self) -> tuple[dict[str, int], Optional[tuple[int, int]]]:
+        try:
+            io_ticks = read_io_ticks(self._diskstats_path)
+        except OSError:
+            io_ticks = dict()
+        try:
+            cpu_times: Optional[tuple[int, int]] = read_cpu_times(
+                self._stat_path)
+        except (OSError, ValueError):
+            cpu_times = None
+        return io_ticks, cpu_times
+
+    def update(self,
+               running: int,
+               running_per_destination: dict[Optional[str], int]) -> None:
+        """Samples the disks and CPU and adjusts the limits, once per interval.
+
+        Args:
+            running: the number of jobs running.
+            running_per_destination: the number of jobs running per
+                destination.
+        """
+        now = time.monotonic()
+        if (self._last_sample is not None and
+                now - self._last_sample < self.interval):
+            return
+        io_ticks, cpu_times = self._read()
+        if self._last_sample is not None:
+            elapsed_ms = (now - self._last_sample) * 1000
+            self._adjust_destinations(
+                io_ticks, elapsed_ms, running_per_destination)
+            self._adjust_total(cpu_times, running)
+        self._last_sample = now
+        self._io_ticks = io_ticks
+        self._cpu_times = cpu_times
+
+    def _adjust_destinations(
+            self, io_ticks: dict[str, int], elapsed_ms: float,
+            running_per_destination: dict[Optional[str], int]) -> None:
+        for destination, devices in self._devices.items():
+            utilizations = [
+                (io_ticks[device] - self._io_ticks[device]) / elapsed_ms
+                for device in devices
+                if device in io_ticks and device in self._io_ticks]
+            if not utilizations or elapsed_ms <= 0:
+                continue
+            utilization = max(utilizations)
+            limit = self._destination_limits[destination]
+            if utilization > self._target_utilization + _HYSTERESIS:
+                limit = max(1, limit - 1)
+            elif (utilization < self._target_utilization - _HYSTERESIS and
+                    running_per_destination.get(destination, 0) >= limit):
+                limit = min(self._max_jobs_per_destination, limit + 1)
+            self._destination_limits[destination] = limit
+
+    def _adjust_total(self, cpu_times: Optional[tuple[int, int]],
+                      running: int) -> None:
+        if cpu_times is None or self._cpu_times is None:
+            return
+        total = cpu_times[1] - self._cpu_times[1]
+        if total <= 0:
+            return
+        iowait = (cpu_times[0] - self._cpu_times[0]) / total
+        if iowait > self._max_iowait:
+            self.max_jobs = max(1, self.max_jobs - 1)
+        elif iowait < self._max_iowait / 2 and running >= self.max_jobs:
+            self.max_jobs = min(self._max_jobs, self.max_jobs + 1)
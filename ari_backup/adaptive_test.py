@@ -0,0 +1,199 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from absl.testing import absltest
+
+from ari_backup import adaptive
+
+
+_DISKSTATS = ('   8       0 sda 1 0 8 0 1 0 8 0 0 {sda} 0 0 0 0 0 0 0\n'
+              ' 253       0 dm-0 1 0 8 0 1 0 8 0 0 {dm0} 0 0 0 0 0 0 0\n')
+_STAT = ('cpu  {user} 0 0 {idle} {iowait} 0 0 0 0 0\n'
+         'cpu0 0 0 0 0 0 0 0 0 0 0\n')
+
+
+class AdaptiveTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.diskstats_path = os.path.join(self.temp_dir, 'diskstats')
+        self.stat_path = os.path.join(self.temp_dir, 'stat')
+        patcher = mock.patch.object(adaptive.time, 'monotonic')
+        self.mock_monotonic = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write_samples(self, sda=0, dm0=0, user=0, idle=0, iowait=0):
+        with open(self.diskstats_path, 'w') as f:
+            f.write(_DISKSTATS.format(sda=sda, dm0=dm0))
+        with open(self.stat_path, 'w') as f:
+            f.write(_STAT.format(user=user, idle=idle, iowait=iowait))
+
+    def _create_limits(self, **kwargs):
+        return adaptive.AdaptiveLimits(
+            diskstats_path=self.diskstats_path, stat_path=self.stat_path,
+            interval=10, **kwargs)
+
+    def testReadIOTicks_parsesEveryDevice(self):
+        self._write_samples(sda=1200, dm0=34)
+
+        self.assertEqual(adaptive.read_io_ticks(self.diskstats_path),
+                         {'sda': 1200, 'dm-0': 34})
+
+    def testReadCPUTimes_returnsIOWaitAndTotal(self):
+        self._write_samples(user=10, idle=80, iowait=10)
+
+        self.assertEqual(adaptive.read_cpu_times(self.stat_path), (10, 100))
+
+    def testParseLoad_dividesByCPUs(self):
+        self.assertEqual(
+            adaptive.parse_load('6.00 3.00 1.00 2/100 1234\n4\n'), 1.5)
+
+    def testParseLoad_garbage_returnsNone(self):
+        self.assertIsNone(adaptive.parse_load('ssh: connection refused'))
+
+    def testGetDestinationDevices_remoteDestination_returnsNoDevices(self):
+        self.assertEqual(
+            adaptive.get_destination_devices('fake-remote-host:tank'), [])
+
+    def testUpdate_destinationUnderTargetAndFull_gainsSlot(self):
+        limits = self._create_limits(
+            max_jobs=4, max_jobs_per_destination=3,
+            destination_devices={'localhost:/store': ['sda']})
+        self._write_samples(sda=0)
+        self.mock_monotonic.return_value = 100
+        limits.update(1, {'localhost:/store': 1})
+        # Busy 30% of the 10 seconds since the last sample.
+        self._write_samples(sda=3000)
+        self.mock_monotonic.return_value = 110
+
+        limits.update(1, {'localhost:/store': 1})
+
+        self.assertEqual(limits.get_destination_limit('localhost:/store'), 2)
+
+    def testUpdate_destinationUnderTargetButNotFull_keepsSlots(self):
+        limits = self._create_limits(
+            max_jobs=4, max_jobs_per_destination=3,
+            destination_devices={'localhost:/store': ['sda']})
+        self._write_samples(sda=0)
+        self.mock_monotonic.return_value = 100
+        limits.update(0, {})
+        self.mock_monotonic.return_value = 110
+
+        limits.update(0, {})
+
+        self.assertEqual(limits.get_destination_limit('localhost:/store'), 1)
+
+    def testUpdate_destinationSaturated_losesSlot(self):
+        limits = self._create_limits(
+            max_jobs=4, max_jobs_per_destination=3,
+            destination_devices={'localhost:/store': ['sda', 'dm-0']})
+        limits._destination_limits['localhost:/store'] = 3
+        self._write_samples(sda=0, dm0=0)
+        self.mock_monotonic.return_value = 100
+        limits.update(3, {'localhost:/store': 3})
+        # dm-0 was busy the whole time.
+        self._write_samples(sda=100, dm0=10000)
+        self.mock_monotonic.return_value = 110
+
+        limits.update(3, {'localhost:/store': 3})
+
+        self.assertEqual(limits.get_destination_limit('localhost:/store'), 2)
+
+    def testUpdate_beforeInterval_doesNothing(self):
+        limits = self._create_limits(
+            max_jobs=4, max_jobs_per_destination=3,
+            destination_devices={'localhost:/store': ['sda']})
+        self._write_samples(sda=0)
+        self.mock_monotonic.return_value = 100
+        limits.update(1, {'localhost:/store': 1})
+        self._write_samples(sda=1)
+        self.mock_monotonic.return_value = 105
+
+        limits.update(1, {'localhost:/store': 1})
+
+        self.assertEqual(limits.get_destination_limit('localhost:/store'), 1)
+
+    def testUpdate_highIOWait_lowersMaxJobs(self):
+        limits = self._create_limits(
+            max_jobs=4, max_jobs_per_destination=1, destination_devices={},
+            max_iowait=0.3)
+        self._write_samples(user=0, idle=0, iowait=0)
+        self.mock_monotonic.return_value = 100
+        limits.update(4, {})
+        self._write_samples(user=20, idle=30, iowait=50)
+        self.mock_monotonic.return_value = 110
+
+        limits.update(4, {})
+
+        self.assertEqual(limits.max_jobs, 3)
+
+    def testGetDestinationLimit_unsampledDestination_returnsCeiling(self):
+        limits = self._create_limits(
+            max_jobs=4, max_jobs_per_destination=3,
+            destination_devices={'zfs-host:tank': []})
+
+        self.assertEqual(limits.get_destination_limit('zfs-host:tank'), 3)
+
+    def testAllowsSource_loadAboveLimit_returnsFalse(self):
+        source_load = mock.Mock(spec=adaptive.SourceLoad)
+        source_load.is_known.return_value = True
+        source_load.get.side_effect = {'busy': 3.0, 'idle': 0.1,
+                                       'unreachable': None}.get
+        limits = self._create_limits(
+            max_jobs=4, max_jobs_per_destination=1, destination_devices={},
+            max_source_load=2.0, source_load=source_load)
+
+        self.assertFalse(limits.allows_source('busy'))
+        self.assertTrue(limits.allows_source('idle'))
+        self.assertTrue(limits.allows_source('unreachable'))
+
+    def testAllowsSource_loadNotFetched_heldBackUntilRefreshed(self):
+        source_load = mock.Mock(spec=adaptive.SourceLoad)
+        source_load.is_known.return_value = False
+        source_load.start_refresh.return_value = True
+        limits = self._create_limits(
+            max_jobs=4, max_jobs_per_destination=1, destination_devices={},
+            max_source_load=2.0, source_load=source_load)
+
+        self.assertFalse(limits.allows_source('fake-host'))
+        refresh = limits.start_source_refresh('fake-host')
+
+        source_load.refresh.assert_not_called()
+        refresh()
+        source_load.refresh.assert_called_once_with('fake-host')
+
+
+class SourceLoadTest(absltest.TestCase):
+
+    @mock.patch.object(adaptive.subprocess, 'run')
+    def testRefresh_remoteHost_fetchesOnceWithSSH(self, mock_run):
+        mock_run.return_value = mock.Mock(
+            returncode=0, stdout='4.00 1.00 1.00 1/10 99\n2\n')
+        source_load = adaptive.SourceLoad(
+            lambda host: ['/fake/ssh', 'fake_user@' + host], max_age=60)
+
+        self.assertTrue(source_load.start_refresh('fake-host'))
+        self.assertFalse(source_load.start_refresh('fake-host'))
+        self.assertEqual(source_load.refresh('fake-host'), 2.0)
+        self.assertFalse(source_load.start_refresh('fake-host'))
+
+        self.assertEqual(source_load.get('fake-host'), 2.0)
+        mock_run.assert_called_once()
+        self.assertEqual(mock_run.call_args.args[0][:2],
+                         ['/fake/ssh', 'fake_user@fake-host'])
+
+    @mock.patch.object(adaptive.subprocess, 'run')
+    def testGet_notFetched_returnsNoneWithoutFetching(self, mock_run):
+        source_load = adaptive.SourceLoad(lambda host: ['/fake/ssh', host])
+
+        self.assertIsNone(source_load.get('fake-host'))
+        self.assertFalse(source_load.is_known('fake-host'))
+        mock_run.assert_not_called()
+
+
+if __name__ == '__main__':
+    absltest.main()
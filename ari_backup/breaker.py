@@ -0,0 +1,125 @@
+"""Circuit breakers which stop jobs against unreachable source hosts.
+
+A job against a host which is down spends all of its command retries and
+several SSH timeouts before it fails. When a job fails, its source host is
+probed with a cheap SSH command to tell connection failures from other
+failures. After enough consecutive connection failures, the breaker of the
+host opens and the host's remaining jobs are set aside so that their slots go
+to healthy hosts. The host is probed again every so often, and its jobs run
+once it answers.
+
+Probes of open breakers take an SSH connection, so HostHealth only says when
+one is due. The scheduler runs it on a thread of its own, and holds the jobs
+of the host back meanwhile.
+"""
+from typing import Callable
+
+import collections
+import threading
+import time
+
+
+class HostHealth:
+    """The breaker state of each source host of a run. Thread-safe."""
+
+    def __init__(self,
+                 probe: Callable[[str], bool],
+                 threshold: int = 2,
+                 probe_interval: float = 600):
+        """Initializes HostHealth.
+
+        Args:
+            probe: returns whether a host can be connected to.
+            threshold: how many jobs in a row must fail to connect to a host
+                for its breaker to open.
+            probe_interval: seconds between probes of a host whose breaker is
+                open.
+        """
+        self.probe_interval = probe_interval
+        self._probe = probe
+        self._threshold = max(1, threshold)
+        self._lock = threading.Lock()
+        self._failures: collections.Counter = collections.Counter()
+        # The time.monotonic() value at which each open breaker is probed.
+        self._next_probes: dict[str, float] = dict()
+        # Hosts with a probe claimed by start_probe() which hasn't finished.
+        self._probing: set[str] = set()
+
+    def record_result(self, host: str, succeeded: bool) -> None:
+        """Records how a job against host went.
+
+        A failed job counts as a connection failure if the host can't be
+        probed right after it.
+        """
+        if host == 'localhost':
+            return
+        if not succeeded and not self._probe(host):
+            with self._lock:
+                self._failures[host] += 1
+                if (self._failures[host] >= self._threshold and
+                        host not in self._next_probes):
+                    self._next_probes[host] = (
+                        time.monotonic() + self.probe_interval)
+            return
+        with self._lock:
+            self._failures[host] = 0
+            self._next_probes.pop(host, None)
+
+    def is_open(self, host: str) -> bool:
+        """Whether jobs against host should be held back. Never probes."""
+        with self._lock:
+            return host in self._next_probes
+
+    def is_probing(self, host: str) -> bool:
+        """Whether a probe of host started by start_probe() is running."""
+        with self._lock:
+            return host in self._probing
+
+    def start_probe(self, host: str, force: bool = False) -> bool:
+        """Claims the next probe of host, if its breaker is open.
+
+        A caller which gets True must call probe() for host, typically from
+        another thread so as not to wait for the host.
+
+        Args:
+            host: the source host.
+            force: claim the probe even if it isn't due yet.
+
+        Returns:
+            Whether a probe is due and nobody else is probing host.
+        """
+        with self._lock:
+            next_probe = self._next_probes.get(host)
+            if next_probe is None or host in self._probing:
+                return False
+            if not force and time.monotonic() < next_probe:
+                return False
+            self._probing.add(host)
+            return True
+
+    def probe(self, host: str) -> bool:
+        """Probes host, closing its breaker if it answers.
+
+        Returns:
+            Whether the breaker of host is still open.
+        """
+        try:
+            reachable = self._probe(host)
+        except Exception:
+            reachable = False
+        with self._lock:
+            self._probing.discard(host)
+            if reachable:
+                self._failures[host] = 0
+                self._next_probes.pop(host, None)
+            elif host in self._next_probes:
+                self._next_probes[host] = (
+                    time.monotonic() + self.probe_interval)
+        return not reachable
+
+    def get_reason(self, host: str) -> str:
+        """Returns why jobs against host aren't being run."""
+        with self._lock:
+            failures = self._failures[host]
+        return ('{} is unreachable: {} jobs in a row failed to connect to '
+                'it and it still does not answer'.format(host, failures))
@@ -0,0 +1,105 @@
+from unittest import mock
+
+from absl.testing import absltest
+
+from ari_backup import breaker
+
+
+class HostHealthTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.reachable = {'fake-host': False}
+        self.probe = mock.Mock(side_effect=lambda host: self.reachable[host])
+        patcher = mock.patch.object(breaker.time, 'monotonic')
+        self.mock_monotonic = patcher.start()
+        self.mock_monotonic.return_value = 1000
+        self.addCleanup(patcher.stop)
+        self.health = breaker.HostHealth(
+            self.probe, threshold=2, probe_interval=600)
+
+    def testRecordResult_connectionFailuresReachThreshold_opens(self):
+        self.health.record_result('fake-host', False)
+        self.assertFalse(self.health.is_open('fake-host'))
+
+        self.health.record_result('fake-host', False)
+
+        self.assertTrue(self.health.is_open('fake-host'))
+        self.assertIn('2 jobs in a row',
+                      self.health.get_reason('fake-host'))
+
+    def testRecordResult_failureWhileHostAnswers_notCounted(self):
+        self.reachable['fake-host'] = True
+
+        self.health.record_result('fake-host', False)
+        self.health.record_result('fake-host', False)
+
+        self.assertFalse(self.health.is_open('fake-host'))
+
+    def testRecordResult_success_resetsCount(self):
+        self.health.record_result('fake-host', False)
+        self.health.record_result('fake-host', True)
+        self.health.record_result('fake-host', False)
+
+        self.assertFalse(self.health.is_open('fake-host'))
+
+    def testRecordResult_localhost_ignored(self):
+        for _ in range(3):
+            self.health.record_result('localhost', False)
+
+        self.assertFalse(self.health.is_open('localhost'))
+        self.probe.assert_not_called()
+
+    def _open_breaker(self):
+        self.health.record_result('fake-host', False)
+        self.health.record_result('fake-host', False)
+        self.probe.reset_mock()
+
+    def testIsOpen_probeDue_doesNotProbe(self):
+        self._open_breaker()
+        self.reachable['fake-host'] = True
+        self.mock_monotonic.return_value = 1600
+
+        self.assertTrue(self.health.is_open('fake-host'))
+        self.probe.assert_not_called()
+
+    def testStartProbe_probeNotDue_false(self):
+        self._open_breaker()
+        self.mock_monotonic.return_value = 1599
+
+        self.assertFalse(self.health.start_probe('fake-host'))
+        self.assertTrue(self.health.start_probe('fake-host', force=True))
+
+    def testStartProbe_alreadyClaimed_false(self):
+        self._open_breaker()
+        self.mock_monotonic.return_value = 1600
+
+        self.assertTrue(self.health.start_probe('fake-host'))
+        self.assertTrue(self.health.is_probing('fake-host'))
+        self.assertFalse(self.health.start_probe('fake-host'))
+
+    def testProbe_hostBack_closes(self):
+        self._open_breaker()
+        self.reachable['fake-host'] = True
+        self.mock_monotonic.return_value = 1600
+        self.health.start_probe('fake-host')
+
+        self.assertFalse(self.health.probe('fake-host'))
+
+        self.assertFalse(self.health.is_open('fake-host'))
+        self.assertFalse(self.health.is_probing('fake-host'))
+
+    def testProbe_hostStillDown_staysOpenForAnotherInterval(self):
+        self._open_breaker()
+        self.mock_monotonic.return_value = 1600
+        self.health.start_probe('fake-host')
+
+        self.assertTrue(self.health.probe('fake-host'))
+
+        self.mock_monotonic.return_value = 2000
+        self.assertTrue(self.health.is_open('fake-host'))
+        self.assertFalse(self.health.start_probe('fake-host'))
+
+
+if __name__ == '__main__':
+    absltest.main()
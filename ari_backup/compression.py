@@ -0,0 +1,234 @@
+"""Automatic choice of compression for transfers between hosts.
+
+Whether compressing a transfer pays off depends on the link and the data: on
+a fast LAN compressing costs more CPU time than it saves on the wire, while
+on a slow WAN link it can cut a transfer short. Both are probed: a sample of
+the source data is compressed with gzip on the source host, and random data
+is sent over the link to time it. Compression and transfer overlap, so
+compressing is worthwhile when the data compresses well enough and the
+source compresses faster than the link carries it.
+
+Probes take a few seconds, so their results are cached in a JSON file for
+every link, i.e. pair of source and destination hosts, until they expire.
+"""
+from typing import Any, NamedTuple, Optional
+
+import json
+import os
+import re
+import shlex
+import tempfile
+
+
+# How much source data is sampled, and how much random data is sent to time
+# the link. The latter is a multiple of 57 bytes, which base64 encodes to one
+# full 76 character line.
+SAMPLE_SIZE = 4 * 1024 * 1024
+TRANSFER_SIZE = 57 * 73584
+# Data which doesn't shrink to at least this fraction of its size isn't worth
+# compressing.
+_MAX_RATIO = 0.9
+# How many files the sample is taken from, at most.
+_SAMPLE_FILES = 1000
+
+_OUTPUT_RE = re.compile(r'^(\w+) (\d+)$', re.MULTILINE)
+
+
+class Probe(NamedTuple):
+    """The measurements used to decide whether to compress a transfer.
+
+    Attributes:
+        sample_bytes: size of the sample of the source data.
+        compressed_bytes: size of the sample once compressed.
+        compress_seconds: time it took to compress the sample.
+        throughput: bytes per second the link carries.
+    """
+    sample_bytes: int
+    compressed_bytes: int
+    compress_seconds: float
+    throughput: float
+
+    @property
+    def ratio(self) -> float:
+        """Returns the size of the compressed sample relative to the sample.
+        """
+        if not self.sample_bytes:
+            return 1.0
+        return self.compressed_bytes / self.sample_bytes
+
+    @property
+    def compress_rate(self) -> float:
+        """Returns the bytes per second the source host compresses."""
+        return self.sample_bytes / max(self.compress_seconds, 1e-9)
+
+
+def should_compress(probe: Probe) -> bool:
+    """Returns whether compressing a transfer probed as probe pays off."""
+    if not probe.sample_bytes:
+        return False
+    return (probe.ratio <= _MAX_RATIO and
+            probe.compress_rate > probe.throughput)
+
+
+def get_rsync_host(destination: str) -> Optional[str]:
+    """Returns the host an rsync destination is reached at over SSH.
+
+    Args:
+        destination: an rsync destination, e.g. backup-host:/tank/job.
+
+    Returns:
+        The host, possibly as user@host, or None when the destination is local
+        or an rsync daemon.
+    """
+    if destination.startswith('rsync://'):
+        return None
+    host, separator, path = destination.partition(':')
+    if not separator or '/' in host or path.startswith(':'):
+        return None
+    return host
+
+
+def build_sample_script(paths: list[str],
+                        sample_size: int = SAMPLE_SIZE) -> str:
+    """Returns a script which measures how well the data in paths compresses.
+
+    The script samples up to sample_size bytes from the files under paths and
+    prints the size of the sample, the size of the sample once compressed and
+    how long that took, one "<name> <value>" line each.
+
+    Args:
+        paths: where the data to sample is.
+        sample_size: how many bytes to sample.
+    """
+    quoted_paths = ' '.join(shlex.quote(path) for path in paths)
+    return '\n'.join([
+        'sample=$(mktemp) || exit 1',
+        'trap \'rm -f "$sample"\' EXIT',
+        ('find {paths} -xdev -type f 2>/dev/null | head -n {files} | '
+         'tr "\\n" "\\0" | xargs -0 cat 2>/dev/null | '
+         'head -c {size} > "$sample"').format(
+             paths=quoted_paths, files=_SAMPLE_FILES, size=sample_size),
+        'echo "sample_bytes $(wc -c < "$sample")"',
+        'start=$(date +%s%N)',
+        'compressed=$(gzip -c "$sample" | wc -c)',
+        'end=$(date +%s%N)',
+        'echo "compressed_bytes $compressed"',
+        'echo "compress_nanoseconds $((end - start))"',
+    ])
+
+
+def build_transfer_script(ssh_command: list[str],
+                          upload: bool,
+                          transfer_size: int = TRANSFER_SIZE) -> str:
+    """Returns a script which times sending random data over an SSH link.
+
+    The script prints how long an SSH command doing nothing takes and how
+    long one sending transfer_size bytes of random data takes, so that the
+    time spent connecting can be told apart from the time spent sending.
+    The data is base64 encoded so that it can't be compressed much by SSH.
+
+    Args:
+        ssh_command: the SSH command line, up to and including the host.
+        upload: whether the data is sent to the host, rather than from it.
+        transfer_size: how many random bytes are sent, before encoding.
+    """
+    ssh = ' '.join(shlex.quote(arg) for arg in ssh_command)
+    generate = 'head -c {} /dev/urandom | base64'.format(transfer_size)
+    if upload:
+        transfer = '{} | {} {}'.format(
+            generate, ssh, shlex.quote('cat > /dev/null'))
+    else:
+        transfer = '{} {} > /dev/null'.format(ssh, shlex.quote(generate))
+    return '\n'.join([
+        'start=$(date +%s%N)',
+        '{} true || exit 1'.format(ssh),
+        'end=$(date +%s%N)',
+        'echo "baseline_nanoseconds $((end - start))"',
+        'start=$(date +%s%N)',
+        '{} || exit 1'.format(transfer),
+        'end=$(date +%s%N)',
+        'echo "transfer_nanoseconds $((end - start))"',
+    ])
+
+
+def parse_output(output: str) -> dict[str, int]:
+    """Returns the "<name> <value>" lines printed by the probe scripts."""
+    return {name: int(value) for name, value in _OUTPUT_RE.findall(output)}
+
+
+def get_probe(sample_output: str, transfer_output: str,
+              transfer_size: int = TRANSFER_SIZE) -> Probe:
+    """Returns the probe measured by the sample and transfer scripts.
+
+    Raises:
+        ValueError: when a measurement is missing from the output.
+    """
+    measurements = parse_output(sample_output)
+    measurements.update(parse_output(transfer_output))
+    try:
+        # base64 turns every 57 bytes into a 76 character line.
+        sent = transfer_size // 57 * 77
+        transfer_seconds = max(
+            measurements['transfer_nanoseconds'] -
+            measurements['baseline_nanoseconds'], 1) / 1e9
+        return Probe(measurements['sample_bytes'],
+                     measurements['compressed_bytes'],
+                     measurements['compress_nanoseconds'] / 1e9,
+                     sent / transfer_seconds)
+    except KeyError as e:
+        raise ValueError('The probe did not report {}.'.format(e))
+
+
+class ProbeCache:
+    """Decisions of earlier probes, kept in a JSON file.
+
+    Every link is keyed by its source and destination hosts. A failure to read
+    the file counts as an empty cache and a failure to write it is ignored,
+    so that the cache can only ever cost a probe.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def get_key(source: str, destination: str) -> str:
+        return '{}>{}'.format(source, destination)
+
+    def _read(self) -> dict[str, Any]:
+        try:
+            with open(self.path) as cache_file:
+                entries = json.load(cache_file)
+        except (OSError, ValueError):
+            return dict()
+        return entries if isinstance(entries, dict) else dict()
+
+    def get(self, key: str, now: float, ttl: float) -> Optional[bool]:
+        """Returns the decision for key if it was made less than ttl ago."""
+        entry = self._read().get(key)
+        if not isinstance(entry, dict):
+            return None
+        measured = entry.get('measured')
+        if not isinstance(measured, (int, float)) or now - measured >= ttl:
+            return None
+        return bool(entry.get('compress'))
+
+    def put(self, key: str, probe: Probe, compress: bool,
+            now: float) -> None:
+        """Records the decision for key along with the probe it's based on.
+        """
+        entries = self._read()
+        entries[key] = dict(probe._asdict(), compress=compress, measured=now)
+        try:
+            directory = os.path.dirname(self.path) or '.'
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(
+                dir=directory, prefix='.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as cache_file:
+                    json.dump(entries, cache_file, indent=2, sort_keys=True)
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError:
+            pass
@@ -0,0 +1,125 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+from absl.testing import absltest
+
+from ari_backup import compression
+
+
+class CompressionTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def _run_script(self, script):
+        return subprocess.run(['sh', '-c', script], check=True,
+                              capture_output=True, text=True).stdout
+
+    def testShouldCompress_compressibleDataOverSlowLink_true(self):
+        probe = compression.Probe(1000, 300, 0.001, throughput=100000)
+
+        self.assertTrue(compression.should_compress(probe))
+
+    def testShouldCompress_linkFasterThanCompression_false(self):
+        probe = compression.Probe(1000, 300, 0.001, throughput=10000000)
+
+        self.assertFalse(compression.should_compress(probe))
+
+    def testShouldCompress_incompressibleData_false(self):
+        probe = compression.Probe(1000, 950, 0.001, throughput=100)
+
+        self.assertFalse(compression.should_compress(probe))
+
+    def testShouldCompress_emptySample_false(self):
+        self.assertFalse(compression.should_compress(
+            compression.Probe(0, 20, 0.001, throughput=100)))
+
+    def testGetRsyncHost(self):
+        self.assertEqual(
+            compression.get_rsync_host('backup@zfs-host:/tank/job'),
+            'backup@zfs-host')
+        self.assertIsNone(compression.get_rsync_host('/tank/job'))
+        self.assertIsNone(compression.get_rsync_host('./a:b'))
+        self.assertIsNone(compression.get_rsync_host('zfs-host::module'))
+        self.assertIsNone(compression.get_rsync_host('rsync://zfs-host/m'))
+
+    def testBuildSampleScript_measuresCompressionOfFiles(self):
+        with open(os.path.join(self.temp_dir, 'text'), 'w') as text_file:
+            text_file.write('all work and no play ' * 5000)
+
+        measurements = compression.parse_output(self._run_script(
+            compression.build_sample_script(
+                [self.temp_dir, '/nonexistent'], sample_size=50000)))
+
+        self.assertEqual(measurements['sample_bytes'], 50000)
+        self.assertLess(measurements['compressed_bytes'], 5000)
+        self.assertIn('compress_nanoseconds', measurements)
+
+    def testBuildTransferScript_timesBothDirections(self):
+        for upload in (False, True):
+            measurements = compression.parse_output(self._run_script(
+                compression.build_transfer_script(
+                    ['sh', '-c'], upload, transfer_size=57000)))
+
+            self.assertEqual(
+                sorted(measurements),
+                ['baseline_nanoseconds', 'transfer_nanoseconds'])
+
+    def testGetProbe_subtractsConnectionTime(self):
+        probe = compression.get_probe(
+            'sample_bytes 1000\ncompressed_bytes 250\n'
+            'compress_nanoseconds 2000000\n',
+            'baseline_nanoseconds 100000000\n'
+            'transfer_nanoseconds 1100000000\n', transfer_size=5700)
+
+        self.assertEqual(probe.throughput, 7700)
+        self.assertEqual(probe.ratio, 0.25)
+        self.assertEqual(probe.compress_rate, 500000)
+
+    def testGetProbe_measurementMissing_raisesValueError(self):
+        with self.assertRaisesRegex(ValueError, 'transfer_nanoseconds'):
+            compression.get_probe(
+                'sample_bytes 1000\ncompressed_bytes 250\n'
+                'compress_nanoseconds 2000000\n',
+                'baseline_nanoseconds 100000000\n')
+
+
+class ProbeCacheTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.cache = compression.ProbeCache(
+            os.path.join(temp_dir, 'cache', 'ssh-compression.json'))
+        self.probe = compression.Probe(1000, 300, 0.001, 100000)
+
+    def testGet_nothingCached_returnsNone(self):
+        self.assertIsNone(self.cache.get('a>b', 1000, 60))
+
+    def testGet_freshDecision_returnsIt(self):
+        self.cache.put('a>b', self.probe, True, 1000)
+        self.cache.put('a>c', self.probe, False, 1000)
+
+        self.assertTrue(self.cache.get('a>b', 1059, 60))
+        self.assertFalse(self.cache.get('a>c', 1059, 60))
+
+    def testGet_expiredDecision_returnsNone(self):
+        self.cache.put('a>b', self.probe, True, 1000)
+
+        self.assertIsNone(self.cache.get('a>b', 1060, 60))
+
+    def testGet_corruptFile_returnsNone(self):
+        os.makedirs(os.path.dirname(self.cache.path))
+        with open(self.cache.path, 'w') as cache_file:
+            cache_file.write('{not json')
+
+        self.assertIsNone(self.cache.get('a>b', 1000, 60))
+
+
+if __name__ == '__main__':
+    absltest.main()
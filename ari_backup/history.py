@@ -0,0 +1,182 @@
+"""A local SQLite store of how past workflow runs went.
+
+Each finished run records its duration, the bytes it transferred and whether
+it succeeded, keyed by the workflow label. The job runner uses the expected
+durations to start the longest jobs first, and the trends show which jobs
+have become slower.
+"""
+from typing import NamedTuple, Optional
+
+import contextlib
+import os
+import sqlite3
+import statistics
+
+from ari_backup import report
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    label TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    transferred_bytes INTEGER,
+    succeeded INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_label ON runs (label, started);
+"""
+
+# Seconds to wait for another job which is writing to the store.
+_BUSY_TIMEOUT = 30
+
+
+class Run(NamedTuple):
+    """A recorded run.
+
+    Attributes:
+        label: the label of the workflow.
+        started: when the run started, in seconds since the epoch.
+        duration: wall time in seconds.
+        transferred_bytes: the bytes the backup transferred, if known.
+        succeeded: whether the run succeeded.
+    """
+    label: str
+    started: float
+    duration: float
+    transferred_bytes: Optional[int]
+    succeeded: bool
+
+
+class Trend(NamedTuple):
+    """How the duration of a job has changed.
+
+    Attributes:
+        label: the label of the workflow.
+        last: the most recent run.
+        baseline: the median duration of the successful runs before it, or
+            None if there were none.
+        recent_failures: how many of the runs compared were failures.
+        regressed: whether the last run took much longer than the baseline.
+    """
+    label: str
+    last: Run
+    baseline: Optional[float]
+    recent_failures: int
+    regressed: bool
+
+    @property
+    def change(self) -> Optional[float]:
+        """The last duration relative to the baseline, e.g. 0.5 for 50% up."""
+        if not self.baseline:
+            return None
+        return self.last.duration / self.baseline - 1
+
+
+class History:
+    """A job history store.
+
+    Several jobs may record runs at once; writers wait for each other.
+    """
+
+    def __init__(self, path: str):
+        """Opens the store at path, creating it if needed.
+
+        Raises:
+            sqlite3.Error: when the store can't be opened.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=_BUSY_TIMEOUT)
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def record(self, run_report: report.RunReport) -> None:
+        """Records a finished run."""
+        transferred_bytes = run_report.metrics.get('transferred_bytes')
+        with self._connection:
+            self._connection.execute(
+                'INSERT INTO runs (label, started, duration, '
+                'transferred_bytes, succeeded) VALUES (?, ?, ?, ?, ?)',
+                (run_report.label, run_report.started, run_report.duration,
+                 None if transferred_bytes is None else int(transferred_bytes),
+                 bool(run_report.succeeded)))
+
+    def get_runs(self, label: str, limit: int = 10) -> list[Run]:
+        """Returns the most recent runs of a job, newest first."""
+        rows = self._connection.execute(
+            'SELECT label, started, duration, transferred_bytes, succeeded '
+            'FROM runs WHERE label = ? ORDER BY started DESC LIMIT ?',
+            (label, limit))
+        return [Run(label, started, duration, transferred_bytes,
+                    bool(succeeded))
+                for label, started, duration, transferred_bytes, succeeded
+                in rows]
+
+    def get_labels(self) -> list[str]:
+        """Returns the labels of every recorded job, sorted."""
+        rows = self._connection.execute(
+            'SELECT DISTINCT label FROM runs ORDER BY label')
+        return [label for label, in rows]
+
+    def get_expected_durations(self, runs: int = 5) -> dict[str, float]:
+        """Returns how long each job is expected to take.
+
+        Args:
+            runs: how many of the most recent successful runs of a job the
+                expectation is based on.
+
+        Returns:
+            The median duration of the recent successful runs in seconds,
+            keyed by label. Jobs which never succeeded are left out.
+        """
+        rows = self._connection.execute(
+            'SELECT label, duration FROM ('
+            '  SELECT label, duration, ROW_NUMBER() OVER ('
+            '    PARTITION BY label ORDER BY started DESC) AS position'
+            '  FROM runs WHERE succeeded)'
+            'WHERE position <= ?', (runs,))
+        durations: dict[str, list[float]] = dict()
+        for label, duration in rows:
+            durations.setdefault(label, list()).append(duration)
+        return {label: statistics.median(values)
+                for label, values in durations.items()}
+
+    def get_trends(self, runs: int = 10,
+                   threshold: float = 0.5) -> list[Trend]:
+        """Compares the last run of each job with the runs before it.
+
+        Args:
+            runs: how many runs before the last one are compared with it.
+            threshold: how much longer than the baseline the last run must
+                take to count as a regression, e.g. 0.5 for 50% longer.
+
+        Returns:
+            A trend per job, sorted by label.
+        """
+        trends = list()
+        for label in self.get_labels():
+            last, *previous = self.get_runs(label, runs + 1)
+            durations = [run.duration for run in previous if run.succeeded]
+            baseline = statistics.median(durations) if durations else None
+            regressed = (baseline is not None and last.succeeded and
+                         last.duration > baseline * (1 + threshold))
+            recent_failures = sum(
+                1 for run in [last] + previous if not run.succeeded)
+            trends.append(
+                Trend(label, last, baseline, recent_failures, regressed))
+        return trends
+
+
+@contextlib.contextmanager
+def open_history(path: str):
+    """Opens the store at path for the duration of a with block."""
+    store = History(path)
+    try:
+        yield store
+    finally:
+        store.close()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+
+from absl.testing import absltest
+
+from ari_backup import history
+from ari_backup import report
+
+
+class HistoryTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.store = history.History(os.path.join(temp_dir, 'history.sqlite'))
+        self.addCleanup(self.store.close)
+        self.started = 1000.0
+
+    def _record(self, label, duration, succeeded=True, **metrics):
+        self.started += 86400
+        self.store.record(report.RunReport(
+            label=label, started=self.started, duration=duration,
+            succeeded=succeeded, metrics=metrics))
+
+    def testRecord_storesRun(self):
+        self._record('job', 12.5, transferred_bytes=2048.0)
+
+        self.assertEqual(self.store.get_runs('job'), [
+            history.Run('job', self.started, 12.5, 2048, True)])
+
+    def testGetRuns_newestFirstAndLimited(self):
+        for duration in [1, 2, 3]:
+            self._record('job', duration)
+
+        self.assertEqual(
+            [run.duration for run in self.store.get_runs('job', limit=2)],
+            [3, 2])
+
+    def testGetExpectedDurations_medianOfRecentSuccesses(self):
+        for duration in [1000, 10, 30, 20]:
+            self._record('job', duration)
+        self._record('job', 500, succeeded=False)
+        self._record('failing-job', 5, succeeded=False)
+
+        self.assertEqual(self.store.get_expected_durations(runs=3),
+                         {'job': 20})
+
+    def testGetTrends_slowerRun_regressed(self):
+        for duration in [100, 110, 90]:
+            self._record('slow-job', duration)
+        self._record('slow-job', 200)
+        for duration in [100, 110]:
+            self._record('steady-job', duration)
+
+        trends = {t.label: t for t in self.store.get_trends(threshold=0.5)}
+
+        self.assertTrue(trends['slow-job'].regressed)
+        self.assertEqual(trends['slow-job'].baseline, 100)
+        self.assertAlmostEqual(trends['slow-job'].change, 1.0)
+        self.assertFalse(trends['steady-job'].regressed)
+
+    def testGetTrends_countsRecentFailures(self):
+        self._record('job', 100, succeeded=False)
+        self._record('job', 100)
+        self._record('job', 10, succeeded=False)
+
+        trend, = self.store.get_trends()
+
+        self.assertEqual(trend.recent_failures, 2)
+        self.assertFalse(trend.regressed)
+
+    def testGetTrends_singleRun_noBaseline(self):
+        self._record('job', 100)
+
+        trend, = self.store.get_trends()
+
+        self.assertIsNone(trend.baseline)
+        self.assertIsNone(trend.change)
+
+
+if __name__ == '__main__':
+    absltest.main()
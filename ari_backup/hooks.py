@@ -0,0 +1,355 @@
+"""Scheduling of workflow hooks by their dependencies."""
+from typing import Awaitable, Callable, Iterable, Optional
+
+import concurrent.futures
+
+# asyncio is imported where it's used, as only workflows run with run_async()
+# need it.
+
+
+class Hook(tuple):
+    """A hook function, the kwargs it is called with, and its dependencies.
+
+    A Hook compares equal to the (function, kwargs) tuple used to represent
+    hooks before dependencies were supported.
+
+    Attributes:
+        function: called when the hook is run.
+        kwargs: key word arguments to pass to function or a callable which
+            returns them for late evaluation.
+        name: optional name other hooks can refer to in their after argument.
+        after: names of the hooks which must finish before this one starts. If
+            None, the hook waits for every hook before it in the list, which
+            makes a list of such hooks run in order. Otherwise the hook still
+            waits for the hooks before it whose after is None, unless they
+            undo a pre-job hook, but it runs even if they failed.
+        undoes: for a post-job hook, the name of the pre-job hook whose work
+            it cleans up. Such a hook also waits for the hooks which undo the
+            pre-job hooks that ran after that one, so that cleanup runs in
+            the reverse order of the pre-job hook dependencies. If after is
+            None, it waits for those hooks, and for the hooks before it as
+            described for an explicit after, only.
+    """
+
+    def __new__(cls,
+                function: Callable,
+                kwargs: dict | Callable,
+                name: Optional[str] = None,
+                after: Optional[Iterable[str]] = None,
+                undoes: Optional[str] = None):
+        hook = super().__new__(cls, (function, kwargs))
+        hook.name = name
+        hook.after = None if after is None else tuple(after)
+        hook.undoes = undoes
+        return hook
+
+    @property
+    def function(self) -> Callable:
+        return self[0]
+
+    @property
+    def kwargs(self) -> dict | Callable:
+        return self[1]
+
+
+def find_hook(hooks: list[Hook], name: str) -> int:
+    """Returns the index of the hook with the given name.
+
+    Raises:
+        KeyError: when no hook has that name.
+    """
+    for index, hook in enumerate(hooks):
+        if hook.name == name:
+            return index
+    raise KeyError('No hook named {!r}.'.format(name))
+
+
+def _get_indexes(hooks: list[Hook]) -> dict[str, int]:
+    """Returns the index of each named hook.
+
+    Raises:
+        ValueError: when hook names are duplicated.
+    """
+    indexes: dict[str, int] = dict()
+    for index, hook in enumerate(hooks):
+        if hook.name is None:
+            continue
+        if hook.name in indexes:
+            raise ValueError('Duplicate hook name {!r}.'.format(hook.name))
+        indexes[hook.name] = index
+    return indexes
+
+
+def get_dependencies(hooks: list[Hook],
+                     undone_hooks: Optional[list[Hook]] = None
+                     ) -> list[set[int]]:
+    """Returns, for each hook, the indexes of the hooks it waits for.
+
+    Args:
+        hooks: the hooks to run.
+        undone_hooks: the pre-job hooks named by the undoes attribute of
+            hooks, when hooks are post-job hooks.
+
+    Raises:
+        ValueError: when hook names are duplicated, a hook waits for or
+            undoes an unknown name, or the dependencies form a cycle.
+    """
+    indexes = _get_indexes(hooks)
+    dependencies = list()
+    for index, hook in enumerate(hooks):
+        if hook.after is None:
+            if hook.undoes is None:
+                dependencies.append(set(range(index)))
+            else:
+                dependencies.append(set())
+            continue
+        try:
+            dependencies.append({indexes[name] for name in hook.after})
+        except KeyError as e:
+            raise ValueError('Hook {!r} waits for unknown hook {}.'.format(
+                hook.name or hook.function, e))
+    for waits_for, ordered_after in zip(
+            dependencies, get_ordering_dependencies(hooks)):
+        waits_for.update(ordered_after)
+    _add_cleanup_dependencies(hooks, undone_hooks or list(), dependencies)
+
+    # Make sure every hook can eventually run.
+    finished: set[int] = set()
+    while len(finished) < len(hooks):
+        ready = {index for index, waits_for in enumerate(dependencies)
+                 if index not in finished and waits_for <= finished}
+        if not ready:
+            raise ValueError('Hook dependencies form a cycle.')
+        finished |= ready
+    return dependencies
+
+
+def get_ordering_dependencies(hooks: list[Hook]) -> list[set[int]]:
+    """Returns, for each hook, the hooks it waits for whatever their outcome.
+
+    A hook which declares after, or undoes a pre-job hook, still waits for
+    the hooks before it which do neither, so that a hook inserted ahead of
+    it runs first. Unless it names them in after, it doesn't depend on their
+    work though, and runs even if they failed.
+    """
+    dependencies = list()
+    in_order: set[int] = set()
+    for index, hook in enumerate(hooks):
+        if hook.after is None and hook.undoes is None:
+            dependencies.append(set())
+            in_order.add(index)
+        else:
+            named = {other for other in in_order
+                     if hooks[other].name in (hook.after or ())}
+            dependencies.append(in_order - named)
+    return dependencies
+
+
+def _add_cleanup_dependencies(hooks: list[Hook],
+                              undone_hooks: list[Hook],
+                              dependencies: list[set[int]]) -> None:
+    """Makes hooks undoing pre-job hooks wait for the cleanup of later ones.
+
+    A hook which undoes pre-job hook A waits for every hook which undoes a
+    pre-job hook that waited for A, directly or not.
+    """
+    undone_indexes = _get_indexes(undone_hooks)
+    undoers: dict[int, list[int]] = dict()
+    for index, hook in enumerate(hooks):
+        if hook.undoes is None:
+            continue
+        if hook.undoes not in undone_indexes:
+            raise ValueError('Hook {!r} undoes unknown hook {!r}.'.format(
+                hook.name or hook.function, hook.undoes))
+        undoers.setdefault(undone_indexes[hook.undoes], list()).append(index)
+    if not undoers:
+        return
+
+    undone_dependencies = get_dependencies(undone_hooks)
+    for undone, indexes in undoers.items():
+        # The pre-job hooks which ran after the undone one.
+        later: set[int] = set()
+        waiting = {undone}
+        while waiting:
+            waiting = {other for other, waits_for
+                       in enumerate(undone_dependencies)
+                       if waits_for & waiting and other not in later}
+            later |= waiting
+        for index in indexes:
+            for other in later:
+                dependencies[index].update(undoers.get(other, list()))
+
+
+class _Schedule:
+    """Tracks which hooks may start given the ones finished so far."""
+
+    def __init__(self,
+                 hooks: list[Hook],
+                 stop_on_failure: bool,
+                 undone_hooks: Optional[list[Hook]] = None):
+        self._dependencies = get_dependencies(hooks, undone_hooks)
+        self._ordering_dependencies = get_ordering_dependencies(hooks)
+        self._stop_on_failure = stop_on_failure
+        self._pending = set(range(len(hooks)))
+        self._succeeded: set[int] = set()
+        self._unsuccessful: set[int] = set()
+        self.errors: list[BaseException] = list()
+
+    def get_ready(self) -> list[int]:
+        """Removes and returns the hooks which may start now, in list order.
+
+        Hooks depending on a hook which failed, or was skipped, are skipped.
+        After a failure nothing more starts when stop_on_failure is set.
+        """
+        if self.errors and self._stop_on_failure:
+            return list()
+        finished = self._succeeded | self._unsuccessful
+        ready = list()
+        for index in sorted(self._pending):
+            waits_for = self._dependencies[index]
+            depends_on = waits_for - self._ordering_dependencies[index]
+            if depends_on & self._unsuccessful:
+                self._pending.discard(index)
+                self._unsuccessful.add(index)
+            elif waits_for <= finished:
+                ready.append(index)
+        self._pending.difference_update(ready)
+        return ready
+
+    def finish(self, index: int, error: Optional[BaseException]) -> None:
+        """Records the outcome of a hook."""
+        if error is None:
+            self._succeeded.add(index)
+        else:
+            self._unsuccessful.add(index)
+            self.errors.append(error)
+
+
+def run_hooks(hooks: list[Hook],
+              call: Callable[[Hook], None],
+              max_workers: int,
+              stop_on_failure: bool = True,
+              on_interrupt: Optional[Callable[[], None]] = None,
+              undone_hooks: Optional[list[Hook]] = None) -> None:
+    """Runs hooks, each once all the hooks it waits for have finished.
+
+    Hooks which don't wait for each other run concurrently on a thread pool.
+    When no two hooks can run at once, or max_workers is 1, they all run in
+    the calling thread instead.
+
+    Args:
+        hooks: the hooks to run.
+        call: runs a single hook.
+        max_workers: how many hooks may run at once.
+        stop_on_failure: whether to start no more hooks once one has failed.
+            Otherwise only the hooks waiting for a failed one are skipped.
+        on_interrupt: called when the calling thread is interrupted (e.g. by
+            KeyboardInterrupt) while hooks run on the pool, so that they can
+            be stopped before the exception propagates.
+        undone_hooks: the pre-job hooks which post-job hooks undo. See
+            Hook.undoes.
+
+    Raises:
+        The exception raised by the first hook which failed, once all hooks
+        which were started have finished.
+    """
+    schedule = _Schedule(hooks, stop_on_failure, undone_hooks)
+    if max_workers <= 1 or all(
+            hook.after is None and hook.undoes is None for hook in hooks):
+        ready = schedule.get_ready()
+        while ready:
+            for index in ready:
+                try:
+                    call(hooks[index])
+                except Exception as e:
+                    schedule.finish(index, e)
+                    if stop_on_failure:
+                        break
+                else:
+                    schedule.finish(index, None)
+            ready = schedule.get_ready()
+    else:
+        _run_hooks_on_pool(
+            hooks, call, max_workers, schedule, stop_on_failure, on_interrupt)
+    if schedule.errors:
+        raise schedule.errors[0]
+
+
+def _run_hooks_on_pool(hooks: list[Hook],
+                       call: Callable[[Hook], None],
+                       max_workers: int,
+                       schedule: _Schedule,
+                       stop_on_failure: bool,
+                       on_interrupt: Optional[Callable[[], None]]) -> None:
+    """Runs hooks on a thread pool. See run_hooks()."""
+    queue: list[int] = list()
+    running: dict[concurrent.futures.Future, int] = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        try:
+            while True:
+                queue.extend(schedule.get_ready())
+                if schedule.errors and stop_on_failure:
+                    queue.clear()
+                while queue and len(running) < max_workers:
+                    index = queue.pop(0)
+                    running[pool.submit(call, hooks[index])] = index
+                if not running:
+                    break
+                done, unused_not_done = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    schedule.finish(running.pop(future), future.exception())
+        except BaseException:
+            for future in running:
+                future.cancel()
+            if on_interrupt is not None:
+                on_interrupt()
+            raise
+
+
+async def run_hooks_async(
+        hooks: list[Hook],
+        call: Callable[[Hook], Awaitable[None]],
+        max_workers: int,
+        stop_on_failure: bool = True,
+        on_interrupt: Optional[Callable[[], None]] = None,
+        undone_hooks: Optional[list[Hook]] = None) -> None:
+    """Runs hooks as asyncio tasks. See run_hooks().
+
+    When cancelled, the running hooks are cancelled and on_interrupt is
+    called in a thread, so that hooks running in threads of their own, which
+    can't be cancelled, can be stopped. The cancellation is propagated once
+    the hooks have finished.
+    """
+    import asyncio
+
+    schedule = _Schedule(hooks, stop_on_failure, undone_hooks)
+    queue: list[int] = list()
+    running: dict[asyncio.Task, int] = dict()
+    try:
+        while True:
+            queue.extend(schedule.get_ready())
+            if schedule.errors and stop_on_failure:
+                queue.clear()
+            while queue and len(running) < max(1, max_workers):
+                index = queue.pop(0)
+                running[asyncio.ensure_future(call(hooks[index]))] = index
+            if not running:
+                break
+            done, unused_pending = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = running.pop(task)
+                if task.cancelled():
+                    schedule.finish(index, asyncio.CancelledError())
+                else:
+                    schedule.finish(index, task.exception())
+    except asyncio.CancelledError:
+        for task in running:
+            task.cancel()
+        if on_interrupt is not None:
+            await asyncio.to_thread(on_interrupt)
+        await asyncio.gather(*running, return_exceptions=True)
+        raise
+    if schedule.errors:
+        raise schedule.errors[0]
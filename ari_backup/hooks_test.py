@@ -0,0 +1,252 @@
+import asyncio
+import threading
+from unittest import mock
+
+from absl.testing import absltest
+
+from ari_backup import hooks
+
+
+class HookTest(absltest.TestCase):
+
+    def testHook_equalsFunctionAndKwargsTuple(self):
+        test_func = mock.MagicMock()
+
+        self.assertEqual(
+            hooks.Hook(test_func, {'kwarg': 'value'}, name='test'),
+            (test_func, {'kwarg': 'value'}))
+
+    def testFindHook_unknownName_raisesKeyError(self):
+        with self.assertRaises(KeyError):
+            hooks.find_hook([hooks.Hook(mock.MagicMock(), {})], 'unknown')
+
+
+class GetDependenciesTest(absltest.TestCase):
+
+    def testGetDependencies_afterIsNone_waitsForAllPreviousHooks(self):
+        test_hooks = [hooks.Hook(mock.MagicMock(), {}) for _ in range(3)]
+
+        self.assertEqual(
+            hooks.get_dependencies(test_hooks), [set(), {0}, {0, 1}])
+
+    def testGetDependencies_afterGiven_waitsForNamedHooksOnly(self):
+        test_hooks = [
+            hooks.Hook(mock.MagicMock(), {}, name='first', after=()),
+            hooks.Hook(mock.MagicMock(), {}, name='second', after=()),
+            hooks.Hook(mock.MagicMock(), {}, after=['first']),
+        ]
+
+        self.assertEqual(
+            hooks.get_dependencies(test_hooks), [set(), set(), {0}])
+
+    def testGetDependencies_afterGiven_waitsForEarlierHooksInOrder(self):
+        test_hooks = [
+            hooks.Hook(mock.MagicMock(), {}, name='first'),
+            hooks.Hook(mock.MagicMock(), {}, name='second', after=()),
+            hooks.Hook(mock.MagicMock(), {}, undoes='first'),
+        ]
+
+        self.assertEqual(
+            hooks.get_dependencies(test_hooks, test_hooks[:1]),
+            [set(), {0}, {0}])
+        self.assertEqual(
+            hooks.get_ordering_dependencies(test_hooks), [set(), {0}, {0}])
+
+    def testGetDependencies_unknownName_raisesValueError(self):
+        test_hooks = [hooks.Hook(mock.MagicMock(), {}, after=['unknown'])]
+
+        with self.assertRaises(ValueError):
+            hooks.get_dependencies(test_hooks)
+
+    def testGetDependencies_duplicateName_raisesValueError(self):
+        test_hooks = [hooks.Hook(mock.MagicMock(), {}, name='test'),
+                      hooks.Hook(mock.MagicMock(), {}, name='test')]
+
+        with self.assertRaises(ValueError):
+            hooks.get_dependencies(test_hooks)
+
+    def testGetDependencies_cycle_raisesValueError(self):
+        test_hooks = [
+            hooks.Hook(mock.MagicMock(), {}, name='first', after=['second']),
+            hooks.Hook(mock.MagicMock(), {}, name='second', after=['first']),
+        ]
+
+        with self.assertRaises(ValueError):
+            hooks.get_dependencies(test_hooks)
+
+    def testGetDependencies_undoes_waitsForCleanupOfLaterPreHooks(self):
+        pre_hooks = [
+            hooks.Hook(mock.MagicMock(), {}, name='create', after=()),
+            hooks.Hook(mock.MagicMock(), {}, name='mount', after=['create']),
+            hooks.Hook(mock.MagicMock(), {}, name='dump', after=['mount']),
+            hooks.Hook(mock.MagicMock(), {}, name='other', after=()),
+        ]
+        post_hooks = [
+            hooks.Hook(mock.MagicMock(), {}, undoes='create'),
+            hooks.Hook(mock.MagicMock(), {}, undoes='dump'),
+            hooks.Hook(mock.MagicMock(), {}, undoes='other'),
+            hooks.Hook(mock.MagicMock(), {}, after=()),
+        ]
+
+        # The cleanup of dump waits for nothing, while the cleanup of create
+        # waits for it even though nothing undoes mount in between.
+        self.assertEqual(
+            hooks.get_dependencies(post_hooks, pre_hooks),
+            [{1}, set(), set(), set()])
+
+    def testGetDependencies_undoesUnknownName_raisesValueError(self):
+        test_hooks = [hooks.Hook(mock.MagicMock(), {}, undoes='unknown')]
+
+        with self.assertRaises(ValueError):
+            hooks.get_dependencies(test_hooks, list())
+
+
+class RunHooksTest(absltest.TestCase):
+
+    def _call(self, hook):
+        hook.function(**hook.kwargs)
+
+    def testRunHooks_independentHooks_runConcurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        test_hooks = [
+            hooks.Hook(barrier.wait, {}, name='first', after=()),
+            hooks.Hook(barrier.wait, {}, name='second', after=()),
+        ]
+
+        # Both hooks only return once the other one is running too.
+        hooks.run_hooks(test_hooks, self._call, max_workers=2)
+
+    def testRunHooks_dependentHook_runsAfterDependency(self):
+        calls = list()
+
+        def record_call(label):
+            calls.append(label)
+
+        test_hooks = [
+            hooks.Hook(record_call, {'label': 'second'}, after=['first']),
+            hooks.Hook(record_call, {'label': 'first'}, name='first',
+                       after=()),
+        ]
+
+        hooks.run_hooks(test_hooks, self._call, max_workers=2)
+
+        self.assertEqual(calls, ['first', 'second'])
+
+    def testRunHooks_hookFails_raisesAndStartsNoMoreHooks(self):
+        mock_hook = mock.MagicMock()
+        failing_hook = mock.MagicMock(side_effect=RuntimeError)
+        test_hooks = [
+            hooks.Hook(failing_hook, {}, name='first', after=()),
+            hooks.Hook(mock_hook, {}, after=['first']),
+        ]
+
+        with self.assertRaises(RuntimeError):
+            hooks.run_hooks(test_hooks, self._call, max_workers=2)
+        self.assertFalse(mock_hook.called)
+
+    def testRunHooks_stopOnFailureFalse_runsHooksOrderedAfterFailure(self):
+        cleanup_hook = mock.MagicMock()
+        failing_hook = mock.MagicMock(side_effect=RuntimeError)
+        test_hooks = [
+            hooks.Hook(failing_hook, {}),
+            hooks.Hook(cleanup_hook, {}, after=()),
+        ]
+
+        with self.assertRaises(RuntimeError):
+            hooks.run_hooks(test_hooks, self._call, max_workers=2,
+                            stop_on_failure=False)
+        self.assertTrue(cleanup_hook.called)
+
+    def testRunHooks_stopOnFailureFalse_runsIndependentHooks(self):
+        dependent_hook = mock.MagicMock()
+        independent_hook = mock.MagicMock()
+        failing_hook = mock.MagicMock(side_effect=RuntimeError)
+        test_hooks = [
+            hooks.Hook(failing_hook, {}, name='first'),
+            hooks.Hook(dependent_hook, {}, name='second', after=['first']),
+            hooks.Hook(independent_hook, {}, after=()),
+        ]
+
+        with self.assertRaises(RuntimeError):
+            hooks.run_hooks(test_hooks, self._call, max_workers=2,
+                            stop_on_failure=False)
+        self.assertFalse(dependent_hook.called)
+        self.assertTrue(independent_hook.called)
+
+    def testRunHooks_sequentialHooks_runInCallingThread(self):
+        threads = list()
+        test_hooks = [
+            hooks.Hook(lambda: threads.append(threading.current_thread()), {})
+            for _ in range(2)]
+
+        hooks.run_hooks(test_hooks, self._call, max_workers=4)
+
+        self.assertEqual(threads, [threading.current_thread()] * 2)
+
+
+class RunHooksAsyncTest(absltest.TestCase):
+
+    async def _call(self, hook):
+        await hook.function(**hook.kwargs)
+
+    def testRunHooksAsync_independentHooks_runConcurrently(self):
+        async def run():
+            barrier = asyncio.Event()
+            calls = list()
+
+            async def wait_for_other_hook():
+                calls.append('waiting')
+                await barrier.wait()
+
+            async def release_other_hook():
+                calls.append('releasing')
+                barrier.set()
+
+            test_hooks = [
+                hooks.Hook(wait_for_other_hook, {}, after=()),
+                hooks.Hook(release_other_hook, {}, after=()),
+            ]
+            await asyncio.wait_for(
+                hooks.run_hooks_async(test_hooks, self._call, max_workers=2),
+                timeout=5)
+            return calls
+
+        self.assertEqual(asyncio.run(run()), ['waiting', 'releasing'])
+
+    def testRunHooksAsync_hookFails_raisesAndSkipsDependentHooks(self):
+        mock_hook = mock.AsyncMock()
+        failing_hook = mock.AsyncMock(side_effect=RuntimeError)
+        test_hooks = [
+            hooks.Hook(failing_hook, {}, name='first'),
+            hooks.Hook(mock_hook, {}, after=['first']),
+        ]
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(hooks.run_hooks_async(
+                test_hooks, self._call, max_workers=2, stop_on_failure=False))
+        self.assertFalse(mock_hook.called)
+
+    def testRunHooksAsync_cancelled_callsOnInterrupt(self):
+        on_interrupt = mock.MagicMock()
+
+        async def run():
+            started = asyncio.Event()
+
+            async def wait_forever():
+                started.set()
+                await asyncio.Event().wait()
+
+            task = asyncio.ensure_future(hooks.run_hooks_async(
+                [hooks.Hook(wait_forever, {})], self._call, max_workers=2,
+                on_interrupt=on_interrupt))
+            await started.wait()
+            task.cancel()
+            await task
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(run())
+        on_interrupt.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    absltest.main()
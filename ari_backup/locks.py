@@ -0,0 +1,103 @@
+"""Advisory file locks which keep two runs of the same job apart.
+
+Each lock is a file holding the PID of the process which holds it. The file
+is emptied when the lock is released, so a lock file still naming a PID
+when it's taken was left behind by a process which died holding it. Since
+the locks are flock()s, the kernel releases them when that happens, and the
+PID only serves to report who holds or held a lock.
+"""
+from typing import Optional
+
+import fcntl
+import os
+import urllib.parse
+
+
+class LockHeld(Exception):
+    """Raised when a lock is held by another run."""
+
+    def __init__(self, path: str, pid: Optional[int]):
+        self.path = path
+        self.pid = pid
+        if pid is None:
+            holder = 'another process'
+        elif is_running(pid):
+            holder = 'PID {}'.format(pid)
+        else:
+            # The PID exited but a child which inherited the lock runs on.
+            holder = ('a process started by PID {}, which has exited'.format(
+                pid))
+        super().__init__('{} is held by {}.'.format(path, holder))
+
+
+def get_lock_path(lock_dir: str, kind: str, key: str) -> str:
+    """Returns the path of the lock file of a key, e.g. a job label.
+
+    Args:
+        lock_dir: the directory holding the lock files.
+        kind: what the key is, e.g. label or destination.
+        key: the key, quoted so that any string makes a distinct file name.
+    """
+    return os.path.join(lock_dir, '{}-{}.lock'.format(
+        kind, urllib.parse.quote(key, safe='')))
+
+
+def read_pid(path: str) -> Optional[int]:
+    """Returns the PID recorded in a lock file, if there is one."""
+    try:
+        with open(path) as lock_file:
+            return int(lock_file.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def is_running(pid: int) -> bool:
+    """Whether a process with the given PID exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists but belongs to another user.
+        return True
+    return True
+
+
+class FileLock:
+    """An exclusive flock() on a file recording the holder's PID."""
+
+    def __init__(self, path: str):
+        self.path = path
+        # The PID a lock file still named when it was taken, i.e. of the
+        # process which left it behind.
+        self.stale_pid: Optional[int] = None
+        self._fd: Optional[int] = None
+
+    def acquire(self) -> None:
+        """Takes the lock without waiting.
+
+        Raises:
+            LockHeld: when another process, or another run in this process,
+                holds the lock.
+            OSError: when the lock file can't be opened.
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise LockHeld(self.path, read_pid(self.path))
+        self.stale_pid = read_pid(self.path)
+        os.ftruncate(fd, 0)
+        os.write(fd, '{}\n'.format(os.getpid()).encode())
+        self._fd = fd
+
+    def release(self) -> None:
+        """Releases the lock, if it's held."""
+        if self._fd is None:
+            return
+        try:
+            os.ftruncate(self._fd, 0)
+        finally:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,79 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from absl.testing import absltest
+
+from ari_backup import locks
+
+
+class FileLockTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir)
+        self.path = os.path.join(self.lock_dir, 'fake.lock')
+
+    def testGetLockPath_keysWithSlashesStayDistinct(self):
+        self.assertNotEqual(
+            locks.get_lock_path(self.lock_dir, 'destination', 'tank/a_b'),
+            locks.get_lock_path(self.lock_dir, 'destination', 'tank_a/b'))
+        self.assertEqual(
+            os.path.dirname(locks.get_lock_path(
+                self.lock_dir, 'destination', 'host:/store/job')),
+            self.lock_dir)
+
+    def testAcquire_recordsPIDAndReleaseClearsIt(self):
+        lock = locks.FileLock(self.path)
+
+        lock.acquire()
+        self.assertEqual(locks.read_pid(self.path), os.getpid())
+        lock.release()
+
+        self.assertIsNone(locks.read_pid(self.path))
+        self.assertIsNone(lock.stale_pid)
+
+    def testAcquire_heldInThisProcess_raisesLockHeld(self):
+        lock = locks.FileLock(self.path)
+        lock.acquire()
+        self.addCleanup(lock.release)
+
+        with self.assertRaisesRegex(locks.LockHeld,
+                                    'held by PID {}'.format(os.getpid())):
+            locks.FileLock(self.path).acquire()
+
+    def testAcquire_heldByAnotherProcess_raisesLockHeldWithItsPID(self):
+        holder = subprocess.Popen(
+            [sys.executable, '-c',
+             'import sys\n'
+             'from ari_backup import locks\n'
+             'locks.FileLock(sys.argv[1]).acquire()\n'
+             'print("locked", flush=True)\n'
+             'sys.stdin.read()\n', self.path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        self.addCleanup(holder.wait)
+        self.addCleanup(holder.stdin.close)
+        self.assertEqual(holder.stdout.readline().strip(), 'locked')
+
+        with self.assertRaises(locks.LockHeld) as raised:
+            locks.FileLock(self.path).acquire()
+
+        self.assertEqual(raised.exception.pid, holder.pid)
+
+    def testAcquire_leftBehindByDeadProcess_takenOverAndReported(self):
+        with open(self.path, 'w') as lock_file:
+            lock_file.write('999999999\n')
+        lock = locks.FileLock(self.path)
+
+        lock.acquire()
+        self.addCleanup(lock.release)
+
+        self.assertEqual(lock.stale_pid, 999999999)
+        self.assertEqual(locks.read_pid(self.path), os.getpid())
+
+
+if __name__ == '__main__':
+    absltest.main()
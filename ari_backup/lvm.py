@@ -1,12 +1,14 @@
 """LVM based backup workflows and MixIn classes."""
-from typing import Iterable, Optional, TypeAlias
+from typing import Callable, Iterable, Optional, TypeAlias
 
 import copy
+import functools
 import os
 
 from absl import flags
 
 from ari_backup import rdiff_backup_wrapper
+from ari_backup import workflow
 
 
 FLAGS = flags.FLAGS
@@ -23,6 +25,8 @@ flags.DEFINE_string(
 
 _LogicalVolumes: TypeAlias = list[tuple[str, str, str]]
 _LVSnapshots: TypeAlias = list[dict]
+# A command and a callback which records its success in the snapshot tracker.
+_SnapshotSteps: TypeAlias = list[tuple[list[str], Callable[[], None]]]
 
 
 class LVMSourceMixIn():
@@ -39,9 +43,9 @@ class LVMSourceMixIn():
 
         # Assign flags to instance vars so they might be easily overridden in
         # workflow configs.
-        self.snapshot_mount_root = FLAGS.snapshot_mount_root
-        self.snapshot_suffix = FLAGS.snapshot_suffix
-        self.snapshot_size = FLAGS.snapshot_size
+        self.snapshot_mount_root = self._flags.snapshot_mount_root
+        self.snapshot_suffix = self._flags.snapshot_suffix
+        self.snapshot_size = self._flags.snapshot_size
 
         # This is a list of 3-tuples, where each inner 3-tuple expresses the LV
         # to back up, the mount point for that LV, and any mount options
@@ -58,11 +62,17 @@ class LVMSourceMixIn():
         self._snapshot_mount_point_base_path = os.path.join(
             self.snapshot_mount_root, self.label)
 
-        # Set up pre and post job hooks to manage snapshot workflow.
-        self.add_pre_hook(self._create_snapshots)
-        self.add_pre_hook(self._mount_snapshots)
-        self.add_post_hook(self._umount_snapshots)
-        self.add_post_hook(self._delete_snapshots)
+        # Set up pre and post job hooks to manage snapshot workflow. They're
+        # named so that other hooks can be scheduled relative to them. The
+        # post job hooks only wait for each other, in the reverse order of the
+        # pre job hooks they undo, so that the snapshots are cleaned up even
+        # when an unrelated post job hook fails.
+        self.add_pre_hook(self._create_snapshots, name='create_snapshots')
+        self.add_pre_hook(self._mount_snapshots, name='mount_snapshots')
+        self.add_post_hook(self._umount_snapshots, name='umount_snapshots',
+                           undoes='mount_snapshots')
+        self.add_post_hook(self._delete_snapshots, name='delete_snapshots',
+                           undoes='create_snapshots')
 
     def add_volume(self,
                    name: str,
@@ -85,9 +95,72 @@ class LVMSourceMixIn():
         volume = (name, mount_point, mount_options)
         self._logical_volumes.append(volume)
 
+    def _run_snapshot_steps(
+            self, steps: _SnapshotSteps, retry: bool = False) -> None:
+        """Runs snapshot management commands in one batch on the source host.
+
+        The commands are sent with run_commands() so that they cost a single
+        round-trip to the source host. The success callback of each step is
+        called once its command is known to have succeeded, so the snapshot
+        tracker always reflects exactly what was done on the host.
+
+        A command which fails is not run again, since creating or mounting a
+        snapshot twice isn't safe. Its result is reported instead, as is the
+        failure of a batch which didn't run to completion. Only when retry is
+        True and the failure is transient are the steps which didn't succeed
+        run again, one at a time with run_command_with_retries(). The cleanup
+        steps are run that way as they may be repeated.
+
+        Args:
+            steps: commands to run, in order, along with their success
+                callbacks.
+            retry: whether commands that don't succeed in the batch should be
+                retried.
+
+        Raises:
+            NonZeroExitCode: when a command failed or the batch didn't run to
+                completion, and the failure isn't retried.
+        """
+        if not steps:
+            return
+
+        error = None
+        try:
+            results = self.run_commands(
+                [command for command, unused_callback in steps],
+                self.source_hostname)
+        except workflow.NonZeroExitCode as e:
+            error = e
+            results = e.results
+        # run_commands() matches the results to the commands by the indices
+        # in the batch markers, and raises when there are more results than
+        # commands, so each result belongs to the step zipped with it.
+
+        completed_steps = 0
+        for (command, on_success), result in zip(steps, results):
+            if result.exitcode != 0:
+                error = workflow.NonZeroExitCode(
+                    self._get_command_error_message(
+                        command, self.source_hostname),
+                    host=self.source_hostname, exitcode=result.exitcode,
+                    stderr=result.stderr, results=results)
+                break
+            on_success()
+            completed_steps += 1
+        if error is None:
+            return
+        if not retry or not self.get_retry_policy().is_transient(error):
+            raise error
+
+        self.logger.warning(str(error))
+        for command, on_success in steps[completed_steps:]:
+            self.run_command_with_retries(command, self.source_hostname)
+            on_success()
+
     def _create_snapshots(self) -> None:
         """Creates snapshots of all the volumns added with add_volume()."""
         self.logger.info('Creating LVM snapshots...')
+        steps = list()
         for volume in self._logical_volumes:
             lv_path, src_mount_path, mount_options = volume
 
@@ -100,16 +173,20 @@ class LVMSourceMixIn():
 
             command = ['lvcreate', '-s', '-L', self.snapshot_size, lv_path,
                        '-n', new_lv_name]
-            self.run_command(command, self.source_hostname)
-
-            self._lv_snapshots.append({
+            snapshot = {
                 'lv_path': vg_name + '/' + new_lv_name,
                 'mount_path': mount_path,
                 'mount_options': mount_options,
                 'created': True,
                 'mount_point_created': False,
                 'mounted': False,
-            })
+            }
+            # Snapshots are only tracked once they have been created.
+            steps.append(
+                (command, functools.partial(self._lv_snapshots.append,
+                                            snapshot)))
+        self._run_snapshot_steps(steps)
+        self.record_metric('lvm_snapshots', len(self._lv_snapshots))
 
     def _delete_snapshots(self, error_case: Optional[bool] = None) -> None:
         """Deletes tracked snapshots.
@@ -120,13 +197,16 @@ class LVMSourceMixIn():
                 post hook API.
         """
         self.logger.info('Deleting LVM snapshots...')
+        steps = list()
         for snapshot in self._lv_snapshots:
             if snapshot['created']:
                 lv_path = snapshot['lv_path']
                 # -f makes lvremove not interactive
                 command = ['lvremove', '-f', lv_path]
-                self.run_command_with_retries(command, self.source_hostname)
-                snapshot['created'] = False
+                steps.append(
+                    (command, functools.partial(
+                        snapshot.__setitem__, 'created', False)))
+        self._run_snapshot_steps(steps, retry=True)
 
     def _mount_snapshots(self) -> None:
         """Creates mountpoints as well as mounts the snapshots.
@@ -140,6 +220,15 @@ class LVMSourceMixIn():
         files.
         """
         self.logger.info('Mounting LVM snapshots...')
+        # If where we want to mount any LV is already a mount point then let's
+        # back out before touching anything.
+        for snapshot in self._lv_snapshots:
+            if os.path.ismount(snapshot['mount_path']):
+                raise Exception(
+                    '{mount_path} is already a mount point.'.format(
+                        mount_path=snapshot['mount_path']))
+
+        steps = list()
         for snapshot in self._lv_snapshots:
             lv_path = snapshot['lv_path']
             device_path = '/dev/' + lv_path
@@ -148,15 +237,9 @@ class LVMSourceMixIn():
 
             # mkdir the mount point
             command = ['mkdir', '-p', mount_path]
-            self.run_command(command, self.source_hostname)
-            snapshot['mount_point_created'] = True
-
-            # If where we want to mount our LV is already a mount point then
-            # let's back out.
-            if os.path.ismount(mount_path):
-                raise Exception(
-                    '{mount_path} is already a mount point.'.format(
-                        mount_path=mount_path))
+            steps.append(
+                (command, functools.partial(
+                    snapshot.__setitem__, 'mount_point_created', True)))
 
             # mount the LV, possibly with mount options
             if mount_options:
@@ -164,8 +247,10 @@ class LVMSourceMixIn():
                            mount_path]
             else:
                 command = ['mount', device_path, mount_path]
-            self.run_command(command, self.source_hostname)
-            snapshot['mounted'] = True
+            steps.append(
+                (command, functools.partial(
+                    snapshot.__setitem__, 'mounted', True)))
+        self._run_snapshot_steps(steps)
 
     def _umount_snapshots(self, error_case: Optional[bool] = None) -> None:
         """Umounts mounted snapshots in self._lv_snapshots.
@@ -188,24 +273,35 @@ class LVMSourceMixIn():
         # We want to umount these logical volumes in reverse order as this
         # should ensure that we umount the deepest paths first.
         local_lv_snapshots.reverse()
+        steps = list()
         for snapshot in local_lv_snapshots:
             mount_path = snapshot['mount_path']
             if snapshot['mounted']:
                 command = ['umount', mount_path]
-                self.run_command_with_retries(command, self.source_hostname)
-                snapshot['mounted'] = False
+                steps.append(
+                    (command, functools.partial(
+                        snapshot.__setitem__, 'mounted', False)))
             if snapshot['mount_point_created']:
                 command = ['rmdir', mount_path]
-                self.run_command_with_retries(command, self.source_hostname)
-                snapshot['mount_point_created'] = False
+                steps.append(
+                    (command, functools.partial(
+                        snapshot.__setitem__, 'mount_point_created', False)))
+        self._run_snapshot_steps(steps, retry=True)
 
-    def _run_custom_workflow(self) -> None:
+    def _check_logical_volumes(self) -> None:
         if len(self._logical_volumes) == 0:
             raise ValueError(
                 'No volumes have been added using add_volume. '
                 'The backup cannot proceed.')
+
+    def _run_custom_workflow(self) -> None:
+        self._check_logical_volumes()
         super()._run_custom_workflow()
 
+    async def _run_custom_workflow_async(self) -> None:
+        self._check_logical_volumes()
+        await super()._run_custom_workflow_async()
+
 
 class RdiffLVMBackup(LVMSourceMixIn, rdiff_backup_wrapper.RdiffBackup):
     """Subclass to add LVM snapshot management to RdiffBackup."""
@@ -241,14 +337,23 @@ class RdiffLVMBackup(LVMSourceMixIn, rdiff_backup_wrapper.RdiffBackup):
         system on the snapshot itself.
         """
         self.logger.debug('RdiffLVMBackup._run_custom_workflow started.')
-        # Cook the self._includes and self._excludes so that the src paths
-        # include the mount path for the logical volumes.
-        self._includes = self._prefix_mount_point_to_paths(self._includes)
-        self._excludes = self._prefix_mount_point_to_paths(self._excludes)
-
+        self._use_snapshot_paths()
         # After changing the top-level src dir to where the snapshots are
         # mounted, have the base class perform an rdiff-backup.
-        self.top_level_src_dir = self._snapshot_mount_point_base_path
         super()._run_custom_workflow()
 
         self.logger.debug('RdiffLVMBackup._run_custom_workflow completed.')
+
+    async def _run_custom_workflow_async(self) -> None:
+        """Run backup of LVM snapshots without blocking the event loop."""
+        self._use_snapshot_paths()
+        await super()._run_custom_workflow_async()
+
+    def _use_snapshot_paths(self) -> None:
+        """Points the includes, excludes and source at the mounted snapshots.
+        """
+        # Cook the self._includes and self._excludes so that the src paths
+        # include the mount path for the logical volumes.
+        self._includes = self._prefix_mount_point_to_paths(self._includes)
+        self._excludes = self._prefix_mount_point_to_paths(self._excludes)
+        self.top_level_src_dir = self._snapshot_mount_point_base_path
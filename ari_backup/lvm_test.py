@@ -13,6 +13,8 @@ from ari_backup import workflow
 FLAGS = flags.FLAGS
 # Disable logging to stderr when running tests.
 FLAGS.stderr_logging = False
+# Keep test runs out of the system lock directory.
+FLAGS.lock_dir = None
 
 
 class FakeBackup(lvm.LVMSourceMixIn, workflow.BaseWorkflow):
@@ -180,7 +182,7 @@ class LVMSourceMixInTest(absltest.TestCase):
     def testDeleteSnapshots_multipleSnapshots_marksSnapshotsAsDeleted(self):
         mock_command_runner = test_lib.GetMockCommandRunner()
         backup = FakeBackup(
-            source_hostname='unused', label='unused', settings_path=None,
+            source_hostname='localhost', label='unused', settings_path=None,
             command_runner=mock_command_runner)
         backup.add_volume('fake_volume_group/fake_volume1', '/unused1')
         backup.add_volume('fake_volume_group/fake_volume2', '/unused2')
@@ -215,7 +217,7 @@ class LVMSourceMixInTest(absltest.TestCase):
     def testMountSnapshots_multipleSnapshots_marksMountPointAsCreated(self):
         mock_command_runner = test_lib.GetMockCommandRunner()
         backup = FakeBackup(
-            source_hostname='unused', label='unused', settings_path=None,
+            source_hostname='localhost', label='unused', settings_path=None,
             command_runner=mock_command_runner)
 
         backup.add_volume('fake_volume_group/fake_volume1', '/unused1')
@@ -296,7 +298,7 @@ class LVMSourceMixInTest(absltest.TestCase):
     def testMountSnapshots_multipleSnapshots_marksSnapshotsAsMounted(self):
         mock_command_runner = test_lib.GetMockCommandRunner()
         backup = FakeBackup(
-            source_hostname='unused', label='unused', settings_path=None,
+            source_hostname='localhost', label='unused', settings_path=None,
             command_runner=mock_command_runner)
         backup.add_volume('fake_volume_group/fake_volume1', '/unused1')
         backup.add_volume('fake_volume_group/fake_volume2', '/unused2')
@@ -358,6 +360,136 @@ class LVMSourceMixInTest(absltest.TestCase):
         mock_command_runner.AssertCallsInOrder(
             [expected_call_fakevolume2, expected_call_fakevolume1])
 
+    @flagsaver.flagsaver
+    def testCreateSnapshots_remoteHost_createsSnapshotsInOneBatch(self):
+        FLAGS.snapshot_suffix = '-fake_backup'
+        FLAGS.snapshot_size = '2G'
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        backup = FakeBackup(
+            source_hostname='fake_host', label='unused', settings_path=None,
+            command_runner=mock_command_runner)
+        backup.run_commands = mock.MagicMock(
+            return_value=[workflow.CommandResult('', '', 0),
+                          workflow.CommandResult('', '', 0)])
+
+        backup.add_volume('fake_volume_group/fake_volume1', '/etc')
+        backup.add_volume('fake_volume_group/fake_volume2', '/var')
+        backup._create_snapshots()
+
+        backup.run_commands.assert_called_once_with(
+            [['lvcreate', '-s', '-L', '2G', 'fake_volume_group/fake_volume1',
+              '-n', 'fake_volume1-fake_backup'],
+             ['lvcreate', '-s', '-L', '2G', 'fake_volume_group/fake_volume2',
+              '-n', 'fake_volume2-fake_backup']],
+            'fake_host')
+        self.assertFalse(mock_command_runner.run.called)
+        self.assertEqual(len(backup._lv_snapshots), 2)
+
+    def testCreateSnapshots_batchCommandFails_tracksOnlyCreatedSnapshots(
+            self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        backup = FakeBackup(
+            source_hostname='fake_host', label='unused', settings_path=None,
+            command_runner=mock_command_runner)
+        backup.run_commands = mock.MagicMock(
+            return_value=[workflow.CommandResult('', '', 0),
+                          workflow.CommandResult('', 'fake_error', 5)])
+
+        backup.add_volume('fake_volume_group/fake_volume1', '/etc')
+        backup.add_volume('fake_volume_group/fake_volume2', '/var')
+        with self.assertRaises(workflow.NonZeroExitCode) as context:
+            backup._create_snapshots()
+
+        # The failed lvcreate isn't run again.
+        self.assertFalse(mock_command_runner.run.called)
+        self.assertEqual(context.exception.exitcode, 5)
+        self.assertEqual(context.exception.stderr, 'fake_error')
+        self.assertEqual(
+            [snapshot['lv_path'] for snapshot in backup._lv_snapshots],
+            ['fake_volume_group/fake_volume1-ari_backup'])
+
+    def testCreateSnapshots_batchStopsEarly_raisesWithoutRerunningSteps(
+            self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        backup = FakeBackup(
+            source_hostname='fake_host', label='unused', settings_path=None,
+            command_runner=mock_command_runner)
+        batch_error = workflow.NonZeroExitCode(
+            'fake_error', results=[workflow.CommandResult('', '', 0)])
+        backup.run_commands = mock.MagicMock(side_effect=batch_error)
+
+        backup.add_volume('fake_volume_group/fake_volume1', '/etc')
+        backup.add_volume('fake_volume_group/fake_volume2', '/var')
+        with self.assertRaises(workflow.NonZeroExitCode) as context:
+            backup._create_snapshots()
+
+        self.assertIs(context.exception, batch_error)
+        self.assertFalse(mock_command_runner.run.called)
+        self.assertEqual(
+            [snapshot['lv_path'] for snapshot in backup._lv_snapshots],
+            ['fake_volume_group/fake_volume1-ari_backup'])
+
+    @flagsaver.flagsaver
+    def testUnmountSnapshots_batchCommandFailsPermanently_notRetried(self):
+        FLAGS.snapshot_mount_root = '/fake_root'
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        backup = FakeBackup(
+            source_hostname='localhost', label='fake_backup',
+            settings_path=None, command_runner=mock_command_runner)
+        backup.add_volume('fake_volume_group/fake_volume1', '/etc')
+        backup._create_snapshots()
+        backup._mount_snapshots()
+        backup.source_hostname = 'fake_host'
+        backup.run_commands = mock.MagicMock(
+            return_value=[workflow.CommandResult('', 'not mounted', 32)])
+        mock_command_runner.run.reset_mock()
+
+        with self.assertRaises(workflow.NonZeroExitCode):
+            backup._umount_snapshots()
+
+        self.assertFalse(mock_command_runner.run.called)
+        self.assertTrue(backup._lv_snapshots[0]['mounted'])
+
+    @flagsaver.flagsaver
+    @mock.patch('time.sleep')
+    def testUnmountSnapshots_batchCommandFails_remainingCommandsRetried(
+            self, unused_mock_sleep):
+        FLAGS.snapshot_mount_root = '/fake_root'
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        backup = FakeBackup(
+            source_hostname='localhost', label='fake_backup',
+            settings_path=None, command_runner=mock_command_runner)
+        backup.add_volume('fake_volume_group/fake_volume1', '/etc')
+        backup._create_snapshots()
+        backup._mount_snapshots()
+        backup.source_hostname = 'fake_host'
+        backup.run_commands = mock.MagicMock(
+            return_value=[workflow.CommandResult('', 'target is busy', 32)])
+        mock_command_runner.run.reset_mock()
+
+        backup._umount_snapshots()
+
+        self.assertEqual(mock_command_runner.run.call_count, 2)
+        self.assertFalse(backup._lv_snapshots[0]['mounted'])
+        self.assertFalse(backup._lv_snapshots[0]['mount_point_created'])
+
+    @mock.patch.object(os.path, 'ismount')
+    def testMountSnapshots_mountPointAlreadyExists_nothingMounted(
+            self, mock_ismount):
+        mock_ismount.return_value = True
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        backup = FakeBackup(
+            source_hostname='localhost', label='unused', settings_path=None,
+            command_runner=mock_command_runner)
+        backup.add_volume('fake_volume_group/fake_volume1', '/unused')
+        backup._create_snapshots()
+        mock_command_runner.run.reset_mock()
+
+        with self.assertRaises(Exception):
+            backup._mount_snapshots()
+
+        self.assertFalse(mock_command_runner.run.called)
+
 
 class RdiffLVMBackupTest(absltest.TestCase):
 
@@ -377,7 +509,8 @@ class RdiffLVMBackupTest(absltest.TestCase):
         FLAGS.snapshot_mount_root = '/fake_root'
         mock_command_runner = test_lib.GetMockCommandRunner()
         backup = lvm.RdiffLVMBackup(
-            source_hostname='unused', label='fake_backup', settings_path=None,
+            source_hostname='localhost', label='fake_backup',
+            settings_path=None,
             command_runner=mock_command_runner, argv=['fake_program'])
 
         backup.add_volume('fake_volume_group/fake_volume', '/var')
@@ -390,7 +523,8 @@ class RdiffLVMBackupTest(absltest.TestCase):
         FLAGS.snapshot_mount_root = '/fake_root'
         mock_command_runner = test_lib.GetMockCommandRunner()
         backup = lvm.RdiffLVMBackup(
-            source_hostname='unused', label='fake_backup', settings_path=None,
+            source_hostname='localhost', label='fake_backup',
+            settings_path=None,
             command_runner=mock_command_runner, argv=['fake_program'])
 
         backup.add_volume('fake_volume_group/fake_volume', '/var')
@@ -413,6 +547,28 @@ class RdiffLVMBackupTest(absltest.TestCase):
 
         self.assertEqual(backup.top_level_src_dir, '/fake_root/fake_backup')
 
+    def testRun_removeOlderThanFails_snapshotsStillDeleted(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+
+        def run(args, unused_shell):
+            if '--remove-older-than' in args:
+                return str(), 'fake_error', 1
+            return str(), str(), 0
+        mock_command_runner.run.side_effect = run
+        backup = lvm.RdiffLVMBackup(
+            source_hostname='localhost', label='fake_backup',
+            settings_path=None, command_runner=mock_command_runner,
+            argv=['fake_program'], remove_older_than_timespec='30D')
+        backup.add_volume('fake_volume_group/fake_volume', '/var')
+
+        with self.assertRaises(workflow.NonZeroExitCode):
+            backup.run()
+
+        self.assertIn(
+            mock.call(['lvremove', '-f',
+                       'fake_volume_group/fake_volume-ari_backup'], False),
+            mock_command_runner.run.mock_calls)
+
 
 if __name__ == '__main__':
     absltest.main()
@@ -0,0 +1,241 @@
+"""Backup jobs defined as data in YAML manifests.
+
+A manifest describes jobs without any code, so that many of them can be
+loaded and checked quickly, and inspected before any is run. Each job maps
+onto the constructor arguments of a workflow class and onto its include(),
+exclude() and add_volume() methods:
+
+    jobs:
+      - class: RdiffLVMBackup
+        label: db-server
+        source_hostname: db-server
+        remove_older_than_timespec: 30D
+        volumes:
+          - name: vg0/root
+            mount_point: /
+            mount_options: noatime
+        includes: [/etc, /var/lib/mysql]
+        excludes: [/var/lib/mysql/tmp]
+
+A manifest may also hold a single job as its top-level mapping.
+"""
+from typing import Any, NamedTuple, Optional
+
+import yaml
+
+import ari_backup
+from ari_backup import workflow
+
+
+# The C loader is much faster, but is only there when libyaml is installed.
+_Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class _ClassSpec(NamedTuple):
+    """What a manifest job of a given workflow class may hold."""
+    required: frozenset[str]
+    optional: frozenset[str]
+    has_paths: bool
+    has_volumes: bool
+
+
+_CLASSES = {
+    'RdiffBackup': _ClassSpec(
+        required=frozenset(['label', 'source_hostname']),
+        optional=frozenset(['remove_older_than_timespec']),
+        has_paths=True, has_volumes=False),
+    'RdiffLVMBackup': _ClassSpec(
+        required=frozenset(['label', 'source_hostname']),
+        optional=frozenset(['remove_older_than_timespec']),
+        has_paths=True, has_volumes=True),
+    'ShardedRdiffBackup': _ClassSpec(
+        required=frozenset(['label', 'source_hostname']),
+        optional=frozenset(['remove_older_than_timespec', 'shards']),
+        has_paths=True, has_volumes=False),
+    'ZFSLVMBackup': _ClassSpec(
+        required=frozenset(['label', 'source_hostname', 'rsync_dst',
+                            'zfs_hostname', 'dataset_name',
+                            'snapshot_expiration_days']),
+        optional=frozenset(),
+        has_paths=False, has_volumes=True),
+}
+# Constructor arguments which aren't strings.
+_INTEGER_ARGUMENTS = frozenset(['shards', 'snapshot_expiration_days'])
+_VOLUME_KEYS = frozenset(['name', 'mount_point', 'mount_options'])
+
+
+class ManifestError(ValueError):
+    """Raised when a manifest is not valid."""
+
+
+class JobSpec(NamedTuple):
+    """A job defined in a manifest.
+
+    Attributes:
+        path: the manifest the job is defined in.
+        class_name: the name of the workflow class, e.g. RdiffBackup.
+        arguments: the constructor arguments of the workflow.
+        includes: paths passed to include(), in order.
+        excludes: paths passed to exclude(), in order.
+        volumes: (name, mount_point, mount_options) arguments of
+            add_volume(), in order.
+    """
+    path: str
+    class_name: str
+    arguments: dict[str, Any]
+    includes: tuple[str, ...] = ()
+    excludes: tuple[str, ...] = ()
+    volumes: tuple[tuple[str, str, Optional[str]], ...] = ()
+
+    @property
+    def label(self) -> str:
+        return self.arguments['label']
+
+
+def _check_strings(values: Any, what: str) -> tuple[str, ...]:
+    if not isinstance(values, list) or not all(
+            isinstance(value, str) for value in values):
+        raise ManifestError('{} must be a list of strings.'.format(what))
+    return tuple(values)
+
+
+def _parse_volume(volume: Any, what: str) -> tuple[str, str, Optional[str]]:
+    if not isinstance(volume, dict):
+        raise ManifestError('{} must be a mapping.'.format(what))
+    unknown = sorted(set(volume) - _VOLUME_KEYS)
+    if unknown:
+        raise ManifestError('{} has unknown keys: {}.'.format(
+            what, ', '.join(unknown)))
+    for key in ('name', 'mount_point'):
+        if not isinstance(volume.get(key), str):
+            raise ManifestError('{} needs a {} string.'.format(what, key))
+    mount_options = volume.get('mount_options')
+    if mount_options is not None and not isinstance(mount_options, str):
+        raise ManifestError('{} mount_options must be a string.'.format(what))
+    return volume['name'], volume['mount_point'], mount_options
+
+
+def parse_job(path: str, job: Any, index: int = 0) -> JobSpec:
+    """Validates a job definition and returns it as a JobSpec.
+
+    Args:
+        path: the manifest the job is defined in.
+        job: the job as loaded from YAML.
+        index: the position of the job in the manifest, for error messages.
+
+    Raises:
+        ManifestError: when the job isn't valid.
+    """
+    what = '{} job {}'.format(path, index + 1)
+    if not isinstance(job, dict):
+        raise ManifestError('{} must be a mapping.'.format(what))
+    job = dict(job)
+    if isinstance(job.get('label'), str):
+        what = '{} job {!r}'.format(path, job['label'])
+    class_name = job.pop('class', None)
+    if class_name not in _CLASSES:
+        raise ManifestError('{} has class {!r}, which must be one of {}.'
+                            .format(what, class_name,
+                                    ', '.join(sorted(_CLASSES))))
+    class_spec = _CLASSES[class_name]
+
+    includes = excludes = volumes = ()
+    if class_spec.has_paths:
+        includes = _check_strings(job.pop('includes', []),
+                                  '{} includes'.format(what))
+        excludes = _check_strings(job.pop('excludes', []),
+                                  '{} excludes'.format(what))
+    if class_spec.has_volumes:
+        raw_volumes = job.pop('volumes', [])
+        if not isinstance(raw_volumes, list):
+            raise ManifestError('{} volumes must be a list.'.format(what))
+        volumes = tuple(
+            _parse_volume(volume, '{} volume {}'.format(what, i + 1))
+            for i, volume in enumerate(raw_volumes))
+
+    missing = sorted(class_spec.required - set(job))
+    if missing:
+        raise ManifestError('{} is missing {}.'.format(
+            what, ', '.join(missing)))
+    unknown = sorted(set(job) - class_spec.required - class_spec.optional)
+    if unknown:
+        raise ManifestError('{} has unknown keys for {}: {}.'.format(
+            what, class_name, ', '.join(unknown)))
+    for name, value in job.items():
+        expected_type = int if name in _INTEGER_ARGUMENTS else str
+        if value is None and name in class_spec.optional:
+            continue
+        # YAML reads bare numbers, e.g. a label of 42, as ints.
+        if expected_type is str and isinstance(value, int) and not isinstance(
+                value, bool):
+            job[name] = value = str(value)
+        if type(value) is not expected_type:
+            raise ManifestError('{} {} must be {}.'.format(
+                what, name,
+                'an integer' if expected_type is int else 'a string'))
+
+    return JobSpec(path, class_name, job, includes, excludes, volumes)
+
+
+def load(path: str) -> list[JobSpec]:
+    """Loads and validates the jobs in a manifest.
+
+    Raises:
+        OSError: when the manifest can't be read.
+        ManifestError: when the manifest or one of its jobs isn't valid.
+    """
+    with open(path, 'r') as manifest_file:
+        try:
+            loaded = yaml.load(manifest_file, Loader=_Loader)
+        except yaml.YAMLError as e:
+            raise ManifestError('{} is not valid YAML: {}'.format(path, e))
+    if isinstance(loaded, dict) and 'jobs' in loaded:
+        if set(loaded) != {'jobs'} or not isinstance(loaded['jobs'], list):
+            raise ManifestError(
+                '{} must only hold a list of jobs under jobs.'.format(path))
+        jobs = loaded['jobs']
+    elif isinstance(loaded, dict):
+        jobs = [loaded]
+    else:
+        raise ManifestError(
+            '{} must hold a job or a list of jobs.'.format(path))
+    specs = [parse_job(path, job, index) for index, job in enumerate(jobs)]
+    check_unique_labels(specs)
+    return specs
+
+
+def check_unique_labels(specs: list[JobSpec]) -> None:
+    """Raises ManifestError when two jobs share a label."""
+    seen: dict[str, str] = dict()
+    for spec in specs:
+        if spec.label in seen:
+            raise ManifestError(
+                'Job {!r} is defined in both {} and {}.'.format(
+                    spec.label, seen[spec.label], spec.path))
+        seen[spec.label] = spec.path
+
+
+def build(spec: JobSpec, **kwargs) -> workflow.BaseWorkflow:
+    """Creates the workflow a job spec describes.
+
+    The workflow is created within workflow.isolated_flags(), so it gets its
+    own copy of the settings.
+
+    Args:
+        spec: the job.
+        **kwargs: further arguments for the workflow constructor, e.g.
+            settings_path.
+
+    Returns:
+        The workflow, ready to run.
+    """
+    workflow_class = getattr(ari_backup, spec.class_name)
+    with workflow.isolated_flags():
+        backup = workflow_class(**spec.arguments, **kwargs)
+    for path in spec.includes:
+        backup.include(path)
+    for path in spec.excludes:
+        backup.exclude(path)
+    for name, mount_point, mount_options in spec.volumes:
+        backup.add_volume(name, mount_point, mount_options)
+    return backup
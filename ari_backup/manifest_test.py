@@ -0,0 +1,145 @@
+import os
+import shutil
+import sys
+import tempfile
+
+from absl import flags
+from absl.testing import absltest
+from absl.testing import flagsaver
+
+from ari_backup import lvm
+from ari_backup import manifest
+from ari_backup import test_lib
+
+
+FLAGS = flags.FLAGS
+# Disable logging to stderr when running tests.
+FLAGS.stderr_logging = False
+
+
+class ManifestTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.path = os.path.join(self.temp_dir, 'jobs.yaml')
+
+    def _load(self, content):
+        with open(self.path, 'w') as manifest_file:
+            manifest_file.write(content)
+        return manifest.load(self.path)
+
+    def testLoad_jobList_mapsOntoWorkflowArguments(self):
+        specs = self._load(
+            'jobs:\n'
+            '  - class: RdiffLVMBackup\n'
+            '    label: db-server\n'
+            '    source_hostname: db-server\n'
+            '    remove_older_than_timespec: 30D\n'
+            '    volumes:\n'
+            '      - {name: vg0/root, mount_point: /}\n'
+            '      - {name: vg0/var, mount_point: /var, '
+            'mount_options: noatime}\n'
+            '    includes: [/etc, /var/lib/mysql]\n'
+            '    excludes: [/var/lib/mysql/tmp]\n'
+            '  - class: RdiffBackup\n'
+            '    label: web-server\n'
+            '    source_hostname: web-server\n')
+
+        self.assertEqual(specs, [
+            manifest.JobSpec(
+                self.path, 'RdiffLVMBackup',
+                {'label': 'db-server', 'source_hostname': 'db-server',
+                 'remove_older_than_timespec': '30D'},
+                ('/etc', '/var/lib/mysql'), ('/var/lib/mysql/tmp',),
+                (('vg0/root', '/', None), ('vg0/var', '/var', 'noatime'))),
+            manifest.JobSpec(
+                self.path, 'RdiffBackup',
+                {'label': 'web-server', 'source_hostname': 'web-server'}),
+        ])
+
+    def testLoad_singleJob_loaded(self):
+        specs = self._load(
+            'class: ZFSLVMBackup\n'
+            'label: web-server\n'
+            'source_hostname: web-server\n'
+            'rsync_dst: zfs-host:/tank/web-server\n'
+            'zfs_hostname: zfs-host\n'
+            'dataset_name: tank/web-server\n'
+            'snapshot_expiration_days: 30\n')
+
+        self.assertEqual([spec.label for spec in specs], ['web-server'])
+
+    def testLoad_shardedJob_shardsLoaded(self):
+        specs = self._load(
+            'class: ShardedRdiffBackup\n'
+            'label: file-server\n'
+            'source_hostname: file-server\n'
+            'shards: 8\n'
+            'includes: [/srv, /home]\n')
+
+        self.assertEqual(specs[0].arguments['shards'], 8)
+
+    def testLoad_unknownClass_raises(self):
+        with self.assertRaisesRegex(manifest.ManifestError, 'FakeBackup'):
+            self._load('class: FakeBackup\nlabel: x\n')
+
+    def testLoad_missingArgument_raises(self):
+        with self.assertRaisesRegex(manifest.ManifestError,
+                                    'missing source_hostname'):
+            self._load('class: RdiffBackup\nlabel: x\n')
+
+    def testLoad_volumesForClassWithoutLVM_raises(self):
+        with self.assertRaisesRegex(manifest.ManifestError, 'volumes'):
+            self._load('class: RdiffBackup\n'
+                       'label: x\n'
+                       'source_hostname: x\n'
+                       'volumes: []\n')
+
+    def testLoad_wrongType_raises(self):
+        with self.assertRaisesRegex(manifest.ManifestError,
+                                    'snapshot_expiration_days must be an '
+                                    'integer'):
+            self._load('class: ZFSLVMBackup\n'
+                       'label: x\n'
+                       'source_hostname: x\n'
+                       'rsync_dst: x:/x\n'
+                       'zfs_hostname: x\n'
+                       'dataset_name: x\n'
+                       'snapshot_expiration_days: a month\n')
+
+    def testLoad_duplicateLabels_raises(self):
+        with self.assertRaisesRegex(manifest.ManifestError, "'x'"):
+            self._load('jobs:\n'
+                       '  - {class: RdiffBackup, label: x, '
+                       'source_hostname: a}\n'
+                       '  - {class: RdiffBackup, label: x, '
+                       'source_hostname: b}\n')
+
+    @flagsaver.flagsaver
+    def testBuild_appliesPathsAndVolumes(self):
+        if not FLAGS.is_parsed():
+            FLAGS(['fake_program'])
+        FLAGS.backup_store_path = '/fake/backup-store'
+        # Any executable will do, since nothing is run.
+        FLAGS.rdiff_backup_path = sys.executable
+        spec = manifest.JobSpec(
+            self.path, 'RdiffLVMBackup',
+            {'label': 'db-server', 'source_hostname': 'db-server'},
+            ('/etc',), ('/etc/ssl',), (('vg0/root', '/', None),))
+
+        backup = manifest.build(
+            spec, settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner())
+
+        self.assertIsInstance(backup, lvm.RdiffLVMBackup)
+        self.assertEqual(backup.label, 'db-server')
+        self.assertEqual(backup.source_hostname, 'db-server')
+        self.assertEqual(backup._includes, ['/etc'])
+        self.assertEqual(backup._excludes, ['/etc/ssl'])
+        self.assertEqual(backup._logical_volumes, [('vg0/root', '/', None)])
+
+
+if __name__ == '__main__':
+    absltest.main()
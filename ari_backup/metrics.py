@@ -0,0 +1,280 @@
+"""Export of run metrics for the node_exporter textfile collector.
+
+Each job writes its own <label>.prom file, so jobs running at the same time
+never write to the same file. Files are replaced atomically so that
+node_exporter never reads a partially written one.
+"""
+from typing import NamedTuple, Optional
+
+import os
+import re
+import tempfile
+
+from ari_backup import report
+
+
+_PREFIX = 'ari_backup_'
+_LAST_SUCCESS = _PREFIX + 'last_success_timestamp_seconds'
+
+# Help text for the metrics every job exports.
+_HELP = {
+    'last_run_timestamp_seconds': 'When the last run of the job started.',
+    'last_success_timestamp_seconds':
+        'When the last successful run of the job started.',
+    'last_run_success': 'Whether the last run of the job succeeded.',
+    'last_run_duration_seconds': 'Wall time of the last run of the job.',
+    'phase_duration_seconds':
+        'Wall time of each hook and of the workflow in the last run.',
+    'command_seconds':
+        'Time spent in commands in the last run, by where they ran.',
+    'command_retries': 'Number of command retries in the last run.',
+    'transferred_bytes': 'Bytes of file data copied in the last run.',
+    'rdiff_backup_elapsed_seconds':
+        'Time rdiff-backup spent on the last run of the job.',
+    'rdiff_backup_source_files':
+        'Number of files in the source of the job.',
+    'rdiff_backup_source_file_bytes':
+        'Size of the files in the source of the job.',
+    'rdiff_backup_changed_files':
+        'Number of files changed since the previous run.',
+    'rdiff_backup_changed_source_bytes':
+        'Size of the files changed since the previous run.',
+    'rdiff_backup_changed_bytes_per_second':
+        'Size of the changed files over the time rdiff-backup spent.',
+    'rdiff_backup_increment_file_bytes':
+        'Size of the increments the last run added to the repository.',
+    'rdiff_backup_errors': 'Number of errors rdiff-backup reported.',
+    'lvm_snapshots': 'Number of LVM snapshots created in the last run.',
+    'zfs_snapshots': 'Number of ZFS snapshots kept for the job.',
+    'zfs_used_bytes': 'Space used by the ZFS dataset of the job.',
+    'zfs_available_bytes': 'Space available to the ZFS dataset of the job.',
+}
+
+# rsync runs on the source host and pushes to the destination, so what it
+# sends is the data transferred; what it receives is little more than the
+# destination's checksums.
+_RSYNC_BYTES_RE = re.compile(
+    r'^Total bytes sent:\s*([\d,.]+)', re.MULTILINE)
+_RDIFF_BACKUP_STATISTIC_RE = re.compile(
+    r'^(\w+) (-?[\d.]+)(?: \(.*\))?$', re.MULTILINE)
+
+
+def parse_rsync_transferred_bytes(output: str) -> Optional[int]:
+    """Returns the bytes sent by rsync according to its --stats output.
+
+    Args:
+        output: the stdout of an rsync run with --stats.
+
+    Returns:
+        The number of bytes sent, or None when the output has no stats.
+    """
+    match = _RSYNC_BYTES_RE.search(output)
+    if match is None:
+        return None
+    return int(match.group(1).replace(',', '').split('.')[0])
+
+
+def parse_rdiff_backup_statistics(output: str) -> dict[str, float]:
+    """Returns the statistics rdiff-backup prints with --print-statistics.
+
+    Args:
+        output: the stdout of rdiff-backup.
+
+    Returns:
+        A dict mapping statistic names (e.g. "NewFileSize") to their values.
+        Empty when the output has no statistics.
+    """
+    return {name: float(value)
+            for name, value in _RDIFF_BACKUP_STATISTIC_RE.findall(output)}
+
+
+class RdiffBackupStatistics(NamedTuple):
+    """The session statistics of an rdiff-backup run.
+
+    Attributes:
+        elapsed_time: seconds the session took.
+        source_files: number of files in the source.
+        source_file_size: bytes in the source files.
+        new_files: number of files new since the previous session.
+        new_file_size: bytes in the new files.
+        changed_files: number of files changed since the previous session.
+        changed_source_size: bytes in the changed source files.
+        increment_file_size: bytes of increments added to the repository.
+        errors: number of errors encountered.
+    """
+    elapsed_time: float
+    source_files: int
+    source_file_size: int
+    new_files: int
+    new_file_size: int
+    changed_files: int
+    changed_source_size: int
+    increment_file_size: int
+    errors: int
+
+    @property
+    def changed_bytes_per_second(self) -> float:
+        """Returns the changed source bytes processed per second."""
+        if self.elapsed_time <= 0:
+            return 0.0
+        return self.changed_source_size / self.elapsed_time
+
+
+# RdiffBackupStatistics fields and the statistics they are read from.
+_SESSION_STATISTICS = {
+    'elapsed_time': 'ElapsedTime',
+    'source_files': 'SourceFiles',
+    'source_file_size': 'SourceFileSize',
+    'new_files': 'NewFiles',
+    'new_file_size': 'NewFileSize',
+    'changed_files': 'ChangedFiles',
+    'changed_source_size': 'ChangedSourceSize',
+    'increment_file_size': 'IncrementFileSize',
+    'errors': 'Errors',
+}
+
+
+def get_rdiff_backup_session_statistics(
+        statistics: dict[str, float]) -> Optional[RdiffBackupStatistics]:
+    """Returns the session statistics of an rdiff-backup run.
+
+    Args:
+        statistics: as returned by parse_rdiff_backup_statistics().
+
+    Returns:
+        The statistics, or None when there are none. Statistics missing from
+        a partial set count as zero.
+    """
+    if 'ElapsedTime' not in statistics:
+        return None
+    return RdiffBackupStatistics(**{
+        field: (statistics.get(name, 0) if field == 'elapsed_time'
+                else int(statistics.get(name, 0)))
+        for field, name in _SESSION_STATISTICS.items()})
+
+
+def combine_rdiff_backup_statistics(
+        sessions: list[RdiffBackupStatistics]
+        ) -> Optional[RdiffBackupStatistics]:
+    """Returns the statistics of rdiff-backup runs made side by side.
+
+    Counts and sizes are added up. Since the runs overlap, the elapsed time
+    is that of the longest.
+
+    Args:
+        sessions: the statistics of each run.
+
+    Returns:
+        The combined statistics, or None when sessions is empty.
+    """
+    if not sessions:
+        return None
+    return RdiffBackupStatistics(
+        max(session.elapsed_time for session in sessions),
+        *(sum(values) for values in list(zip(*sessions))[1:]))
+
+
+def _escape_label_value(value: str) -> str:
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape_label_value(value))
+        for name, value in sorted(labels.items())) + '}'
+
+
+def _read_last_success(path: str) -> Optional[float]:
+    """Returns the last success timestamp from a previously written file."""
+    try:
+        with open(path) as metrics_file:
+            for line in metrics_file:
+                if line.startswith(_LAST_SUCCESS + '{'):
+                    return float(line.rsplit(' ', 1)[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def format_metrics(run_report: report.RunReport,
+                   last_success: Optional[float] = None) -> str:
+    """Returns the metrics of a run in the Prometheus text format.
+
+    Args:
+        run_report: the report of a finished run.
+        last_success: when the last successful run started, for when this
+            run failed.
+    """
+    # Prometheus sets the job label to the scrape job itself, which would
+    # rename ours to exported_job.
+    job = {'backup_job': run_report.label}
+    samples: list[tuple[str, dict[str, str], float]] = list()
+    samples.append(('last_run_timestamp_seconds', job, run_report.started))
+    if run_report.succeeded:
+        last_success = run_report.started
+    if last_success is not None:
+        samples.append(('last_success_timestamp_seconds', job, last_success))
+    samples.append(
+        ('last_run_success', job, 1 if run_report.succeeded else 0))
+    samples.append(
+        ('last_run_duration_seconds', job, run_report.duration or 0))
+    # Hooks may share a name, so their durations are added up to keep each
+    # series unique.
+    phase_durations: dict[tuple[str, str], float] = dict()
+    for phase in run_report.phases:
+        key = (phase.name, phase.kind)
+        phase_durations[key] = phase_durations.get(key, 0) + phase.duration
+    for (name, kind), duration in phase_durations.items():
+        samples.append(('phase_duration_seconds',
+                        dict(job, phase=name, kind=kind), duration))
+    samples.append(
+        ('command_seconds', dict(job, where='ssh'), run_report.ssh_time))
+    samples.append(
+        ('command_seconds', dict(job, where='local'), run_report.local_time))
+    samples.append(('command_retries', job,
+                    sum(1 for c in run_report.commands if c.retries)))
+    for name, value in sorted(run_report.metrics.items()):
+        samples.append((name, job, value))
+
+    lines = list()
+    described = set()
+    for name, labels, value in samples:
+        if name not in described:
+            described.add(name)
+            lines.append('# HELP {}{} {}'.format(
+                _PREFIX, name,
+                _HELP.get(name, 'Reported by the workflow of the job.')))
+            lines.append('# TYPE {}{} gauge'.format(_PREFIX, name))
+        lines.append('{}{}{} {}'.format(
+            _PREFIX, name, _format_labels(labels), repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(run_report: report.RunReport, directory: str) -> str:
+    """Writes the metrics of a run to <label>.prom in directory.
+
+    The last success timestamp is carried over from the previous file when
+    this run failed. The file is written under a temporary name and renamed,
+    which node_exporter ignores until then as it only reads *.prom files.
+
+    Args:
+        run_report: the report of a finished run.
+        directory: the textfile collector directory.
+
+    Returns:
+        The path of the written file.
+    """
+    path = os.path.join(directory, '{}.prom'.format(
+        run_report.label.replace(os.sep, '_')))
+    content = format_metrics(run_report, _read_last_success(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return path
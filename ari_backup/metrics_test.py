@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+
+from absl.testing import absltest
+
+from ari_backup import metrics
+from ari_backup import report
+
+
+class MetricsTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.textfile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.textfile_dir)
+
+    def _get_report(self, succeeded, started=1000.0):
+        run_report = report.RunReport(
+            label='test_label', started=started, duration=5.0,
+            succeeded=succeeded)
+        run_report.phases.append(
+            report.PhaseRecord('workflow', 'workflow', 4.0, succeeded))
+        run_report.commands.append(report.CommandRecord(
+            'test_command', 'fake_host', 3.0, 0, retries=1))
+        run_report.metrics['transferred_bytes'] = 1234
+        return run_report
+
+    def _read_textfile(self):
+        with open(os.path.join(self.textfile_dir, 'test_label.prom')) as f:
+            return f.read()
+
+    def testParseRsyncTransferredBytes_statsOutput_returnsBytes(self):
+        output = ('Number of files: 3\n'
+                  'Total bytes sent: 1,234,567\n'
+                  'Total bytes received: 100\n')
+
+        self.assertEqual(
+            metrics.parse_rsync_transferred_bytes(output), 1234567)
+
+    def testParseRsyncTransferredBytes_noStats_returnsNone(self):
+        self.assertIsNone(metrics.parse_rsync_transferred_bytes('output'))
+
+    def testGetRdiffBackupSessionStatistics_partialStatistics_zeroFilled(
+            self):
+        statistics = metrics.parse_rdiff_backup_statistics(
+            'ElapsedTime 4.00 (4 seconds)\n'
+            'ChangedSourceSize 1000 (1000 bytes)\n')
+
+        session = metrics.get_rdiff_backup_session_statistics(statistics)
+
+        self.assertEqual(session.changed_source_size, 1000)
+        self.assertEqual(session.increment_file_size, 0)
+        self.assertEqual(session.changed_bytes_per_second, 250.0)
+
+    def testGetRdiffBackupSessionStatistics_noStatistics_returnsNone(self):
+        self.assertIsNone(metrics.get_rdiff_backup_session_statistics(dict()))
+
+    def testCombineRdiffBackupStatistics_sumsSizesAndKeepsLongestTime(self):
+        first = metrics.RdiffBackupStatistics(10.0, 1, 2, 3, 4, 5, 6, 7, 0)
+        second = metrics.RdiffBackupStatistics(30.0, 1, 1, 1, 1, 1, 1, 1, 1)
+
+        self.assertEqual(
+            metrics.combine_rdiff_backup_statistics([first, second]),
+            metrics.RdiffBackupStatistics(30.0, 2, 3, 4, 5, 6, 7, 8, 1))
+
+    def testWriteTextfile_writesMetrics(self):
+        metrics.write_textfile(self._get_report(True), self.textfile_dir)
+
+        textfile = self._read_textfile()
+        self.assertIn(
+            'ari_backup_last_success_timestamp_seconds'
+            '{backup_job="test_label"} 1000.0\n', textfile)
+        self.assertIn(
+            'ari_backup_phase_duration_seconds{backup_job="test_label",'
+            'kind="workflow",phase="workflow"} 4.0\n', textfile)
+        self.assertIn(
+            'ari_backup_command_retries{backup_job="test_label"} 1.0\n',
+            textfile)
+        self.assertIn(
+            'ari_backup_transferred_bytes{backup_job="test_label"} 1234.0\n',
+            textfile)
+        self.assertEqual(os.listdir(self.textfile_dir), ['test_label.prom'])
+
+    def testWriteTextfile_runFailed_keepsLastSuccessTimestamp(self):
+        metrics.write_textfile(self._get_report(True), self.textfile_dir)
+
+        metrics.write_textfile(
+            self._get_report(False, started=2000.0), self.textfile_dir)
+
+        textfile = self._read_textfile()
+        self.assertIn(
+            'ari_backup_last_success_timestamp_seconds'
+            '{backup_job="test_label"} 1000.0\n', textfile)
+        self.assertIn(
+            'ari_backup_last_run_success{backup_job="test_label"} 0.0\n',
+            textfile)
+
+    def testFormatMetrics_labelNeedsEscaping_escapesLabel(self):
+        run_report = self._get_report(True)
+        run_report.label = 'test "label"'
+
+        self.assertIn('{backup_job="test \\"label\\""}',
+                      metrics.format_metrics(run_report))
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,275 @@
+"""Checks that every host of a run is ready before any job starts.
+
+Problems on remote hosts otherwise only show up in the middle of a job, e.g.
+after an LVM snapshot has been taken. Each host the jobs use is checked with
+a single command over SSH (or locally for localhost), all hosts at once:
+
+* that it can be reached,
+* that the binaries the jobs run on it are installed,
+* that no LVM snapshots are left over from an earlier run, for hosts which
+  have their volumes snapshotted,
+* that the backup stores and ZFS pools written to have enough free space.
+"""
+from typing import Callable, Iterable, NamedTuple, Optional
+
+import concurrent.futures
+import shlex
+import subprocess
+
+
+# The binaries each workflow class runs, on its source host and on the host
+# it writes to.
+_LVM_BINARIES = ('lvcreate', 'lvremove', 'lvs', 'mount', 'umount')
+_SOURCE_BINARIES = {
+    'RdiffBackup': ('rdiff-backup',),
+    'RdiffLVMBackup': ('rdiff-backup',) + _LVM_BINARIES,
+    'ShardedRdiffBackup': ('du', 'rdiff-backup'),
+    'ZFSLVMBackup': ('rsync',) + _LVM_BINARIES,
+}
+_DESTINATION_BINARIES = {
+    'RdiffBackup': ('rdiff-backup',),
+    'RdiffLVMBackup': ('rdiff-backup',),
+    'ShardedRdiffBackup': ('rdiff-backup',),
+    'ZFSLVMBackup': ('rsync', 'zfs'),
+}
+_LVM_CLASSES = frozenset(['RdiffLVMBackup', 'ZFSLVMBackup'])
+# Seconds a host has to run its checks.
+_TIMEOUT = 60
+_GIB = 1024 ** 3
+
+
+class HostRequirements:
+    """What the jobs of a run need from one host.
+
+    Attributes:
+        binaries: the names of the binaries which must be installed.
+        check_snapshots: whether to look for left over LVM snapshots.
+        stores: backup store paths on the host which are written to.
+        pools: ZFS pools on the host which are written to.
+    """
+
+    def __init__(self):
+        self.binaries: set[str] = set()
+        self.check_snapshots = False
+        self.stores: set[str] = set()
+        self.pools: set[str] = set()
+
+
+class Check(NamedTuple):
+    """The outcome of one check on one host.
+
+    Attributes:
+        host: the host checked.
+        name: what was checked, e.g. ssh or binaries.
+        ok: whether the check passed.
+        detail: what was found.
+    """
+    host: str
+    name: str
+    ok: bool
+    detail: str = ''
+
+
+def get_requirements(
+        jobs: Iterable[tuple[Optional[str], Optional[str], Optional[str]]]
+        ) -> dict[str, HostRequirements]:
+    """Works out what to check on each host.
+
+    Args:
+        jobs: the workflow class name, source host and destination of each
+            job, any of which may be None when unknown. Destinations are in
+            host:path form for backup stores and host:pool form for ZFS
+            pools.
+
+    Returns:
+        The requirements keyed by host.
+    """
+    requirements: dict[str, HostRequirements] = dict()
+    for workflow_class, source, destination in jobs:
+        if source is not None:
+            source_requirements = requirements.setdefault(
+                source, HostRequirements())
+            source_requirements.binaries.update(
+                _SOURCE_BINARIES.get(workflow_class or '', ()))
+            if workflow_class in _LVM_CLASSES:
+                source_requirements.check_snapshots = True
+        host, _, location = (destination or '').partition(':')
+        if host and location:
+            destination_requirements = requirements.setdefault(
+                host, HostRequirements())
+            destination_requirements.binaries.update(
+                _DESTINATION_BINARIES.get(workflow_class or '', ()))
+            if location.startswith('/'):
+                destination_requirements.stores.add(location)
+            else:
+                destination_requirements.pools.add(location)
+    return requirements
+
+
+def build_script(requirements: HostRequirements) -> str:
+    """Returns a shell script which reports on requirements.
+
+    The script prints "missing <binary>", "lv <vg> <lv>", "free <store or
+    pool> <KiB>" and finally "done" lines.
+    """
+    lines = ['PATH="$PATH:/sbin:/usr/sbin"']
+    if requirements.binaries:
+        lines.append(
+            'for binary in {}; do command -v "$binary" >/dev/null 2>&1 || '
+            'echo "missing $binary"; done'.format(' '.join(
+                shlex.quote(b) for b in sorted(requirements.binaries))))
+    if requirements.check_snapshots:
+        lines.append('lvs --noheadings -o vg_name,lv_name 2>/dev/null | '
+                     'while read vg lv; do echo "lv $vg $lv"; done')
+    for store in sorted(requirements.stores):
+        lines.append(
+            'echo "free {0} $(df -Pk {1} 2>/dev/null | '
+            'awk \'NR == 2 {{print $4}}\')"'.format(
+                store, shlex.quote(store)))
+    for pool in sorted(requirements.pools):
+        # zfs reports bytes, which are turned into KiB like df's.
+        lines.append(
+            'echo "free {0} $(zfs list -Hp -o avail {1} 2>/dev/null | '
+            'awk \'{{print int($1 / 1024)}}\')"'.format(
+                pool, shlex.quote(pool)))
+    lines.append('echo done')
+    return '\n'.join(lines)
+
+
+def parse_output(host: str,
+                 requirements: HostRequirements,
+                 output: str,
+                 snapshot_suffix: str,
+                 min_free_space: float) -> list[Check]:
+    """Turns the output of build_script() into checks.
+
+    Args:
+        host: the host the script ran on.
+        requirements: what the script checked.
+        output: the output of the script.
+        snapshot_suffix: the suffix of the LVM snapshots ari-backup takes.
+        min_free_space: GiB which must be free on each store and pool.
+    """
+    missing = list()
+    snapshots = list()
+    free: dict[str, Optional[int]] = dict()
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == 'missing':
+            missing.append(fields[1])
+        elif len(fields) == 3 and fields[0] == 'lv':
+            if fields[2].endswith(snapshot_suffix):
+                snapshots.append('{}/{}'.format(fields[1], fields[2]))
+        elif fields and fields[0] == 'free' and len(fields) in (2, 3):
+            free[fields[1]] = (
+                int(fields[2]) if len(fields) == 3 and fields[2].isdigit()
+                else None)
+
+    checks = list()
+    if requirements.binaries:
+        checks.append(Check(
+            host, 'binaries', not missing,
+            'missing ' + ', '.join(missing) if missing else ''))
+    if requirements.check_snapshots:
+        checks.append(Check(
+            host, 'snapshots', not snapshots,
+            'left over ' + ', '.join(snapshots) if snapshots else ''))
+    for location in sorted(requirements.stores | requirements.pools):
+        kib = free.get(location)
+        if kib is None:
+            checks.append(Check(host, 'free space ' + location, False,
+                                'unable to tell'))
+            continue
+        gib = kib * 1024 / _GIB
+        checks.append(Check(host, 'free space ' + location,
+                            gib >= min_free_space,
+                            '{:.1f} GiB free'.format(gib)))
+    return checks
+
+
+def check_host(host: str,
+               requirements: HostRequirements,
+               ssh_args: Callable[[str], list[str]],
+               snapshot_suffix: str,
+               min_free_space: float) -> list[Check]:
+    """Runs the checks for one host.
+
+    Args:
+        host: the host to check. localhost is checked without SSH.
+        requirements: what to check.
+        ssh_args: returns the ssh command prefix for a host.
+        snapshot_suffix: the suffix of the LVM snapshots ari-backup takes.
+        min_free_space: GiB which must be free on each store and pool.
+
+    Returns:
+        The checks, starting with whether the host could be reached.
+    """
+    script = build_script(requirements)
+    if host == 'localhost':
+        args = ['sh', '-c', script]
+    else:
+        args = ssh_args(host) + [script]
+    try:
+        result = subprocess.run(
+            args, stdin=subprocess.DEVNULL, capture_output=True, text=True,
+            timeout=_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return [Check(host, 'ssh', False, str(e))]
+    if not result.stdout.rstrip().endswith('done'):
+        lines = result.stderr.strip().splitlines()
+        return [Check(host, 'ssh', False,
+                      lines[-1] if lines else 'no answer')]
+    return [Check(host, 'ssh', True)] + parse_output(
+        host, requirements, result.stdout, snapshot_suffix, min_free_space)
+
+
+def run_checks(requirements: dict[str, HostRequirements],
+               ssh_args: Callable[[str], list[str]],
+               snapshot_suffix: str = '-ari_backup',
+               min_free_space: float = 1.0,
+               max_workers: int = 16) -> list[Check]:
+    """Checks every host at once.
+
+    Returns:
+        The checks, grouped by host in host order.
+    """
+    hosts = sorted(requirements)
+    if not hosts:
+        return list()
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(max_workers, len(hosts))) as executor:
+        results = executor.map(
+            lambda host: check_host(host, requirements[host], ssh_args,
+                                    snapshot_suffix, min_free_space),
+            hosts)
+        return [check for checks in results for check in checks]
+
+
+def get_failed_hosts(checks: list[Check]) -> dict[str, Check]:
+    """Returns the first failed check of each host which failed one."""
+    failed: dict[str, Check] = dict()
+    for check in checks:
+        if not check.ok:
+            failed.setdefault(check.host, check)
+    return failed
+
+
+def format_table(checks: list[Check]) -> str:
+    """Returns a go/no-go table of checks, ending with the verdict."""
+    host_width = max([len('host')] + [len(c.host) for c in checks])
+    name_width = max([len('check')] + [len(c.name) for c in checks])
+    row = '{:<%d}  {:<%d}  {:<5}  {}' % (host_width, name_width)
+    lines = [row.format('host', 'check', 'go', 'detail').rstrip()]
+    for check in checks:
+        lines.append(row.format(check.host, check.name,
+                                'GO' if check.ok else 'NO-GO',
+                                check.detail).rstrip())
+    failed = get_failed_hosts(checks)
+    hosts = set(check.host for check in checks)
+    if failed:
+        lines.append('NO-GO: {} of {} hosts failed their checks.'.format(
+            len(failed), len(hosts)))
+    else:
+        lines.append('GO: all {} hosts passed their checks.'.format(
+            len(hosts)))
+    return '\n'.join(lines)
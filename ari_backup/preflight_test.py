@@ -0,0 +1,123 @@
+import subprocess
+from unittest import mock
+
+from absl.testing import absltest
+
+from ari_backup import preflight
+
+
+def _fake_ssh_args(host):
+    return ['/fake/ssh', 'fake_user@' + host]
+
+
+class PreflightTest(absltest.TestCase):
+
+    def testGetRequirements_lvmAndZFSJobs_splitBetweenHosts(self):
+        requirements = preflight.get_requirements([
+            ('ZFSLVMBackup', 'web-server', 'zfs-host:tank'),
+            ('RdiffBackup', 'db-server', 'localhost:/backup-store'),
+            (None, 'unknown-host', None),
+        ])
+
+        self.assertCountEqual(
+            requirements,
+            ['web-server', 'zfs-host', 'db-server', 'localhost',
+             'unknown-host'])
+        self.assertIn('lvcreate', requirements['web-server'].binaries)
+        self.assertTrue(requirements['web-server'].check_snapshots)
+        self.assertEqual(requirements['zfs-host'].binaries, {'rsync', 'zfs'})
+        self.assertEqual(requirements['zfs-host'].pools, {'tank'})
+        self.assertFalse(requirements['db-server'].check_snapshots)
+        self.assertEqual(requirements['localhost'].stores, {'/backup-store'})
+        self.assertEqual(requirements['unknown-host'].binaries, set())
+
+    def testBuildScript_runsUnderSh(self):
+        requirements = preflight.HostRequirements()
+        requirements.binaries.update(['sh', 'fake-missing-binary'])
+        requirements.stores.add('/')
+
+        output = subprocess.run(
+            ['sh', '-c', preflight.build_script(requirements)],
+            capture_output=True, text=True).stdout
+
+        lines = output.splitlines()
+        self.assertEqual(lines[0], 'missing fake-missing-binary')
+        self.assertRegex(lines[1], r'^free / \d+$')
+        self.assertEqual(lines[2], 'done')
+
+    def testParseOutput_reportsEachCheck(self):
+        requirements = preflight.HostRequirements()
+        requirements.binaries.update(['lvcreate', 'rsync'])
+        requirements.check_snapshots = True
+        requirements.stores.update(['/full-store', '/empty-store'])
+        requirements.pools.add('tank')
+        output = ('missing rsync\n'
+                  'lv vg0 root\n'
+                  'lv vg0 home-ari_backup\n'
+                  'free /full-store 1024\n'
+                  'free /empty-store 10485760\n'
+                  'free tank\n'
+                  'done\n')
+
+        checks = preflight.parse_output(
+            'fake-host', requirements, output, '-ari_backup', 1.0)
+
+        self.assertEqual(checks, [
+            preflight.Check('fake-host', 'binaries', False, 'missing rsync'),
+            preflight.Check('fake-host', 'snapshots', False,
+                            'left over vg0/home-ari_backup'),
+            preflight.Check('fake-host', 'free space /empty-store', True,
+                            '10.0 GiB free'),
+            preflight.Check('fake-host', 'free space /full-store', False,
+                            '0.0 GiB free'),
+            preflight.Check('fake-host', 'free space tank', False,
+                            'unable to tell'),
+        ])
+
+    @mock.patch.object(preflight.subprocess, 'run')
+    def testCheckHost_sshFails_reportsOnlySSH(self, mock_run):
+        mock_run.return_value = mock.Mock(
+            returncode=255, stdout='',
+            stderr='ssh: connect to host fake-host port 22: No route\n')
+        requirements = preflight.HostRequirements()
+        requirements.binaries.add('rsync')
+
+        checks = preflight.check_host(
+            'fake-host', requirements, _fake_ssh_args, '-ari_backup', 1.0)
+
+        self.assertEqual(checks, [preflight.Check(
+            'fake-host', 'ssh', False,
+            'ssh: connect to host fake-host port 22: No route')])
+        self.assertEqual(mock_run.call_args.args[0][:2],
+                         ['/fake/ssh', 'fake_user@fake-host'])
+
+    @mock.patch.object(preflight.subprocess, 'run')
+    def testRunChecks_checksEveryHost(self, mock_run):
+        mock_run.return_value = mock.Mock(returncode=0, stdout='done\n',
+                                          stderr='')
+        requirements = {'host1': preflight.HostRequirements(),
+                        'host2': preflight.HostRequirements()}
+
+        checks = preflight.run_checks(requirements, _fake_ssh_args)
+
+        self.assertEqual(checks, [preflight.Check('host1', 'ssh', True),
+                                  preflight.Check('host2', 'ssh', True)])
+        self.assertEqual(mock_run.call_count, 2)
+
+    def testFormatTable_failedHost_noGo(self):
+        checks = [preflight.Check('db-server', 'ssh', True),
+                  preflight.Check('db-server', 'binaries', False,
+                                  'missing lvcreate'),
+                  preflight.Check('localhost', 'ssh', True)]
+
+        self.assertEqual(preflight.format_table(checks).splitlines(), [
+            'host       check     go     detail',
+            'db-server  ssh       GO',
+            'db-server  binaries  NO-GO  missing lvcreate',
+            'localhost  ssh       GO',
+            'NO-GO: 1 of 2 hosts failed their checks.',
+        ])
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,216 @@
+"""Live progress reports for long running transfers.
+
+A ProgressMonitor is fed the output of a transfer line by line while it runs.
+Every interval it logs the files transferred so far, along with the bytes and
+the current throughput for transfers which report them, and writes them to a
+small JSON status file which other processes
+can read to find stalled or slow transfers within the backup window. The file
+is replaced atomically so that readers never see a partially written one.
+"""
+from typing import Any, NamedTuple, Optional
+
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+
+# The overall progress rsync prints with --info=progress2, e.g.
+# "  1,234,567  45%   12.34MB/s    0:01:23 (xfr#12, to-chk=100/2000)".
+_RSYNC_PROGRESS_RE = re.compile(
+    r'^\s*([\d,]+)\s+\d+%\s+\S+/s\s+[\d:]+(?:\s+\(xfr#(\d+),)?')
+# What rdiff-backup prints for each file it backs up at terminal verbosity 5.
+_RDIFF_BACKUP_FILE_RE = re.compile(r'Processing changed file ')
+
+_UNITS = ['B', 'KiB', 'MiB', 'GiB', 'TiB']
+
+
+class Progress(NamedTuple):
+    """The progress of a transfer.
+
+    Attributes:
+        label: the label of the job.
+        name: what is being transferred, e.g. rsync.
+        started: when the transfer started, in seconds since the epoch.
+        elapsed: seconds since the transfer started.
+        files: number of files transferred so far.
+        bytes: number of bytes transferred so far, or None when the transfer
+            doesn't report it.
+        bytes_per_second: throughput since the previous report, or None when
+            the transfer doesn't report bytes.
+        idle: seconds since the transfer last printed anything.
+        running: whether the transfer is still running.
+    """
+    label: str
+    name: str
+    started: float
+    elapsed: float
+    files: int
+    bytes: Optional[int]
+    bytes_per_second: Optional[float]
+    idle: float
+    running: bool
+
+
+def format_bytes(size: float) -> str:
+    """Returns a size in bytes in human readable binary units."""
+    for unit in _UNITS[:-1]:
+        if abs(size) < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} {}'.format(size, _UNITS[-1])
+
+
+def get_status_path(status_dir: str, label: str) -> str:
+    """Returns the path of the status file of a job."""
+    return os.path.join(
+        status_dir, '{}.json'.format(label.replace(os.sep, '_')))
+
+
+def read_status(path: str) -> dict[str, Any]:
+    """Returns the progress last written to a status file.
+
+    Raises:
+        OSError: when the file can't be read.
+        ValueError: when the file isn't valid JSON.
+    """
+    with open(path) as status_file:
+        return json.load(status_file)
+
+
+class ProgressMonitor:
+    """Follows the output of a transfer and reports its progress.
+
+    feed() may be called from any thread, e.g. by several commands running at
+    once, while start() reports from a thread of its own.
+    """
+
+    def __init__(self,
+                 label: str,
+                 name: str,
+                 logger: logging.Logger,
+                 interval: float,
+                 status_path: Optional[str] = None):
+        """Initializes ProgressMonitor.
+
+        Args:
+            label: the label of the job.
+            name: what is being transferred, e.g. rsync.
+            logger: where progress is logged.
+            interval: seconds between progress reports.
+            status_path: where the status file is written, if anywhere.
+        """
+        self.label = label
+        self.name = name
+        self.interval = interval
+        self.status_path = status_path
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started = time.time()
+        self._start = time.monotonic()
+        self._last_output = self._start
+        self._files = 0
+        self._bytes: Optional[int] = None
+        self._last_report = self._start
+        self._last_report_bytes = 0
+
+    def feed(self, line: str) -> None:
+        """Consumes a line of output of the transfer."""
+        match = _RSYNC_PROGRESS_RE.match(line)
+        with self._lock:
+            self._last_output = time.monotonic()
+            if match is not None:
+                self._bytes = int(match.group(1).replace(',', ''))
+                if match.group(2) is not None:
+                    self._files = int(match.group(2))
+            elif _RDIFF_BACKUP_FILE_RE.search(line):
+                self._files += 1
+
+    def report(self, running: bool = True) -> Progress:
+        """Logs the progress so far and writes it to the status file.
+
+        Args:
+            running: whether the transfer is still running.
+
+        Returns:
+            The progress reported.
+        """
+        with self._lock:
+            now = time.monotonic()
+            bytes_per_second = None
+            if self._bytes is not None:
+                # A retried transfer starts counting from zero again.
+                bytes_per_second = max(
+                    0, self._bytes - self._last_report_bytes) / max(
+                        now - self._last_report, 1e-9)
+                self._last_report_bytes = self._bytes
+            self._last_report = now
+            current = Progress(
+                self.label, self.name, self._started, now - self._start,
+                self._files, self._bytes, bytes_per_second,
+                now - self._last_output, running)
+        self._log(current)
+        if self.status_path:
+            self._write_status(current)
+        return current
+
+    def _log(self, current: Progress) -> None:
+        message = '{} {}: {} files'.format(
+            self.name, 'progress' if current.running else 'finished',
+            current.files)
+        if current.bytes is not None:
+            message += ', {}'.format(format_bytes(current.bytes))
+        if current.running and current.bytes_per_second is not None:
+            message += ', {}/s'.format(
+                format_bytes(current.bytes_per_second))
+        message += ' after {:.0f} seconds'.format(current.elapsed)
+        if current.running and current.idle >= self.interval:
+            self._logger.warning(
+                message + ', no output for {:.0f} seconds'.format(
+                    current.idle))
+        else:
+            self._logger.info(message)
+
+    def _write_status(self, current: Progress) -> None:
+        directory = os.path.dirname(self.status_path) or '.'  # type: ignore
+        status = dict(current._asdict(), updated=time.time())
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(
+                dir=directory, prefix='.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as status_file:
+                    json.dump(status, status_file, sort_keys=True)
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, self.status_path)  # type: ignore
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError as e:
+            self._logger.warning(
+                'Unable to write the progress status to {}: {}'.format(
+                    self.status_path, e))
+
+    def _report_periodically(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def start(self) -> None:
+        """Starts reporting every interval seconds."""
+        self._thread = threading.Thread(
+            target=self._report_periodically,
+            name='progress ({})'.format(self.label), daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Progress:
+        """Stops the periodic reports and reports the final progress."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self.report(running=False)
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from absl.testing import absltest
+
+from ari_backup import progress
+
+
+class ProgressMonitorTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.mock_logger = mock.MagicMock()
+        patcher = mock.patch.object(progress.time, 'monotonic')
+        self.addCleanup(patcher.stop)
+        self.mock_monotonic = patcher.start()
+        self.mock_monotonic.return_value = 1000.0
+        status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, status_dir)
+        self.status_path = os.path.join(
+            status_dir, 'status', 'fake_label.json')
+
+    def _create_monitor(self, **kwargs):
+        return progress.ProgressMonitor(
+            'fake_label', 'rsync', self.mock_logger, 60, **kwargs)
+
+    def testReport_rsyncProgress_bytesFilesAndThroughput(self):
+        monitor = self._create_monitor()
+        monitor.feed('      1,024   0%    1.00kB/s    0:00:01 (xfr#1, '
+                     'to-chk=9/10)')
+        monitor.report()
+        self.mock_monotonic.return_value = 1010.0
+        monitor.feed('  1,049,600  50%  100.00kB/s    0:00:10 (xfr#4, '
+                     'to-chk=6/10)')
+
+        current = monitor.report()
+
+        self.assertEqual(current.files, 4)
+        self.assertEqual(current.bytes, 1049600)
+        self.assertEqual(current.bytes_per_second, 104857.6)
+        self.mock_logger.info.assert_called_with(
+            'rsync progress: 4 files, 1.0 MiB, 102.4 KiB/s after 10 seconds')
+
+    def testReport_rdiffBackupOutput_countsFilesWithoutBytes(self):
+        monitor = self._create_monitor()
+        monitor.feed('Processing changed file etc/hosts')
+        monitor.feed('Incrementing mirror file /backup/etc/hosts')
+        monitor.feed('Processing changed file etc/passwd')
+
+        current = monitor.report()
+
+        self.assertEqual(current.files, 2)
+        self.assertIsNone(current.bytes)
+        self.assertIsNone(current.bytes_per_second)
+
+    def testReport_noOutputForAnInterval_warnsOfStall(self):
+        monitor = self._create_monitor()
+        monitor.feed('Processing changed file etc/hosts')
+        self.mock_monotonic.return_value = 1300.0
+
+        current = monitor.report()
+
+        self.assertEqual(current.idle, 300)
+        self.mock_logger.warning.assert_called_once_with(
+            'rsync progress: 1 files after 300 seconds, no output for 300 '
+            'seconds')
+
+    def testReport_statusPathSet_writesStatusFile(self):
+        monitor = self._create_monitor(status_path=self.status_path)
+        monitor.feed('  2,048  50%  1.00kB/s  0:00:02 (xfr#3, to-chk=1/4)')
+
+        monitor.report(running=False)
+
+        status = progress.read_status(self.status_path)
+        self.assertEqual(status['label'], 'fake_label')
+        self.assertEqual(status['bytes'], 2048)
+        self.assertFalse(status['running'])
+        self.assertIn('updated', status)
+
+    def testStop_reportsFinalProgress(self):
+        monitor = self._create_monitor(status_path=self.status_path)
+        monitor.start()
+
+        current = monitor.stop()
+
+        self.assertFalse(current.running)
+        self.assertFalse(progress.read_status(self.status_path)['running'])
+        self.mock_logger.info.assert_called_once_with(
+            'rsync finished: 0 files after 0 seconds')
+
+    def testFormatBytes_usesBinaryUnits(self):
+        self.assertEqual(progress.format_bytes(512), '512.0 B')
+        self.assertEqual(progress.format_bytes(3 * 1024 ** 3), '3.0 GiB')
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,137 @@
+"""A cache of the output of read-only commands run during a run.
+
+Hooks and jobs running in the same process often ask a host the same
+questions, e.g. which snapshots a ZFS dataset has. Commands run with
+BaseWorkflow.run_query() have their output kept here, keyed by host and
+command line, for a limited time. Since any command which changes the
+snapshots, datasets or volumes of a host would make those answers stale,
+running one drops everything cached for that host.
+"""
+from typing import Optional, Union
+
+import os
+import shlex
+import threading
+import time
+
+
+# Commands which change what read-only queries would report.
+_MUTATING_COMMANDS = frozenset([
+    'lvchange', 'lvconvert', 'lvcreate', 'lvextend', 'lvreduce', 'lvremove',
+    'lvrename', 'lvresize', 'mount', 'umount',
+])
+# Subcommands which do the same, by command.
+_MUTATING_SUBCOMMANDS = {
+    'zfs': frozenset([
+        'clone', 'create', 'destroy', 'inherit', 'mount', 'promote',
+        'receive', 'recv', 'rename', 'rollback', 'set', 'snapshot',
+        'unmount',
+    ]),
+    'zpool': frozenset([
+        'add', 'attach', 'create', 'destroy', 'detach', 'export', 'import',
+        'remove', 'replace',
+    ]),
+}
+
+
+def get_key(command: Union[str, list]) -> str:
+    """Returns the command line a command is cached under."""
+    if isinstance(command, str):
+        return command
+    return shlex.join(str(arg) for arg in command)
+
+
+def _get_tokens(command: Union[str, list]) -> Optional[list[str]]:
+    if not isinstance(command, str):
+        return [str(arg) for arg in command]
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        return list(lexer)
+    except ValueError:
+        return None
+
+
+def is_mutating(command: Union[str, list, None]) -> bool:
+    """Whether a command may change what queries on its host report.
+
+    Every word of the command is looked at, so that commands run through a
+    shell, e.g. "sync && zfs snapshot tank@now", are recognized too. Command
+    lines which can't be parsed are assumed to change things.
+    """
+    if command is None:
+        return False
+    tokens = _get_tokens(command)
+    if tokens is None:
+        return True
+    names = [os.path.basename(token) for token in tokens]
+    for i, name in enumerate(names):
+        if name in _MUTATING_COMMANDS:
+            return True
+        subcommands = _MUTATING_SUBCOMMANDS.get(name)
+        if subcommands is not None and i + 1 < len(names) and (
+                names[i + 1] in subcommands):
+            return True
+    return False
+
+
+class QueryCache:
+    """The output of queries, keyed by host and command line. Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (host, command line) -> (time.monotonic() expiry, stdout, stderr)
+        self._entries: dict[tuple[str, str], tuple[float, str, str]] = dict()
+        # How many times each host has been invalidated.
+        self._generations: dict[str, int] = dict()
+
+    def get(self, host: str,
+            command: Union[str, list]) -> Optional[tuple[str, str]]:
+        """Returns the cached stdout and stderr of a query, if still fresh."""
+        key = (host, get_key(command))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry[0]:
+                del self._entries[key]
+                return None
+            return entry[1], entry[2]
+
+    def get_generation(self, host: str) -> int:
+        """Returns a number which changes whenever host is invalidated."""
+        with self._lock:
+            return self._generations.get(host, 0)
+
+    def put(self, host: str, command: Union[str, list], stdout: str,
+            stderr: str, ttl: float, generation: Optional[int] = None) -> None:
+        """Caches the output of a query for ttl seconds.
+
+        Args:
+            host: the host the query ran on.
+            command: the query.
+            stdout: the stdout of the query.
+            stderr: the stderr of the query.
+            ttl: seconds for which the output is reused.
+            generation: the get_generation() of host from before the query
+                ran. The output isn't cached if host was invalidated since,
+                as it may predate the change.
+        """
+        with self._lock:
+            if generation is not None and (
+                    generation != self._generations.get(host, 0)):
+                return
+            self._entries[(host, get_key(command))] = (
+                time.monotonic() + ttl, stdout, stderr)
+
+    def invalidate(self, host: str) -> None:
+        """Drops everything cached for host."""
+        with self._lock:
+            self._generations[host] = self._generations.get(host, 0) + 1
+            for key in [key for key in self._entries if key[0] == host]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        """Drops everything cached."""
+        with self._lock:
+            self._entries.clear()
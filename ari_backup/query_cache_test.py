@@ -0,0 +1,77 @@
+from unittest import mock
+
+from absl.testing import absltest
+
+from ari_backup import query_cache
+
+
+class IsMutatingTest(absltest.TestCase):
+
+    def testIsMutating_zfsSubcommands(self):
+        self.assertTrue(query_cache.is_mutating(
+            ['zfs', 'snapshot', 'tank/job@now']))
+        self.assertTrue(query_cache.is_mutating(
+            ['/sbin/zfs', 'destroy', 'tank/job@then']))
+        self.assertFalse(query_cache.is_mutating(
+            ['zfs', 'get', '-H', 'creation', 'tank/job@then']))
+
+    def testIsMutating_lvmCommands(self):
+        self.assertTrue(query_cache.is_mutating(
+            ['lvcreate', '-s', '-L', '1G', 'vg0/root', '-n', 'root-snap']))
+        self.assertFalse(query_cache.is_mutating(['lvs', '--noheadings']))
+
+    def testIsMutating_shellCommandLine_looksAtEveryCommand(self):
+        self.assertTrue(query_cache.is_mutating(
+            'sync && zfs snapshot tank/job@now'))
+        self.assertTrue(query_cache.is_mutating('echo one;lvremove -f vg0/x'))
+        self.assertFalse(query_cache.is_mutating("echo 'zfs snapshot'"))
+
+    def testIsMutating_unparsableCommandLine_assumedMutating(self):
+        self.assertTrue(query_cache.is_mutating('echo "unbalanced'))
+
+
+class QueryCacheTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(query_cache.time, 'monotonic')
+        self.mock_monotonic = patcher.start()
+        self.mock_monotonic.return_value = 100
+        self.addCleanup(patcher.stop)
+        self.cache = query_cache.QueryCache()
+
+    def testGet_keyedByHostAndCommand(self):
+        self.cache.put('host1', ['zfs', 'list'], 'out', 'err', ttl=60)
+
+        self.assertEqual(self.cache.get('host1', 'zfs list'), ('out', 'err'))
+        self.assertIsNone(self.cache.get('host2', ['zfs', 'list']))
+        self.assertIsNone(self.cache.get('host1', ['zfs', 'list', '-H']))
+
+    def testGet_expired_returnsNone(self):
+        self.cache.put('host1', ['zfs', 'list'], 'out', '', ttl=60)
+        self.mock_monotonic.return_value = 160
+
+        self.assertIsNone(self.cache.get('host1', ['zfs', 'list']))
+
+    def testInvalidate_dropsOnlyThatHost(self):
+        self.cache.put('host1', ['zfs', 'list'], 'out1', '', ttl=60)
+        self.cache.put('host2', ['zfs', 'list'], 'out2', '', ttl=60)
+
+        self.cache.invalidate('host1')
+
+        self.assertIsNone(self.cache.get('host1', ['zfs', 'list']))
+        self.assertEqual(self.cache.get('host2', ['zfs', 'list']),
+                         ('out2', ''))
+
+    def testPut_invalidatedWhileQueryRan_notCached(self):
+        generation = self.cache.get_generation('host1')
+        self.cache.invalidate('host1')
+
+        self.cache.put('host1', ['zfs', 'list'], 'out', '', ttl=60,
+                       generation=generation)
+
+        self.assertIsNone(self.cache.get('host1', ['zfs', 'list']))
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -1,13 +1,20 @@
 """rdiff-backup based backup workflows."""
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
+import glob
 import os
 import shlex
+import tempfile
 
 from absl import flags
 
 from ari_backup import workflow
 
+# Like workflow.py, this imports asyncio and metrics where they're used, so
+# that they're only loaded once a job gets to them.
+if TYPE_CHECKING:
+    from ari_backup import metrics
+
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('backup_store_path', None,
@@ -17,11 +24,16 @@ flags.DEFINE_string('rdiff_backup_path', '/usr/bin/rdiff-backup',
 flags.DEFINE_boolean('ssh_compression', False,
                      'compress rdiff-backup SSH streams')
 # terminal-verbosity=1 brings the terminal verbosity down so that we only see
-# errors.
+# errors. print-statistics lets us report how much data was backed up.
 flags.DEFINE_string('rdiff_backup_options',
                     ('--exclude-device-files --exclude-fifos '
-                     '--exclude-sockets --terminal-verbosity 1'),
+                     '--exclude-sockets --terminal-verbosity 1 '
+                     '--print-statistics'),
                     'default rdiff-backup options')
+flags.DEFINE_boolean(
+    'selection_filelists', False,
+    'pass the included and excluded paths to rdiff-backup in temporary '
+    'filelists rather than on its command line, for jobs with many paths')
 flags.DEFINE_string(
     'remove_older_than_timespec', None,
     ('Global timespec for timming rdiff-backup recovery points. Default is '
@@ -68,18 +80,26 @@ class RdiffBackup(workflow.BaseWorkflow):
 
         # Assign flags to instance vars so they might be easily overridden in
         # workflow configs.
-        self.backup_store_path = FLAGS.backup_store_path
-        self.rdiff_backup_path = FLAGS.rdiff_backup_path
-        self.ssh_compression = FLAGS.ssh_compression
-        self.top_level_src_dir = FLAGS.top_level_src_dir
+        self.backup_store_path = self._flags.backup_store_path
+        self.rdiff_backup_path = self._flags.rdiff_backup_path
+        self.rdiff_backup_options = self._flags.rdiff_backup_options
+        self.ssh_compression = self._flags.ssh_compression
+        self.selection_filelists = self._flags.selection_filelists
+        self.top_level_src_dir = self._flags.top_level_src_dir
         if remove_older_than_timespec is None:
-            self.remove_older_than_timespec = FLAGS.remove_older_than_timespec
+            self.remove_older_than_timespec = (
+                self._flags.remove_older_than_timespec)
         else:
             self.remove_older_than_timespec = remove_older_than_timespec
 
         # Initialize include and exclude lists.
         self._includes: list[str] = list()
         self._excludes: list[str] = list()
+        # Temporary filelists written for the current run.
+        self._filelist_paths: list[str] = list()
+        # Session statistics of the last run, if rdiff-backup reported any.
+        self.session_statistics: Optional[
+            'metrics.RdiffBackupStatistics'] = None
 
         self._check_required_flags()
         self._check_required_binaries()
@@ -90,7 +110,25 @@ class RdiffBackup(workflow.BaseWorkflow):
             def return_timespec() -> dict[str, str]:
                 return {'timespec': self.remove_older_than_timespec}
 
-            self.add_post_hook(self._remove_older_than, return_timespec)
+            self.add_post_hook(self._remove_older_than, return_timespec,
+                               name='remove_older_than', after=())
+        # Neither hook depends on any other, so a failure of one doesn't keep
+        # later cleanup hooks from running.
+        self.add_post_hook(self._remove_selection_filelists,
+                           name='remove_selection_filelists', after=())
+
+    def _get_lock_destination(self) -> str:
+        """Returns the rdiff-backup repository of the job."""
+        return 'localhost:' + os.path.normpath(self._get_repository_path())
+
+    def _get_repository_path(self) -> str:
+        """Returns the path under which the job's backups are stored."""
+        return '{backup_store_path}/{label}'.format(
+            backup_store_path=self.backup_store_path, label=self.label)
+
+    def _get_repository_paths(self) -> list[str]:
+        """Returns the rdiff-backup repositories the job writes to."""
+        return [self._get_repository_path()]
 
     def _check_required_flags(self):
         if self.backup_store_path is None:
@@ -124,6 +162,131 @@ class RdiffBackup(workflow.BaseWorkflow):
         the configuration in the RdiffBackup instance.
         """
         self.logger.debug('_run_custom_workflow started.')
+        self.session_statistics = None
+        self._choose_ssh_compression()
+        # Rdiff-backup GO!
+        with self.monitor_progress('rdiff-backup'):
+            stdout, unused_stderr = self.run_command(
+                self._get_rdiff_backup_args(progress=True))
+        self._record_statistics(self._get_session_statistics(
+            stdout, self._get_repository_path()))
+        self.logger.debug('_run_backup completed.')
+
+    async def _run_custom_workflow_async(self) -> None:
+        """Run rdiff-backup job without blocking the event loop."""
+        import asyncio
+
+        self.logger.debug('_run_custom_workflow_async started.')
+        self.session_statistics = None
+        await asyncio.to_thread(self._choose_ssh_compression)
+        with self.monitor_progress('rdiff-backup'):
+            stdout, unused_stderr = await self.run_command_async(
+                self._get_rdiff_backup_args(progress=True))
+        self._record_statistics(self._get_session_statistics(
+            stdout, self._get_repository_path()))
+        self.logger.debug('_run_custom_workflow_async completed.')
+
+    def _choose_ssh_compression(self) -> None:
+        """Sets ssh_compression from a probe of the source host.
+
+        Nothing changes unless auto_ssh_compression is set and the probe
+        succeeds. See BaseWorkflow.get_ssh_compression().
+        """
+        if self.source_hostname == 'localhost':
+            return
+        compress = self.get_ssh_compression(
+            self.source_hostname, self._includes or [self.top_level_src_dir])
+        if compress is not None:
+            self.ssh_compression = compress
+
+    def _get_session_statistics(
+            self, stdout: str,
+            repository: str) -> Optional['metrics.RdiffBackupStatistics']:
+        """Returns the statistics of the rdiff-backup session just run.
+
+        They're parsed from stdout when rdiff-backup ran with
+        --print-statistics, and otherwise read from the newest
+        session_statistics file rdiff-backup keeps in the repository.
+
+        Args:
+            stdout: the stdout of rdiff-backup.
+            repository: the repository rdiff-backup backed up to.
+        """
+        from ari_backup import metrics
+
+        statistics = metrics.parse_rdiff_backup_statistics(stdout)
+        if not statistics and not self.dry_run:
+            statistics = self._read_session_statistics_file(repository)
+        return metrics.get_rdiff_backup_session_statistics(statistics)
+
+    def _read_session_statistics_file(
+            self, repository: str) -> dict[str, float]:
+        """Returns the statistics of the newest session in repository."""
+        from ari_backup import metrics
+
+        paths = glob.glob(os.path.join(
+            glob.escape(repository), 'rdiff-backup-data',
+            'session_statistics.*'))
+        try:
+            if not paths:
+                return dict()
+            with open(max(paths, key=os.path.getmtime)) as statistics_file:
+                return metrics.parse_rdiff_backup_statistics(
+                    statistics_file.read())
+        except OSError as e:
+            self.logger.warning(
+                'Could not read the session statistics of {}: {}'.format(
+                    repository, e))
+            return dict()
+
+    def _record_statistics(
+            self,
+            session: Optional['metrics.RdiffBackupStatistics']) -> None:
+        """Keeps the session statistics of a run and records them as metrics.
+        """
+        self.session_statistics = session
+        if session is None:
+            return
+        self.record_metric('transferred_bytes',
+                           session.new_file_size + session.changed_source_size)
+        self.record_metric('rdiff_backup_elapsed_seconds',
+                           session.elapsed_time)
+        self.record_metric('rdiff_backup_source_files', session.source_files)
+        self.record_metric('rdiff_backup_source_file_bytes',
+                           session.source_file_size)
+        self.record_metric('rdiff_backup_changed_files',
+                           session.changed_files)
+        self.record_metric('rdiff_backup_changed_source_bytes',
+                           session.changed_source_size)
+        self.record_metric('rdiff_backup_changed_bytes_per_second',
+                           session.changed_bytes_per_second)
+        self.record_metric('rdiff_backup_increment_file_bytes',
+                           session.increment_file_size)
+        self.record_metric('rdiff_backup_errors', session.errors)
+        if session.errors:
+            self.logger.warning(
+                'rdiff-backup reported {} errors.'.format(session.errors))
+
+    def _get_rdiff_backup_args(
+            self,
+            includes: Optional[list[str]] = None,
+            repository: Optional[str] = None,
+            progress: bool = False) -> list[str]:
+        """Returns the rdiff-backup command line for this backup job.
+
+        Args:
+            includes: the paths to back up. Defaults to those added with
+                include().
+            repository: the repository to back up to. Defaults to
+                _get_repository_path().
+            progress: whether the command runs within monitor_progress(), in
+                which case rdiff-backup lists the files it processes when
+                progress_interval is set.
+        """
+        if includes is None:
+            includes = self._includes
+        if repository is None:
+            repository = self._get_repository_path()
         # Init our arguments list with the path to rdiff-backup.
         # This will be in the format we'd normally pass to the command-line
         # e.g. [ '--include', '/dir/to/include', '--exclude',
@@ -131,8 +294,14 @@ class RdiffBackup(workflow.BaseWorkflow):
         args = [self.rdiff_backup_path]
 
         # Add default options to arguments.
-        default_options = shlex.split(FLAGS.rdiff_backup_options)
+        default_options = shlex.split(self.rdiff_backup_options)
         args.extend(default_options)
+        # Progress is followed by counting the files rdiff-backup lists at
+        # terminal verbosity 5, as it doesn't report bytes while it runs. The
+        # list is counted as it streams past and only its tail is kept, but a
+        # command which isn't monitored would keep all of it.
+        if progress and self.progress_interval:
+            args.extend(['--terminal-verbosity', '5'])
 
         # This conditional reads strangely, but that's because rdiff-backup not
         # only defaults to having SSH compression enabled, it also doesn't have
@@ -142,13 +311,23 @@ class RdiffBackup(workflow.BaseWorkflow):
             args.append('--ssh-no-compression')
 
         # Add exclude and includes to our arguments...
-        for path in self._excludes:
-            args.append('--exclude')
-            args.append(path)
+        if self.selection_filelists:
+            if self._excludes:
+                args.append('--exclude-globbing-filelist')
+                args.append(self._write_selection_filelist(
+                    self._excludes, 'exclude'))
+            if includes:
+                args.append('--include-globbing-filelist')
+                args.append(self._write_selection_filelist(
+                    includes, 'include'))
+        else:
+            for path in self._excludes:
+                args.append('--exclude')
+                args.append(path)
 
-        for path in self._includes:
-            args.append('--include')
-            args.append(path)
+            for path in includes:
+                args.append('--include')
+                args.append(path)
 
         # Exclude everything else
         args += ['--exclude', '**']
@@ -164,12 +343,46 @@ class RdiffBackup(workflow.BaseWorkflow):
                     top_level_src_dir=self.top_level_src_dir))
 
         # Add a destination argument
-        args.append('{backup_store_path}/{label}'.format(
-            backup_store_path=self.backup_store_path, label=self.label))
+        args.append(repository)
 
-        # Rdiff-backup GO!
-        self.run_command(args)
-        self.logger.debug('_run_backup completed.')
+        return args
+
+    def _write_selection_filelist(self, paths: list[str], kind: str) -> str:
+        """Writes paths to a temporary rdiff-backup globbing filelist.
+
+        Duplicate paths are dropped and longer paths are listed first, so that
+        the most specific entries are matched first. The file is removed by
+        the remove_selection_filelists post-job hook.
+
+        Args:
+            paths: the paths to select.
+            kind: include or exclude, used in the name of the file.
+
+        Returns:
+            The path of the filelist.
+        """
+        entries = sorted(set(paths), key=lambda path: (-len(path), path))
+        fd, filelist_path = tempfile.mkstemp(
+            prefix='ari-backup-{}-'.format(self.label), suffix='.' + kind)
+        self._filelist_paths.append(filelist_path)
+        with os.fdopen(fd, 'w') as filelist:
+            for entry in entries:
+                filelist.write(entry + '\n')
+        return filelist_path
+
+    def _remove_selection_filelists(self, error_case: bool) -> None:
+        """Removes the filelists written for this run.
+
+        Args:
+            error_case: whether an error has occurred during the backup. The
+                filelists are removed either way.
+        """
+        while self._filelist_paths:
+            path = self._filelist_paths.pop()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
     def _remove_older_than(self, timespec: str, error_case: bool):
         """Trims increments older than timespec.
@@ -187,13 +400,14 @@ class RdiffBackup(workflow.BaseWorkflow):
         if not error_case:
             self.logger.info('remove_older_than %s started.' % timespec)
 
-            args = [
-                self.rdiff_backup_path,
-                '--force',
-                '--remove-older-than',
-                timespec,
-                '{}/{}'.format(self.backup_store_path, self.label),
-            ]
+            for repository in self._get_repository_paths():
+                args = [
+                    self.rdiff_backup_path,
+                    '--force',
+                    '--remove-older-than',
+                    timespec,
+                    repository,
+                ]
 
-            self.run_command(args)
+                self.run_command(args)
             self.logger.info('remove_older_than %s completed.' % timespec)
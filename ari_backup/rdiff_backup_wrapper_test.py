@@ -1,10 +1,16 @@
+import asyncio
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 from unittest import mock
 
 from absl import flags
 from absl.testing import absltest
 from absl.testing import flagsaver
 
+from ari_backup import metrics
 from ari_backup import rdiff_backup_wrapper
 from ari_backup import test_lib
 
@@ -12,6 +18,30 @@ from ari_backup import test_lib
 FLAGS = flags.FLAGS
 # Disable logging to stderr when running tests.
 FLAGS.stderr_logging = False
+# Keep test runs out of the system lock directory.
+FLAGS.lock_dir = None
+
+_SESSION_STATISTICS = (
+    '--------------[ Session statistics ]--------------\n'
+    'StartTime 1700000000.00 (Tue Nov 14 22:13:20 2023)\n'
+    'EndTime 1700000020.00 (Tue Nov 14 22:13:40 2023)\n'
+    'ElapsedTime 20.00 (20 seconds)\n'
+    'SourceFiles 1000\n'
+    'SourceFileSize 50000 (48.8 KB)\n'
+    'MirrorFiles 995\n'
+    'MirrorFileSize 48000 (46.9 KB)\n'
+    'NewFiles 10\n'
+    'NewFileSize 2000 (1.95 KB)\n'
+    'DeletedFiles 5\n'
+    'DeletedFileSize 0 (0 bytes)\n'
+    'ChangedFiles 5\n'
+    'ChangedSourceSize 8000 (7.81 KB)\n'
+    'ChangedMirrorSize 7900 (7.71 KB)\n'
+    'IncrementFiles 20\n'
+    'IncrementFileSize 300 (300 bytes)\n'
+    'TotalDestinationSizeChange 2100 (2.05 KB)\n'
+    'Errors 1\n'
+    '--------------------------------------------------\n')
 
 
 class RdiffBackupTest(absltest.TestCase):
@@ -226,6 +256,29 @@ class RdiffBackupTest(absltest.TestCase):
              'fake_user@fake_host::/', '/fake/backup-store/fake_backup'],
             False)
 
+    @flagsaver.flagsaver
+    @mock.patch.object(rdiff_backup_wrapper.RdiffBackup,
+                       'get_ssh_compression', return_value=True)
+    def testRunCustomWorkflow_compressionPaysOff_sshCompressionNotDisabled(
+            self, mock_get_ssh_compression):
+        FLAGS.ssh_compression = False
+        FLAGS.remote_user = 'fake_user'
+        FLAGS.rdiff_backup_path = '/fake/rdiff-backup'
+        FLAGS.backup_store_path = '/fake/backup-store'
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        backup = rdiff_backup_wrapper.RdiffBackup(
+            label='fake_backup', source_hostname='fake_host',
+            settings_path=None, command_runner=mock_command_runner,
+            argv=['fake_program'])
+
+        backup.include('/fake_dir')
+        backup.run()
+
+        mock_get_ssh_compression.assert_called_once_with(
+            'fake_host', ['/fake_dir'])
+        self.assertNotIn('--ssh-no-compression',
+                         mock_command_runner.run.call_args.args[0])
+
     @flagsaver.flagsaver
     def testRunCustomWorkflow_sourceHostnameIsLocalhost_sourceIsPath(self):
         FLAGS.rdiff_backup_path = '/fake/rdiff-backup'
@@ -289,6 +342,181 @@ class RdiffBackupTest(absltest.TestCase):
              '**', '/', '/fake/backup-store/fake_backup'],
             False)
 
+    @flagsaver.flagsaver
+    def testRunCustomWorkflow_progressIntervalSet_listsChangedFiles(self):
+        FLAGS.progress_interval = 3600
+        FLAGS.rdiff_backup_path = '/fake/rdiff-backup'
+        FLAGS.backup_store_path = '/fake/backup-store'
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        backup = rdiff_backup_wrapper.RdiffBackup(
+            label='fake_backup', source_hostname='localhost',
+            settings_path=None, command_runner=mock_command_runner,
+            argv=['fake_program'])
+        backup.logger = mock.MagicMock()
+
+        backup.include('/fake_dir')
+        backup.run()
+
+        mock_command_runner.run.assert_called_once_with(
+            ['/fake/rdiff-backup', '--terminal-verbosity', '5', '--include',
+             '/fake_dir', '--exclude', '**', '/',
+             '/fake/backup-store/fake_backup'],
+            False)
+        self.assertIn(
+            'rdiff-backup finished: 0 files',
+            [c.args[0].split(' after ')[0]
+             for c in backup.logger.info.call_args_list])
+
+    @flagsaver.flagsaver
+    def testRunCustomWorkflow_selectionFilelists_pathsPassedInFiles(self):
+        FLAGS.rdiff_backup_path = '/fake/rdiff-backup'
+        FLAGS.backup_store_path = '/fake/backup-store'
+        FLAGS.selection_filelists = True
+        filelists = dict()
+
+        def read_filelists(args, unused_shell):
+            for option, value in zip(args, args[1:]):
+                if option.endswith('-globbing-filelist'):
+                    with open(value) as filelist:
+                        filelists[option] = filelist.read()
+            return str(), str(), 0
+
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.side_effect = read_filelists
+        backup = rdiff_backup_wrapper.RdiffBackup(
+            label='fake_backup', source_hostname='localhost',
+            settings_path=None, command_runner=mock_command_runner,
+            argv=['fake_program'])
+
+        backup.include('/etc')
+        backup.include('/var/lib')
+        backup.include('/etc')
+        backup.exclude('/var/lib/cache')
+        backup.run()
+
+        args = mock_command_runner.run.call_args.args[0]
+        self.assertNotIn('--include', args)
+        self.assertEqual(args[-4:], ['--exclude', '**', '/',
+                                     '/fake/backup-store/fake_backup'])
+        self.assertLess(args.index('--exclude-globbing-filelist'),
+                        args.index('--include-globbing-filelist'))
+        self.assertEqual(filelists, {
+            '--exclude-globbing-filelist': '/var/lib/cache\n',
+            '--include-globbing-filelist': '/var/lib\n/etc\n',
+        })
+        # The post-job hook removed the filelists.
+        self.assertFalse(os.path.exists(
+            args[args.index('--include-globbing-filelist') + 1]))
+
+    @flagsaver.flagsaver
+    def testRunCustomWorkflow_statisticsPrinted_recordedAsMetrics(self):
+        FLAGS.rdiff_backup_path = '/fake/rdiff-backup'
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.return_value = (
+            _SESSION_STATISTICS, str(), 0)
+        backup = rdiff_backup_wrapper.RdiffBackup(
+            label='fake_backup', source_hostname='localhost',
+            settings_path=None, command_runner=mock_command_runner,
+            argv=['fake_program'])
+
+        backup.include('/etc')
+        backup.run()
+
+        self.assertEqual(
+            backup.session_statistics,
+            metrics.RdiffBackupStatistics(
+                elapsed_time=20.0, source_files=1000, source_file_size=50000,
+                new_files=10, new_file_size=2000, changed_files=5,
+                changed_source_size=8000, increment_file_size=300, errors=1))
+        self.assertEqual(backup.run_report.metrics, {
+            'transferred_bytes': 10000,
+            'rdiff_backup_elapsed_seconds': 20.0,
+            'rdiff_backup_source_files': 1000,
+            'rdiff_backup_source_file_bytes': 50000,
+            'rdiff_backup_changed_files': 5,
+            'rdiff_backup_changed_source_bytes': 8000,
+            'rdiff_backup_changed_bytes_per_second': 400.0,
+            'rdiff_backup_increment_file_bytes': 300,
+            'rdiff_backup_errors': 1,
+        })
+
+    @flagsaver.flagsaver
+    def testRunCustomWorkflow_statisticsNotPrinted_readFromRepository(self):
+        backup_store_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, backup_store_path)
+        FLAGS.backup_store_path = backup_store_path
+        data_dir = os.path.join(
+            backup_store_path, 'fake_backup', 'rdiff-backup-data')
+        os.makedirs(data_dir)
+        old_path = os.path.join(
+            data_dir, 'session_statistics.2023-11-13T22:13:20Z.data')
+        with open(old_path, 'w') as statistics_file:
+            statistics_file.write('ElapsedTime 1.00 (1 second)\n')
+        os.utime(old_path, (0, 0))
+        with open(os.path.join(
+                data_dir, 'session_statistics.2023-11-14T22:13:20Z.data'),
+                'w') as statistics_file:
+            statistics_file.write(_SESSION_STATISTICS)
+        backup = rdiff_backup_wrapper.RdiffBackup(
+            label='fake_backup', source_hostname='localhost',
+            settings_path=None, command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+
+        backup.include('/etc')
+        backup.run()
+
+        self.assertEqual(backup.session_statistics.elapsed_time, 20.0)
+        self.assertEqual(
+            backup.run_report.metrics['rdiff_backup_increment_file_bytes'],
+            300)
+
+    @flagsaver.flagsaver
+    def testRunAsync_runsRdiffBackupWithAsyncCommandRunner(self):
+        FLAGS.rdiff_backup_path = '/fake/rdiff-backup'
+        FLAGS.backup_store_path = '/fake/backup-store'
+        FLAGS.top_level_src_dir = '/'
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_async_command_runner = mock.MagicMock()
+        mock_async_command_runner.run_async = mock.AsyncMock(
+            return_value=('', '', 0))
+        backup = rdiff_backup_wrapper.RdiffBackup(
+            label='fake_backup', source_hostname='localhost',
+            settings_path=None, command_runner=mock_command_runner,
+            async_command_runner=mock_async_command_runner,
+            argv=['fake_program'])
+
+        backup.include('/fake_dir')
+        self.assertTrue(asyncio.run(backup.run_async()))
+
+        mock_async_command_runner.run_async.assert_awaited_once_with(
+            ['/fake/rdiff-backup', '--include', '/fake_dir', '--exclude', '**',
+             '/', '/fake/backup-store/fake_backup'], False)
+        self.assertFalse(mock_command_runner.run.called)
+
+    @flagsaver.flagsaver
+    def testRunAsync_progressIntervalSet_listsChangedFiles(self):
+        FLAGS.progress_interval = 3600
+        FLAGS.rdiff_backup_path = '/fake/rdiff-backup'
+        FLAGS.backup_store_path = '/fake/backup-store'
+        FLAGS.top_level_src_dir = '/'
+        mock_async_command_runner = mock.MagicMock()
+        mock_async_command_runner.run_async = mock.AsyncMock(
+            return_value=('', '', 0))
+        backup = rdiff_backup_wrapper.RdiffBackup(
+            label='fake_backup', source_hostname='localhost',
+            settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            async_command_runner=mock_async_command_runner,
+            argv=['fake_program'])
+
+        backup.include('/fake_dir')
+        self.assertTrue(asyncio.run(backup.run_async()))
+
+        mock_async_command_runner.run_async.assert_awaited_once_with(
+            ['/fake/rdiff-backup', '--terminal-verbosity', '5', '--include',
+             '/fake_dir', '--exclude', '**', '/',
+             '/fake/backup-store/fake_backup'], False)
+
 
 class RdiffBackupCheckRequiredBinariesTest(absltest.TestCase):
     """Class for testing methods that were mocked out in RdiffBackupTest."""
@@ -305,5 +533,21 @@ class RdiffBackupCheckRequiredBinariesTest(absltest.TestCase):
                 label='unused', source_hostname='unused', settings_path=None)
 
 
+class RdiffBackupImportTest(absltest.TestCase):
+
+    def testImport_asyncioAndMetricsNotLoaded(self):
+        # A fresh interpreter, as this one has loaded them for other tests.
+        output = subprocess.run(
+            [sys.executable, '-c',
+             'import sys\n'
+             'import ari_backup\n'
+             'ari_backup.RdiffBackup\n'
+             'print("asyncio" in sys.modules,\n'
+             '      "ari_backup.metrics" in sys.modules)\n'],
+            check=True, stdout=subprocess.PIPE, text=True).stdout
+
+        self.assertEqual(output.split(), ['False', 'False'])
+
+
 if __name__ == '__main__':
     absltest.main()
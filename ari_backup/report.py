@@ -0,0 +1,110 @@
+"""Structured reports on how the time of a workflow run was spent."""
+from typing import Any, Optional
+
+import dataclasses
+import json
+import os
+import tempfile
+
+
+@dataclasses.dataclass
+class CommandRecord:
+    """A single command run by a workflow.
+
+    Attributes:
+        command: the command line as given to the workflow.
+        host: the host the command ran on.
+        duration: wall time in seconds.
+        exitcode: the exit code, or None if the command never finished (e.g.
+            it timed out or could not be found).
+        retries: how many times the command had been retried before this
+            attempt.
+        phase: the name of the phase the command ran in.
+    """
+    command: str
+    host: str
+    duration: float
+    exitcode: Optional[int]
+    retries: int = 0
+    phase: Optional[str] = None
+
+    @property
+    def remote(self) -> bool:
+        """Whether the command ran over SSH."""
+        return self.host != 'localhost'
+
+
+@dataclasses.dataclass
+class PhaseRecord:
+    """A pre-job hook, the custom workflow or a post-job hook.
+
+    Attributes:
+        name: the hook name, or its function name if it has none. The custom
+            workflow is named "workflow".
+        kind: one of "pre_hook", "workflow" or "post_hook".
+        duration: wall time in seconds.
+        succeeded: whether the phase finished without raising.
+    """
+    name: str
+    kind: str
+    duration: float
+    succeeded: bool
+
+
+@dataclasses.dataclass
+class RunReport:
+    """Where the time of a single workflow run went.
+
+    Attributes:
+        label: the label of the workflow.
+        started: when the run started, in seconds since the epoch.
+        dry_run: whether the run was in dry_run mode.
+        duration: wall time of the whole run in seconds, once it is over.
+        succeeded: whether the run succeeded, once it is over.
+        phases: the phases in the order they finished.
+        commands: the commands in the order they finished.
+        metrics: values specific to the workflow (e.g. bytes transferred),
+            keyed by metric name.
+    """
+    label: str
+    started: float
+    dry_run: bool = False
+    duration: Optional[float] = None
+    succeeded: Optional[bool] = None
+    phases: list[PhaseRecord] = dataclasses.field(default_factory=list)
+    commands: list[CommandRecord] = dataclasses.field(default_factory=list)
+    metrics: dict[str, float] = dataclasses.field(default_factory=dict)
+
+    @property
+    def ssh_time(self) -> float:
+        """Total seconds spent in commands run over SSH."""
+        return sum(c.duration for c in self.commands if c.remote)
+
+    @property
+    def local_time(self) -> float:
+        """Total seconds spent in commands run locally."""
+        return sum(c.duration for c in self.commands if not c.remote)
+
+    def to_dict(self) -> dict[str, Any]:
+        """Returns the report as a dict of JSON serializable values."""
+        report = dataclasses.asdict(self)
+        report['ssh_time'] = self.ssh_time
+        report['local_time'] = self.local_time
+        return report
+
+    def write_json(self, path: str) -> None:
+        """Writes the report to path as JSON.
+
+        The report is written to a temporary file first and then renamed, so
+        readers never see a partially written report.
+        """
+        directory = os.path.dirname(path) or '.'
+        fd, temp_path = tempfile.mkstemp(
+            dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as report_file:
+                json.dump(self.to_dict(), report_file, indent=2)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
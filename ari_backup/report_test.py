@@ -0,0 +1,48 @@
+import json
+import os
+import tempfile
+
+from absl.testing import absltest
+
+from ari_backup import report
+
+
+class RunReportTest(absltest.TestCase):
+
+    def _get_report(self):
+        run_report = report.RunReport(label='test_label', started=100.0)
+        run_report.commands.append(report.CommandRecord(
+            'local_command', 'localhost', 2.0, 0))
+        run_report.commands.append(report.CommandRecord(
+            'remote_command', 'fake_host', 3.0, 1, retries=2))
+        run_report.commands.append(report.CommandRecord(
+            'remote_command', 'fake_host', 4.0, 0, retries=3))
+        return run_report
+
+    def testSshTime_sumsRemoteCommands(self):
+        self.assertEqual(self._get_report().ssh_time, 7.0)
+
+    def testLocalTime_sumsLocalCommands(self):
+        self.assertEqual(self._get_report().local_time, 2.0)
+
+    def testToDict_includesTotals(self):
+        report_dict = self._get_report().to_dict()
+
+        self.assertEqual(report_dict['ssh_time'], 7.0)
+        self.assertEqual(report_dict['local_time'], 2.0)
+        self.assertEqual(report_dict['commands'][1]['retries'], 2)
+
+    def testWriteJson_writesReportAndNoTemporaryFiles(self):
+        with tempfile.TemporaryDirectory() as report_dir:
+            path = os.path.join(report_dir, 'test_label.json')
+
+            self._get_report().write_json(path)
+
+            with open(path) as report_file:
+                self.assertEqual(json.load(report_file)['label'],
+                                 'test_label')
+            self.assertEqual(os.listdir(report_dir), ['test_label.json'])
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,1061 @@
+"""Runs the backup jobs in a jobs directory, several at a time.
+
+This replaces piping run-parts into xargs. Jobs still run as separate
+processes, but the runner knows which source host and which backup
+destination each job uses. It limits how many jobs run at once overall, per
+source host and per destination, so that concurrency can be raised without
+two jobs hammering the same host or the same backup disk.
+
+The source host and destination of a job are read from its script without
+running it: the source_hostname, zfs_hostname, dataset_name and rsync_dst
+arguments of the workflow it constructs, and any backup_store_path it sets.
+A job can also state them in a comment, which takes precedence:
+
+    # ari-backup: source=db-server destination=backup-disk1
+
+When a history_path is set, jobs are started longest expected duration
+first, based on their past runs, so that a long job doesn't start last and
+stretch the backup window. Jobs with no history are started before the rest,
+since nothing is known about how long they take.
+
+With --in_process, Python job scripts are loaded and run in the runner
+process instead of each starting its own interpreter, so that startup and
+import costs are paid once per run rather than once per job.
+
+Jobs can also be defined in YAML manifests in the jobs directory (see the
+manifest module). run-parts ignores these since their names hold a dot.
+They are validated before any job starts and always run in the runner
+process.
+
+With --preflight, every host the jobs use is checked at once before the run
+(see the preflight module), a go/no-go table is printed, and the jobs of
+hosts which failed a check are not run. --preflight_only prints the table
+and exits.
+"""
+from typing import Any, Callable, NamedTuple, Optional
+
+import ast
+import collections
+import functools
+import inspect
+import os
+import re
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+from absl import app
+from absl import flags
+
+import ari_backup
+from ari_backup import adaptive
+from ari_backup import breaker
+from ari_backup import history
+from ari_backup import locks
+from ari_backup import manifest
+from ari_backup import preflight
+from ari_backup import settings
+from ari_backup import workflow
+
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('jobs_dir', '/etc/ari-backup/jobs.d',
+                    'directory holding the backup job scripts')
+flags.DEFINE_integer('max_jobs', 1, 'maximum number of jobs run at once')
+flags.DEFINE_integer(
+    'max_jobs_per_source', 1,
+    'maximum number of jobs run at once against the same source host')
+flags.DEFINE_integer(
+    'max_jobs_per_destination', 1,
+    'maximum number of jobs run at once writing to the same destination')
+flags.DEFINE_string(
+    'run_lock_path', None,
+    'lock file which keeps two runners from running at the same time; by '
+    'default each jobs_dir has its own in lock_dir, so that runners of '
+    'different jobs directories may overlap')
+flags.DEFINE_boolean(
+    'in_process', False,
+    'run Python job scripts in this process, each with its own copy of the '
+    'settings, rather than starting an interpreter for each of them')
+flags.DEFINE_boolean(
+    'adaptive_concurrency', False,
+    'treat max_jobs and max_jobs_per_destination as ceilings and run as many '
+    'jobs as the destination disks, the CPU iowait and the load of the '
+    'source hosts allow')
+flags.DEFINE_float(
+    'target_utilization', 0.8,
+    'with adaptive_concurrency, the fraction of time the local disks of a '
+    'destination should be busy')
+flags.DEFINE_float(
+    'max_iowait', 0.3,
+    'with adaptive_concurrency, the fraction of CPU time spent in iowait '
+    'above which fewer jobs are run')
+flags.DEFINE_float(
+    'max_source_load', 2.0,
+    'with adaptive_concurrency, the 1 minute load average per CPU of a '
+    'source host above which no more jobs are started against it')
+flags.DEFINE_integer(
+    'adaptive_interval', 15,
+    'with adaptive_concurrency, seconds between samples of the load')
+flags.DEFINE_integer(
+    'breaker_threshold', 0,
+    'number of jobs in a row which must fail to connect to a source host '
+    'before its remaining jobs are held back; 0, the default, disables this')
+flags.DEFINE_integer(
+    'breaker_probe_interval', 600,
+    'seconds between checks of whether a source host whose jobs are held '
+    'back answers again')
+flags.DEFINE_boolean(
+    'preflight', False,
+    'check every host the jobs use before the run, and skip the jobs of '
+    'hosts which fail a check')
+flags.DEFINE_boolean(
+    'preflight_only', False,
+    'check every host the jobs use, print the results, and exit')
+flags.DEFINE_float(
+    'min_free_space', 1.0,
+    'GiB which must be free on each backup store and ZFS pool for the '
+    'preflight checks to pass')
+flags.DEFINE_boolean(
+    'show_trends', False,
+    'print how the duration of each job has changed according to the job '
+    'history, and exit')
+
+# Job names run-parts accepts under its default LSB naming rules.
+_JOB_NAME_RE = re.compile(r'^[a-zA-Z0-9_-]+$')
+_ANNOTATION_RE = re.compile(r'^#\s*ari-backup:(.*)$', re.MULTILINE)
+_WORKFLOW_CLASSES = frozenset(
+    ['RdiffBackup', 'RdiffLVMBackup', 'ShardedRdiffBackup', 'ZFSLVMBackup'])
+# Longest the runner waits without checking for signals. Python only handles
+# a signal which arrives just before a wait starts once the wait is over.
+_MAX_WAIT = 1.0
+
+
+class Job(NamedTuple):
+    """A job script and the resources it uses.
+
+    Attributes:
+        path: the path of the job script.
+        source: the source host, or None if unknown.
+        destination: where the job writes its backups, or None if unknown.
+        label: the label of the workflow the job runs, or None if unknown.
+        spec: the job definition, for jobs defined in a manifest.
+        workflow_class: the name of the workflow class the job runs, or None
+            if unknown.
+    """
+    path: str
+    source: Optional[str] = None
+    destination: Optional[str] = None
+    label: Optional[str] = None
+    spec: Optional[manifest.JobSpec] = None
+    workflow_class: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        if self.spec is not None:
+            return self.spec.label
+        return os.path.basename(self.path)
+
+    @property
+    def history_label(self) -> str:
+        """The label the job's runs are recorded under in the history."""
+        return self.label or self.name
+
+
+class JobResult(NamedTuple):
+    """The outcome of a job.
+
+    Attributes:
+        job: the job which was run.
+        exitcode: the exit code of the job script.
+        duration: wall time in seconds.
+        reason: why the job failed without being run, if it was.
+    """
+    job: Job
+    exitcode: int
+    duration: float
+    reason: Optional[str] = None
+
+
+def find_job_paths(jobs_dir: str) -> list[str]:
+    """Returns the job scripts run-parts would run, in the order it would.
+
+    Like run-parts, this only considers executable files with names made of
+    letters, digits, underscores and hyphens.
+    """
+    paths = list()
+    for name in sorted(os.listdir(jobs_dir)):
+        path = os.path.join(jobs_dir, name)
+        if (_JOB_NAME_RE.match(name) and os.path.isfile(path) and
+                os.access(path, os.X_OK)):
+            paths.append(path)
+    return paths
+
+
+def find_manifest_paths(jobs_dir: str) -> list[str]:
+    """Returns the job manifests in jobs_dir, sorted by name."""
+    return [os.path.join(jobs_dir, name)
+            for name in sorted(os.listdir(jobs_dir))
+            if name.endswith('.yaml') and not name.startswith('.')]
+
+
+def _get_string(node: ast.expr) -> Optional[str]:
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return None
+
+
+def _get_init_signature(class_name: str) -> Optional[inspect.Signature]:
+    """Returns the constructor signature of a workflow class.
+
+    Constructors which only pass *args and **kwargs on, e.g. those of mixins,
+    are skipped for the first one which names its arguments.
+    """
+    workflow_class = getattr(ari_backup, class_name)
+    for cls in inspect.getmro(workflow_class):
+        if '__init__' not in vars(cls):
+            continue
+        signature = inspect.signature(vars(cls)['__init__'])
+        if any(parameter.kind in (parameter.POSITIONAL_ONLY,
+                                  parameter.POSITIONAL_OR_KEYWORD)
+               for parameter in list(signature.parameters.values())[1:]):
+            return signature
+    return None
+
+
+def _get_call_arguments(node: ast.Call,
+                        class_name: Optional[str]) -> dict[str, str]:
+    """Returns the string arguments of a call by parameter name.
+
+    Positional arguments are only named for calls of workflow classes,
+    whose constructor signature tells their names.
+    """
+    arguments = {keyword.arg: _get_string(keyword.value)
+                 for keyword in node.keywords if keyword.arg}
+    signature = None
+    if (class_name is not None and node.args and
+            not any(isinstance(arg, ast.Starred) for arg in node.args) and
+            all(keyword.arg for keyword in node.keywords)):
+        signature = _get_init_signature(class_name)
+    if signature is not None:
+        try:
+            # None stands in for self.
+            bound = signature.bind_partial(
+                None, *[_get_string(arg) for arg in node.args], **arguments)
+        except TypeError:
+            pass
+        else:
+            arguments = dict()
+            for name, value in list(bound.arguments.items())[1:]:
+                if (signature.parameters[name].kind ==
+                        inspect.Parameter.VAR_KEYWORD):
+                    arguments.update(value)
+                else:
+                    arguments[name] = value
+    return {name: value for name, value in arguments.items()
+            if value is not None}
+
+
+def describe_job(path: str,
+                 default_backup_store_path: Optional[str] = None) -> Job:
+    """Works out the source host and destination of a job from its script.
+
+    Args:
+        path: the job script.
+        default_backup_store_path: the backup_store_path setting, used for
+            jobs which don't set their own.
+
+    Returns:
+        The job. Its source, destination and label are None when they can't
+        be determined, e.g. for job scripts which aren't Python.
+    """
+    try:
+        with open(path) as job_file:
+            source_code = job_file.read()
+    except (OSError, UnicodeDecodeError):
+        return Job(path)
+
+    annotations: dict[str, str] = dict()
+    for match in _ANNOTATION_RE.finditer(source_code):
+        for pair in match.group(1).split():
+            key, _, value = pair.partition('=')
+            annotations[key] = value
+
+    arguments: dict[str, str] = dict()
+    workflow_class = None
+    try:
+        tree = ast.parse(source_code, path)
+    except (SyntaxError, ValueError):
+        tree = None
+    for node in ast.walk(tree) if tree is not None else ():
+        if isinstance(node, ast.Call):
+            name = getattr(node.func, 'attr', getattr(node.func, 'id', None))
+            if name not in _WORKFLOW_CLASSES:
+                name = None
+            elif workflow_class is None:
+                workflow_class = name
+            for argument, value in _get_call_arguments(node, name).items():
+                arguments.setdefault(argument, value)
+        elif isinstance(node, ast.Assign):
+            value = _get_string(node.value)
+            for target in node.targets:
+                if (isinstance(target, ast.Attribute) and
+                        target.attr == 'backup_store_path' and
+                        value is not None):
+                    arguments['backup_store_path'] = value
+
+    source, destination = get_resources(arguments, default_backup_store_path)
+    return Job(path, annotations.get('source', source),
+               annotations.get('destination', destination),
+               annotations.get('label', arguments.get('label')),
+               workflow_class=workflow_class)
+
+
+def get_resources(
+        arguments: dict[str, Any],
+        default_backup_store_path: Optional[str] = None
+        ) -> tuple[Optional[str], Optional[str]]:
+    """Works out the source host and destination of a workflow.
+
+    Args:
+        arguments: the constructor arguments of the workflow, and its
+            backup_store_path if it sets one.
+        default_backup_store_path: the backup_store_path setting.
+
+    Returns:
+        The source host and the destination, either of which may be None.
+    """
+    source = arguments.get('source_hostname')
+    if 'zfs_hostname' in arguments:
+        # ZFS jobs write to a pool on the ZFS host.
+        pool = arguments.get('dataset_name', '').split('/')[0]
+        destination: Optional[str] = '{}:{}'.format(
+            arguments['zfs_hostname'], pool)
+    elif 'rsync_dst' in arguments:
+        destination = arguments['rsync_dst'].split(':')[0]
+    elif source is not None:
+        # rdiff-backup writes to the local backup store.
+        backup_store_path = arguments.get(
+            'backup_store_path', default_backup_store_path)
+        destination = 'localhost:{}'.format(backup_store_path)
+    else:
+        destination = None
+    return source, destination
+
+
+def describe_manifest_job(
+        spec: manifest.JobSpec,
+        default_backup_store_path: Optional[str] = None) -> Job:
+    """Returns the job a manifest defines, with its source and destination.
+    """
+    source, destination = get_resources(
+        spec.arguments, default_backup_store_path)
+    return Job(spec.path, source, destination, spec.label, spec,
+               spec.class_name)
+
+
+def order_jobs(jobs: list[Job],
+               expected_durations: dict[str, float]) -> list[Job]:
+    """Orders jobs longest expected duration first.
+
+    Jobs with no expected duration come first, in their original order.
+
+    Args:
+        jobs: the jobs in run-parts order.
+        expected_durations: expected durations in seconds, keyed by label.
+    """
+    unknown = [job for job in jobs
+               if job.history_label not in expected_durations]
+    known = [job for job in jobs if job.history_label in expected_durations]
+    known.sort(key=lambda job: expected_durations[job.history_label],
+               reverse=True)
+    return unknown + known
+
+
+class Scheduler:
+    """Decides which job may start next within the concurrency limits.
+
+    Jobs are started in order, except that a job whose source host or
+    destination is busy is passed over for the next job which can start.
+    Jobs with an unknown source host or destination are only bound by the
+    global limit for that resource.
+
+    With adaptive limits, the total and per destination limits follow the
+    load of the hosts involved, and jobs against a busy source host are held
+    back while other jobs run.
+
+    With host health tracking, jobs against a source host whose breaker is
+    open are held back. Once only such jobs are left, their hosts are probed
+    one last time and the jobs of those which still don't answer are
+    rejected. See take_rejected().
+
+    The scheduler never waits for a host itself, as it's used under the lock
+    of run_jobs(). Probes of open breakers and fetches of source loads are
+    handed out by take_probes() instead, and the jobs of the host are held
+    back until they finish.
+    """
+
+    def __init__(self,
+                 jobs: list[Job],
+                 max_jobs: int,
+                 max_jobs_per_source: int,
+                 max_jobs_per_destination: int,
+                 limits: Optional[adaptive.AdaptiveLimits] = None,
+                 health: Optional[breaker.HostHealth] = None):
+        self._pending = list(jobs)
+        self._max_jobs = max(1, max_jobs)
+        self._max_jobs_per_source = max(1, max_jobs_per_source)
+        self._max_jobs_per_destination = max(1, max_jobs_per_destination)
+        self._limits = limits
+        self._health = health
+        self._rejected: list[JobResult] = list()
+        self._probes: list[Callable[[], object]] = list()
+        # Hosts given one last probe since a job against them last started.
+        self._last_probed: set[str] = set()
+        self._running = 0
+        self._sources: collections.Counter = collections.Counter()
+        self._destinations: collections.Counter = collections.Counter()
+
+    @property
+    def done(self) -> bool:
+        """Whether every job has been started and has finished."""
+        return not self._pending and not self._running
+
+    @property
+    def poll_interval(self) -> Optional[float]:
+        """Seconds after which next_job() should be retried, if limits or
+        breakers may have changed without a job finishing.
+        """
+        intervals = list()
+        if self._limits is not None:
+            intervals.append(self._limits.interval)
+        if self._health is not None:
+            intervals.append(self._health.probe_interval)
+        return min(intervals) if intervals else None
+
+    def _get_max_jobs(self) -> int:
+        if self._limits is not None:
+            return min(self._max_jobs, self._limits.max_jobs)
+        return self._max_jobs
+
+    def _get_max_jobs_per_destination(self, destination: str) -> int:
+        if self._limits is not None:
+            return min(self._max_jobs_per_destination,
+                       self._limits.get_destination_limit(destination))
+        return self._max_jobs_per_destination
+
+    def _can_start(self, job: Job) -> bool:
+        if (job.source is not None and
+                self._sources[job.source] >= self._max_jobs_per_source):
+            return False
+        if (job.destination is not None and
+                self._destinations[job.destination] >=
+                self._get_max_jobs_per_destination(job.destination)):
+            return False
+        # Checked last since they may have to ask the source host, which
+        # take_probes() hands out rather than wait for.
+        if (self._health is not None and job.source is not None and
+                self._health.is_open(job.source)):
+            if self._health.start_probe(job.source):
+                self._probes.append(
+                    functools.partial(self._health.probe, job.source))
+            return False
+        if (self._limits is not None and self._running and
+                not self._limits.allows_source(job.source)):
+            refresh = self._limits.start_source_refresh(job.source)
+            if refresh is not None:
+                self._probes.append(refresh)
+            return False
+        return True
+
+    def _find_job(self) -> Optional[Job]:
+        for index, job in enumerate(self._pending):
+            if self._can_start(job):
+                return self._pending.pop(index)
+        return None
+
+    def _reject_unreachable(self) -> None:
+        """Rejects the jobs of hosts which still don't answer a probe.
+
+        Hosts which haven't had their last probe yet get it first, and their
+        jobs are rejected by a later call if it fails.
+        """
+        assert self._health is not None
+        hosts = {job.source for job in self._pending
+                 if job.source is not None and
+                 self._health.is_open(job.source)}
+        if any(self._health.is_probing(host) for host in hosts):
+            return
+        unreachable = set()
+        for host in hosts:
+            if host in self._last_probed:
+                unreachable.add(host)
+            elif self._health.start_probe(host, force=True):
+                self._last_probed.add(host)
+                self._probes.append(
+                    functools.partial(self._health.probe, host))
+        pending = list()
+        for job in self._pending:
+            if job.source in unreachable:
+                self._rejected.append(JobResult(
+                    job, 1, 0.0, self._health.get_reason(job.source)))
+            else:
+                pending.append(job)
+        self._pending = pending
+
+    def take_rejected(self) -> list[JobResult]:
+        """Returns the results of the jobs rejected since the last call."""
+        rejected = self._rejected
+        self._rejected = list()
+        return rejected
+
+    def take_probes(self) -> list[Callable[[], object]]:
+        """Returns the probes of hosts handed out since the last call.
+
+        Each must be run without holding up the scheduler, after which
+        next_job() should be called again.
+        """
+        probes = self._probes
+        self._probes = list()
+        return probes
+
+    def next_job(self) -> Optional[Job]:
+        """Returns the next job to start, marking it as running.
+
+        Returns:
+            The job, or None if no job may start until another one finishes
+            or, with adaptive limits, until the limits change.
+        """
+        if self._limits is not None:
+            self._limits.update(self._running, self._destinations)
+        if self._running >= self._get_max_jobs():
+            return None
+        job = self._find_job()
+        if (job is None and not self._running and self._pending and
+                self._health is not None):
+            # Nothing else can run, so rather than wait for the next probe,
+            # give up on the hosts which are still down.
+            self._reject_unreachable()
+            job = self._find_job()
+        if job is not None:
+            self._last_probed.discard(job.source)
+            self._running += 1
+            self._sources[job.source] += 1
+            self._destinations[job.destination] += 1
+        return job
+
+    def finish(self, job: Job) -> None:
+        """Marks a job started by next_job() as finished."""
+        self._running -= 1
+        self._sources[job.source] -= 1
+        self._destinations[job.destination] -= 1
+
+
+class SubprocessJobRunner:
+    """Runs job scripts as subprocesses, letting their output through.
+
+    The job scripts run in the runner's process group, so they get the
+    terminal's SIGINT along with it. stop() passes on a SIGTERM, which only
+    the runner gets.
+    """
+
+    def __init__(self, kill_grace_period: float = 10):
+        """Initializes SubprocessJobRunner.
+
+        Args:
+            kill_grace_period: seconds a job script has to exit after SIGTERM
+                before it is sent SIGKILL.
+        """
+        self.kill_grace_period = kill_grace_period
+        self._processes: set[subprocess.Popen] = set()
+        self._processes_lock = threading.Lock()
+
+    def __call__(self, job: Job) -> JobResult:
+        """Runs a job script and waits for it to exit."""
+        start = time.monotonic()
+        try:
+            process = subprocess.Popen([job.path])
+        except OSError as e:
+            print('Unable to run {}: {}'.format(job.path, e), file=sys.stderr)
+            return JobResult(job, 126, time.monotonic() - start)
+        with self._processes_lock:
+            self._processes.add(process)
+        try:
+            exitcode = process.wait()
+        finally:
+            with self._processes_lock:
+                self._processes.discard(process)
+        return JobResult(job, exitcode, time.monotonic() - start)
+
+    def stop(self) -> None:
+        """Stops the running job scripts.
+
+        They're sent SIGTERM, and SIGKILL if they're still running once
+        kill_grace_period has passed. This blocks until they have exited.
+        """
+        with self._processes_lock:
+            processes = list(self._processes)
+        for process in processes:
+            process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.kill_grace_period
+        for process in processes:
+            try:
+                process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+def _run_job(job: Job) -> JobResult:
+    """Runs a job script, letting its output through."""
+    return SubprocessJobRunner()(job)
+
+
+def _is_python_job(path: str) -> bool:
+    """Whether a job script is run by a Python interpreter."""
+    try:
+        with open(path, 'rb') as job_file:
+            first_line = job_file.readline()
+    except OSError:
+        return False
+    return first_line.startswith(b'#!') and b'python' in first_line
+
+
+class InProcessJobRunner:
+    """Runs jobs in this process where possible, the rest as subprocesses.
+
+    Manifest jobs always run in this process. Python job scripts do too when
+    load_scripts is set. Their workflows are all created up front, so that
+    the workflow modules they use are imported once and from a single
+    thread.
+    """
+
+    def __init__(self,
+                 jobs: list[Job],
+                 load_scripts: bool = True,
+                 kill_grace_period: float = 10):
+        self._interrupted = False
+        self._subprocess_runner = SubprocessJobRunner(kill_grace_period)
+        self._runs: dict[tuple, list[Callable[[], bool]]] = dict()
+        self._load_errors: dict[tuple, Exception] = dict()
+        for job in jobs:
+            try:
+                if job.spec is not None:
+                    self._runs[self._get_key(job)] = [
+                        manifest.build(job.spec).run]
+                elif load_scripts and _is_python_job(job.path):
+                    self._runs[self._get_key(job)] = (
+                        workflow.load_workflows(job.path))
+            except Exception as e:
+                self._load_errors[self._get_key(job)] = e
+
+    @staticmethod
+    def _get_key(job: Job) -> tuple:
+        # Jobs from the same manifest share a path.
+        return job.path, job.label
+
+    def __call__(self, job: Job) -> JobResult:
+        """Runs a job. Jobs which failed to load fail with exit code 1."""
+        key = self._get_key(job)
+        if key in self._load_errors:
+            print('Unable to load {}: {}'.format(
+                job.name, self._load_errors[key]), file=sys.stderr)
+            return JobResult(job, 1, 0.0)
+        if key not in self._runs:
+            return self._subprocess_runner(job)
+        start = time.monotonic()
+        succeeded = True
+        for run in self._runs[key]:
+            if self._interrupted:
+                succeeded = False
+                break
+            try:
+                succeeded = run() and succeeded
+            except Exception as e:
+                print('Unable to run {}: {}'.format(job.name, e),
+                      file=sys.stderr)
+                succeeded = False
+        return JobResult(job, 0 if succeeded else 1, time.monotonic() - start)
+
+    def interrupt(self, stop_subprocesses: bool = False) -> None:
+        """Stops the jobs running in this process, and any more runs of them.
+
+        The interrupted workflows still run their post-job hooks. Their
+        commands run in sessions of their own, so unlike jobs run as
+        subprocesses, they never get the terminal's SIGINT.
+
+        Args:
+            stop_subprocesses: whether to also stop the jobs run as
+                subprocesses. See SubprocessJobRunner.stop(). Leave this
+                unset for a SIGINT from the terminal, which they got too and
+                may be cleaning up after.
+        """
+        self._interrupted = True
+        stopper = None
+        if stop_subprocesses:
+            stopper = threading.Thread(target=self._subprocess_runner.stop)
+            stopper.start()
+        workflow.interrupt_workflows()
+        if stopper is not None:
+            stopper.join()
+
+
+def run_jobs(jobs: list[Job],
+             scheduler: Scheduler,
+             run_job: Callable[[Job], JobResult] = _run_job,
+             on_interrupt: Optional[Callable[[], None]] = None
+             ) -> list[JobResult]:
+    """Runs jobs in threads as the scheduler allows.
+
+    Args:
+        jobs: the jobs to run.
+        scheduler: decides which job may start next.
+        run_job: runs a job and returns its result. Defaults to running the
+            job script as a subprocess.
+        on_interrupt: called when the calling thread is interrupted (e.g. by
+            KeyboardInterrupt), so that the running jobs can be stopped. The
+            jobs are then waited for before the exception propagates, so
+            that they get to clean up.
+
+    Returns:
+        The results in the order the jobs finished.
+    """
+    results: list[JobResult] = list()
+    finished: list[JobResult] = list()
+    condition = threading.Condition()
+    threads: list[threading.Thread] = list()
+
+    def run(job: Job) -> None:
+        result = run_job(job)
+        with condition:
+            finished.append(result)
+            condition.notify()
+
+    def probe(function: Callable[[], object]) -> None:
+        try:
+            function()
+        finally:
+            with condition:
+                condition.notify()
+
+    try:
+        with condition:
+            while not scheduler.done:
+                job = scheduler.next_job()
+                while job is not None:
+                    thread = threading.Thread(target=run, args=(job,))
+                    thread.start()
+                    threads.append(thread)
+                    job = scheduler.next_job()
+                for function in scheduler.take_probes():
+                    threading.Thread(
+                        target=probe, args=(function,), daemon=True).start()
+                rejected = scheduler.take_rejected()
+                results.extend(rejected)
+                if not finished and not rejected:
+                    condition.wait(min(
+                        scheduler.poll_interval or _MAX_WAIT, _MAX_WAIT))
+                for result in finished:
+                    scheduler.finish(result.job)
+                    results.append(result)
+                finished.clear()
+    except BaseException:
+        if on_interrupt is not None:
+            on_interrupt()
+        for thread in threads:
+            thread.join()
+        raise
+    return results
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}h{:02d}m{:02d}s'.format(hours, minutes, seconds)
+    if minutes:
+        return '{}m{:02d}s'.format(minutes, seconds)
+    return '{}s'.format(seconds)
+
+
+def format_summary(results: list[JobResult], elapsed: float) -> str:
+    """Returns a summary of a run with one line per job, slowest first."""
+    failed = [r for r in results if r.exitcode != 0]
+    lines = ['{} jobs ran in {}: {} succeeded, {} failed.'.format(
+        len(results), _format_duration(elapsed), len(results) - len(failed),
+        len(failed))]
+    for result in sorted(results, key=lambda r: r.duration, reverse=True):
+        status = 'OK' if result.exitcode == 0 else 'FAILED ({})'.format(
+            result.exitcode)
+        line = '  {:<12} {:>10}  {}'.format(
+            status, _format_duration(result.duration), result.job.name)
+        if result.reason:
+            line += ': ' + result.reason
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def format_trends(trends: list[history.Trend]) -> str:
+    """Returns a table of job duration trends, regressions first."""
+    lines = ['{:<10} {:>10} {:>10} {:>8} {:>9}  {}'.format(
+        'status', 'last', 'baseline', 'change', 'failures', 'job')]
+    for trend in sorted(trends, key=lambda t: not t.regressed):
+        if trend.regressed:
+            status = 'REGRESSED'
+        elif not trend.last.succeeded:
+            status = 'FAILED'
+        else:
+            status = 'OK'
+        baseline = ('-' if trend.baseline is None else
+                    _format_duration(trend.baseline))
+        change = ('-' if trend.change is None else
+                  '{:+.0%}'.format(trend.change))
+        lines.append('{:<10} {:>10} {:>10} {:>8} {:>9}  {}'.format(
+            status, _format_duration(trend.last.duration), baseline, change,
+            trend.recent_failures, trend.label))
+    return '\n'.join(lines)
+
+
+def load_manifests(
+        paths: list[str]) -> tuple[list[manifest.JobSpec], list[str]]:
+    """Loads job manifests, setting aside the invalid ones.
+
+    Returns:
+        The jobs of the valid manifests, and an error message for each
+        invalid one. A job whose label is already taken is an error too.
+    """
+    specs: list[manifest.JobSpec] = list()
+    errors: list[str] = list()
+    labels: dict[str, str] = dict()
+    for path in paths:
+        try:
+            loaded = manifest.load(path)
+        except (OSError, manifest.ManifestError) as e:
+            errors.append(str(e))
+            continue
+        for spec in loaded:
+            if spec.label in labels:
+                errors.append('Job {!r} is defined in both {} and {}.'.format(
+                    spec.label, labels[spec.label], spec.path))
+                continue
+            labels[spec.label] = spec.path
+            specs.append(spec)
+    return specs, errors
+
+
+def _get_setting(user_settings: dict, name: str):
+    """Returns a workflow flag as a job would see it."""
+    if FLAGS[name].present:
+        return FLAGS[name].value
+    return user_settings.get(name, FLAGS[name].value)
+
+
+def _get_ssh_args_function(
+        user_settings: dict) -> Callable[[str], list[str]]:
+    """Returns a function returning the ssh command prefix for a host.
+
+    The commands the runner runs itself must be quick, so they never prompt
+    and give up on hosts which don't answer.
+    """
+    ssh_path = _get_setting(user_settings, 'ssh_path')
+    ssh_port = _get_setting(user_settings, 'ssh_port')
+    remote_user = _get_setting(user_settings, 'remote_user')
+
+    def get_ssh_args(host: str) -> list[str]:
+        return [ssh_path, '-p', str(ssh_port), '-o', 'BatchMode=yes',
+                '-o', 'ConnectTimeout=10', '{}@{}'.format(remote_user, host)]
+
+    return get_ssh_args
+
+
+def _create_host_health(user_settings: dict) -> breaker.HostHealth:
+    get_ssh_args = _get_ssh_args_function(user_settings)
+
+    def probe(host: str) -> bool:
+        try:
+            return subprocess.run(
+                get_ssh_args(host) + ['true'], stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                timeout=30).returncode == 0
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+
+    return breaker.HostHealth(probe, FLAGS.breaker_threshold,
+                              FLAGS.breaker_probe_interval)
+
+
+def track_health(run_job: Callable[[Job], JobResult],
+                 health: breaker.HostHealth) -> Callable[[Job], JobResult]:
+    """Wraps run_job so that job results feed the source host breakers."""
+    def run(job: Job) -> JobResult:
+        result = run_job(job)
+        if job.source is not None:
+            health.record_result(job.source, result.exitcode == 0)
+        return result
+    return run
+
+
+def _create_adaptive_limits(
+        jobs: list[Job], user_settings: dict) -> adaptive.AdaptiveLimits:
+    get_ssh_args = _get_ssh_args_function(user_settings)
+    destinations = set(job.destination for job in jobs
+                       if job.destination is not None)
+    return adaptive.AdaptiveLimits(
+        FLAGS.max_jobs, FLAGS.max_jobs_per_destination,
+        {destination: adaptive.get_destination_devices(destination)
+         for destination in destinations},
+        target_utilization=FLAGS.target_utilization,
+        max_iowait=FLAGS.max_iowait,
+        max_source_load=FLAGS.max_source_load,
+        source_load=adaptive.SourceLoad(get_ssh_args),
+        interval=FLAGS.adaptive_interval)
+
+
+def run_preflight(jobs: list[Job],
+                  user_settings: dict) -> list[preflight.Check]:
+    """Runs the preflight checks of every host jobs use."""
+    requirements = preflight.get_requirements(
+        (job.workflow_class, job.source, job.destination) for job in jobs)
+    return preflight.run_checks(
+        requirements, _get_ssh_args_function(user_settings),
+        snapshot_suffix=user_settings.get('snapshot_suffix', '-ari_backup'),
+        min_free_space=FLAGS.min_free_space)
+
+
+def reject_failed_jobs(
+        jobs: list[Job],
+        checks: list[preflight.Check]) -> tuple[list[Job], list[JobResult]]:
+    """Sets aside the jobs using a host which failed a preflight check.
+
+    Returns:
+        The jobs which may run, and a result for each job set aside.
+    """
+    failed = preflight.get_failed_hosts(checks)
+    passed: list[Job] = list()
+    rejected: list[JobResult] = list()
+    for job in jobs:
+        destination_host = (job.destination or '').partition(':')[0]
+        check = failed.get(job.source or '') or failed.get(destination_host)
+        if check is None:
+            passed.append(job)
+            continue
+        rejected.append(JobResult(
+            job, 1, 0.0, 'preflight check {} failed on {}: {}'.format(
+                check.name, check.host, check.detail or 'no-go')))
+    return passed, rejected
+
+
+def _load_settings() -> dict:
+    try:
+        return settings.load(workflow.SETTINGS_PATH).values
+    except (OSError, ValueError):
+        return dict()
+
+
+def _get_expected_durations(history_path: Optional[str]) -> dict[str, float]:
+    if not history_path:
+        return dict()
+    try:
+        with history.open_history(history_path) as store:
+            return store.get_expected_durations()
+    except (OSError, sqlite3.Error) as e:
+        print('Unable to read the job history in {}: {}'.format(
+            history_path, e), file=sys.stderr)
+        return dict()
+
+
+def main(argv: list[str]) -> int:
+    """Runs every job in jobs_dir and prints a summary.
+
+    SIGTERM interrupts the run like Ctrl-C does. The running jobs are then
+    stopped, and waited for while they clean up. Job scripts run as
+    subprocesses are passed the SIGTERM, as unlike a SIGINT from the terminal
+    it doesn't reach them otherwise.
+
+    Returns:
+        0 when every job succeeded, 1 otherwise, 2 when another runner is
+        already running, and 130 when the run was interrupted.
+    """
+    del argv  # Unused.
+    user_settings = _load_settings()
+    history_path = FLAGS.history_path or user_settings.get('history_path')
+    if FLAGS.show_trends:
+        if not history_path:
+            print('No history_path is set.', file=sys.stderr)
+            return 1
+        with history.open_history(history_path) as store:
+            print(format_trends(store.get_trends()))
+        return 0
+
+    run_lock_path = FLAGS.run_lock_path
+    lock_dir = _get_setting(user_settings, 'lock_dir')
+    if run_lock_path is None and lock_dir:
+        os.makedirs(lock_dir, exist_ok=True)
+        run_lock_path = locks.get_lock_path(
+            lock_dir, 'run', os.path.abspath(FLAGS.jobs_dir))
+    if run_lock_path is not None:
+        # Held until the process exits.
+        run_lock = locks.FileLock(run_lock_path)
+        try:
+            run_lock.acquire()
+        except locks.LockHeld as e:
+            print('ari-backup is already running: {} exiting...'.format(e))
+            return 2
+
+    default_backup_store_path = user_settings.get('backup_store_path')
+    jobs = [describe_job(path, default_backup_store_path)
+            for path in find_job_paths(FLAGS.jobs_dir)]
+    specs, manifest_errors = load_manifests(
+        find_manifest_paths(FLAGS.jobs_dir))
+    for error in manifest_errors:
+        print(error, file=sys.stderr)
+    jobs.extend(describe_manifest_job(spec, default_backup_store_path)
+                for spec in specs)
+    jobs = order_jobs(jobs, _get_expected_durations(history_path))
+    rejected: list[JobResult] = list()
+    if FLAGS.preflight or FLAGS.preflight_only:
+        checks = run_preflight(jobs, user_settings)
+        print(preflight.format_table(checks))
+        if FLAGS.preflight_only:
+            return 1 if preflight.get_failed_hosts(checks) else 0
+        jobs, rejected = reject_failed_jobs(jobs, checks)
+    limits = None
+    if FLAGS.adaptive_concurrency:
+        limits = _create_adaptive_limits(jobs, user_settings)
+    in_process_runner = InProcessJobRunner(
+        jobs, FLAGS.in_process, FLAGS.kill_grace_period)
+    run_job: Callable[[Job], JobResult] = in_process_runner
+    health = None
+    if FLAGS.breaker_threshold > 0:
+        health = _create_host_health(user_settings)
+        run_job = track_health(run_job, health)
+    scheduler = Scheduler(jobs, FLAGS.max_jobs, FLAGS.max_jobs_per_source,
+                          FLAGS.max_jobs_per_destination, limits, health)
+    start = time.monotonic()
+    terminated = threading.Event()
+
+    def terminate(unused_signum: int, unused_frame) -> None:
+        terminated.set()
+        raise KeyboardInterrupt
+
+    def interrupt() -> None:
+        in_process_runner.interrupt(stop_subprocesses=terminated.is_set())
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        results = rejected + run_jobs(jobs, scheduler, run_job, interrupt)
+    except KeyboardInterrupt:
+        print('Interrupted; the running jobs were stopped.', file=sys.stderr)
+        return 130
+    print(format_summary(results, time.monotonic() - start))
+    if manifest_errors:
+        return 1
+    return 0 if all(r.exitcode == 0 for r in results) else 1
+
+
+def run_main() -> None:
+    """Entry point of the ari-backup-run script."""
+    app.run(main)
@@ -0,0 +1,445 @@
+import os
+import shutil
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from absl import flags
+from absl.testing import absltest
+
+from ari_backup import adaptive
+from ari_backup import breaker
+from ari_backup import history
+from ari_backup import manifest
+from ari_backup import preflight
+from ari_backup import runner
+
+
+FLAGS = flags.FLAGS
+# Keep test runs out of the system lock directory.
+FLAGS.lock_dir = None
+
+
+class RunnerTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.jobs_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.jobs_dir)
+
+    def _write_job(self, name, content, executable=True):
+        path = os.path.join(self.jobs_dir, name)
+        with open(path, 'w') as job_file:
+            job_file.write(content)
+        if executable:
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        return path
+
+    def testFindJobPaths_followsRunPartsRules(self):
+        self._write_job('b-job', '')
+        self._write_job('a_job', '')
+        self._write_job('not-executable', '', executable=False)
+        self._write_job('backup.py', '')
+        self._write_job('editor-backup~', '')
+
+        self.assertEqual(
+            [os.path.basename(p)
+             for p in runner.find_job_paths(self.jobs_dir)],
+            ['a_job', 'b-job'])
+
+    def testDescribeJob_rdiffBackup_usesBackupStorePath(self):
+        path = self._write_job('job', (
+            'import ari_backup\n'
+            'backup = ari_backup.RdiffLVMBackup(\n'
+            '    label="job", source_hostname="db-server")\n'
+            'backup.run()\n'))
+
+        job = runner.describe_job(path, '/backup-store')
+
+        self.assertEqual(job, runner.Job(
+            path, 'db-server', 'localhost:/backup-store', 'job',
+            workflow_class='RdiffLVMBackup'))
+
+    def testDescribeJob_label_readFromWorkflowArguments(self):
+        path = self._write_job('job-script', (
+            'import ari_backup\n'
+            'backup = ari_backup.RdiffBackup(\n'
+            '    label="mybackup", source_hostname="db-server")\n'))
+
+        job = runner.describe_job(path)
+
+        self.assertEqual(job.label, 'mybackup')
+        self.assertEqual(job.history_label, 'mybackup')
+
+    def testDescribeJob_zfsBackup_usesZFSHostAndPool(self):
+        path = self._write_job('job', (
+            'import ari_backup\n'
+            'backup = ari_backup.ZFSLVMBackup(\n'
+            '    label="job", source_hostname="web-server",\n'
+            '    rsync_dst="zfs-host:/tank/job", zfs_hostname="zfs-host",\n'
+            '    dataset_name="tank/backups/job",\n'
+            '    snapshot_expiration_days=30)\n'))
+
+        job = runner.describe_job(path)
+
+        self.assertEqual(job.destination, 'zfs-host:tank')
+
+    def testDescribeManifestJob_zfsBackup_usesZFSHostAndPool(self):
+        spec = manifest.JobSpec(
+            '/jobs/jobs.yaml', 'ZFSLVMBackup',
+            {'label': 'web-server', 'source_hostname': 'web-server',
+             'rsync_dst': 'zfs-host:/tank/web-server',
+             'zfs_hostname': 'zfs-host', 'dataset_name': 'tank/web-server',
+             'snapshot_expiration_days': 30})
+
+        job = runner.describe_manifest_job(spec)
+
+        self.assertEqual(job.name, 'web-server')
+        self.assertEqual((job.source, job.destination, job.label),
+                         ('web-server', 'zfs-host:tank', 'web-server'))
+
+    def testLoadManifests_invalidManifestsSetAside(self):
+        job = ('- {{class: RdiffBackup, label: {}, source_hostname: a}}\n')
+        self._write_job('a.yaml', 'jobs:\n  ' + job.format('job1'))
+        self._write_job('b.yaml', 'jobs:\n  ' + job.format('job1') +
+                        '  ' + job.format('job2'))
+        self._write_job('c.yaml', 'class: FakeBackup\n')
+        self._write_job('.hidden.yaml', 'class: FakeBackup\n')
+        self._write_job('job-script', '')
+
+        specs, errors = runner.load_manifests(
+            runner.find_manifest_paths(self.jobs_dir))
+
+        self.assertEqual([spec.label for spec in specs], ['job1', 'job2'])
+        self.assertLen(errors, 2)
+        self.assertIn("'job1' is defined in both", errors[0])
+        self.assertIn('FakeBackup', errors[1])
+
+    def testDescribeJob_positionalArguments_boundToConstructor(self):
+        rdiff_path = self._write_job('rdiff', (
+            '#!/usr/bin/env python3\n'
+            'import ari_backup\n'
+            'backup = ari_backup.RdiffLVMBackup("db", "db-server")\n'))
+        zfs_path = self._write_job('zfs', (
+            '#!/usr/bin/env python3\n'
+            'import ari_backup\n'
+            'backup = ari_backup.ZFSLVMBackup(\n'
+            '    "web", "web-server", "zfs-host:/tank/web", "zfs-host",\n'
+            '    dataset_name="tank/web", snapshot_expiration_days=7)\n'))
+
+        rdiff_job = runner.describe_job(rdiff_path, '/backup-store')
+        zfs_job = runner.describe_job(zfs_path)
+
+        self.assertEqual(
+            rdiff_job,
+            runner.Job(rdiff_path, 'db-server', 'localhost:/backup-store',
+                       'db', workflow_class='RdiffLVMBackup'))
+        self.assertEqual(
+            zfs_job,
+            runner.Job(zfs_path, 'web-server', 'zfs-host:tank', 'web',
+                       workflow_class='ZFSLVMBackup'))
+
+    def testDescribeJob_annotated_annotationTakesPrecedence(self):
+        path = self._write_job('job', (
+            '#!/bin/sh\n'
+            '# ari-backup: source=fake-host destination=fake-disk\n'
+            'exit 0\n'))
+
+        job = runner.describe_job(path)
+
+        self.assertEqual(job, runner.Job(path, 'fake-host', 'fake-disk'))
+
+    def testRejectFailedJobs_jobsOfNoGoHostsSetAside(self):
+        source_down = runner.Job('job1', 'down-host', 'localhost:/store')
+        destination_full = runner.Job('job2', 'web-server', 'zfs-host:tank')
+        ok = runner.Job('job3', 'db-server', 'localhost:/store')
+        checks = [
+            preflight.Check('down-host', 'ssh', False, 'no answer'),
+            preflight.Check('zfs-host', 'ssh', True),
+            preflight.Check('zfs-host', 'free space tank', False,
+                            '0.2 GiB free'),
+        ]
+
+        passed, rejected = runner.reject_failed_jobs(
+            [source_down, destination_full, ok], checks)
+
+        self.assertEqual(passed, [ok])
+        self.assertEqual([result.job for result in rejected],
+                         [source_down, destination_full])
+        self.assertEqual(
+            rejected[1].reason,
+            'preflight check free space tank failed on zfs-host: '
+            '0.2 GiB free')
+
+    def testOrderJobs_longestExpectedFirstThenUnknownFirst(self):
+        short = runner.Job('/jobs/short', label='short')
+        long = runner.Job('/jobs/long', label='long')
+        new = runner.Job('/jobs/new', label='new')
+        unlabeled = runner.Job('/jobs/unlabeled')
+
+        ordered = runner.order_jobs(
+            [short, long, new, unlabeled],
+            {'short': 60.0, 'long': 3600.0, 'unlabeled': 600.0})
+
+        self.assertEqual(ordered, [new, long, unlabeled, short])
+
+    def testScheduler_sameSourceBusy_startsJobForOtherSource(self):
+        job1 = runner.Job('job1', 'host1', 'disk1')
+        job2 = runner.Job('job2', 'host1', 'disk2')
+        job3 = runner.Job('job3', 'host2', 'disk3')
+        scheduler = runner.Scheduler(
+            [job1, job2, job3], max_jobs=3, max_jobs_per_source=1,
+            max_jobs_per_destination=1)
+
+        self.assertEqual(scheduler.next_job(), job1)
+        self.assertEqual(scheduler.next_job(), job3)
+        self.assertIsNone(scheduler.next_job())
+        scheduler.finish(job1)
+        self.assertEqual(scheduler.next_job(), job2)
+
+    def testScheduler_sameDestinationBusy_waits(self):
+        job1 = runner.Job('job1', 'host1', 'disk1')
+        job2 = runner.Job('job2', 'host2', 'disk1')
+        scheduler = runner.Scheduler(
+            [job1, job2], max_jobs=2, max_jobs_per_source=1,
+            max_jobs_per_destination=1)
+
+        self.assertEqual(scheduler.next_job(), job1)
+        self.assertIsNone(scheduler.next_job())
+
+    def testScheduler_globalLimitReached_waits(self):
+        job1 = runner.Job('job1')
+        job2 = runner.Job('job2')
+        scheduler = runner.Scheduler(
+            [job1, job2], max_jobs=1, max_jobs_per_source=1,
+            max_jobs_per_destination=1)
+
+        self.assertEqual(scheduler.next_job(), job1)
+        self.assertIsNone(scheduler.next_job())
+
+    def testScheduler_adaptiveLimits_busySourceHeldWhileOthersRun(self):
+        limits = mock.Mock(spec=adaptive.AdaptiveLimits)
+        limits.max_jobs = 3
+        limits.get_destination_limit.return_value = 3
+        limits.allows_source.side_effect = lambda source: source != 'busy'
+        job1 = runner.Job('job1', 'busy', 'disk1')
+        job2 = runner.Job('job2', 'busy2', 'disk1')
+        job3 = runner.Job('job3', 'busy', 'disk1')
+        scheduler = runner.Scheduler(
+            [job1, job2, job3], max_jobs=3, max_jobs_per_source=2,
+            max_jobs_per_destination=3, limits=limits)
+
+        # Nothing is running yet, so the busy source isn't held back.
+        self.assertEqual(scheduler.next_job(), job1)
+        self.assertEqual(scheduler.next_job(), job2)
+        self.assertIsNone(scheduler.next_job())
+
+    def testScheduler_adaptiveLimits_lowerThanFixedLimitsApply(self):
+        limits = mock.Mock(spec=adaptive.AdaptiveLimits)
+        limits.max_jobs = 3
+        limits.get_destination_limit.return_value = 1
+        limits.allows_source.return_value = True
+        job1 = runner.Job('job1', 'host1', 'disk1')
+        job2 = runner.Job('job2', 'host2', 'disk1')
+        scheduler = runner.Scheduler(
+            [job1, job2], max_jobs=3, max_jobs_per_source=1,
+            max_jobs_per_destination=2, limits=limits)
+
+        self.assertEqual(scheduler.next_job(), job1)
+        self.assertIsNone(scheduler.next_job())
+        limits.update.assert_called_with(1, mock.ANY)
+
+    def testScheduler_breakerOpen_jobsHeldUntilOnlyTheyAreLeft(self):
+        health = mock.Mock(spec=breaker.HostHealth)
+        health.is_open.side_effect = lambda host: host == 'down-host'
+        health.is_probing.return_value = False
+        # No probe is due until nothing else is left to run.
+        health.start_probe.side_effect = lambda host, force=False: force
+        health.get_reason.return_value = 'fake reason'
+        down_job1 = runner.Job('down1', 'down-host', 'disk1')
+        down_job2 = runner.Job('down2', 'down-host', 'disk2')
+        up_job = runner.Job('up', 'up-host', 'disk3')
+        scheduler = runner.Scheduler(
+            [down_job1, down_job2, up_job], max_jobs=2,
+            max_jobs_per_source=1, max_jobs_per_destination=1, health=health)
+
+        self.assertEqual(scheduler.next_job(), up_job)
+        self.assertIsNone(scheduler.next_job())
+        self.assertEqual(scheduler.take_rejected(), [])
+        self.assertEqual(scheduler.take_probes(), [])
+        scheduler.finish(up_job)
+        self.assertIsNone(scheduler.next_job())
+        self.assertEqual(scheduler.take_rejected(), [])
+
+        # The last probe is left to the caller, and the jobs are only
+        # rejected once it has failed.
+        health.probe.assert_not_called()
+        for probe in scheduler.take_probes():
+            probe()
+        health.probe.assert_called_once_with('down-host')
+        self.assertIsNone(scheduler.next_job())
+
+        self.assertEqual(scheduler.take_rejected(), [
+            runner.JobResult(down_job1, 1, 0.0, 'fake reason'),
+            runner.JobResult(down_job2, 1, 0.0, 'fake reason')])
+        self.assertTrue(scheduler.done)
+
+    def testScheduler_probeDue_handedOutInsteadOfRun(self):
+        health = mock.Mock(spec=breaker.HostHealth)
+        health.is_open.side_effect = lambda host: host == 'down-host'
+        health.start_probe.return_value = True
+        up_job = runner.Job('up', 'up-host', 'disk1')
+        down_job = runner.Job('down', 'down-host', 'disk2')
+        scheduler = runner.Scheduler(
+            [down_job, up_job], max_jobs=2, max_jobs_per_source=1,
+            max_jobs_per_destination=1, health=health)
+
+        self.assertEqual(scheduler.next_job(), up_job)
+
+        health.probe.assert_not_called()
+        probes = scheduler.take_probes()
+        self.assertLen(probes, 1)
+        probes[0]()
+        health.probe.assert_called_once_with('down-host')
+
+    def testRunJobs_sourceHostDown_remainingJobsRejected(self):
+        jobs = [runner.Job(self._write_job(name, '#!/bin/sh\nexit 255\n'),
+                           source='down-host')
+                for name in ['job1', 'job2', 'job3']]
+        health = breaker.HostHealth(lambda host: False, threshold=2)
+        scheduler = runner.Scheduler(jobs, 1, 1, 1, health=health)
+
+        results = runner.run_jobs(
+            jobs, scheduler, runner.track_health(runner._run_job, health))
+
+        self.assertEqual(
+            [(r.job.name, r.exitcode, r.reason is not None) for r in results],
+            [('job1', 255, False), ('job2', 255, False), ('job3', 1, True)])
+
+    def testRunJobs_recordsExitCodes(self):
+        jobs = [runner.Job(self._write_job('ok', '#!/bin/sh\nexit 0\n')),
+                runner.Job(self._write_job('fail', '#!/bin/sh\nexit 3\n'))]
+        scheduler = runner.Scheduler(jobs, 2, 1, 1)
+
+        results = runner.run_jobs(jobs, scheduler)
+
+        self.assertEqual(
+            sorted((r.job.name, r.exitcode) for r in results),
+            [('fail', 3), ('ok', 0)])
+        self.assertTrue(scheduler.done)
+
+    def testRunJobs_interrupted_stopsAndWaitsForRunningJobs(self):
+        jobs = [runner.Job('/jobs/job1'), runner.Job('/jobs/job2')]
+        scheduler = runner.Scheduler(jobs, 2, 2, 2)
+        stopped = threading.Event()
+        cleaned_up = list()
+        both_started = threading.Barrier(3)
+
+        def run_job(job):
+            both_started.wait()
+            stopped.wait(30)
+            time.sleep(0.1)
+            cleaned_up.append(job.name)
+            return runner.JobResult(job, 1, 0.0)
+
+        def interrupt():
+            both_started.wait()
+            # Sent to the main thread, as the process could pass it to any.
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+
+        threading.Thread(target=interrupt).start()
+        with self.assertRaises(KeyboardInterrupt):
+            runner.run_jobs(jobs, scheduler, run_job, stopped.set)
+
+        self.assertCountEqual(cleaned_up, ['job1', 'job2'])
+
+    def testMain_sigterm_stopsSubprocessJobs(self):
+        started_path = os.path.join(self.jobs_dir, 'started')
+        self._write_job('sleeping-job', (
+            '#!/bin/sh\n'
+            'touch {}\n'
+            'exec sleep 60\n').format(started_path))
+        process = subprocess.Popen(
+            [sys.executable, '-c',
+             'from ari_backup import runner; runner.run_main()',
+             '--jobs_dir={}'.format(self.jobs_dir),
+             '--run_lock_path={}'.format(
+                 os.path.join(self.jobs_dir, 'run.lock')),
+             '--kill_grace_period=5'],
+            stderr=subprocess.DEVNULL)
+        self.addCleanup(process.kill)
+        deadline = time.monotonic() + 30
+        while not os.path.exists(started_path):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+        start = time.monotonic()
+        process.send_signal(signal.SIGTERM)
+
+        self.assertEqual(process.wait(timeout=30), 130)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def testInProcessJobRunner_runsPythonJobsInProcess(self):
+        if not FLAGS.is_parsed():
+            FLAGS(['fake_program'])
+        marker_path = os.path.join(self.jobs_dir, 'ran')
+        python_job = runner.Job(self._write_job('python-job', (
+            '#!/usr/bin/env python3\n'
+            'import os\n'
+            'from ari_backup import workflow\n'
+            'backup = workflow.BaseWorkflow(label="fake_backup",\n'
+            '                               settings_path=None)\n'
+            'backup._run_custom_workflow = lambda: open({!r}, "w").close()\n'
+            'backup.run()\n').format(marker_path)))
+        broken_job = runner.Job(self._write_job('broken-job', (
+            '#!/usr/bin/python3\n'
+            'raise RuntimeError("fake error")\n')))
+        shell_job = runner.Job(self._write_job(
+            'shell-job', '#!/bin/sh\nexit 3\n'))
+        jobs = [python_job, broken_job, shell_job]
+
+        run_job = runner.InProcessJobRunner(jobs)
+
+        self.assertFalse(os.path.exists(marker_path))
+        self.assertEqual(
+            [run_job(job).exitcode for job in jobs], [0, 1, 3])
+        self.assertTrue(os.path.exists(marker_path))
+
+    def testFormatSummary_countsFailures(self):
+        results = [runner.JobResult(runner.Job('/jobs/ok'), 0, 65.0),
+                   runner.JobResult(runner.Job('/jobs/fail'), 1, 5.0),
+                   runner.JobResult(runner.Job('/jobs/held'), 1, 0.0,
+                                    'host is down')]
+
+        summary = runner.format_summary(results, 70.0)
+
+        self.assertEqual(summary.splitlines(), [
+            '3 jobs ran in 1m10s: 1 succeeded, 2 failed.',
+            '  OK                1m05s  ok',
+            '  FAILED (1)           5s  fail',
+            '  FAILED (1)           0s  held: host is down',
+        ])
+
+    def testFormatTrends_regressionsFirst(self):
+        trends = [
+            history.Trend('ok-job', history.Run('ok-job', 0, 60, None, True),
+                          60.0, 0, False),
+            history.Trend('slow-job',
+                          history.Run('slow-job', 0, 7200, None, True),
+                          3600.0, 1, True),
+        ]
+
+        self.assertEqual(runner.format_trends(trends).splitlines(), [
+            'status           last   baseline   change  failures  job',
+            'REGRESSED    2h00m00s   1h00m00s    +100%         1  slow-job',
+            'OK              1m00s      1m00s      +0%         0  ok-job',
+        ])
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,198 @@
+"""Loading of user-defined settings, with a compiled cache.
+
+Settings come from a YAML file and from the *.yaml files of a conf.d
+directory next to it, which are merged on top in file name order. Parsing
+YAML and validating the keys on every job start is slow on big fleets, so
+the merged settings are cached with marshal. The cache is keyed by the inode,
+mtime and size of every source file and is rebuilt whenever one changes.
+"""
+from typing import Any, NamedTuple, Optional
+
+import ast
+import functools
+import hashlib
+import marshal
+import os
+import tempfile
+
+import yaml
+
+
+# Bump when the cache format or the validation changes.
+_CACHE_VERSION = 1
+OVERLAY_DIR_NAME = 'conf.d'
+
+
+class Settings(NamedTuple):
+    """Settings loaded from a settings file and its overlays.
+
+    Attributes:
+        values: setting values keyed by flag name.
+        unknown: keys which are not flags of any ari_backup module.
+        from_cache: whether the settings came from the cache, in which case
+            the unknown keys were reported when the cache was built.
+    """
+    values: dict[str, Any]
+    unknown: list[str]
+    from_cache: bool
+
+
+@functools.lru_cache(maxsize=None)
+def get_package_flag_names() -> frozenset[str]:
+    """Returns the names of the flags defined by any ari_backup module.
+
+    The ari_backup package only imports the workflow modules a job uses, so
+    their flags may not be defined yet. The module sources are parsed instead
+    of imported to keep startup fast.
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    names = set()
+    for filename in os.listdir(package_dir):
+        if not filename.endswith('.py') or filename.endswith('_test.py'):
+            continue
+        try:
+            with open(os.path.join(package_dir, filename)) as source:
+                tree = ast.parse(source.read(), filename)
+        except (OSError, SyntaxError):
+            continue
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.Call) and
+                    isinstance(node.func, ast.Attribute) and
+                    node.func.attr.startswith('DEFINE') and node.args and
+                    isinstance(node.args[0], ast.Constant) and
+                    isinstance(node.args[0].value, str)):
+                names.add(node.args[0].value)
+    return frozenset(names)
+
+
+def get_default_cache_dir() -> str:
+    """Returns where settings caches are kept.
+
+    This is $ARI_BACKUP_CACHE_DIR if set, or ari-backup in the XDG cache
+    directory otherwise.
+    """
+    cache_dir = os.environ.get('ARI_BACKUP_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'ari-backup')
+
+
+def _get_sources(path: str) -> list[str]:
+    """Returns the settings file followed by its overlays, in merge order."""
+    overlay_dir = os.path.join(os.path.dirname(path), OVERLAY_DIR_NAME)
+    try:
+        overlays = sorted(
+            name for name in os.listdir(overlay_dir)
+            if name.endswith('.yaml') and not name.startswith('.'))
+    except OSError:
+        overlays = list()
+    return [path] + [os.path.join(overlay_dir, name) for name in overlays]
+
+
+def _get_cache_key(sources: list[str]) -> list:
+    """Returns what must not change for a cached copy of sources to be valid.
+
+    Raises:
+        OSError: when the settings file can't be accessed.
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    key: list = [_CACHE_VERSION, os.stat(package_dir).st_mtime_ns]
+    for source in sources:
+        stat = os.stat(source)
+        key.append((source, stat.st_ino, stat.st_mtime_ns, stat.st_size))
+    return key
+
+
+def _parse(sources: list[str]) -> dict[str, Any]:
+    """Returns the settings of sources merged in order.
+
+    Raises:
+        OSError: when a file can't be read.
+        ValueError: when a file doesn't hold a mapping of settings.
+    """
+    values: dict[str, Any] = dict()
+    for source in sources:
+        with open(source, 'r') as settings_file:
+            loaded = yaml.safe_load(settings_file)
+        if loaded is None:
+            continue
+        if not isinstance(loaded, dict):
+            raise ValueError(
+                '{} must hold a mapping of settings.'.format(source))
+        values.update(loaded)
+    return values
+
+
+def _read_cache(cache_path: str, key: list) -> Optional[tuple]:
+    """Returns the cached (values, unknown) if they match key."""
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached = marshal.load(cache_file)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(cached, dict) or cached.get('key') != key:
+        return None
+    return cached['values'], cached['unknown']
+
+
+def _write_cache(cache_path: str, key: list, values: dict[str, Any],
+                 unknown: list[str]) -> None:
+    """Writes the cache, silently giving up if that isn't possible.
+
+    Settings which marshal can't serialize (e.g. YAML timestamps) are simply
+    never cached.
+    """
+    try:
+        data = marshal.dumps(
+            {'key': key, 'values': values, 'unknown': unknown})
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(
+            dir=cache_dir, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(data)
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except (OSError, ValueError):
+        pass
+
+
+def load(path: str, cache_dir: Optional[str] = None) -> Settings:
+    """Loads the settings in path and its conf.d overlays.
+
+    Args:
+        path: the settings file.
+        cache_dir: where to cache the settings. Defaults to
+            get_default_cache_dir().
+
+    Returns:
+        The merged settings.
+
+    Raises:
+        OSError: when the settings file can't be read.
+        ValueError: when a file doesn't hold a mapping of settings.
+        yaml.YAMLError: when a file isn't valid YAML.
+    """
+    if cache_dir is None:
+        cache_dir = get_default_cache_dir()
+    path = os.path.abspath(path)
+    cache_path = os.path.join(cache_dir, 'settings-{}.marshal'.format(
+        hashlib.sha1(path.encode()).hexdigest()))
+
+    sources = _get_sources(path)
+    key = _get_cache_key(sources)
+    cached = _read_cache(cache_path, key)
+    if cached is not None:
+        values, unknown = cached
+        return Settings(values, unknown, from_cache=True)
+
+    values = _parse(sources)
+    known = get_package_flag_names()
+    unknown = sorted(name for name in values if name not in known)
+    _write_cache(cache_path, key, values, unknown)
+    return Settings(values, unknown, from_cache=False)
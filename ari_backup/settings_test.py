@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from absl.testing import absltest
+
+from ari_backup import settings
+
+
+class LoadTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conf_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.conf_dir)
+        self.cache_dir = os.path.join(self.conf_dir, 'cache')
+        self.settings_path = os.path.join(
+            self.conf_dir, 'ari-backup.conf.yaml')
+
+    def _write(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _load(self):
+        return settings.load(self.settings_path, cache_dir=self.cache_dir)
+
+    def testLoad_overlays_mergedInFileNameOrder(self):
+        self._write(self.settings_path, 'remote_user: base\nssh_port: 22\n')
+        overlay_dir = os.path.join(self.conf_dir, 'conf.d')
+        self._write(os.path.join(overlay_dir, '20-late.yaml'),
+                    'remote_user: late\n')
+        self._write(os.path.join(overlay_dir, '10-early.yaml'),
+                    'remote_user: early\nssh_port: 2222\n')
+        self._write(os.path.join(overlay_dir, 'ignored.txt'),
+                    'remote_user: ignored\n')
+
+        loaded = self._load()
+
+        self.assertEqual(loaded.values,
+                         {'remote_user': 'late', 'ssh_port': 2222})
+
+    def testLoad_unchangedFiles_servedFromCache(self):
+        self._write(self.settings_path, 'remote_user: cached\n')
+        self._load()
+
+        with mock.patch.object(settings.yaml, 'safe_load') as mock_safe_load:
+            loaded = self._load()
+
+        self.assertFalse(mock_safe_load.called)
+        self.assertTrue(loaded.from_cache)
+        self.assertEqual(loaded.values, {'remote_user': 'cached'})
+
+    def testLoad_fileChanged_cacheRebuilt(self):
+        self._write(self.settings_path, 'remote_user: old\n')
+        self._load()
+        self._write(self.settings_path, 'remote_user: new_user\n')
+
+        loaded = self._load()
+
+        self.assertFalse(loaded.from_cache)
+        self.assertEqual(loaded.values, {'remote_user': 'new_user'})
+
+    def testLoad_overlayAdded_cacheRebuilt(self):
+        self._write(self.settings_path, 'remote_user: base\n')
+        self._load()
+        self._write(os.path.join(self.conf_dir, 'conf.d', 'user.yaml'),
+                    'remote_user: overlay\n')
+
+        self.assertEqual(self._load().values, {'remote_user': 'overlay'})
+
+    def testLoad_unknownKey_reportedUntilCached(self):
+        self._write(self.settings_path, 'remote_user: x\nfake_setting: 1\n')
+
+        first = self._load()
+        second = self._load()
+
+        self.assertEqual(first.unknown, ['fake_setting'])
+        self.assertFalse(first.from_cache)
+        self.assertTrue(second.from_cache)
+
+    def testLoad_settingsFileMissing_raisesOSError(self):
+        with self.assertRaises(OSError):
+            self._load()
+
+    def testLoad_notAMapping_raisesValueError(self):
+        self._write(self.settings_path, '- a list\n')
+
+        with self.assertRaises(ValueError):
+            self._load()
+
+    def testGetPackageFlagNames_includesFlagsOfOtherModules(self):
+        self.assertContainsSubset(
+            ['rsync_options', 'snapshot_size', 'rdiff_backup_options'],
+            settings.get_package_flag_names())
+
+
+if __name__ == '__main__':
+    absltest.main()
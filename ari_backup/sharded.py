@@ -0,0 +1,252 @@
+"""rdiff-backup workflow which spreads a large source over several processes.
+
+rdiff-backup runs on a single core, so backing up a large source with many
+top-level directories is CPU bound. ShardedRdiffBackup splits the included
+paths into shards, each backed up by its own rdiff-backup process into its
+own repository under <backup_store_path>/<label>/shard-<k>, several at once.
+
+A path has to stay in the same shard from one run to the next, or its
+history would be split across repositories. Which shard each included path
+belongs to is therefore recorded in <backup_store_path>/<label>/shards.json.
+Paths seen for the first time are measured with du on the source host and
+given to the shards holding the least data, largest first, so that the shards
+stay balanced as paths are added.
+"""
+from typing import Optional
+
+import concurrent.futures
+import contextvars
+import json
+import os
+
+from absl import flags
+
+from ari_backup import rdiff_backup_wrapper
+
+# Like workflow.py, this imports asyncio and metrics where they're used, so
+# that they're only loaded once a job gets to them.
+
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+    'max_shard_workers', 4,
+    'maximum number of rdiff-backup processes a sharded backup runs at once')
+
+_ASSIGNMENTS_FILE = 'shards.json'
+
+
+def parse_du_output(output: str) -> dict[str, int]:
+    """Returns the KiB used by each path in the output of du -sk."""
+    sizes = dict()
+    for line in output.splitlines():
+        size, _, path = line.partition('\t')
+        if path and size.isdigit():
+            sizes[path] = int(size)
+    return sizes
+
+
+def assign_shards(paths: list[str],
+                  shards: int,
+                  sizes: dict[str, int],
+                  assignments: Optional[dict[str, int]] = None
+                  ) -> dict[str, int]:
+    """Assigns paths to shards so that each shard holds about as much data.
+
+    Paths which already have a shard keep it. The others are handed out
+    largest first, each to the shard holding the least data so far.
+
+    Args:
+        paths: the paths to assign.
+        shards: the number of shards.
+        sizes: the size of each path. Paths without one count as empty.
+        assignments: the shard of each path assigned in earlier runs.
+
+    Returns:
+        The shard of each path in paths.
+    """
+    assignments = assignments or dict()
+    result = {path: assignments[path] for path in paths
+              if 0 <= assignments.get(path, -1) < shards}
+    loads = [0] * shards
+    for path, shard in result.items():
+        loads[shard] += sizes.get(path, 0)
+    new_paths = sorted(set(paths) - set(result),
+                       key=lambda path: (-sizes.get(path, 0), path))
+    for path in new_paths:
+        shard = loads.index(min(loads))
+        result[path] = shard
+        loads[shard] += sizes.get(path, 0)
+    return result
+
+
+class ShardedRdiffBackup(rdiff_backup_wrapper.RdiffBackup):
+    """RdiffBackup which backs up its paths with several rdiff-backups."""
+
+    def __init__(self,
+                 label: str,
+                 source_hostname: str,
+                 shards: int = 4,
+                 **kwargs):
+        """Configure a ShardedRdiffBackup object.
+
+        Args:
+            label: label for the backup job.
+            source_hostname: the name of the host with the source data to
+                backup.
+            shards: the number of repositories the paths are spread over.
+                Lowering it later moves the paths of the dropped shards, which
+                then start over without history.
+        """
+        super().__init__(label, source_hostname, **kwargs)
+        self.shards = shards
+
+        # Assign flags to instance vars so they might be easily overridden in
+        # workflow configs.
+        self.max_shard_workers = self._flags.max_shard_workers
+
+    def _get_shard_repository_path(self, shard: int) -> str:
+        return '{}/shard-{}'.format(self._get_repository_path(), shard)
+
+    def _get_assignments_path(self) -> str:
+        return os.path.join(self._get_repository_path(), _ASSIGNMENTS_FILE)
+
+    def _load_assignments(self) -> dict[str, int]:
+        """Returns the shard of each path recorded by earlier runs."""
+        try:
+            with open(self._get_assignments_path()) as assignments_file:
+                return json.load(assignments_file)['paths']
+        except FileNotFoundError:
+            return dict()
+
+    def _save_assignments(self, assignments: dict[str, int]) -> None:
+        path = self._get_assignments_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as assignments_file:
+            json.dump({'shards': self.shards, 'paths': assignments},
+                      assignments_file, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
+
+    def _measure_paths(self, paths: list[str]) -> dict[str, int]:
+        """Returns the KiB used by each path on the source host.
+
+        Paths which can't be measured, e.g. globs, are left out.
+        """
+        result, = self.run_commands(
+            [['du', '-sk', '--'] + paths], self.source_hostname,
+            stop_on_failure=False)
+        return parse_du_output(result.stdout)
+
+    def _get_shard_includes(self) -> dict[int, list[str]]:
+        """Returns the included paths of each shard, assigning new paths.
+
+        The assignments are saved unless in dry_run mode.
+        """
+        saved = self._load_assignments()
+        paths = list(dict.fromkeys(self._includes))
+        unassigned = [path for path in paths
+                      if not 0 <= saved.get(path, -1) < self.shards]
+        sizes = self._measure_paths(paths) if unassigned else dict()
+        assignments = assign_shards(paths, self.shards, sizes, saved)
+        if assignments != saved and not self.dry_run:
+            # Paths no longer included keep their shard in case they return.
+            self._save_assignments(dict(saved, **assignments))
+        shard_includes: dict[int, list[str]] = dict()
+        for path in paths:
+            shard_includes.setdefault(assignments[path], list()).append(path)
+        return dict(sorted(shard_includes.items()))
+
+    def _get_repository_paths(self) -> list[str]:
+        """Returns the repository of each shard paths are assigned to."""
+        shards = sorted(set(self._load_assignments().values()))
+        return [self._get_shard_repository_path(shard) for shard in shards]
+
+    def _run_custom_workflow(self) -> None:
+        """Backs up each shard with its own rdiff-backup, several at once.
+
+        Every shard is run even when others fail, after which the first
+        failure is raised.
+        """
+        self.logger.debug('ShardedRdiffBackup._run_custom_workflow started.')
+        self.session_statistics = None
+        self._choose_ssh_compression()
+        shard_includes = self._get_shard_includes()
+        repositories = [self._get_shard_repository_path(shard)
+                        for shard in shard_includes]
+        commands = [
+            self._get_rdiff_backup_args(includes, repository, progress=True)
+            for includes, repository
+            in zip(shard_includes.values(), repositories)]
+        if not commands:
+            return
+        with self.monitor_progress('rdiff-backup'), \
+                concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max(1, self.max_shard_workers)) as executor:
+            # Each command runs in a copy of the current context so that it's
+            # attributed to the current phase of the run, and its progress to
+            # that of the whole backup.
+            futures = list()
+            try:
+                for command in commands:
+                    futures.append(executor.submit(
+                        contextvars.copy_context().run, self.run_command,
+                        command))
+                concurrent.futures.wait(futures)
+            except BaseException:
+                # E.g. KeyboardInterrupt. Keep shards from starting and stop
+                # those already running, as they'd run on unattended.
+                for future in futures:
+                    future.cancel()
+                self._get_command_runner().terminate()
+                raise
+        sessions = list()
+        error: Optional[BaseException] = None
+        for future, repository in zip(futures, repositories):
+            if future.exception() is not None:
+                error = error or future.exception()
+                continue
+            stdout, unused_stderr = future.result()
+            session = self._get_session_statistics(stdout, repository)
+            if session is not None:
+                sessions.append(session)
+        from ari_backup import metrics
+
+        self._record_statistics(
+            metrics.combine_rdiff_backup_statistics(sessions))
+        if error is not None:
+            raise error
+        self.logger.debug('ShardedRdiffBackup._run_custom_workflow completed.')
+
+    async def _run_custom_workflow_async(self) -> None:
+        """Runs the shards without blocking the event loop."""
+        import asyncio
+
+        await asyncio.to_thread(self._run_custom_workflow)
+
+    def restore(self, path: str, target: str,
+                restore_as_of: str = 'now') -> None:
+        """Restores a backed up path from the shard holding it.
+
+        Args:
+            path: a path on the source, within one of the included paths.
+            target: the local path to restore to.
+            restore_as_of: the point in time to restore, in any of the
+                formats rdiff-backup's --restore-as-of accepts.
+
+        Raises:
+            ValueError: when no shard holds path.
+        """
+        assignments = self._load_assignments()
+        matches = [included for included in assignments
+                   if path == included or
+                   path.startswith(included.rstrip('/') + '/')]
+        if not matches:
+            raise ValueError(
+                '{} is not within any path backed up by {}.'.format(
+                    path, self.label))
+        shard = assignments[max(matches, key=len)]
+        source = os.path.join(
+            self._get_shard_repository_path(shard),
+            os.path.relpath(path, self.top_level_src_dir))
+        self.run_command([self.rdiff_backup_path, '--restore-as-of',
+                          restore_as_of, source, target])
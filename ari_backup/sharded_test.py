@@ -0,0 +1,213 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+from absl import flags
+from absl.testing import absltest
+from absl.testing import flagsaver
+
+from ari_backup import rdiff_backup_wrapper
+from ari_backup import sharded
+from ari_backup import test_lib
+
+
+FLAGS = flags.FLAGS
+# Disable logging to stderr when running tests.
+FLAGS.stderr_logging = False
+# Keep test runs out of the system lock directory.
+FLAGS.lock_dir = None
+
+
+class AssignShardsTest(absltest.TestCase):
+
+    def testAssignShards_largestFirstToLightestShard(self):
+        sizes = {'/a': 100, '/b': 60, '/c': 50, '/d': 10}
+
+        assignments = sharded.assign_shards(
+            ['/d', '/c', '/b', '/a'], 2, sizes)
+
+        self.assertEqual(assignments, {'/a': 0, '/b': 1, '/c': 1, '/d': 0})
+
+    def testAssignShards_assignedPathsKeepTheirShard(self):
+        sizes = {'/a': 100, '/b': 60, '/new': 10}
+
+        assignments = sharded.assign_shards(
+            ['/a', '/b', '/new'], 2, sizes, {'/a': 1, '/b': 1})
+
+        self.assertEqual(assignments, {'/a': 1, '/b': 1, '/new': 0})
+
+    def testAssignShards_shardNoLongerExists_pathReassigned(self):
+        assignments = sharded.assign_shards(['/a'], 2, {}, {'/a': 3})
+
+        self.assertEqual(assignments, {'/a': 0})
+
+    def testParseDuOutput_skipsErrors(self):
+        self.assertEqual(
+            sharded.parse_du_output(
+                '100\t/home\ndu: cannot access \'/x*\': No such file\n'),
+            {'/home': 100})
+
+
+class ShardedRdiffBackupTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(
+            flagsaver.restore_flag_values, flagsaver.save_flag_values())
+        self.backup_store_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.backup_store_path)
+        FLAGS.backup_store_path = self.backup_store_path
+        FLAGS.rdiff_backup_path = '/fake/rdiff-backup'
+        FLAGS.rdiff_backup_options = str()
+        FLAGS.top_level_src_dir = '/'
+        patcher = mock.patch.object(
+            rdiff_backup_wrapper.RdiffBackup, '_check_required_binaries')
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.mock_command_runner = test_lib.GetMockCommandRunner()
+        self.mock_command_runner.run.side_effect = self._run
+
+    def _run(self, args, unused_shell):
+        if args[0] == 'du':
+            return '300\t/srv\n200\t/home\n100\t/etc\n', str(), 0
+        return str(), str(), 0
+
+    def _create_backup(self, **kwargs):
+        return sharded.ShardedRdiffBackup(
+            label='fake_backup', source_hostname='localhost', shards=2,
+            settings_path=None, command_runner=self.mock_command_runner,
+            argv=['fake_program'], **kwargs)
+
+    def _get_rdiff_backup_calls(self):
+        return sorted(
+            call.args[0] for call in self.mock_command_runner.run.mock_calls
+            if call.args and call.args[0][0] == '/fake/rdiff-backup')
+
+    def testRun_backsUpEachShardToItsOwnRepository(self):
+        backup = self._create_backup()
+        for path in ['/etc', '/home', '/srv']:
+            backup.include(path)
+
+        self.assertTrue(backup.run())
+
+        repository = '{}/fake_backup'.format(self.backup_store_path)
+        self.assertEqual(self._get_rdiff_backup_calls(), [
+            ['/fake/rdiff-backup', '--include', '/etc', '--include', '/home',
+             '--exclude', '**', '/', repository + '/shard-1'],
+            ['/fake/rdiff-backup', '--include', '/srv', '--exclude', '**',
+             '/', repository + '/shard-0'],
+        ])
+        with open(os.path.join(repository, 'shards.json')) as shards_file:
+            self.assertEqual(json.load(shards_file)['paths'],
+                             {'/srv': 0, '/home': 1, '/etc': 1})
+
+    def testRun_pathsAlreadyAssigned_notMeasuredAgain(self):
+        backup = self._create_backup()
+        backup.include('/srv')
+        backup.run()
+        self.mock_command_runner.run.reset_mock()
+
+        backup.run()
+
+        self.assertNotIn(
+            'du', [call.args[0][0]
+                   for call in self.mock_command_runner.run.mock_calls
+                   if call.args])
+
+    def testRun_shardFails_otherShardsStillRun(self):
+        def run(args, shell):
+            if args[-1].endswith('shard-0'):
+                return str(), 'fake error', 1
+            return self._run(args, shell)
+        self.mock_command_runner.run.side_effect = run
+        backup = self._create_backup()
+        backup.include('/srv')
+        backup.include('/home')
+
+        self.assertFalse(backup.run())
+
+        self.assertLen(self._get_rdiff_backup_calls(), 2)
+
+    def testRunCustomWorkflow_interrupted_stopsShards(self):
+        terminated = threading.Event()
+        self.mock_command_runner.terminate.side_effect = terminated.set
+
+        def run(args, shell):
+            if args[0] == '/fake/rdiff-backup':
+                terminated.wait(5)
+            return self._run(args, shell)
+        self.mock_command_runner.run.side_effect = run
+        backup = self._create_backup()
+        backup.max_shard_workers = 1
+        backup.include('/srv')
+        backup.include('/home')
+
+        with mock.patch.object(sharded.concurrent.futures, 'wait',
+                               side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                backup._run_custom_workflow()
+
+        self.mock_command_runner.terminate.assert_called_once_with()
+        self.assertLess(len(self._get_rdiff_backup_calls()), 2)
+
+    def testRun_statisticsOfShardsCombined(self):
+        def run(args, shell):
+            if args[0] == '/fake/rdiff-backup':
+                return ('ElapsedTime 10.00 (10 seconds)\n'
+                        'NewFileSize 100 (100 bytes)\n'
+                        'ChangedSourceSize 50 (50 bytes)\n'), str(), 0
+            return self._run(args, shell)
+        self.mock_command_runner.run.side_effect = run
+        backup = self._create_backup()
+        backup.include('/srv')
+        backup.include('/home')
+
+        backup.run()
+
+        self.assertEqual(backup.session_statistics.elapsed_time, 10.0)
+        self.assertEqual(backup.session_statistics.changed_source_size, 100)
+        self.assertEqual(backup.run_report.metrics['transferred_bytes'], 300)
+
+    def testRemoveOlderThan_trimsEveryShard(self):
+        backup = self._create_backup(remove_older_than_timespec='30D')
+        backup.include('/srv')
+        backup.include('/home')
+
+        backup.run()
+
+        trims = [call.args[0][-1]
+                 for call in self.mock_command_runner.run.mock_calls
+                 if call.args and '--remove-older-than' in call.args[0]]
+        repository = '{}/fake_backup'.format(self.backup_store_path)
+        self.assertEqual(trims, [repository + '/shard-0',
+                                 repository + '/shard-1'])
+
+    def testRestore_restoresFromShardHoldingPath(self):
+        backup = self._create_backup()
+        backup.include('/srv')
+        backup.include('/home')
+        backup.run()
+        self.mock_command_runner.run.reset_mock()
+
+        backup.restore('/home/user/notes.txt', '/tmp/notes.txt', '3D')
+
+        self.mock_command_runner.run.assert_called_once_with(
+            ['/fake/rdiff-backup', '--restore-as-of', '3D',
+             '{}/fake_backup/shard-1/home/user/notes.txt'.format(
+                 self.backup_store_path),
+             '/tmp/notes.txt'], False)
+
+    def testRestore_pathNotBackedUp_raisesValueError(self):
+        backup = self._create_backup()
+        backup.include('/home')
+        backup.run()
+
+        with self.assertRaises(ValueError):
+            backup.restore('/homeless/file', '/tmp/file')
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -24,6 +24,8 @@ def GetMockCommandRunner():
     stderr = str()
     returncode = 0
     mock_command_runner.run.return_value = (stdout, stderr, returncode)
+    # Like the real CommandRunner, leave logging of the output to the caller.
+    mock_command_runner.logs_output = False
 
     # Attach the AssertCallsInOrder function as a function on the returned
     # object to make using the AssertCallsInOrder function more convenient (the
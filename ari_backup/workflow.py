@@ -9,20 +9,46 @@ xargs. The base features include:
   jobs
 * logging to syslog
 """
-from typing import Any, Callable, Optional, Union
+from typing import (
+    TYPE_CHECKING, Callable, Iterable, NamedTuple, Optional, Union)
 
+import codecs
+import collections
+import contextlib
+import contextvars
 import copy
+import inspect
+import logging
+import os
+import random
+import re
+import selectors
+import shutil
+import signal
 import subprocess
 import shlex
 import sys
+import tempfile
+import threading
 import time
-import yaml
+import uuid
 
 from absl import app
 from absl import flags
 
+from ari_backup import hooks
+from ari_backup import locks
+from ari_backup import query_cache
+from ari_backup import report
+from ari_backup import settings
 from ari_backup.logger import Logger
 
+# The compression, history, metrics and progress modules, along with asyncio,
+# runpy and sqlite3, are imported where they're used. Most runs need few of
+# them, and every job started from cron pays for the imports.
+if TYPE_CHECKING:
+    import asyncio
+
 
 SETTINGS_PATH = '/etc/ari-backup/ari-backup.conf.yaml'
 
@@ -31,11 +57,137 @@ flags.DEFINE_boolean('debug', False, 'enable debug logging')
 flags.DEFINE_boolean('dry_run', False, 'log actions but do not execute them')
 flags.DEFINE_integer('max_retries', 3, 'number of times to retry a command')
 flags.DEFINE_integer('retry_interval', 5,
-                     'number of seconds between command retries')
+                     'number of seconds before the first command retry')
+flags.DEFINE_float('retry_backoff_multiplier', 2,
+                   'factor by which the wait grows with each command retry')
+flags.DEFINE_integer('max_retry_interval', 300,
+                     'maximum number of seconds between command retries')
+flags.DEFINE_integer(
+    'max_retry_time', None,
+    'number of seconds after the first attempt of a command after which it '
+    'is no longer retried')
+flags.DEFINE_float(
+    'retry_jitter', 0.5,
+    'largest fraction by which the wait before a command retry is randomly '
+    'shortened')
 flags.DEFINE_string('remote_user', 'root', 'username used for SSH sessions')
 flags.DEFINE_string('ssh_path', '/usr/bin/ssh', 'path to ssh binary')
 flags.DEFINE_integer('ssh_port', 22, 'SSH destination port')
+flags.DEFINE_string(
+    'run_report_dir', None,
+    'directory in which a JSON report on where the time of each run went is '
+    'written, as <label>.json')
+flags.DEFINE_string(
+    'metrics_textfile_dir', None,
+    'node_exporter textfile collector directory in which Prometheus metrics '
+    'for each run are written, as <label>.prom')
+flags.DEFINE_string(
+    'history_path', None,
+    'SQLite database in which the duration and outcome of each run are '
+    'recorded, so that ari-backup-run can start the longest jobs first')
+flags.DEFINE_string(
+    'lock_dir', '/var/lock/ari-backup',
+    'directory in which each run locks its label and its backup destination '
+    'so that two runs of the same job or against the same destination never '
+    'overlap')
+flags.DEFINE_integer(
+    'query_cache_ttl', 60,
+    'number of seconds the output of read-only commands run with run_query() '
+    'is reused by the jobs and hooks of this process; 0 disables this')
+flags.DEFINE_integer(
+    'max_hook_workers', 4,
+    'maximum number of hooks run at once when their dependencies allow it')
+flags.DEFINE_integer(
+    'command_timeout', None,
+    'number of seconds after which a running command is stopped')
+flags.DEFINE_integer(
+    'job_timeout', None,
+    'number of seconds after which the pre-job hooks and the backup itself '
+    'are stopped so that the post-job hooks can clean up')
+flags.DEFINE_integer(
+    'kill_grace_period', 10,
+    'number of seconds a stopped command has to exit after SIGTERM before it '
+    'is sent SIGKILL')
+flags.DEFINE_boolean(
+    'ssh_multiplexing', False,
+    'share one SSH ControlMaster connection per remote host for all commands '
+    'run during a job')
+flags.DEFINE_integer(
+    'ssh_master_timeout', 30,
+    'number of seconds opening an SSH ControlMaster connection may take '
+    'before commands connect directly instead')
+flags.DEFINE_integer(
+    'ssh_master_persist', 600,
+    'number of seconds an SSH ControlMaster connection stays open without '
+    'any commands using it, so that a master left behind by a job which '
+    'died goes away on its own')
+flags.DEFINE_boolean(
+    'auto_ssh_compression', False,
+    'decide for each source host whether to compress transfers from it, '
+    'based on a probe of its link and of how well its data compresses, '
+    'instead of following ssh_compression')
+flags.DEFINE_integer(
+    'ssh_compression_probe_ttl', 7 * 24 * 60 * 60,
+    'number of seconds for which the compression decision of a probe is '
+    'reused for the same link')
+flags.DEFINE_string(
+    'ssh_compression_cache_path', None,
+    'JSON file in which compression probes are cached. Defaults to '
+    'ssh-compression.json in the ari-backup cache directory')
 flags.DEFINE_boolean('stderr_logging', True, 'enable error logging to stderr')
+flags.DEFINE_boolean(
+    'stream_command_output', False,
+    'log command output as it arrives instead of when the command exits')
+flags.DEFINE_integer(
+    'command_output_tail_lines', 100,
+    'number of trailing lines of command output kept in memory when it is '
+    'streamed, and logged again when a command fails')
+flags.DEFINE_integer(
+    'max_logged_lines_per_second', 50,
+    'maximum number of lines per second logged from each output stream of a '
+    'command when stream_command_output is enabled')
+flags.DEFINE_integer(
+    'progress_interval', None,
+    'number of seconds between progress reports on running transfers. The '
+    'progress is read from the output of the transfer, so command output is '
+    'streamed while this is set')
+flags.DEFINE_string(
+    'progress_status_dir', None,
+    'directory to which the progress of running transfers is written, one '
+    '<label>.json file per job')
+
+
+# The phase of the run and the retry number of the command being run. These
+# are context variables so that concurrently running hooks each see their own.
+_current_phase: contextvars.ContextVar[Optional[str]] = (
+    contextvars.ContextVar('current_phase', default=None))
+_current_retry: contextvars.ContextVar[int] = (
+    contextvars.ContextVar('current_retry', default=0))
+# While a transfer's progress is monitored, each line of output of the
+# commands it runs is passed to this.
+_output_line_callback: contextvars.ContextVar[
+    Optional[Callable[[str], None]]] = contextvars.ContextVar(
+        'output_line_callback', default=None)
+# Whether streamed commands return their whole output rather than only its
+# tail. See keep_whole_output().
+_whole_output: contextvars.ContextVar[bool] = (
+    contextvars.ContextVar('whole_output', default=False))
+# While load_workflows() runs a job script, the runs it asks for are collected
+# here instead of being carried out.
+_collected_runs: contextvars.ContextVar[Optional[list[Callable[[], bool]]]] = (
+    contextvars.ContextVar('collected_runs', default=None))
+# Whether new workflows get their own copy of FLAGS. See isolated_flags().
+_isolated_flags: contextvars.ContextVar[bool] = (
+    contextvars.ContextVar('isolated_flags', default=False))
+
+# Shared by every workflow in the process, so that queries one job or hook
+# makes are reused by the others.
+_QUERY_CACHE = query_cache.QueryCache()
+
+# The workflows of this process which are running their pre-job hooks or the
+# backup itself. See interrupt_workflows().
+_interruptible_workflows: set['BaseWorkflow'] = set()
+_interruptible_workflows_lock = threading.Lock()
 
 
 class WorkflowError(Exception):
@@ -49,16 +201,309 @@ class CommandNotFound(WorkflowError):
 class NonZeroExitCode(WorkflowError):
     """Raises when subprocess returns a non-zero exitcode."""
 
+    def __init__(self,
+                 message: str,
+                 host: Optional[str] = None,
+                 exitcode: Optional[int] = None,
+                 stderr: Optional[str] = None,
+                 results: Optional[list['CommandResult']] = None):
+        """Initializes NonZeroExitCode.
+
+        Args:
+            message: the error message.
+            host: the host the command ran on.
+            exitcode: the exit code of the command.
+            stderr: the stderr of the command.
+            results: for a batch of commands which stopped early, the results
+                of the commands which ran to completion, in order.
+        """
+        super().__init__(message)
+        self.host = host
+        self.exitcode = exitcode
+        self.stderr = stderr
+        self.results = results or list()
+
+
+class CommandTimeout(WorkflowError):
+    """Raised when a command runs past its deadline and is stopped."""
+
+
+class JobTimeout(WorkflowError):
+    """Raised when a command would start after the job deadline passed."""
+
+
+class JobInterrupted(WorkflowError):
+    """Raised when a command would start after the job was interrupted."""
+
+
+class RetryPolicy:
+    """Decides whether, and after how long, a failed command is retried.
+
+    Only transient failures are retried: SSH failing to reach a remote host,
+    and errors like a device being busy which usually clear up on their own.
+    Any other failure is considered permanent and is raised right away, as
+    retrying it would only delay the inevitable.
+
+    The delay before each retry grows exponentially from initial_interval up
+    to max_interval. Each delay is also shortened by a random fraction of up
+    to jitter, so that many jobs failing at the same moment don't all retry
+    in lockstep.
+    """
+
+    # SSH exits with this code when it fails to connect to the remote host.
+    SSH_ERROR_EXIT_CODE = 255
+
+    # Patterns matched against stderr of failures which are worth retrying.
+    TRANSIENT_ERROR_PATTERNS = (
+        r'device is busy',
+        r'target is busy',
+        r'device or resource busy',
+        r'logical volume .* in use',
+        r"can't remove open logical volume",
+    )
+
+    def __init__(self,
+                 max_retries: int = 3,
+                 initial_interval: float = 5,
+                 multiplier: float = 2,
+                 max_interval: float = 300,
+                 max_total_time: Optional[float] = None,
+                 jitter: float = 0.5,
+                 transient_error_patterns: Optional[tuple[str, ...]] = None):
+        """Initializes RetryPolicy.
+
+        Args:
+            max_retries: the maximum number of times a command is retried.
+            initial_interval: seconds to wait before the first retry.
+            multiplier: factor by which the wait grows with each retry.
+            max_interval: the longest wait before any single retry.
+            max_total_time: seconds after the first attempt after which no
+                more retries are started, or None for no limit.
+            jitter: the largest fraction, between 0 and 1, by which a wait is
+                randomly shortened.
+            transient_error_patterns: regular expressions matched against
+                stderr to recognize transient failures. Defaults to
+                TRANSIENT_ERROR_PATTERNS.
+        """
+        self.max_retries = max_retries
+        self.initial_interval = initial_interval
+        self.multiplier = multiplier
+        self.max_interval = max_interval
+        self.max_total_time = max_total_time
+        self.jitter = jitter
+        if transient_error_patterns is None:
+            transient_error_patterns = self.TRANSIENT_ERROR_PATTERNS
+        self._transient_error_re = re.compile(
+            '|'.join(transient_error_patterns), re.IGNORECASE)
+
+    def is_transient(self, error: Exception) -> bool:
+        """Returns whether error is a failure worth retrying."""
+        if not isinstance(error, NonZeroExitCode):
+            return False
+        if (error.exitcode == self.SSH_ERROR_EXIT_CODE and
+                error.host not in (None, 'localhost')):
+            return True
+        return bool(error.stderr and
+                    self._transient_error_re.search(error.stderr))
+
+    def get_delay(self, retry_number: int) -> float:
+        """Returns the seconds to wait before the given retry.
+
+        Args:
+            retry_number: 1 for the first retry, 2 for the second, and so on.
+        """
+        delay = min(self.max_interval,
+                    self.initial_interval *
+                    self.multiplier ** (retry_number - 1))
+        return delay * (1 - self.jitter * random.random())
+
+
+class CommandResult(NamedTuple):
+    """The outcome of a single command run by BaseWorkflow.run_commands()."""
+    stdout: str
+    stderr: str
+    exitcode: int
+
+
+def _build_batch_script(
+        commands: list[Union[str, list]],
+        marker: str,
+        stop_on_failure: bool) -> str:
+    """Returns a shell script which runs commands and delimits their output.
+
+    Each command runs in a subshell. Both its stdout and its stderr are
+    preceded by a "<marker> begin <index>" line and followed by a "<marker> end
+    <index> <exitcode>" line, where index is the position of the command in
+    commands. A newline is always written before the end line, which
+    _parse_batch_output() removes again, so that output lacking a trailing
+    newline doesn't run into the marker.
+
+    Args:
+        commands: command lines or lists of command line arguments.
+        marker: a token which won't appear in the output of the commands.
+        stop_on_failure: whether the script exits after the first command
+            which exits with a non-zero exit code.
+    """
+    lines = list()
+    for index, command in enumerate(commands):
+        if isinstance(command, list):
+            command = shlex.join(command)
+        elif not isinstance(command, str):
+            raise TypeError(
+                'run_commands: commands must be of type str or list.')
+        lines.append("printf '%s begin %d\\n' {marker} {index}; "
+                     "printf '%s begin %d\\n' {marker} {index} >&2".format(
+                         marker=marker, index=index))
+        lines.append('(\n{command}\n)'.format(command=command))
+        lines.append('rc=$?')
+        lines.append("printf '\\n%s end %d %d\\n' {marker} {index} $rc; "
+                     "printf '\\n%s end %d %d\\n' {marker} {index} $rc "
+                     ">&2".format(marker=marker, index=index))
+        if stop_on_failure:
+            lines.append('[ $rc -eq 0 ] || exit $rc')
+    return '\n'.join(lines) + '\n'
+
+
+def _describe_batch(commands: list[Union[str, list]]) -> str:
+    """Returns a batch of commands as one command line, for the run report."""
+    return '; '.join(
+        command if isinstance(command, str) else shlex.join(command)
+        for command in commands)
+
+
+def _parse_batch_output(
+        output: str, marker: str) -> list[tuple[int, str, int]]:
+    """Splits output from a _build_batch_script() script by command.
+
+    Args:
+        output: the stdout or the stderr of the script.
+        marker: the marker the script was built with.
+
+    Returns:
+        A list of 3-tuples with the index, the output and the exit code of
+        each command which ran to completion.
+    """
+    pattern = re.compile(
+        r'^{marker} begin (\d+)\n(.*?)\n{marker} end \1 (\d+)$'.format(
+            marker=re.escape(marker)),
+        re.DOTALL | re.MULTILINE)
+    return [(int(match.group(1)), match.group(2), int(match.group(3)))
+            for match in pattern.finditer(output)]
+
+
+def _get_last_lines(output: str, count: int) -> str:
+    """Returns the last count lines of output."""
+    if count <= 0:
+        return str()
+    return '\n'.join(output.rstrip('\n').split('\n')[-count:])
+
+
+def _signal_process_group(pid: int, signum: int) -> None:
+    """Sends signum to the process group led by pid, if it still exists."""
+    try:
+        os.killpg(pid, signum)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _has_exited(pid: int) -> bool:
+    """Whether the child process pid has exited, without reaping it."""
+    try:
+        return os.waitid(
+            os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+    except ChildProcessError:
+        # Already reaped.
+        return True
+
 
 class CommandRunner:
     """This class is a simple abstration layer to the subprocess module."""
 
-    def run(self, args: list, shell: bool) -> tuple[str, str, int]:
+    # Whether run() already sends the command output to a logger. When False,
+    # BaseWorkflow.run_command() logs the returned output itself.
+    logs_output = False
+
+    def __init__(self, kill_grace_period: float = 10):
+        """Initializes CommandRunner.
+
+        Args:
+            kill_grace_period: seconds a process has to exit after SIGTERM
+                before it is sent SIGKILL.
+        """
+        self.kill_grace_period = kill_grace_period
+        # Commands may be run from several threads at once, e.g. by hooks
+        # running concurrently, so every running process is tracked.
+        self._processes: set = set()
+        self._processes_lock = threading.Lock()
+
+    def _start_process(self, args: list, shell: bool,
+                       stdin: int) -> subprocess.Popen:
+        """Starts args as a subprocess in a new process group.
+
+        A process group of its own lets terminate() stop everything the
+        command started, not only the command itself. The caller must pass
+        the process to _forget_process() once it has exited.
+
+        Raises:
+            CommandNotFound: when the executable is not found on the file
+                system.
+        """
+        try:
+            process = subprocess.Popen(
+                args, shell=shell, stdin=stdin, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, start_new_session=True)
+        except IOError:
+            raise CommandNotFound('Unable to execute/find {}.'.format(args))
+        with self._processes_lock:
+            self._processes.add(process)
+            # The most recently started process, for use in tests.
+            self._process = process
+        return process
+
+    def _forget_process(self, process: subprocess.Popen) -> None:
+        """Stops tracking a process started by _start_process()."""
+        with self._processes_lock:
+            self._processes.discard(process)
+
+    def _stop_processes(self, processes: list[subprocess.Popen]) -> None:
+        """Stops processes and their process groups.
+
+        The process groups are sent SIGTERM. Whatever is still running once
+        the processes have exited, or once kill_grace_period has passed, is
+        sent SIGKILL. This method blocks until the processes have been reaped.
+        """
+        for process in processes:
+            _signal_process_group(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.kill_grace_period
+        for process in processes:
+            try:
+                process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                pass
+        for process in processes:
+            _signal_process_group(process.pid, signal.SIGKILL)
+            process.wait()
+
+    def _stop_process(self, process: subprocess.Popen) -> None:
+        """Stops a process which ran past its timeout or was interrupted.
+
+        Its pipes are closed too.
+        """
+        self._stop_processes([process])
+        try:
+            process.communicate(timeout=self.kill_grace_period)
+        except (subprocess.TimeoutExpired, ValueError):
+            pass
+
+    def run(self, args: list, shell: bool,
+            timeout: Optional[float] = None) -> tuple[str, str, int]:
         """Runs a command as a subprocess.
 
         Args:
             args: command line arguments to be executed.
             shell: whether to run the command within a shell.
+            timeout: seconds after which the command is stopped the way
+                terminate() does, or None to let it run until it exits.
 
         Returns:
             A 3-tuple containing a str with the stdout, a str with the stderr,
@@ -67,22 +512,522 @@ class CommandRunner:
         Raises:
             CommandNotFound: when the executable is not found on the file
                 system.
+            CommandTimeout: when the command ran past its timeout.
         """
+        process = self._start_process(args, shell, subprocess.PIPE)
         try:
-            self._process = subprocess.Popen(
-                args, shell=shell, stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        except IOError:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self._stop_process(process)
+            raise CommandTimeout(
+                'Stopped {} after {} seconds.'.format(args, timeout))
+        except BaseException:
+            # E.g. KeyboardInterrupt. The process runs in a session of its
+            # own, so the terminal's SIGINT never reached it, and it must be
+            # stopped before it's forgotten and terminate() can't find it.
+            self._stop_process(process)
+            raise
+        finally:
+            self._forget_process(process)
+        return stdout.decode(), stderr.decode(), process.returncode
+
+    def terminate(self):
+        """Stops all running subprocesses and their process groups.
+
+        The process groups are sent SIGTERM. Whatever is still running once
+        the processes have exited, or once kill_grace_period has passed, is
+        sent SIGKILL. This method blocks until the processes have been reaped.
+        """
+        with self._processes_lock:
+            processes = list(self._processes)
+        self._stop_processes(processes)
+
+
+class _OutputStream:
+    """Line splitter, rate limited logger and tail buffer for one pipe."""
+
+    # Partial lines longer than this are flushed as if they were complete so
+    # that a process which never writes a newline can't grow the buffer
+    # without bound.
+    _MAX_LINE_LENGTH = 64 * 1024
+
+    def __init__(self,
+                 logger: Optional[logging.Logger],
+                 level: int,
+                 tail_lines: Optional[int],
+                 max_lines_per_second: int,
+                 on_line: Optional[Callable[[str], None]] = None):
+        """Initializes _OutputStream.
+
+        Args:
+            logger: where complete lines are logged, or None to only keep
+                them.
+            level: the logging level used for lines from this stream.
+            tail_lines: how many of the most recent lines to keep, or None to
+                keep them all.
+            max_lines_per_second: how many lines may be logged in any one
+                second. Lines over this limit are counted but not logged.
+            on_line: called with every line as it arrives, including lines
+                which are ended by a carriage return to be overwritten, like
+                progress meters. Those aren't logged.
+        """
+        self._logger = logger
+        self._on_line = on_line
+        self._level = level
+        self._max_lines_per_second = max_lines_per_second
+        self._decoder = codecs.getincrementaldecoder('utf-8')(
+            errors='replace')
+        self._partial_line = str()
+        self._tail: collections.deque[str] = collections.deque(
+            maxlen=tail_lines)
+        self._window_start = time.monotonic()
+        self._lines_in_window = 0
+        self._suppressed_lines = 0
+
+    def feed(self, data: bytes) -> None:
+        """Consumes a chunk of raw output read from the pipe."""
+        lines = (self._partial_line + self._decoder.decode(data)).split('\n')
+        self._partial_line = lines.pop()
+        if len(self._partial_line) > self._MAX_LINE_LENGTH:
+            lines.append(self._partial_line)
+            self._partial_line = str()
+        for line in lines:
+            self._emit(line)
+        if self._on_line is not None and '\r' in self._partial_line:
+            # Lines overwritten in place are only of interest while the
+            # command runs, so they're passed on and dropped.
+            *updates, self._partial_line = self._partial_line.split('\r')
+            for update in updates:
+                if update:
+                    self._on_line(update)
+
+    def close(self) -> None:
+        """Flushes any buffered partial line once the pipe is closed."""
+        last_line = self._partial_line + self._decoder.decode(b'', final=True)
+        self._partial_line = str()
+        if last_line:
+            self._emit(last_line)
+        self._report_suppressed_lines()
+
+    def get_tail(self) -> str:
+        """Returns the most recent lines seen on this stream."""
+        return '\n'.join(self._tail)
+
+    def _emit(self, line: str) -> None:
+        if self._on_line is not None:
+            # Only the last of the lines overwritten in place is kept.
+            updates = [update for update in line.split('\r') if update]
+            for update in updates:
+                self._on_line(update)
+            line = updates[-1] if updates else str()
+        self._tail.append(line)
+        if self._logger is None:
+            return
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+            self._report_suppressed_lines()
+            self._window_start = now
+            self._lines_in_window = 0
+        if self._lines_in_window < self._max_lines_per_second:
+            self._lines_in_window += 1
+            self._logger.log(self._level, line)
+        else:
+            self._suppressed_lines += 1
+
+    def _report_suppressed_lines(self) -> None:
+        if self._suppressed_lines:
+            self._logger.log(  # type: ignore
+                self._level, '[%d lines of output suppressed]',
+                self._suppressed_lines)
+            self._suppressed_lines = 0
+
+
+class StreamingCommandRunner(CommandRunner):
+    """A CommandRunner which logs command output as it is produced.
+
+    Both pipes are read incrementally instead of waiting on communicate(), so
+    output shows up in the logs while the command is still running. Only a
+    bounded tail of each stream is kept in memory, which is what run() returns
+    and what BaseWorkflow.run_command() reports when a command fails, so that
+    a transfer listing millions of files runs in flat memory. Commands run
+    within keep_whole_output() return their whole output instead.
+    """
+
+    logs_output = True
+
+    _READ_SIZE = 64 * 1024
+
+    def __init__(self,
+                 logger: logging.Logger,
+                 tail_lines: int = 100,
+                 max_lines_per_second: int = 50,
+                 kill_grace_period: float = 10):
+        """Initializes StreamingCommandRunner.
+
+        Args:
+            logger: where command output is logged. Lines from stdout are
+                logged at the DEBUG level and lines from stderr at the WARNING
+                level.
+            tail_lines: how many trailing lines of each stream to keep.
+            max_lines_per_second: how many lines per second may be logged from
+                each stream.
+            kill_grace_period: seconds a process has to exit after SIGTERM
+                before it is sent SIGKILL.
+        """
+        super().__init__(kill_grace_period)
+        self._logger = logger
+        self._tail_lines = tail_lines
+        self._max_lines_per_second = max_lines_per_second
+
+    def run(self, args: list, shell: bool,
+            timeout: Optional[float] = None) -> tuple[str, str, int]:
+        """Runs a command as a subprocess, streaming its output.
+
+        Args:
+            args: command line arguments to be executed.
+            shell: whether to run the command within a shell.
+            timeout: seconds after which the command is stopped the way
+                terminate() does, or None to let it run until it exits.
+
+        Returns:
+            A 3-tuple containing a str with the tail of the stdout, a str with
+            the tail of the stderr, and an int with the return code of the
+            executed process. Within keep_whole_output(), the whole stdout and
+            stderr are returned instead. Lines overwritten in place by a
+            carriage return are left out.
+
+        Raises:
+            CommandNotFound: when the executable is not found on the file
+                system.
+            CommandTimeout: when the command ran past its timeout.
+        """
+        process = self._start_process(args, shell, subprocess.DEVNULL)
+        try:
+            return self._stream(process, args, timeout)
+        except CommandTimeout:
+            raise
+        except BaseException:
+            # See CommandRunner.run().
+            self._stop_process(process)
+            raise
+        finally:
+            self._forget_process(process)
+
+    def _stream(self, process: subprocess.Popen, args: list,
+                timeout: Optional[float]) -> tuple[str, str, int]:
+        """Logs the output of process until it exits. See run()."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        on_line = _output_line_callback.get()
+        tail_lines = None if _whole_output.get() else self._tail_lines
+        stdout = _OutputStream(self._logger, logging.DEBUG, tail_lines,
+                               self._max_lines_per_second, on_line)
+        stderr = _OutputStream(self._logger, logging.WARNING, tail_lines,
+                               self._max_lines_per_second, on_line)
+        streams = {
+            process.stdout.fileno(): stdout,  # type: ignore
+            process.stderr.fileno(): stderr,  # type: ignore
+        }
+        with selectors.DefaultSelector() as selector:
+            for fd in streams:
+                selector.register(fd, selectors.EVENT_READ)
+            while selector.get_map():
+                if deadline is None:
+                    select_timeout = None
+                else:
+                    select_timeout = deadline - time.monotonic()
+                    if select_timeout <= 0:
+                        self._stop_process(process)
+                        for stream in streams.values():
+                            stream.close()
+                        raise CommandTimeout(
+                            'Stopped {} after {} seconds.'.format(
+                                args, timeout))
+                for key, unused_events in selector.select(select_timeout):
+                    data = os.read(key.fd, self._READ_SIZE)
+                    if data:
+                        streams[key.fd].feed(data)
+                    else:
+                        selector.unregister(key.fd)
+                        streams[key.fd].close()
+        process.stdout.close()  # type: ignore
+        process.stderr.close()  # type: ignore
+
+        if deadline is None:
+            returncode = process.wait()
+        else:
+            try:
+                returncode = process.wait(
+                    timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                self._stop_process(process)
+                raise CommandTimeout(
+                    'Stopped {} after {} seconds.'.format(args, timeout))
+        return stdout.get_tail(), stderr.get_tail(), returncode
+
+
+class AsyncCommandRunner(CommandRunner):
+    """A CommandRunner built on asyncio subprocesses.
+
+    run_async() lets an event loop wait on many commands at once without a
+    thread per subprocess. run() is kept as a blocking wrapper so that this
+    class can be used anywhere a CommandRunner is expected.
+
+    The output of commands whose progress is monitored, see
+    BaseWorkflow.monitor_progress(), is read as it arrives, and only a
+    bounded tail of it is kept, as StreamingCommandRunner does.
+    """
+
+    _READ_SIZE = 64 * 1024
+
+    def __init__(self, kill_grace_period: float = 10, tail_lines: int = 100):
+        """Initializes AsyncCommandRunner.
+
+        Args:
+            kill_grace_period: seconds a process has to exit after SIGTERM
+                before it is sent SIGKILL.
+            tail_lines: how many trailing lines of each stream to keep for
+                commands whose progress is monitored.
+        """
+        super().__init__(kill_grace_period)
+        self._tail_lines = tail_lines
+        self._processes: set[asyncio.subprocess.Process] = set()
+
+    async def run_async(
+            self,
+            args: Union[str, list],
+            shell: bool,
+            timeout: Optional[float] = None) -> tuple[str, str, int]:
+        """Runs a command as an asyncio subprocess.
+
+        If the awaiting task is cancelled, the subprocess is stopped before
+        the cancellation is propagated.
+
+        Args:
+            args: command line arguments to be executed.
+            shell: whether to run the command within a shell.
+            timeout: seconds after which the command is stopped, or None to
+                let it run until it exits.
+
+        Returns:
+            A 3-tuple containing a str with the stdout, a str with the stderr,
+            and an int with the return code of the executed process.
+
+        Raises:
+            CommandNotFound: when the executable is not found on the file
+                system.
+            CommandTimeout: when the command ran past its timeout.
+        """
+        import asyncio
+
+        try:
+            if shell:
+                process = await asyncio.create_subprocess_shell(
+                    args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    start_new_session=True)  # type: ignore
+            else:
+                process = await asyncio.create_subprocess_exec(
+                    *args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, start_new_session=True)
+        except OSError:
             raise CommandNotFound('Unable to execute/find {}.'.format(args))
 
-        stdout, stderr = self._process.communicate()
-        return stdout.decode(), stderr.decode(), self._process.returncode
+        self._processes.add(process)
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                self._communicate_async(process), timeout)
+        except asyncio.TimeoutError:
+            await self._stop_process_async(process)
+            raise CommandTimeout(
+                'Stopped {} after {} seconds.'.format(args, timeout))
+        except asyncio.CancelledError:
+            await self._stop_process_async(process)
+            raise
+        finally:
+            self._processes.discard(process)
+        return stdout, stderr, process.returncode  # type: ignore
+
+    async def _communicate_async(
+            self, process: 'asyncio.subprocess.Process') -> tuple[str, str]:
+        """Returns the stdout and stderr of process once it has exited.
+
+        Within monitor_progress(), each line is also passed on as it arrives,
+        and only a tail of the output is returned unless within
+        keep_whole_output().
+        """
+        import asyncio
+
+        on_line = _output_line_callback.get()
+        if on_line is None:
+            stdout, stderr = await process.communicate()
+            return stdout.decode(), stderr.decode()
+        tail_lines = None if _whole_output.get() else self._tail_lines
+        streams = [_OutputStream(None, logging.NOTSET, tail_lines, 0, on_line)
+                   for unused_pipe in range(2)]
+        await asyncio.gather(
+            self._read_async(process.stdout, streams[0]),  # type: ignore
+            self._read_async(process.stderr, streams[1]))  # type: ignore
+        await process.wait()
+        return streams[0].get_tail(), streams[1].get_tail()
+
+    async def _read_async(self, pipe: 'asyncio.StreamReader',
+                          stream: _OutputStream) -> None:
+        """Feeds what is read from pipe to stream until the pipe is closed."""
+        while True:
+            data = await pipe.read(self._READ_SIZE)
+            if not data:
+                break
+            stream.feed(data)
+        stream.close()
+
+    async def _stop_process_async(
+            self, process: 'asyncio.subprocess.Process') -> None:
+        """Stops process and its process group like CommandRunner does."""
+        import asyncio
+
+        _signal_process_group(process.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), self.kill_grace_period)
+        except asyncio.TimeoutError:
+            pass
+        _signal_process_group(process.pid, signal.SIGKILL)
+        await process.wait()
+
+    def run(self, args: list, shell: bool,
+            timeout: Optional[float] = None) -> tuple[str, str, int]:
+        """Runs a command, blocking until it exits. See run_async()."""
+        import asyncio
+
+        return asyncio.run(self.run_async(args, shell, timeout))
 
     def terminate(self):
-        """Sends a SIGTERM to the executed subprocess."""
-        # TODO(jpwoodbu) terminate() doesn't block but it would be nice if it
-        # did, so we should be polling.
-        self._process.terminate()
+        """Stops all running subprocesses and their process groups.
+
+        As with CommandRunner.terminate(), the process groups are sent
+        SIGTERM, and SIGKILL once the processes have exited or once
+        kill_grace_period has passed. The processes are left for their
+        run_async() calls to reap, so this may be called from any thread.
+        """
+        processes = list(self._processes)
+        for process in processes:
+            _signal_process_group(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.kill_grace_period
+        while (time.monotonic() < deadline and
+               not all(_has_exited(process.pid) for process in processes)):
+            time.sleep(0.05)
+        for process in processes:
+            _signal_process_group(process.pid, signal.SIGKILL)
+
+
+async def _run_workflows_async(workflows: list) -> list[bool]:
+    import asyncio
+
+    return await asyncio.gather(
+        *[workflow.run_async() for workflow in workflows])
+
+
+def run_concurrently(workflows: list) -> list[bool]:
+    """Runs several workflows concurrently in one event loop.
+
+    Args:
+        workflows: BaseWorkflow objects to run.
+
+    Returns:
+        A list with the return value of run_async() for each workflow.
+    """
+    import asyncio
+
+    collected = _collected_runs.get()
+    if collected is not None:
+        collected.append(
+            lambda: all(asyncio.run(_run_workflows_async(workflows))))
+        return [True] * len(workflows)
+    return asyncio.run(_run_workflows_async(workflows))
+
+
+def interrupt_workflows() -> None:
+    """Interrupts every workflow of this process which is running a job.
+
+    See BaseWorkflow.interrupt(). The workflows are interrupted at once, and
+    this returns once all of their commands have been stopped.
+    """
+    with _interruptible_workflows_lock:
+        running = list(_interruptible_workflows)
+    threads = [threading.Thread(target=running_workflow.interrupt)
+               for running_workflow in running]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+@contextlib.contextmanager
+def keep_whole_output():
+    """Makes commands run within it return their whole output.
+
+    A StreamingCommandRunner otherwise returns only the tail of the output,
+    which is fine for transfers but not for commands whose output is parsed
+    in full, like the batches of run_commands() or the answers of
+    run_query().
+    """
+    token = _whole_output.set(True)
+    try:
+        yield
+    finally:
+        _whole_output.reset(token)
+
+
+@contextlib.contextmanager
+def isolated_flags():
+    """Gives workflows created within it their own copy of FLAGS.
+
+    Such workflows don't parse argv or change FLAGS, so that one process can
+    hold many jobs. Their copy is taken from FLAGS, which must already have
+    been parsed, with the settings file applied to it. Command line flags
+    therefore apply to every job and take precedence over the settings.
+    """
+    token = _isolated_flags.set(True)
+    try:
+        yield
+    finally:
+        _isolated_flags.reset(token)
+
+
+def load_workflows(path: str) -> list[Callable[[], bool]]:
+    """Loads a job script without running its workflows.
+
+    This lets one process run many jobs, paying for interpreter startup and
+    imports once. The script is run as __main__, but its calls to run(),
+    run_async() and run_concurrently() only record the run and report
+    success. Code which follows those calls therefore runs before the
+    workflows do.
+
+    The workflows the script creates are created within isolated_flags(), so
+    jobs don't see each other's settings.
+
+    Args:
+        path: the job script.
+
+    Returns:
+        A function for each run the script asked for, in order. Calling it
+        carries out the run and returns whether it succeeded.
+
+    Raises:
+        Whatever the script raises, other than SystemExit.
+    """
+    import runpy
+
+    collected: list[Callable[[], bool]] = list()
+    token = _collected_runs.set(collected)
+    try:
+        with isolated_flags():
+            runpy.run_path(path, run_name='__main__')
+    except SystemExit:
+        pass
+    finally:
+        _collected_runs.reset(token)
+    return collected
 
 
 class BaseWorkflow:
@@ -92,7 +1037,8 @@ class BaseWorkflow:
                  label: str,
                  settings_path: Optional[str] = SETTINGS_PATH,
                  command_runner: Optional[CommandRunner] = None,
-                 argv: list[str] = sys.argv):
+                 argv: list[str] = sys.argv,
+                 async_command_runner: Optional[AsyncCommandRunner] = None):
         """Configure a workflow object.
 
         Args:
@@ -105,164 +1051,314 @@ class BaseWorkflow:
             argv: Passed to FLAGS for flags parsing. By default, it's set to
                 sys.argv, but can be overridden for testing. When a test runner
                 is used, there are many flags passed into the interpreter which
-                are invalid according to absl flags.
+                are invalid according to absl flags. It's ignored within
+                isolated_flags().
+            async_command_runner: an instantiated object that provides the
+                AsyncCommandRunner interface or None. It's used by
+                run_command_async(). If None, the AsyncCommandRunner class will
+                be used by default.
         """
         self._settings_path = settings_path
-        # Override default flag values from user provided settings file.
-        self._load_settings()
-        # Since we're not using app.run(), flags like --help won't work unless
-        # we explicitly call define_help_flags() before parsing flags.
-        app.define_help_flags()
-        # Initialize FLAGS. Normally this is done by the main() function but in
-        # the model where the config files are excutable it seems the best
-        # place to do this is here in the BaseWorkflow constructor.
-        FLAGS(argv)
+        if not _isolated_flags.get():
+            self._flags = FLAGS
+            # Override default flag values from user provided settings file.
+            self._load_settings()
+            # Since we're not using app.run(), flags like --help won't work
+            # unless we explicitly call define_help_flags() before parsing
+            # flags.
+            app.define_help_flags()
+            # Initialize FLAGS. Normally this is done by the main() function
+            # but in the model where the config files are excutable it seems
+            # the best place to do this is here in the BaseWorkflow
+            # constructor.
+            FLAGS(argv)
+        else:
+            # Created alongside other jobs, so this workflow gets its own
+            # copy of the already parsed FLAGS rather than changing them for
+            # every job in the process. argv is ignored.
+            self._flags = copy.deepcopy(FLAGS)
+            self._load_settings()
         # Setup logging.
         self.logger = Logger('ari_backup ({label})'.format(label=label),
-                             FLAGS.debug, FLAGS.stderr_logging)
+                             self._flags.debug, self._flags.stderr_logging)
         self.label = label
 
         # Assign flags to instance vars so they might be easily overridden in
         # workflow configs.
-        self.dry_run = FLAGS.dry_run
-        self.max_retries = FLAGS.max_retries
-        self.remote_user = FLAGS.remote_user
-        self.retry_interval = FLAGS.retry_interval
-        self.ssh_path = FLAGS.ssh_path
-        self.ssh_port = FLAGS.ssh_port
+        self.dry_run = self._flags.dry_run
+        self.max_retries = self._flags.max_retries
+        self.remote_user = self._flags.remote_user
+        self.retry_interval = self._flags.retry_interval
+        self.retry_backoff_multiplier = self._flags.retry_backoff_multiplier
+        self.max_retry_interval = self._flags.max_retry_interval
+        self.max_retry_time = self._flags.max_retry_time
+        self.retry_jitter = self._flags.retry_jitter
+        self.ssh_path = self._flags.ssh_path
+        self.ssh_port = self._flags.ssh_port
+        self.ssh_multiplexing = self._flags.ssh_multiplexing
+        self.ssh_master_timeout = self._flags.ssh_master_timeout
+        self.ssh_master_persist = self._flags.ssh_master_persist
+        self.auto_ssh_compression = self._flags.auto_ssh_compression
+        self.ssh_compression_probe_ttl = (
+            self._flags.ssh_compression_probe_ttl)
+        self.ssh_compression_cache_path = (
+            self._flags.ssh_compression_cache_path or os.path.join(
+                settings.get_default_cache_dir(), 'ssh-compression.json'))
+        self.command_timeout = self._flags.command_timeout
+        self.job_timeout = self._flags.job_timeout
+        self.max_hook_workers = self._flags.max_hook_workers
+        self.run_report_dir = self._flags.run_report_dir
+        self.metrics_textfile_dir = self._flags.metrics_textfile_dir
+        self.history_path = self._flags.history_path
+        self.lock_dir = self._flags.lock_dir
+        self.query_cache_ttl = self._flags.query_cache_ttl
+        self.progress_interval = self._flags.progress_interval
+        self.progress_status_dir = self._flags.progress_status_dir
+        self._query_cache = _QUERY_CACHE
+
+        # Describes the last run, once one has started.
+        self.run_report: Optional[report.RunReport] = None
+        self._run_start_time = 0.0
 
         # Initialize hook lists.
-        self._pre_job_hooks: list[tuple[Callable, dict | Callable]] = list()
-        self._post_job_hooks: list[tuple[Callable, dict | Callable]] = list()
+        self._pre_job_hooks: list[hooks.Hook] = list()
+        self._post_job_hooks: list[hooks.Hook] = list()
 
         # Initialize the command runner object.
-        self._command_runner = command_runner or CommandRunner()
-
-    def _get_settings_from_file(self) -> dict:
-        """Returns settings stored as YAML in the configuration file as a dict.
+        # Progress is read from the output of the transfer as it arrives, so
+        # the commands run by monitor_progress() are streamed even when the
+        # others aren't. See _get_command_runner().
+        self._progress_command_runner = command_runner
+        if command_runner is None:
+            if self._flags.stream_command_output:
+                command_runner = self._get_streaming_command_runner()
+            else:
+                command_runner = CommandRunner(self._flags.kill_grace_period)
+            if (self._flags.progress_interval and
+                    not command_runner.logs_output):
+                self._progress_command_runner = (
+                    self._get_streaming_command_runner())
+        self._command_runner = command_runner
+        if self._progress_command_runner is None:
+            self._progress_command_runner = command_runner
+        self._async_command_runner = (
+            async_command_runner or
+            AsyncCommandRunner(self._flags.kill_grace_period,
+                               self._flags.command_output_tail_lines))
+
+        # When set, the time.monotonic() value after which no more commands
+        # may be started. See run().
+        self._job_deadline: Optional[float] = None
+        # Whether interrupt() was called, and whether it may stop commands
+        # right now. Commands run by the post-job hooks are never stopped.
+        self._interrupted = False
+        self._interruptible = False
+        self._interrupt_lock = threading.Lock()
+
+        # SSH ControlMaster sockets keyed by host. A value of None means
+        # opening a master for that host failed and commands connect directly.
+        self._ssh_control_dir: Optional[str] = None
+        self._ssh_control_paths: dict[str, Optional[str]] = dict()
+        self._ssh_control_lock = threading.Lock()
+        # Held while a master connection to the host is opened, so that a
+        # slow host only holds up the commands for that host.
+        self._ssh_host_locks: dict[str, threading.Lock] = dict()
+
+    def _get_settings_from_file(self) -> settings.Settings:
+        """Returns settings stored as YAML in the configuration files.
+
+        These are the settings file and the *.yaml files in the conf.d
+        directory next to it, served from a cache while none of them change.
         """
-        settings: dict[str, Any] = dict()
         if self._settings_path is None:
-            return settings
+            return settings.Settings(dict(), list(), from_cache=False)
         try:
-            with open(self._settings_path, 'r') as settings_file:
-                settings = yaml.safe_load(settings_file)
+            return settings.load(self._settings_path)
         except IOError:
             # We can't log anything yet because self.logger isn't set up yet.
             print('Unable to load {} file. Continuing with default '
                   'settings.'.format(self._settings_path))
-        finally:
-            return settings
+            return settings.Settings(dict(), list(), from_cache=False)
 
     def _load_settings(self) -> None:
-        """Loads user-defined settings."""
-        settings = self._get_settings_from_file()
-        for setting, value in settings.items():
+        """Loads user-defined settings.
+
+        Settings which aren't flags of any ari_backup module are reported
+        when the settings cache is built, rather than by every job.
+        """
+        loaded = self._get_settings_from_file()
+        for setting, value in loaded.values.items():
             try:
-                FLAGS.set_default(setting, value)
-            except AttributeError as e:
+                self._flags.set_default(setting, value)
+            except (AttributeError, flags.UnrecognizedFlagError) as e:
+                # Settings for workflow modules this job doesn't import are
+                # expected in a shared settings file.
+                if setting not in loaded.unknown or loaded.from_cache:
+                    continue
                 # We can't log anything yet because self.logger isn't set up
                 # yet.
                 print('WARNING: Skipping unknown setting in {}: {}'.format(
-                      SETTINGS_PATH, e))
+                      self._settings_path, e))
 
     def add_pre_hook(
-            self, function: Callable, kwargs: Optional[dict] = None) -> None:
+            self,
+            function: Callable,
+            kwargs: Optional[dict | Callable] = None,
+            name: Optional[str] = None,
+            after: Optional[Iterable[str]] = None) -> None:
         """Adds a funtion to the list of hooks run before the main workflow.
 
+        By default a hook runs once all the hooks added before it have
+        finished. Passing after instead lets it run as soon as the named hooks
+        have finished, concurrently with any other hooks which are ready, up
+        to max_hook_workers at once. after=() lets it start right away. Either
+        way, it still runs after the hooks before it which kept the default
+        after, though without depending on their success.
+
         Args:
             function: called when hook is run.
-            kwargs: key word arguments to pass to function.
+            kwargs: key word arguments to pass to function or a callable which
+               returns them for late evaluation.
+            name: name other hooks can refer to in their after argument.
+            after: names of the hooks which must finish before this one starts.
         """
         if kwargs is None:
             kwargs = dict()
-        self._pre_job_hooks.append((function, kwargs))
+        self._pre_job_hooks.append(hooks.Hook(function, kwargs, name, after))
 
     def insert_pre_hook(
             self,
             index: int,
             function: Callable,
-            kwargs: Optional[dict | Callable] = None) -> None:
+            kwargs: Optional[dict | Callable] = None,
+            name: Optional[str] = None,
+            after: Optional[Iterable[str]] = None) -> None:
         """Inserts a funtion to the list of hooks run before the main workflow.
 
         Inserting is most useful if you want to ensure that your hook runs
         first in the list. To do so, pass 0 as the value of index. You can
         technically insert a hook at any position, but it can be difficult to
         know what other hooks have been inserted by the workflow class being
-        used.
+        used. Declaring what the hook runs after, with add_pre_hook(), is
+        usually more robust.
 
         Args:
             index: the positional index at which the hook will be inserted.
             function: called when hook is run.
             kwargs: key word arguments to pass to function or a callable which
                returns them for late evaluation.
+            name: name other hooks can refer to in their after argument.
+            after: names of the hooks which must finish before this one starts.
         """
         if kwargs is None:
             kwargs = dict()
-        self._pre_job_hooks.insert(index, (function, kwargs))
+        self._pre_job_hooks.insert(
+            index, hooks.Hook(function, kwargs, name, after))
 
-    def delete_pre_hook(self, index: int) -> None:
-        """Removes, by index number, a hook run before the main workflow.
+    def delete_pre_hook(self, index: int | str) -> None:
+        """Removes a hook run before the main workflow by index number or name.
 
         Args:
-            index: the positional index at which the hook will be deleted.
+            index: the positional index or the name of the hook to delete.
         """
+        if isinstance(index, str):
+            index = hooks.find_hook(self._pre_job_hooks, index)
         self._pre_job_hooks.pop(index)
 
     def add_post_hook(
             self,
             function: Callable,
-            kwargs: Optional[dict | Callable] = None) -> None:
+            kwargs: Optional[dict | Callable] = None,
+            name: Optional[str] = None,
+            after: Optional[Iterable[str]] = None,
+            undoes: Optional[str] = None) -> None:
         """Adds a funtion to the list of hooks run after the main workflow.
 
+        See add_pre_hook() for how name and after schedule the hook. A hook
+        which cleans up after a pre-job hook should name it in undoes. The
+        cleanup hooks then run in the reverse order of the pre-job hooks they
+        undo, without having to declare what they run after.
+
         Args:
             function: called when hook is run.
             kwargs: key word arguments to pass to function.
+            name: name other hooks can refer to in their after argument.
+            after: names of the hooks which must finish before this one starts.
+            undoes: name of the pre-job hook whose work this hook cleans up.
         """
         if kwargs is None:
             kwargs = dict()
-        self._post_job_hooks.append((function, kwargs))
+        self._post_job_hooks.append(
+            hooks.Hook(function, kwargs, name, after, undoes))
 
     def insert_post_hook(
             self,
             index: int,
             function: Callable,
-            kwargs: Optional[dict] = None) -> None:
+            kwargs: Optional[dict | Callable] = None,
+            name: Optional[str] = None,
+            after: Optional[Iterable[str]] = None,
+            undoes: Optional[str] = None) -> None:
         """Inserts a funtion to the list of hooks run after the main workflow.
 
         Inserting is most useful if you want to ensure that your hook runs
         first in the list. To do so, pass 0 as the value of index. You can
         technically insert a hook at any position, but it can be difficult to
         know what other hooks have been inserted by the workflow class being
-        used.
+        used. Declaring what the hook runs after, with add_post_hook(), is
+        usually more robust.
 
         Args:
             index: the positional index at which the hook will be inserted.
             function: called when hook is run.
             kwargs: key word arguments to pass to function.
+            name: name other hooks can refer to in their after argument.
+            after: names of the hooks which must finish before this one starts.
+            undoes: name of the pre-job hook whose work this hook cleans up.
         """
         if kwargs is None:
             kwargs = dict()
-        self._post_job_hooks.insert(index, (function, kwargs))
+        self._post_job_hooks.insert(
+            index, hooks.Hook(function, kwargs, name, after, undoes))
 
-    def delete_post_hook(self, index: int) -> None:
-        """Removes, by index number, a hook run after the main workflow.
+    def delete_post_hook(self, index: int | str) -> None:
+        """Removes a hook run after the main workflow by index number or name.
 
         Args:
-            index: the positional index at which the hook will be deleted.
+            index: the positional index or the name of the hook to delete.
         """
+        if isinstance(index, str):
+            index = hooks.find_hook(self._post_job_hooks, index)
         self._post_job_hooks.pop(index)
 
     def _process_pre_job_hooks(self) -> None:
-        """Executes pre-job hook functions."""
+        """Executes pre-job hook functions.
+
+        Once a hook fails no more hooks are started. The exception it raised
+        is re-raised after the hooks already running have finished.
+        """
+        self.logger.info('Processing pre-job hooks...')
+
+        def call(hook: hooks.Hook) -> None:
+            with self._phase(self._get_hook_name(hook), 'pre_hook'):
+                hook.function(**self._get_hook_kwargs(hook.kwargs))
+
+        hooks.run_hooks(
+            self._pre_job_hooks, call, self.max_hook_workers,
+            on_interrupt=self._command_runner.terminate)
+
+    async def _process_pre_job_hooks_async(self) -> None:
+        """Executes pre-job hook functions, awaiting any coroutine hooks."""
         self.logger.info('Processing pre-job hooks...')
-        for task in self._pre_job_hooks:
-            hook = task[0]
-            kwargs = task[1]
-            # Support callbacks for late evaluation of kwargs in hooks.
-            if callable(kwargs):
-                kwargs = kwargs()
-            hook(**kwargs)
+
+        async def call(hook: hooks.Hook) -> None:
+            with self._phase(self._get_hook_name(hook), 'pre_hook'):
+                await self._call_hook_async(
+                    hook, self._get_hook_kwargs(hook.kwargs))
+
+        await hooks.run_hooks_async(
+            self._pre_job_hooks, call, self.max_hook_workers,
+            on_interrupt=self._command_runner.terminate)
 
     def _process_post_job_hooks(
             self, error_case: Optional[bool] = None) -> None:
@@ -279,6 +1375,12 @@ class BaseWorkflow:
         operation when error_case is True to avoid reducing the number of
         recovery points in the backup history.
 
+        Unlike pre-job hooks, a failing post-job hook only keeps the hooks
+        which run after it from starting. Other cleanup still happens before
+        the exception is re-raised. The built-in cleanup hooks declare which
+        pre-job hook they undo, so they run in the reverse order of those and
+        are never skipped for an unrelated hook which failed.
+
         Args:
             error_case: whether an error has occurred during the backup.
         """
@@ -287,43 +1389,318 @@ class BaseWorkflow:
         else:
             self.logger.info('Processing post-job hooks...')
 
-        for task in self._post_job_hooks:
-            hook = task[0]
-            kwargs = task[1]
-            # Support callbacks for late evaluation of kwargs in hooks.
-            if callable(kwargs):
-                kwargs = kwargs()
-            kwargs['error_case'] = error_case
-            hook(**kwargs)
+        def call(hook: hooks.Hook) -> None:
+            with self._phase(self._get_hook_name(hook), 'post_hook'):
+                kwargs = self._get_hook_kwargs(hook.kwargs)
+                kwargs['error_case'] = error_case
+                hook.function(**kwargs)
 
-    def run_command(
+        hooks.run_hooks(
+            self._post_job_hooks, call, self.max_hook_workers,
+            stop_on_failure=False,
+            on_interrupt=self._command_runner.terminate,
+            undone_hooks=self._pre_job_hooks)
+
+    async def _process_post_job_hooks_async(
+            self, error_case: Optional[bool] = None) -> None:
+        """Executes post-job hook functions, awaiting any coroutine hooks.
+
+        See _process_post_job_hooks().
+
+        Args:
+            error_case: whether an error has occurred during the backup.
+        """
+        if error_case:
+            self.logger.error('Processing post-job hooks for error case...')
+        else:
+            self.logger.info('Processing post-job hooks...')
+
+        async def call(hook: hooks.Hook) -> None:
+            with self._phase(self._get_hook_name(hook), 'post_hook'):
+                kwargs = self._get_hook_kwargs(hook.kwargs)
+                kwargs['error_case'] = error_case
+                await self._call_hook_async(hook, kwargs)
+
+        await hooks.run_hooks_async(
+            self._post_job_hooks, call, self.max_hook_workers,
+            stop_on_failure=False,
+            on_interrupt=self._command_runner.terminate,
+            undone_hooks=self._pre_job_hooks)
+
+    def _get_hook_name(self, hook: hooks.Hook) -> str:
+        """Returns the name of a hook for use in the run report."""
+        if hook.name is not None:
+            return hook.name
+        return getattr(hook.function, '__name__', repr(hook.function))
+
+    @contextlib.contextmanager
+    def _phase(self, name: str, kind: str):
+        """Records the time spent in the with block as a phase of the run.
+
+        Commands run within the block are attributed to the phase.
+
+        Args:
+            name: the name of the phase.
+            kind: the kind of phase. See report.PhaseRecord.
+        """
+        token = _current_phase.set(name)
+        start = time.monotonic()
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            _current_phase.reset(token)
+            if self.run_report is not None:
+                self.run_report.phases.append(report.PhaseRecord(
+                    name, kind, time.monotonic() - start, succeeded))
+
+    @contextlib.contextmanager
+    def monitor_progress(self, name: str):
+        """Reports the progress of the commands run in the with block.
+
+        Every progress_interval seconds, the files transferred so far are
+        logged and, when progress_status_dir is set, written to <label>.json
+        in it, along with the bytes transferred and the throughput for
+        transfers which report them, like rsync. The progress is read from the
+        output of commands run with run_command(), run_commands() and
+        run_command_async(). Nothing is reported unless progress_interval is
+        set, or in dry_run mode.
+
+        Args:
+            name: what is being transferred, e.g. rsync.
+
+        Yields:
+            The progress.ProgressMonitor, or None when progress isn't
+            reported.
+        """
+        if not self.progress_interval or self.dry_run:
+            yield None
+            return
+        from ari_backup import progress
+
+        status_path = None
+        if self.progress_status_dir:
+            status_path = progress.get_status_path(
+                self.progress_status_dir, self.label)
+        monitor = progress.ProgressMonitor(
+            self.label, name, self.logger, self.progress_interval,
+            status_path)
+        token = _output_line_callback.set(monitor.feed)
+        monitor.start()
+        try:
+            yield monitor
+        finally:
+            _output_line_callback.reset(token)
+            monitor.stop()
+
+    def _get_streaming_command_runner(self) -> StreamingCommandRunner:
+        """Returns a new StreamingCommandRunner configured from the flags."""
+        return StreamingCommandRunner(
+            self.logger, self._flags.command_output_tail_lines,
+            self._flags.max_logged_lines_per_second,
+            self._flags.kill_grace_period)
+
+    def _get_command_runner(self) -> CommandRunner:
+        """Returns the command runner for commands started right now.
+
+        Commands whose progress is monitored by monitor_progress() are run
+        with one which streams their output. All others are run with the
+        command runner given to the constructor, or the default one.
+        """
+        if _output_line_callback.get() is not None:
+            return self._progress_command_runner  # type: ignore
+        return self._command_runner
+
+    def _invalidate_queries(
+            self, command: Union[str, list, None], host: str) -> None:
+        """Drops the cached queries of host if command may change them."""
+        if query_cache.is_mutating(command):
+            self._query_cache.invalidate(host)
+
+    def _record_command(
             self,
-            command: Optional[Union[str, list]],
-            host: str = 'localhost') -> tuple[str, str]:
-        """Runs an arbitrary command on a given host.
+            command: Union[str, list, None],
+            host: str,
+            duration: float,
+            exitcode: Optional[int]) -> None:
+        """Adds a command to the run report, if a run is in progress."""
+        if self.run_report is None:
+            return
+        if not isinstance(command, str):
+            command = ' '.join(str(arg) for arg in command or [])
+        self.run_report.commands.append(report.CommandRecord(
+            command, host, duration, exitcode, _current_retry.get(),
+            _current_phase.get()))
+
+    async def _call_hook_async(self, hook: hooks.Hook, kwargs: dict) -> None:
+        """Calls a hook without blocking the event loop.
+
+        Coroutine functions are awaited directly. Other hooks run in a thread,
+        and if they return an awaitable it is awaited as well.
+
+        A thread can't be cancelled, so when this is cancelled it waits for
+        the thread to finish first. Otherwise the post-job hooks could race a
+        pre-job hook which is still creating or mounting a snapshot.
+        hooks.run_hooks_async() stops the thread's commands meanwhile.
+        """
+        import asyncio
 
-        Given a command line, attempt to execute it on the host named in the
-        host argument via SSH, or locally if host is "localhost".
+        if inspect.iscoroutinefunction(hook.function):
+            await hook.function(**kwargs)
+            return
+        thread = asyncio.ensure_future(
+            asyncio.to_thread(hook.function, **kwargs))
+        try:
+            result = await asyncio.shield(thread)
+        except asyncio.CancelledError:
+            await asyncio.wait([thread])
+            if not thread.cancelled():
+                # Retrieved so that asyncio doesn't log it as unhandled.
+                thread.exception()
+            raise
+        if inspect.isawaitable(result):
+            await result
+
+    def _get_hook_kwargs(self, kwargs: dict | Callable) -> dict:
+        """Returns the kwargs to call a hook with.
 
-        Remote commands are always run through a shell on the remote host.
-        Local commands will be run through a shell only when the command arg is
-        a string. This is partly due to the subprocess.Popen interface
-        recommending passing it args as a string when running a new process
-        within a shell.
+        Args:
+            kwargs: the kwargs the hook was registered with, or a callable
+                which returns them.
+        """
+        # Support callbacks for late evaluation of kwargs in hooks.
+        if callable(kwargs):
+            kwargs = kwargs()
+        return kwargs
+
+    def _get_ssh_args(self, host: str) -> list[str]:
+        """Returns the SSH command line prefix for running commands on host.
+
+        When ssh_multiplexing is enabled, the first call for a host opens a
+        ControlMaster connection to it and the returned arguments route the
+        command through that connection.
+
+        Args:
+            host: the remote host the command will run on.
+        """
+        ssh_args = shlex.split('{ssh} -p {port}'.format(
+            ssh=self.ssh_path, port=self.ssh_port))
+        if self.ssh_multiplexing and not self.dry_run:
+            control_path = self._get_ssh_control_path(host)
+            if control_path is not None:
+                # With ControlMaster=no, ssh still connects directly if the
+                # master has gone away.
+                ssh_args += ['-o', 'ControlMaster=no',
+                             '-o', 'ControlPath=' + control_path]
+        ssh_args.append('{user}@{host}'.format(user=self.remote_user,
+                                               host=host))
+        return ssh_args
+
+    def _get_ssh_control_path(self, host: str) -> Optional[str]:
+        """Returns the ControlMaster socket for host, opening it if needed.
+
+        Args:
+            host: the remote host to connect to.
+
+        Returns:
+            The path to the ControlMaster socket, or None if a master
+            connection could not be established.
+        """
+        with self._ssh_control_lock:
+            if host in self._ssh_control_paths:
+                return self._ssh_control_paths[host]
+            host_lock = self._ssh_host_locks.setdefault(
+                host, threading.Lock())
+        with host_lock:
+            with self._ssh_control_lock:
+                # Another thread may have opened it in the meantime.
+                if host in self._ssh_control_paths:
+                    return self._ssh_control_paths[host]
+                if self._ssh_control_dir is None:
+                    self._ssh_control_dir = tempfile.mkdtemp(
+                        prefix='ari-backup-ssh-')
+                control_path = os.path.join(
+                    self._ssh_control_dir,
+                    str(list(self._ssh_host_locks).index(host)))
+            args = shlex.split('{ssh} -p {port}'.format(
+                ssh=self.ssh_path, port=self.ssh_port)) + [
+                '-o', 'ControlMaster=yes',
+                '-o', 'ControlPath=' + control_path,
+                # Bounded, so that the master exits on its own if the job
+                # dies before _close_ssh_masters() gets to close it.
+                '-o', 'ControlPersist={}s'.format(self.ssh_master_persist),
+                # Fail rather than wait for a password or passphrase nobody
+                # will type, or for a host which doesn't answer.
+                '-o', 'BatchMode=yes',
+                '-o', 'ConnectTimeout={}'.format(self.ssh_master_timeout),
+                # Background the master after authentication and don't run a
+                # remote command.
+                '-f', '-N',
+                '{user}@{host}'.format(user=self.remote_user, host=host),
+            ]
+            self.logger.debug('Opening SSH master connection %r' % args)
+            # The backgrounded master keeps its standard streams open for as
+            # long as it lives, so they must not be pipes we wait on. The
+            # timeout also covers a host which connects but then stalls.
+            try:
+                returncode = subprocess.run(
+                    args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=self.ssh_master_timeout).returncode
+            except (OSError, subprocess.TimeoutExpired):
+                returncode = None
+            if returncode != 0:
+                self.logger.warning(
+                    'Unable to open an SSH master connection to {host}. '
+                    'Commands will connect directly.'.format(host=host))
+                control_path = None
+            with self._ssh_control_lock:
+                self._ssh_control_paths[host] = control_path
+            return control_path
+
+    def _close_ssh_masters(self) -> None:
+        """Closes all ControlMaster connections opened by this workflow."""
+        with self._ssh_control_lock:
+            for host, control_path in self._ssh_control_paths.items():
+                if control_path is None:
+                    continue
+                args = shlex.split('{ssh} -p {port}'.format(
+                    ssh=self.ssh_path, port=self.ssh_port)) + [
+                    '-o', 'ControlPath=' + control_path, '-O', 'exit',
+                    '{user}@{host}'.format(user=self.remote_user, host=host),
+                ]
+                self.logger.debug('Closing SSH master connection %r' % args)
+                try:
+                    subprocess.run(
+                        args, stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                except OSError as e:
+                    self.logger.warning(
+                        'Unable to close the SSH master connection to '
+                        '{host}: {error}'.format(host=host, error=e))
+            self._ssh_control_paths.clear()
+            self._ssh_host_locks.clear()
+            if self._ssh_control_dir is not None:
+                shutil.rmtree(self._ssh_control_dir, ignore_errors=True)
+                self._ssh_control_dir = None
+
+    def _build_command_args(
+            self,
+            command: Optional[Union[str, list]],
+            host: str) -> tuple[Union[str, list], bool]:
+        """Returns the args and shell setting used to run command on host.
 
         Args:
             command: a command line or list of command line arguments to run.
             host: the host on which the command will be executed.
 
         Returns:
-            A 2-tuple containing the stdout and stderr from the executed
-            process.
+            A 2-tuple containing the args to pass to the command runner and
+            a bool for whether they should be run within a shell.
 
         Raises:
             TypeError: when command arg is not a str or a list.
-            CommandNotFound: when the executable is not found on the file
-                system.
-            NonZeroExitCode: when the executable returns a non-zero exit code.
         """
         # Let's avoid mutating the user provided command as it may be a mutable
         # type.
@@ -343,44 +1720,140 @@ class BaseWorkflow:
         # Add SSH arguments if this is a remote command.
         if host != 'localhost':
             shell = False
-            ssh_args = shlex.split('{ssh} -p {port} {user}@{host}'.format(
-                ssh=self.ssh_path, port=self.ssh_port, user=self.remote_user,
-                host=host))
-            args = ssh_args + args  # type: ignore
+            args = self._get_ssh_args(host) + args  # type: ignore
+
+        return args, shell  # type: ignore
+
+    def _execute_command(
+            self,
+            args: Union[str, list],
+            shell: bool,
+            host: str = 'localhost',
+            command: Union[str, list, None] = None) -> tuple[str, str, int]:
+        """Runs fully built args with the command runner.
+
+        Nothing is executed in dry_run mode, in which case empty output and a
+        successful exit code are returned.
 
+        Args:
+            args: the args returned by _build_command_args().
+            shell: whether to run the command within a shell.
+            host: the host the command runs on, for the run report.
+            command: the command as given by the caller, for the run report.
+                Defaults to args.
+
+        Returns:
+            A 3-tuple containing the stdout, the stderr, and the exit code.
+        """
         self.logger.debug('run_command %r' % args)
-        stdout = str()
-        stderr = str()
-        exitcode = 0
-        if not self.dry_run:
-            # We really want to block until our subprocess exists or
-            # KeyboardInterrupt. If we don't, clean-up tasks will likely fail.
-            try:
-                stdout, stderr, exitcode = self._command_runner.run(
-                    args, shell)  # type: ignore
-            except KeyboardInterrupt:
-                # Let's try to stop our subprocess if the user issues a
-                # KeyboardInterrupt.
-                self._command_runner.terminate()
-                # We should re-raise this exception so our caller knows the
-                # user wants to stop the workflow.
-                raise
-
-        if exitcode > 0:
-            error_message = ('[{host}] A command terminated with errors and '
-                             'likely requires intervention. '
-                             'The command attempted was: {command}.').format(
-                                 host=host, command=' '.join(command))
+        start = time.monotonic()
+        result = None
+        try:
+            result = self._run_with_command_runner(args, shell)
+            return result
+        finally:
+            self._invalidate_queries(
+                args if command is None else command, host)
+            self._record_command(
+                args if command is None else command, host,
+                time.monotonic() - start,
+                None if result is None else result[2])
+
+    def _run_with_command_runner(
+            self, args: Union[str, list], shell: bool) -> tuple[str, str, int]:
+        """Runs args with the command runner, or does nothing in dry_run mode.
+        """
+        if self.dry_run:
+            return str(), str(), 0
+        timeout = self._get_command_timeout()
+        command_runner = self._get_command_runner()
+        # We really want to block until our subprocess exists or
+        # KeyboardInterrupt. If we don't, clean-up tasks will likely fail.
+        try:
+            if timeout is None:
+                return command_runner.run(args, shell)  # type: ignore
+            return command_runner.run(
+                args, shell, timeout=timeout)  # type: ignore
+        except KeyboardInterrupt:
+            # Let's try to stop our subprocess if the user issues a
+            # KeyboardInterrupt.
+            command_runner.terminate()
+            # We should re-raise this exception so our caller knows the
+            # user wants to stop the workflow.
+            raise
+
+    def _get_command_timeout(self) -> Optional[float]:
+        """Returns the seconds the next command may run, or None if unlimited.
+
+        This is the command_timeout, shortened to what is left until the job
+        deadline while one is in effect.
+
+        Raises:
+            JobTimeout: when the job deadline has already passed.
+            JobInterrupted: when the job was interrupted and hasn't reached
+                its post-job hooks yet.
+        """
+        if self._interrupted and self._interruptible:
+            raise JobInterrupted('The job was interrupted.')
+        timeouts = list()
+        if self.command_timeout:
+            timeouts.append(self.command_timeout)
+        if self._job_deadline is not None:
+            remaining = self._job_deadline - time.monotonic()
+            if remaining <= 0:
+                raise JobTimeout(
+                    'The job ran past its deadline of {} seconds.'.format(
+                        self.job_timeout))
+            timeouts.append(remaining)
+        return min(timeouts) if timeouts else None
+
+    def _get_command_error_message(
+            self, command: Union[str, list], host: str) -> str:
+        """Returns the message used to report a failed command."""
+        if not isinstance(command, str):
+            command = ' '.join(command)
+        return ('[{host}] A command terminated with errors and likely '
+                'requires intervention. The command attempted was: '
+                '{command}.').format(host=host, command=command)
+
+    def _log_command_output(
+            self,
+            stdout: str,
+            stderr: str,
+            failed: bool,
+            command_runner: Optional[CommandRunner] = None) -> None:
+        """Logs the output of a command at a level fitting its outcome.
 
+        Args:
+            stdout: the stdout of the command.
+            stderr: the stderr of the command.
+            failed: whether the command exited with a non-zero exit code.
+            command_runner: the command runner which ran the command. Defaults
+                to the one _get_command_runner() returns.
+        """
+        if command_runner is None:
+            command_runner = self._get_command_runner()
+        if failed:
             # Since this is an error, let's make sure the error message gets
             # written at the error log level so that the user can find it
             # without too much digging.
+            if command_runner.logs_output:
+                # The whole output has already been logged as it arrived, so
+                # only its end, where the error usually is, is repeated.
+                stdout = _get_last_lines(
+                    stdout, self._flags.command_output_tail_lines)
+                stderr = _get_last_lines(
+                    stderr, self._flags.command_output_tail_lines)
             if stdout:
                 self.logger.error(stdout)
             if stderr:
                 self.logger.error(stderr)
+            return
 
-            raise NonZeroExitCode(error_message)
+        # Streaming command runners have already logged the output as it
+        # arrived.
+        if command_runner.logs_output:
+            return
 
         if stdout:
             self.logger.debug(stdout)
@@ -389,23 +1862,557 @@ class BaseWorkflow:
             # the exitcode.
             self.logger.warning(stderr)
 
+    def run_command(
+            self,
+            command: Optional[Union[str, list]],
+            host: str = 'localhost') -> tuple[str, str]:
+        """Runs an arbitrary command on a given host.
+
+        Given a command line, attempt to execute it on the host named in the
+        host argument via SSH, or locally if host is "localhost".
+
+        Remote commands are always run through a shell on the remote host.
+        Local commands will be run through a shell only when the command arg is
+        a string. This is partly due to the subprocess.Popen interface
+        recommending passing it args as a string when running a new process
+        within a shell.
+
+        Args:
+            command: a command line or list of command line arguments to run.
+            host: the host on which the command will be executed.
+
+        Returns:
+            A 2-tuple containing the stdout and stderr from the executed
+            process.
+
+        Raises:
+            TypeError: when command arg is not a str or a list.
+            CommandNotFound: when the executable is not found on the file
+                system.
+            NonZeroExitCode: when the executable returns a non-zero exit code.
+        """
+        args, shell = self._build_command_args(command, host)
+        stdout, stderr, exitcode = self._execute_command(
+            args, shell, host, command)
+
+        if exitcode != 0:
+            self._log_command_output(stdout, stderr, failed=True)
+            raise NonZeroExitCode(
+                self._get_command_error_message(command, host),  # type: ignore
+                host=host, exitcode=exitcode, stderr=stderr)
+
+        self._log_command_output(stdout, stderr, failed=False)
         return stdout, stderr
 
-    def run_command_with_retries(self, command, host='localhost',
-                                 try_number=1):
-        """Runs a command retrying on failure up to self.max_retries."""
+    async def run_command_async(
+            self,
+            command: Optional[Union[str, list]],
+            host: str = 'localhost') -> tuple[str, str]:
+        """Runs an arbitrary command on a given host without blocking.
+
+        This is the coroutine version of run_command(), which it behaves like
+        in every other respect. The command is run with the async command
+        runner so the event loop is free to drive other commands and
+        workflows while it runs.
+
+        Args:
+            command: a command line or list of command line arguments to run.
+            host: the host on which the command will be executed.
+
+        Returns:
+            A 2-tuple containing the stdout and stderr from the executed
+            process.
+
+        Raises:
+            TypeError: when command arg is not a str or a list.
+            CommandNotFound: when the executable is not found on the file
+                system.
+            NonZeroExitCode: when the executable returns a non-zero exit code.
+        """
+        args, shell = self._build_command_args(command, host)
+        self.logger.debug('run_command %r' % args)
+        stdout = str()
+        stderr = str()
+        exitcode: Optional[int] = None
+        start = time.monotonic()
         try:
-            return self.run_command(command, host)
-        except Exception as e:
-            if try_number > self.max_retries:
-                raise e
-            time.sleep(self.retry_interval)
-            return self.run_command_with_retries(command, host, try_number + 1)
+            if self.dry_run:
+                exitcode = 0
+            else:
+                timeout = self._get_command_timeout()
+                if timeout is None:
+                    stdout, stderr, exitcode = (
+                        await self._async_command_runner.run_async(
+                            args, shell))
+                else:
+                    stdout, stderr, exitcode = (
+                        await self._async_command_runner.run_async(
+                            args, shell, timeout=timeout))
+        finally:
+            self._invalidate_queries(command, host)
+            self._record_command(
+                command, host, time.monotonic() - start, exitcode)
+
+        if exitcode != 0:
+            self._log_command_output(
+                stdout, stderr, failed=True,
+                command_runner=self._async_command_runner)
+            raise NonZeroExitCode(
+                self._get_command_error_message(command, host),  # type: ignore
+                host=host, exitcode=exitcode, stderr=stderr)
+
+        self._log_command_output(stdout, stderr, failed=False,
+                                 command_runner=self._async_command_runner)
+        return stdout, stderr
+
+    def run_commands(
+            self,
+            commands: list[Union[str, list]],
+            host: str = 'localhost',
+            stop_on_failure: bool = True) -> list[CommandResult]:
+        """Runs several commands on a host, using one SSH session if remote.
+
+        Remote commands are wrapped in a single shell script which marks the
+        start and end of each command's output, so the whole list costs one
+        round-trip to the host instead of one per command. Local commands are
+        simply run one after another.
+
+        Unlike run_command(), a command exiting with a non-zero exit code does
+        not raise. Callers should inspect the exitcode of each result.
+
+        Args:
+            commands: command lines or lists of command line arguments to run,
+                in order.
+            host: the host on which the commands will be executed.
+            stop_on_failure: whether to skip the remaining commands once one
+                exits with a non-zero exit code.
+
+        Returns:
+            A list with one CommandResult for each command that was run, in
+            the order of commands. When stop_on_failure is True and a command
+            fails, its result is the last one in the list.
+
+        Raises:
+            TypeError: when a command is not a str or a list.
+            CommandNotFound: when the executable is not found on the file
+                system.
+            NonZeroExitCode: when the batch did not run to completion on the
+                remote host (e.g. SSH failed to connect or the connection
+                dropped). Its results attribute holds the results of the
+                commands which did complete.
+        """
+        if not commands:
+            return list()
+
+        # Callers parse the output of each command, and the markers of a
+        # batch must survive, so none of it may be cut to a tail.
+        if host == 'localhost':
+            results = list()
+            for command in commands:
+                args, shell = self._build_command_args(command, host)
+                with keep_whole_output():
+                    result = CommandResult(
+                        *self._execute_command(args, shell, host, command))
+                self._log_command_output(
+                    result.stdout, result.stderr, failed=result.exitcode != 0)
+                results.append(result)
+                if result.exitcode != 0 and stop_on_failure:
+                    break
+            return results
+
+        marker = 'ari-backup-batch-{}'.format(uuid.uuid4().hex)
+        script = _build_batch_script(commands, marker, stop_on_failure)
+        # The remote shell parses the command line SSH sends it, so the
+        # script must be quoted to reach sh intact.
+        args = self._get_ssh_args(host) + ['sh', '-c', shlex.quote(script)]
+        with keep_whole_output():
+            stdout, stderr, exitcode = self._execute_command(
+                args, False, host, _describe_batch(commands))
+        if self.dry_run:
+            return [CommandResult(str(), str(), 0) for _ in commands]
+
+        stdout_parts = _parse_batch_output(stdout, marker)
+        stderr_parts = _parse_batch_output(stderr, marker)
+        indices = [index for index, unused_out, unused_code in stdout_parts]
+        if (len(indices) > len(commands) or
+                indices != list(range(len(indices))) or
+                indices != [index for index, unused_err, unused_code
+                            in stderr_parts]):
+            self._log_command_output(stdout, stderr, failed=True)
+            raise NonZeroExitCode(
+                '[{host}] The output of a batch of {count} commands could '
+                'not be matched to the commands (exit code {exitcode}).'
+                .format(host=host, count=len(commands), exitcode=exitcode),
+                host=host, exitcode=exitcode, stderr=stderr)
+        results = [
+            CommandResult(out, err, code)
+            for (unused_index, out, code), (unused_index, err, unused_code)
+            in zip(stdout_parts, stderr_parts)]
+        for result in results:
+            self._log_command_output(
+                result.stdout, result.stderr, failed=result.exitcode != 0)
+
+        finished = len(results) == len(commands) or (
+            stop_on_failure and results and results[-1].exitcode != 0)
+        if not finished:
+            self._log_command_output(stdout, stderr, failed=True)
+            raise NonZeroExitCode(
+                '[{host}] A batch of {count} commands did not run to '
+                'completion (exit code {exitcode}).'.format(
+                    host=host, count=len(commands), exitcode=exitcode),
+                host=host, exitcode=exitcode, stderr=stderr, results=results)
+        return results
+
+    def get_retry_policy(self) -> RetryPolicy:
+        """Returns a RetryPolicy built from this workflow's retry settings."""
+        return RetryPolicy(
+            max_retries=self.max_retries,
+            initial_interval=self.retry_interval,
+            multiplier=self.retry_backoff_multiplier,
+            max_interval=self.max_retry_interval,
+            max_total_time=self.max_retry_time,
+            jitter=self.retry_jitter)
+
+    def run_query(
+            self,
+            command: Union[str, list],
+            host: str = 'localhost',
+            ttl: Optional[float] = None) -> tuple[str, str]:
+        """Runs a read-only command, reusing its output when possible.
+
+        The output of a successful query is reused for the same command on
+        the same host, by any workflow in this process, for ttl seconds or
+        until a command which may change its answer (e.g. zfs snapshot or
+        lvcreate) runs on that host. Only use this for commands which change
+        nothing and whose output only such commands affect.
+
+        Args:
+            command: a command line or list of command line arguments to run.
+            host: the host on which the command will be executed.
+            ttl: seconds for which the output is reused. Defaults to
+                query_cache_ttl.
+
+        Returns:
+            A 2-tuple containing the stdout and stderr from the executed
+            process.
+
+        Raises:
+            The exceptions run_command() raises. Failures aren't cached.
+        """
+        if ttl is None:
+            ttl = self.query_cache_ttl
+        if self.dry_run or ttl <= 0:
+            with keep_whole_output():
+                return self.run_command(command, host)
+        cached = self._query_cache.get(host, command)
+        if cached is not None:
+            self.logger.debug('run_query {!r} answered from the cache'.format(
+                command))
+            return cached
+        generation = self._query_cache.get_generation(host)
+        with keep_whole_output():
+            stdout, stderr = self.run_command(command, host)
+        self._query_cache.put(
+            host, command, stdout, stderr, ttl, generation)
+        return stdout, stderr
+
+    def get_ssh_compression(
+            self,
+            source: str,
+            paths: list[str],
+            destination: str = 'localhost') -> Optional[bool]:
+        """Returns whether to compress a transfer from source to destination.
+
+        The decision is made by compression.should_compress() from a probe of
+        the link and of a sample of the data in paths, and is reused for
+        ssh_compression_probe_ttl seconds. A transfer to destination is run
+        on source, and one to localhost is pulled from source.
+
+        Args:
+            source: the host the data is sent from.
+            paths: where the data is on source.
+            destination: the host the data is sent to, as reached over SSH
+                from source.
+
+        Returns:
+            The decision, or None when auto_ssh_compression isn't set, in
+            dry_run mode, or when the probe failed, in which case the
+            configured setting should be kept.
+        """
+        if not self.auto_ssh_compression or self.dry_run:
+            return None
+        if source == destination:
+            return False
+        from ari_backup import compression
+
+        cache = compression.ProbeCache(self.ssh_compression_cache_path)
+        key = cache.get_key(source, destination)
+        now = time.time()
+        compress = cache.get(key, now, self.ssh_compression_probe_ttl)
+        if compress is not None:
+            return compress
+
+        def run_script(script: str, host: str) -> str:
+            if host != 'localhost':
+                # The remote shell parses the command line SSH sends it, so
+                # the script must be quoted to reach sh intact.
+                script = shlex.quote(script)
+            stdout, unused_stderr = self.run_command(
+                ['sh', '-c', script], host)
+            return stdout
+
+        try:
+            sample_output = run_script(
+                compression.build_sample_script(paths), source)
+            if destination == 'localhost':
+                transfer_output = run_script(
+                    compression.build_transfer_script(
+                        self._get_ssh_args(source), upload=False),
+                    'localhost')
+            else:
+                transfer_output = run_script(
+                    compression.build_transfer_script(
+                        ['ssh', '-o', 'BatchMode=yes', destination],
+                        upload=True),
+                    source)
+            probe = compression.get_probe(sample_output, transfer_output)
+        except (CommandNotFound, NonZeroExitCode, ValueError) as e:
+            self.logger.warning(
+                'Unable to probe the link from {} to {}: {}'.format(
+                    source, destination, e))
+            return None
+        compress = compression.should_compress(probe)
+        self.logger.info(
+            'Compression {} from {} to {}: data compresses to {:.0%} at '
+            '{:.1f} MiB/s, link carries {:.1f} MiB/s.'.format(
+                'enabled' if compress else 'disabled', source, destination,
+                probe.ratio, probe.compress_rate / 2 ** 20,
+                probe.throughput / 2 ** 20))
+        cache.put(key, probe, compress, now)
+        return compress
+
+    def run_command_with_retries(
+            self,
+            command: Optional[Union[str, list]],
+            host: str = 'localhost',
+            retry_policy: Optional[RetryPolicy] = None) -> tuple[str, str]:
+        """Runs a command, retrying it when it fails for a transient reason.
+
+        Args:
+            command: a command line or list of command line arguments to run.
+            host: the host on which the command will be executed.
+            retry_policy: decides which failures are retried and how long to
+                wait in between. Defaults to get_retry_policy().
+
+        Returns:
+            A 2-tuple containing the stdout and stderr from the executed
+            process.
+
+        Raises:
+            The exception from the last attempt, when the failure is
+            permanent or the policy allows no further retries.
+        """
+        if retry_policy is None:
+            retry_policy = self.get_retry_policy()
+        start_time = time.monotonic()
+        retry_number = 0
+        while True:
+            token = _current_retry.set(retry_number)
+            try:
+                return self.run_command(command, host)
+            except Exception as e:
+                if not retry_policy.is_transient(e):
+                    raise
+                retry_number += 1
+                if retry_number > retry_policy.max_retries:
+                    raise
+                delay = retry_policy.get_delay(retry_number)
+                if (retry_policy.max_total_time is not None and
+                        time.monotonic() - start_time + delay >
+                        retry_policy.max_total_time):
+                    raise
+                self.logger.warning(
+                    'Retrying in {delay:.1f} seconds (retry {number} of '
+                    '{max_retries}).'.format(
+                        delay=delay, number=retry_number,
+                        max_retries=retry_policy.max_retries))
+                time.sleep(delay)
+            finally:
+                _current_retry.reset(token)
 
     def _run_custom_workflow(self):
         """Override this method to run the desired workflow."""
         raise NotImplementedError
 
+    async def _run_custom_workflow_async(self):
+        """Runs the desired workflow from within an event loop.
+
+        By default this calls _run_custom_workflow(), which blocks the event
+        loop while it runs. Override it to await run_command_async() for the
+        long running steps of a workflow.
+        """
+        self._run_custom_workflow()
+
+    def _start_run_report(self) -> None:
+        """Starts a new run_report for the run about to begin."""
+        self.run_report = report.RunReport(
+            label=self.label, started=time.time(), dry_run=self.dry_run)
+        self._run_start_time = time.monotonic()
+
+    def _finish_run_report(self, succeeded: bool) -> None:
+        """Completes the run_report and writes it out.
+
+        The report is written to run_report_dir and its metrics to
+        metrics_textfile_dir, and the run is recorded in the history at
+        history_path unless it is a dry run, when those are set. Failing to
+        write any of them is logged but doesn't fail the job.
+        """
+        run_report = self.run_report
+        if run_report is None:
+            return
+        run_report.duration = time.monotonic() - self._run_start_time
+        run_report.succeeded = succeeded
+        if self.run_report_dir:
+            path = os.path.join(self.run_report_dir, '{}.json'.format(
+                self.label.replace(os.sep, '_')))
+            try:
+                run_report.write_json(path)
+            except (OSError, TypeError, ValueError) as e:
+                self.logger.warning(
+                    'Unable to write the run report to {}: {}'.format(
+                        path, e))
+        if self.metrics_textfile_dir:
+            from ari_backup import metrics
+
+            try:
+                metrics.write_textfile(run_report, self.metrics_textfile_dir)
+            except OSError as e:
+                self.logger.warning(
+                    'Unable to write metrics to {}: {}'.format(
+                        self.metrics_textfile_dir, e))
+        if self.history_path and not self.dry_run:
+            import sqlite3
+
+            from ari_backup import history
+
+            try:
+                with history.open_history(self.history_path) as store:
+                    store.record(run_report)
+            except (OSError, sqlite3.Error) as e:
+                self.logger.warning(
+                    'Unable to record the run in {}: {}'.format(
+                        self.history_path, e))
+
+    def record_metric(self, name: str, value: float) -> None:
+        """Records a workflow specific value in the run report.
+
+        The value is exported along with the timings of the run when
+        metrics_textfile_dir is set. Nothing is recorded outside of a run.
+
+        Args:
+            name: the metric name, without the ari_backup_ prefix
+                (e.g. transferred_bytes).
+            value: the value of the metric.
+        """
+        if self.run_report is not None:
+            self.run_report.metrics[name] = value
+
+    def _get_lock_destination(self) -> Optional[str]:
+        """Returns the backup destination the job writes to, if it has one.
+
+        Subclasses override this so that two jobs writing to the same
+        destination never run at once.
+        """
+        return None
+
+    def _acquire_locks(self) -> list[locks.FileLock]:
+        """Locks the label and the destination of the job.
+
+        Nothing is locked in dry_run mode or when lock_dir isn't set. When the
+        lock directory can't be used, a warning is logged and the job runs
+        without locks.
+
+        Returns:
+            The locks taken.
+
+        Raises:
+            locks.LockHeld: when another run holds one of the locks.
+        """
+        if self.dry_run or not self.lock_dir:
+            return list()
+        paths = [locks.get_lock_path(self.lock_dir, 'label', self.label)]
+        destination = self._get_lock_destination()
+        if destination is not None:
+            paths.append(locks.get_lock_path(
+                self.lock_dir, 'destination', destination))
+        held: list[locks.FileLock] = list()
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            for path in paths:
+                lock = locks.FileLock(path)
+                lock.acquire()
+                held.append(lock)
+                if lock.stale_pid is not None:
+                    self.logger.warning(
+                        'Took over {} which PID {} left behind.'.format(
+                            path, lock.stale_pid))
+        except OSError as e:
+            self.logger.warning(
+                'Unable to lock {}, running without locks: {}'.format(
+                    self.lock_dir, e))
+            self._release_locks(held)
+            return list()
+        except locks.LockHeld:
+            self._release_locks(held)
+            raise
+        return held
+
+    def _release_locks(self, held: list[locks.FileLock]) -> None:
+        for lock in reversed(held):
+            lock.release()
+
+    def _set_interruptible(self, interruptible: bool) -> None:
+        """Sets whether interrupt() may stop the commands of this workflow.
+
+        It may while the pre-job hooks and the backup itself run, but not
+        once the post-job hooks clean up. This waits for an interrupt() in
+        progress, so that it doesn't stop the first cleanup commands.
+        """
+        with self._interrupt_lock:
+            self._interruptible = interruptible
+        with _interruptible_workflows_lock:
+            if interruptible:
+                _interruptible_workflows.add(self)
+            else:
+                _interruptible_workflows.discard(self)
+
+    def interrupt(self) -> None:
+        """Stops the running job so that its post-job hooks can clean up.
+
+        The commands run by the pre-job hooks and by _run_custom_workflow()
+        are stopped, and those started afterwards fail with JobInterrupted,
+        either of which counts as an error. Once the post-job hooks have
+        started, they're left to finish. This may be called from any thread,
+        and also before the run starts.
+        """
+        with self._interrupt_lock:
+            self._interrupted = True
+            if not self._interruptible:
+                return
+            command_runners = {
+                id(command_runner): command_runner for command_runner in (
+                    self._command_runner, self._progress_command_runner,
+                    self._async_command_runner)}
+            for command_runner in command_runners.values():
+                command_runner.terminate()
+
+    def _start_job_deadline(self) -> None:
+        """Starts the job_timeout clock, if a job_timeout is set."""
+        if self.job_timeout:
+            self._job_deadline = time.monotonic() + self.job_timeout
+        else:
+            self._job_deadline = None
+
     def run(self):
         """Excutes the complete workflow for a single job.
 
@@ -419,17 +2426,50 @@ class BaseWorkflow:
         _run_customer_workflow(), then the error_case argument will be set to
         True.
 
+        When job_timeout is set, commands run by the pre-job hooks and by
+        _run_custom_workflow() are stopped once it has passed, which counts
+        as an error. The post-job hooks are only bound by command_timeout so
+        that they always get to clean up. interrupt() stops the job the same
+        way.
+
+        Any SSH master connections opened while the job ran are closed once
+        the post-job hooks have finished.
+
+        The time spent in each hook, in _run_custom_workflow() and in each
+        command is recorded in run_report, which is also written out as JSON
+        when run_report_dir is set.
+
+        The label of the job and its destination are locked for the duration
+        of the run. If another run holds either lock, nothing is run, not
+        even the hooks, and False is returned.
+
+        Within load_workflows(), the run is only recorded and True is
+        returned.
+
         Returns:
             A bool for whether the job ran successfully or not.
         """
+        collected = _collected_runs.get()
+        if collected is not None:
+            collected.append(self.run)
+            return True
         error_case = False
         self.logger.info('ari-backup started.')
         if self.dry_run:
             self.logger.info('Running in dry_run mode.')
+        try:
+            held_locks = self._acquire_locks()
+        except locks.LockHeld as e:
+            self.logger.error('Another run is in progress: {}'.format(e))
+            return False
+        self._start_run_report()
+        self._start_job_deadline()
+        self._set_interruptible(True)
         try:
             self._process_pre_job_hooks()
             self.logger.info('Data backup started.')
-            self._run_custom_workflow()
+            with self._phase('workflow', 'workflow'):
+                self._run_custom_workflow()
             self.logger.info('Data backup complete.')
         except KeyboardInterrupt:
             error_case = True
@@ -442,9 +2482,85 @@ class BaseWorkflow:
             self.logger.error(str(e))
             self.logger.error("Trying to clean up...")
         finally:
-            self._process_post_job_hooks(error_case)
+            # The post-job hooks must get to clean up no matter how late it
+            # is, so they're only bound by the command_timeout.
+            self._set_interruptible(False)
+            self._job_deadline = None
+            try:
+                self._process_post_job_hooks(error_case)
+            finally:
+                self._close_ssh_masters()
+                self._finish_run_report(not error_case)
+                self._release_locks(held_locks)
             self.logger.info('ari-backup stopped.')
             if error_case:
                 return False
             else:
                 return True
+
+    async def run_async(self) -> bool:
+        """Excutes the complete workflow for a single job in an event loop.
+
+        This is the coroutine version of run(). Pre-job and post-job hooks may
+        be coroutine functions, in which case they are awaited, and the
+        workflow itself is run with _run_custom_workflow_async(). Use
+        run_concurrently() to drive several workflows at once.
+
+        If the task running this coroutine is cancelled, the post-job hooks
+        are run for the error case before the cancellation is propagated.
+
+        Locks are taken as in run().
+
+        Within load_workflows(), the run is only recorded and True is
+        returned.
+
+        Returns:
+            A bool for whether the job ran successfully or not.
+        """
+        import asyncio
+
+        collected = _collected_runs.get()
+        if collected is not None:
+            collected.append(lambda: asyncio.run(self.run_async()))
+            return True
+        error_case = False
+        cancelled = False
+        self.logger.info('ari-backup started.')
+        if self.dry_run:
+            self.logger.info('Running in dry_run mode.')
+        try:
+            held_locks = self._acquire_locks()
+        except locks.LockHeld as e:
+            self.logger.error('Another run is in progress: {}'.format(e))
+            return False
+        self._start_run_report()
+        self._start_job_deadline()
+        self._set_interruptible(True)
+        try:
+            await self._process_pre_job_hooks_async()
+            self.logger.info('Data backup started.')
+            with self._phase('workflow', 'workflow'):
+                await self._run_custom_workflow_async()
+            self.logger.info('Data backup complete.')
+        except (KeyboardInterrupt, asyncio.CancelledError) as e:
+            error_case = True
+            cancelled = isinstance(e, asyncio.CancelledError)
+            self.logger.error('Backup job cancelled.')
+            self.logger.error("Trying to clean up...")
+        except Exception as e:
+            error_case = True
+            self.logger.error(str(e))
+            self.logger.error("Trying to clean up...")
+
+        self._set_interruptible(False)
+        self._job_deadline = None
+        try:
+            await self._process_post_job_hooks_async(error_case)
+        finally:
+            self._close_ssh_masters()
+            self._finish_run_report(not error_case)
+            self._release_locks(held_locks)
+        self.logger.info('ari-backup stopped.')
+        if cancelled:
+            raise asyncio.CancelledError
+        return not error_case
@@ -1,4 +1,16 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import shlex
+import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
 import time
 # import unittest
 from unittest import mock
@@ -7,6 +19,10 @@ from absl import flags
 from absl.testing import absltest
 from absl.testing import flagsaver
 
+from ari_backup import history
+from ari_backup import progress
+from ari_backup import query_cache
+from ari_backup import settings
 from ari_backup import workflow
 from ari_backup import test_lib
 
@@ -14,6 +30,8 @@ from ari_backup import test_lib
 FLAGS = flags.FLAGS
 # Disable logging to stderr when running tests.
 FLAGS.stderr_logging = False
+# Keep test runs out of the system lock directory.
+FLAGS.lock_dir = None
 
 
 class CommandRunnerTest(absltest.TestCase):
@@ -31,13 +49,15 @@ class CommandRunnerTest(absltest.TestCase):
         self.command_runner.run(['fake_program', 'fake_arg1'], True)
         self.mock_popen.assert_called_once_with(
             ['fake_program', 'fake_arg1'], shell=True, stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=True)
 
     def testRun_shellIsFalse_opensProcessWithoutShell(self):
         self.command_runner.run(['fake_program', 'fake_arg1'], False)
         self.mock_popen.assert_called_once_with(
             ['fake_program', 'fake_arg1'], shell=False, stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=True)
 
     def testRun_commandNotFound_raisesException(self):
         self.mock_popen.side_effect = IOError
@@ -79,6 +99,309 @@ class CommandRunnerTest(absltest.TestCase):
         self.assertEqual(return_code, 3)
 
 
+class CommandRunnerTimeoutTest(absltest.TestCase):
+    """Tests command timeouts against real (but trivial) processes."""
+
+    # Writes the PID of a long running child to the file named by $0.
+    _SPAWNS_CHILD = 'sleep 60 & echo $! > "$0"; wait'
+    # Ignores SIGTERM.
+    _IGNORES_SIGTERM = (
+        'import signal, time; '
+        'signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+        'print("ready", flush=True); time.sleep(60)')
+
+    def _assertProcessGone(self, pid):
+        """Asserts pid exits soon; it may linger as a zombie until reaped."""
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                with open('/proc/{}/stat'.format(pid)) as stat:
+                    state = stat.read().rsplit(')', 1)[1].split()[0]
+            except FileNotFoundError:
+                return
+            if state == 'Z':
+                return
+            if time.monotonic() > deadline:
+                self.fail('Process {} is still running.'.format(pid))
+            time.sleep(0.05)
+
+    def testRun_commandTimesOut_raisesCommandTimeout(self):
+        command_runner = workflow.CommandRunner(kill_grace_period=1)
+
+        with self.assertRaises(workflow.CommandTimeout):
+            command_runner.run(
+                [sys.executable, '-c', 'import time; time.sleep(60)'], False,
+                timeout=0.2)
+
+        self.assertIsNotNone(command_runner._process.returncode)
+
+    def testRun_commandFinishesInTime_returnsOutput(self):
+        command_runner = workflow.CommandRunner()
+
+        stdout, _, return_code = command_runner.run(
+            [sys.executable, '-c', 'print("out")'], False, timeout=30)
+
+        self.assertEqual(stdout, 'out\n')
+        self.assertEqual(return_code, 0)
+
+    def testTerminate_sigtermIgnored_escalatesToSigkill(self):
+        command_runner = workflow.CommandRunner(kill_grace_period=0.2)
+        start = time.monotonic()
+
+        with self.assertRaises(workflow.CommandTimeout):
+            command_runner.run(
+                [sys.executable, '-c', self._IGNORES_SIGTERM], False,
+                timeout=0.5)
+
+        self.assertEqual(command_runner._process.returncode, -signal.SIGKILL)
+        self.assertLess(time.monotonic() - start, 30)
+
+    def testTerminate_commandStartedChild_killsProcessGroup(self):
+        command_runner = workflow.StreamingCommandRunner(
+            mock.MagicMock(), kill_grace_period=0.2)
+        with tempfile.NamedTemporaryFile('r') as pid_file:
+            with self.assertRaises(workflow.CommandTimeout):
+                command_runner.run(
+                    ['sh', '-c', self._SPAWNS_CHILD, pid_file.name],
+                    False, timeout=1)
+
+            self._assertProcessGone(int(pid_file.read()))
+
+    def _interruptSoon(self):
+        """Sends SIGINT to this process, as Ctrl-C would, in a moment."""
+        timer = threading.Timer(
+            0.5, os.kill, args=(os.getpid(), signal.SIGINT))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+    def testRun_interrupted_stopsCommand(self):
+        for command_runner in (
+                workflow.CommandRunner(kill_grace_period=0.2),
+                workflow.StreamingCommandRunner(
+                    mock.MagicMock(), kill_grace_period=0.2)):
+            with tempfile.NamedTemporaryFile('r') as pid_file:
+                self._interruptSoon()
+                with self.assertRaises(KeyboardInterrupt):
+                    command_runner.run(
+                        ['sh', '-c', self._SPAWNS_CHILD, pid_file.name],
+                        False, timeout=30)
+
+                self.assertIsNotNone(command_runner._process.poll())
+                self._assertProcessGone(int(pid_file.read()))
+
+    def testStreamingRun_commandTimesOut_raisesCommandTimeout(self):
+        command_runner = workflow.StreamingCommandRunner(
+            mock.MagicMock(), kill_grace_period=1)
+
+        with self.assertRaises(workflow.CommandTimeout):
+            command_runner.run(
+                [sys.executable, '-c', 'import time; time.sleep(60)'], False,
+                timeout=0.2)
+
+    def testTerminateAsync_sigtermIgnored_escalatesToSigkill(self):
+        command_runner = workflow.AsyncCommandRunner(kill_grace_period=0.2)
+        results = list()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ready_path = os.path.join(temp_dir, 'ready')
+            thread = threading.Thread(target=lambda: results.append(
+                asyncio.run(command_runner.run_async(
+                    [sys.executable, '-c',
+                     'import signal, sys, time; '
+                     'signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+                     'open(sys.argv[1], "w").close(); time.sleep(60)',
+                     ready_path], False, timeout=30))))
+            thread.start()
+            deadline = time.monotonic() + 10
+            while ((not os.path.exists(ready_path) or
+                    not command_runner._processes) and
+                   time.monotonic() < deadline):
+                time.sleep(0.05)
+
+            command_runner.terminate()
+            thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(results[0][2], -signal.SIGKILL)
+
+    def testRunAsync_commandTimesOut_raisesCommandTimeout(self):
+        command_runner = workflow.AsyncCommandRunner(kill_grace_period=0.2)
+
+        with self.assertRaises(workflow.CommandTimeout):
+            asyncio.run(command_runner.run_async(
+                [sys.executable, '-c', self._IGNORES_SIGTERM], False,
+                timeout=0.5))
+
+
+class StreamingCommandRunnerTest(absltest.TestCase):
+    """Tests StreamingCommandRunner against real (but trivial) processes."""
+
+    def setUp(self):
+        super().setUp()
+        self.mock_logger = mock.MagicMock()
+
+    def _run_python(self, command_runner, code):
+        return command_runner.run([sys.executable, '-c', code], False)
+
+    def testRun_returnsOutputAndReturnCode(self):
+        command_runner = workflow.StreamingCommandRunner(self.mock_logger)
+
+        stdout, stderr, return_code = self._run_python(
+            command_runner,
+            'import sys; print("out"); print("err", file=sys.stderr); '
+            'sys.exit(3)')
+
+        self.assertEqual(stdout, 'out')
+        self.assertEqual(stderr, 'err')
+        self.assertEqual(return_code, 3)
+
+    def testRun_logsLinesAtStreamLevels(self):
+        command_runner = workflow.StreamingCommandRunner(self.mock_logger)
+
+        self._run_python(
+            command_runner,
+            'import sys; print("out"); print("err", file=sys.stderr)')
+
+        self.mock_logger.log.assert_has_calls(
+            [mock.call(logging.DEBUG, 'out'),
+             mock.call(logging.WARNING, 'err')], any_order=True)
+
+    def testRun_manyLines_returnsOnlyTail(self):
+        command_runner = workflow.StreamingCommandRunner(
+            self.mock_logger, tail_lines=2)
+
+        stdout, _, _ = self._run_python(
+            command_runner, 'for i in range(1000): print(i)')
+
+        self.assertEqual(stdout, '998\n999')
+
+    def testRun_farMoreLinesThanTail_keepsOnlyTail(self):
+        command_runner = workflow.StreamingCommandRunner(
+            self.mock_logger, tail_lines=10, max_lines_per_second=1)
+        streams = list()
+        original_init = workflow._OutputStream.__init__
+
+        def record_stream(stream, *args, **kwargs):
+            original_init(stream, *args, **kwargs)
+            streams.append(stream)
+
+        with mock.patch.object(
+                workflow._OutputStream, '__init__', record_stream):
+            stdout, _, _ = self._run_python(
+                command_runner, 'for i in range(200000): print(i)')
+
+        self.assertEqual(stdout.split('\n'),
+                         [str(i) for i in range(199990, 200000)])
+        for stream in streams:
+            self.assertLessEqual(len(stream._tail), 10)
+
+    def testRun_keepWholeOutput_returnsAllLines(self):
+        command_runner = workflow.StreamingCommandRunner(
+            self.mock_logger, tail_lines=2)
+
+        with workflow.keep_whole_output():
+            stdout, _, _ = self._run_python(
+                command_runner, 'for i in range(1000): print(i)')
+
+        self.assertEqual(stdout, '\n'.join(str(i) for i in range(1000)))
+
+    def testRun_tooManyLinesPerSecond_suppressesExcessLines(self):
+        command_runner = workflow.StreamingCommandRunner(
+            self.mock_logger, max_lines_per_second=5)
+
+        self._run_python(command_runner, 'for i in range(1000): print(i)')
+
+        logged_lines = [
+            c for c in self.mock_logger.log.call_args_list
+            if c == mock.call(logging.DEBUG, mock.ANY)]
+        self.assertLess(len(logged_lines), 1000)
+        self.mock_logger.log.assert_any_call(
+            logging.DEBUG, '[%d lines of output suppressed]', mock.ANY)
+
+    def testRun_noTrailingNewline_lastLineReturned(self):
+        command_runner = workflow.StreamingCommandRunner(self.mock_logger)
+
+        stdout, _, _ = self._run_python(
+            command_runner, 'import sys; sys.stdout.write("a\\nb")')
+
+        self.assertEqual(stdout, 'a\nb')
+
+    def testRun_progressMonitored_linesAndOverwrittenLinesPassedOn(self):
+        command_runner = workflow.StreamingCommandRunner(self.mock_logger)
+        lines = list()
+        token = workflow._output_line_callback.set(lines.append)
+        self.addCleanup(workflow._output_line_callback.reset, token)
+
+        stdout, _, _ = self._run_python(
+            command_runner,
+            'import sys; sys.stdout.write("a\\n\\r10%\\r20%\\r")\n'
+            'sys.stdout.flush(); sys.stdout.write("done\\n")')
+
+        self.assertEqual(lines, ['a', '10%', '20%', 'done'])
+        self.assertEqual(stdout, 'a\ndone')
+
+    def testRun_commandNotFound_raisesException(self):
+        command_runner = workflow.StreamingCommandRunner(self.mock_logger)
+
+        with self.assertRaises(workflow.CommandNotFound):
+            command_runner.run(['/nonexistent/fake_program'], False)
+
+
+class AsyncCommandRunnerTest(absltest.TestCase):
+    """Tests AsyncCommandRunner against real (but trivial) processes."""
+
+    def testRunAsync_returnsOutputAndReturnCode(self):
+        command_runner = workflow.AsyncCommandRunner()
+
+        stdout, stderr, return_code = asyncio.run(command_runner.run_async(
+            [sys.executable, '-c',
+             'import sys; print("out"); print("err", file=sys.stderr); '
+             'sys.exit(3)'],
+            False))
+
+        self.assertEqual(stdout, 'out\n')
+        self.assertEqual(stderr, 'err\n')
+        self.assertEqual(return_code, 3)
+
+    def testRunAsync_progressMonitored_linesPassedOnAndTailReturned(self):
+        command_runner = workflow.AsyncCommandRunner(tail_lines=2)
+        lines = list()
+        token = workflow._output_line_callback.set(lines.append)
+        self.addCleanup(workflow._output_line_callback.reset, token)
+
+        stdout, _, _ = asyncio.run(command_runner.run_async(
+            [sys.executable, '-c',
+             'import sys; sys.stdout.write("a\\nb\\n\\r10%\\r20%\\r")\n'
+             'sys.stdout.flush(); sys.stdout.write("done\\n")'],
+            False))
+
+        self.assertEqual(lines, ['a', 'b', '10%', '20%', 'done'])
+        self.assertEqual(stdout, 'b\ndone')
+
+    def testRunAsync_shellIsTrue_runsCommandInShell(self):
+        command_runner = workflow.AsyncCommandRunner()
+
+        stdout, _, _ = asyncio.run(
+            command_runner.run_async('echo fake | tr a-z A-Z', True))
+
+        self.assertEqual(stdout, 'FAKE\n')
+
+    def testRunAsync_commandNotFound_raisesException(self):
+        command_runner = workflow.AsyncCommandRunner()
+
+        with self.assertRaises(workflow.CommandNotFound):
+            asyncio.run(command_runner.run_async(
+                ['/nonexistent/fake_program'], False))
+
+    def testRun_blocksUntilCommandExits(self):
+        command_runner = workflow.AsyncCommandRunner()
+
+        stdout, _, return_code = command_runner.run(
+            [sys.executable, '-c', 'print("out")'], False)
+
+        self.assertEqual(stdout, 'out\n')
+        self.assertEqual(return_code, 0)
+
+
 class BaseWorkflowTest(absltest.TestCase):
 
     @flagsaver.flagsaver
@@ -86,8 +409,8 @@ class BaseWorkflowTest(absltest.TestCase):
     def testInit_userSettingsOverridesFlagDefaults(
             self, mock_get_settings_from_file):
         FLAGS.set_default('remote_user', 'not_overridden_username')
-        mock_get_settings_from_file.return_value = {'remote_user':
-                                                    'overridden_username'}
+        mock_get_settings_from_file.return_value = settings.Settings(
+            {'remote_user': 'overridden_username'}, [], from_cache=False)
 
         workflow.BaseWorkflow(
             label='unused',
@@ -96,6 +419,48 @@ class BaseWorkflowTest(absltest.TestCase):
 
         self.assertEqual(FLAGS.remote_user, 'overridden_username')
 
+    @mock.patch('builtins.print')
+    @mock.patch.object(workflow.BaseWorkflow, '_get_settings_from_file')
+    def testInit_settingForModuleNotImported_skippedWithoutWarning(
+            self, mock_get_settings_from_file, mock_print):
+        mock_get_settings_from_file.return_value = settings.Settings(
+            {'fake_module_flag': 1}, [], from_cache=False)
+
+        workflow.BaseWorkflow(
+            label='unused',
+            settings_path='/path/which/is/not/None/so/settings/are/loaded',
+            argv=['fake_program'])
+
+        self.assertFalse(mock_print.called)
+
+    @mock.patch('builtins.print')
+    @mock.patch.object(workflow.BaseWorkflow, '_get_settings_from_file')
+    def testInit_unknownSetting_warns(
+            self, mock_get_settings_from_file, mock_print):
+        mock_get_settings_from_file.return_value = settings.Settings(
+            {'fake_unknown_flag': 1}, ['fake_unknown_flag'], from_cache=False)
+
+        workflow.BaseWorkflow(
+            label='unused',
+            settings_path='/path/which/is/not/None/so/settings/are/loaded',
+            argv=['fake_program'])
+
+        self.assertIn('fake_unknown_flag', mock_print.call_args[0][0])
+
+    @mock.patch('builtins.print')
+    @mock.patch.object(workflow.BaseWorkflow, '_get_settings_from_file')
+    def testInit_unknownSettingFromCache_doesNotWarnAgain(
+            self, mock_get_settings_from_file, mock_print):
+        mock_get_settings_from_file.return_value = settings.Settings(
+            {'fake_unknown_flag': 1}, ['fake_unknown_flag'], from_cache=True)
+
+        workflow.BaseWorkflow(
+            label='unused',
+            settings_path='/path/which/is/not/None/so/settings/are/loaded',
+            argv=['fake_program'])
+
+        self.assertFalse(mock_print.called)
+
     def testAddPreHook_functionWithKwargs_addsHook(self):
         def test_func(x):
             return x
@@ -168,6 +533,94 @@ class BaseWorkflowTest(absltest.TestCase):
 
         self.assertEqual(test_workflow._pre_job_hooks, [(test_func2, {})])
 
+    def testDeletePreHook_byName_deletesNamedHook(self):
+        def test_func1(x):
+            return x
+
+        def test_func2(x):
+            return x
+
+        test_workflow = workflow.BaseWorkflow(label='unused',
+                                              settings_path=None,
+                                              argv=['fake_program'])
+
+        test_workflow.add_pre_hook(test_func1)
+        test_workflow.add_pre_hook(test_func2, name='test_hook')
+        test_workflow.delete_pre_hook('test_hook')
+
+        self.assertEqual(test_workflow._pre_job_hooks, [(test_func1, {})])
+
+    @flagsaver.flagsaver
+    def testProcessPreJobHooks_independentHooks_runConcurrently(self):
+        FLAGS.max_hook_workers = 2
+        barrier = threading.Barrier(2, timeout=5)
+        test_workflow = workflow.BaseWorkflow(label='unused',
+                                              settings_path=None,
+                                              argv=['fake_program'])
+
+        # Each hook only returns once the other one is running too.
+        test_workflow.add_pre_hook(barrier.wait, name='dump_db1', after=())
+        test_workflow.add_pre_hook(barrier.wait, name='dump_db2', after=())
+
+        test_workflow._process_pre_job_hooks()
+
+    def testProcessPostJobHooks_hookFails_independentCleanupStillRuns(self):
+        mock_umount = mock.MagicMock(side_effect=RuntimeError)
+        mock_delete = mock.MagicMock()
+        mock_other_cleanup = mock.MagicMock()
+        test_workflow = workflow.BaseWorkflow(label='unused',
+                                              settings_path=None,
+                                              argv=['fake_program'])
+        test_workflow.add_post_hook(mock_umount, name='umount')
+        test_workflow.add_post_hook(mock_delete, after=['umount'])
+        test_workflow.add_post_hook(mock_other_cleanup, after=())
+
+        with self.assertRaises(RuntimeError):
+            test_workflow._process_post_job_hooks(error_case=True)
+
+        self.assertFalse(mock_delete.called)
+        mock_other_cleanup.assert_called_once_with(error_case=True)
+
+    def testProcessPostJobHooks_undoes_runInReverseOfPreJobHooks(self):
+        calls = list()
+        test_workflow = workflow.BaseWorkflow(label='unused',
+                                              settings_path=None,
+                                              argv=['fake_program'])
+        test_workflow.add_pre_hook(mock.MagicMock(), name='create')
+        test_workflow.add_pre_hook(mock.MagicMock(), name='mount')
+        # Added in the order they are created, not the order they must run.
+        test_workflow.add_post_hook(
+            lambda error_case: calls.append('delete'), undoes='create')
+        test_workflow.add_post_hook(
+            lambda error_case: calls.append('umount'), undoes='mount')
+
+        test_workflow._process_post_job_hooks(error_case=True)
+
+        self.assertEqual(calls, ['umount', 'delete'])
+
+    def testProcessPostJobHooks_insertedFirst_finishesBeforeCleanup(self):
+        FLAGS.max_hook_workers = 2
+        calls = list()
+
+        def flush(error_case):
+            time.sleep(0.1)
+            calls.append('flush')
+
+        test_workflow = workflow.BaseWorkflow(label='unused',
+                                              settings_path=None,
+                                              argv=['fake_program'])
+        test_workflow.add_pre_hook(mock.MagicMock(), name='create')
+        test_workflow.add_pre_hook(mock.MagicMock(), name='mount')
+        test_workflow.add_post_hook(
+            lambda error_case: calls.append('umount'), undoes='mount')
+        test_workflow.add_post_hook(
+            lambda error_case: calls.append('delete'), undoes='create')
+        test_workflow.insert_post_hook(0, flush)
+
+        test_workflow._process_post_job_hooks(error_case=False)
+
+        self.assertEqual(calls, ['flush', 'umount', 'delete'])
+
     def testAddPostHook_functionWithKwargs_addsHook(self):
         def test_func(x):
             return x
@@ -348,6 +801,137 @@ class BaseWorkflowTest(absltest.TestCase):
             ['/fake/ssh', '-p', '1234', 'test_user@fake_host', 'test_command',
              '--test_flag', 'test_arg'], False)
 
+    @flagsaver.flagsaver
+    @mock.patch.object(subprocess, 'run')
+    def testRunCommand_sshMultiplexingEnabled_commandUsesControlMaster(
+            self, mock_subprocess_run):
+        FLAGS.remote_user = 'test_user'
+        FLAGS.ssh_path = '/fake/ssh'
+        FLAGS.ssh_port = 1234
+        FLAGS.ssh_multiplexing = True
+        FLAGS.ssh_master_persist = 120
+        mock_subprocess_run.return_value = mock.MagicMock(returncode=0)
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+        self.addCleanup(test_workflow._close_ssh_masters)
+
+        test_workflow.run_command(['test_command'], host='fake_host')
+        test_workflow.run_command(['test_command'], host='fake_host')
+
+        # Only one master connection is opened for the host.
+        self.assertEqual(mock_subprocess_run.call_count, 1)
+        master_args = mock_subprocess_run.call_args[0][0]
+        self.assertIn('ControlMaster=yes', master_args)
+        self.assertIn('BatchMode=yes', master_args)
+        self.assertIn('ConnectTimeout=30', master_args)
+        self.assertIn('ControlPersist=120s', master_args)
+        self.assertEqual(mock_subprocess_run.call_args[1]['timeout'], 30)
+        control_path = test_workflow._ssh_control_paths['fake_host']
+        mock_command_runner.run.assert_called_with(
+            ['/fake/ssh', '-p', '1234', '-o', 'ControlMaster=no', '-o',
+             'ControlPath=' + control_path, 'test_user@fake_host',
+             'test_command'], False)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(subprocess, 'run')
+    def testRunCommand_sshMasterFails_commandConnectsDirectly(
+            self, mock_subprocess_run):
+        FLAGS.remote_user = 'test_user'
+        FLAGS.ssh_path = '/fake/ssh'
+        FLAGS.ssh_port = 1234
+        FLAGS.ssh_multiplexing = True
+        mock_subprocess_run.return_value = mock.MagicMock(returncode=255)
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+        self.addCleanup(test_workflow._close_ssh_masters)
+
+        test_workflow.run_command(['test_command'], host='fake_host')
+
+        mock_command_runner.run.assert_called_once_with(
+            ['/fake/ssh', '-p', '1234', 'test_user@fake_host',
+             'test_command'], False)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(subprocess, 'run')
+    def testRunCommand_sshMasterTimesOut_commandConnectsDirectly(
+            self, mock_subprocess_run):
+        FLAGS.remote_user = 'test_user'
+        FLAGS.ssh_path = '/fake/ssh'
+        FLAGS.ssh_port = 1234
+        FLAGS.ssh_multiplexing = True
+        mock_subprocess_run.side_effect = subprocess.TimeoutExpired(
+            'ssh', 30)
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+        self.addCleanup(test_workflow._close_ssh_masters)
+
+        test_workflow.run_command(['test_command'], host='fake_host')
+
+        mock_command_runner.run.assert_called_once_with(
+            ['/fake/ssh', '-p', '1234', 'test_user@fake_host',
+             'test_command'], False)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(subprocess, 'run')
+    def testGetSSHControlPath_slowHost_otherHostsNotHeldUp(
+            self, mock_subprocess_run):
+        FLAGS.ssh_multiplexing = True
+        slow_host_connecting = threading.Event()
+        slow_host_released = threading.Event()
+
+        def run(args, **unused_kwargs):
+            if args[-1].endswith('@slow_host'):
+                slow_host_connecting.set()
+                slow_host_released.wait(5)
+            return mock.MagicMock(returncode=0)
+        mock_subprocess_run.side_effect = run
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+        self.addCleanup(test_workflow._close_ssh_masters)
+        slow_thread = threading.Thread(
+            target=test_workflow._get_ssh_control_path, args=('slow_host',))
+        slow_thread.start()
+        self.addCleanup(slow_thread.join)
+        self.addCleanup(slow_host_released.set)
+        slow_host_connecting.wait(5)
+
+        control_path = test_workflow._get_ssh_control_path('fast_host')
+
+        self.assertFalse(slow_host_released.is_set())
+        self.assertIsNotNone(control_path)
+        self.assertNotIn('slow_host', test_workflow._ssh_control_paths)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(subprocess, 'run')
+    def testRun_sshMultiplexingEnabled_closesMastersAfterPostHooks(
+            self, mock_subprocess_run):
+        FLAGS.ssh_multiplexing = True
+        mock_subprocess_run.return_value = mock.MagicMock(returncode=0)
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+        test_workflow._run_custom_workflow = mock.MagicMock()
+
+        def post_hook(error_case):
+            test_workflow.run_command(['test_command'], host='fake_host')
+
+        test_workflow.add_post_hook(post_hook)
+        test_workflow.run()
+
+        exit_args = mock_subprocess_run.call_args[0][0]
+        self.assertIn('-O', exit_args)
+        self.assertIn('exit', exit_args)
+        self.assertEqual(test_workflow._ssh_control_paths, {})
+
     def testRunCommand_commandHasNonZeroExitCode_rasiesException(self):
         mock_command_runner = test_lib.GetMockCommandRunner()
         # Return empty strings for stdout and stderr and 1 for the exit code.
@@ -359,6 +943,121 @@ class BaseWorkflowTest(absltest.TestCase):
         with self.assertRaises(workflow.NonZeroExitCode):
             test_workflow.run_command('test_command')
 
+    def testRunCommand_commandKilledBySignal_raisesException(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        # subprocess reports a command killed by a signal with a negative
+        # return code.
+        mock_command_runner.run.return_value = (str(), str(), -signal.SIGKILL)
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        with self.assertRaises(workflow.NonZeroExitCode) as context:
+            test_workflow.run_command('test_command')
+
+        self.assertEqual(context.exception.exitcode, -signal.SIGKILL)
+
+    def testRunCommands_localCommandKilledBySignal_stopsBatch(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.side_effect = [
+            (str(), str(), -signal.SIGTERM), (str(), str(), 0)]
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        results = test_workflow.run_commands(
+            [['test_command1'], ['test_command2']])
+
+        self.assertEqual(results, [('', '', -signal.SIGTERM)])
+
+    @flagsaver.flagsaver
+    def testInit_streamCommandOutputFlagSet_usesStreamingCommandRunner(self):
+        FLAGS.stream_command_output = True
+
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None, argv=['fake_program'])
+
+        self.assertIsInstance(test_workflow._command_runner,
+                              workflow.StreamingCommandRunner)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(workflow.StreamingCommandRunner, 'run')
+    @mock.patch.object(workflow.CommandRunner, 'run')
+    def testRunCommand_progressIntervalSet_onlyMonitoredCommandsStreamed(
+            self, mock_run, mock_streaming_run):
+        FLAGS.progress_interval = 3600
+        mock_run.return_value = ('', '', 0)
+        mock_streaming_run.return_value = ('', '', 0)
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None, argv=['fake_program'])
+
+        test_workflow.run_command(['test_query'])
+        with test_workflow.monitor_progress('rsync'):
+            test_workflow.run_command(['test_transfer'])
+        test_workflow.run_commands([['test_query1'], ['test_query2']])
+
+        self.assertEqual(
+            mock_run.call_args_list,
+            [mock.call(['test_query'], False),
+             mock.call(['test_query1'], False),
+             mock.call(['test_query2'], False)])
+        mock_streaming_run.assert_called_once_with(['test_transfer'], False)
+
+    @flagsaver.flagsaver
+    def testMonitorProgress_progressIntervalSet_reportsCommandOutput(self):
+        FLAGS.progress_interval = 3600
+        status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, status_dir)
+        FLAGS.progress_status_dir = status_dir
+        mock_command_runner = test_lib.GetMockCommandRunner()
+
+        def run(args, shell):
+            workflow._output_line_callback.get()(
+                '  2,048  50%  1.00kB/s  0:00:02 (xfr#3, to-chk=1/4)')
+            return str(), str(), 0
+
+        mock_command_runner.run.side_effect = run
+        test_workflow = workflow.BaseWorkflow(
+            label='fake_label', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        with test_workflow.monitor_progress('rsync') as monitor:
+            test_workflow.run_command(['rsync'])
+
+        self.assertIsNotNone(monitor)
+        self.assertIsNone(workflow._output_line_callback.get())
+        status = progress.read_status(
+            os.path.join(status_dir, 'fake_label.json'))
+        self.assertEqual(
+            (status['name'], status['files'], status['bytes'],
+             status['running']),
+            ('rsync', 3, 2048, False))
+
+    def testMonitorProgress_progressIntervalNotSet_nothingMonitored(self):
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+
+        with test_workflow.monitor_progress('rsync') as monitor:
+            self.assertIsNone(workflow._output_line_callback.get())
+
+        self.assertIsNone(monitor)
+
+    def testRunCommand_commandRunnerLogsOutput_outputNotLoggedAgain(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.logs_output = True
+        mock_command_runner.run.return_value = ('fake_stdout', 'fake_stderr',
+                                                0)
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+        test_workflow.logger = mock.MagicMock()
+
+        test_workflow.run_command('test_command')
+
+        test_workflow.logger.warning.assert_not_called()
+
     def testRunCommand_returnsStdoutAndStdErr(self):
         mock_command_runner = test_lib.GetMockCommandRunner()
         # Return fake strings for stdout and stderr and 0 for the exit code.
@@ -373,63 +1072,541 @@ class BaseWorkflowTest(absltest.TestCase):
         self.assertEqual(stdout, 'fake_stdout')
         self.assertEqual(stderr, 'fake_stderr')
 
-    @mock.patch.object(time, 'sleep')
-    def testRunCommandWithRetries_firstTrySucceeds_commandNotRetried(
-            self, unused_mock_sleep):
+    def testRunCommands_localhost_runsEachCommand(self):
         mock_command_runner = test_lib.GetMockCommandRunner()
-        # Return empty strings for stdout and stderr and 0 (success) for the
-        # exit code.
-        mock_command_runner.run.return_value = (str(), str(), 0)
         test_workflow = workflow.BaseWorkflow(
             label='unused', settings_path=None,
             command_runner=mock_command_runner, argv=['fake_program'])
 
-        test_workflow.run_command_with_retries('test_command')
+        results = test_workflow.run_commands(
+            [['test_command1'], ['test_command2']])
 
-        self.assertEqual(mock_command_runner.run.call_count, 1)
+        mock_command_runner.AssertCallsInOrder(
+            [mock.call.run(['test_command1'], False),
+             mock.call.run(['test_command2'], False)])
+        self.assertEqual(results, [('', '', 0), ('', '', 0)])
 
-    @flagsaver.flagsaver
-    @mock.patch.object(time, 'sleep')
-    def testRunCommandWithRetries_firstTryFails_commandRetried(
-            self, unused_mock_sleep):
-        FLAGS.max_retries = 1
+    def testRunCommands_localhostStopOnFailure_stopsAfterFailedCommand(self):
         mock_command_runner = test_lib.GetMockCommandRunner()
-        return1 = (str(), str(), 1)  # command failed
-        return2 = (str(), str(), 0)  # command succeeded
-        mock_command_runner.run.side_effect = [return1, return2]
+        mock_command_runner.run.side_effect = [
+            ('', 'fake_error', 1), ('', '', 0)]
         test_workflow = workflow.BaseWorkflow(
             label='unused', settings_path=None,
             command_runner=mock_command_runner, argv=['fake_program'])
 
-        test_workflow.run_command_with_retries('test_command')
+        results = test_workflow.run_commands(
+            [['test_command1'], ['test_command2']])
 
-        self.assertEqual(mock_command_runner.run.call_count, 2)
+        self.assertEqual(mock_command_runner.run.call_count, 1)
+        self.assertEqual(results, [('', 'fake_error', 1)])
+
+    def _run_batch_locally(self, args, shell):
+        """Fake CommandRunner.run() which runs a batch script with sh."""
+        sh_index = args.index('sh')
+        script = shlex.split(args[sh_index + 2])[0]
+        process = subprocess.run(
+            ['sh', '-c', script], capture_output=True, text=True)
+        return process.stdout, process.stderr, process.returncode
 
     @flagsaver.flagsaver
-    @mock.patch.object(time, 'sleep')
-    def testRunCommandWithRetries_maxRetriesReached_raisesException(
-            self, unused_mock_sleep):
-        FLAGS.max_retries = 1
+    def testRunCommands_remoteHost_runsBatchInOneSSHSession(self):
+        FLAGS.remote_user = 'test_user'
+        FLAGS.ssh_path = '/fake/ssh'
+        FLAGS.ssh_port = 1234
         mock_command_runner = test_lib.GetMockCommandRunner()
-        return1 = (str(), str(), 1)  # command failed
-        return2 = (str(), str(), 1)  # command failed
-        return3 = (str(), str(), 0)  # command succeeded
-        mock_command_runner.run.side_effect = [return1, return2, return3]
+        mock_command_runner.run.side_effect = self._run_batch_locally
         test_workflow = workflow.BaseWorkflow(
             label='unused', settings_path=None,
             command_runner=mock_command_runner, argv=['fake_program'])
 
-        with self.assertRaises(workflow.NonZeroExitCode):
-            test_workflow.run_command_with_retries('test_command')
+        results = test_workflow.run_commands(
+            [['echo', 'fake output'], 'printf partial; echo err >&2; exit 3',
+             ['echo', 'not run']],
+            host='fake_host')
 
-    @flagsaver.flagsaver
-    @mock.patch.object(time, 'sleep')
-    def testRunCommandWithRetries_firstTryFails_sleepsBetweenRetries(
-            self, mock_sleep):
-        FLAGS.max_retries = 1
-        FLAGS.retry_interval = 7
+        self.assertEqual(mock_command_runner.run.call_count, 1)
+        self.assertEqual(
+            mock_command_runner.run.call_args[0][0][:6],
+            ['/fake/ssh', '-p', '1234', 'test_user@fake_host', 'sh', '-c'])
+        self.assertEqual(
+            results,
+            [('fake output\n', '', 0), ('partial', 'err\n', 3)])
+
+    def testRunCommands_remoteHostNoStopOnFailure_runsAllCommands(self):
         mock_command_runner = test_lib.GetMockCommandRunner()
-        return1 = (str(), str(), 1)  # command failed
+        mock_command_runner.run.side_effect = self._run_batch_locally
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        results = test_workflow.run_commands(
+            ['false', ['echo', 'still run']], host='fake_host',
+            stop_on_failure=False)
+
+        self.assertEqual(results, [('', '', 1), ('still run\n', '', 0)])
+
+    def testRunCommands_remoteBatchDoesNotRun_raisesException(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        # SSH exits with 255 when it can't connect.
+        mock_command_runner.run.return_value = ('', 'fake_ssh_error', 255)
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        with self.assertRaises(workflow.NonZeroExitCode):
+            test_workflow.run_commands([['test_command']], host='fake_host')
+
+    def testRunCommands_remoteBatchStopsEarly_exceptionHasCompletedResults(
+            self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.side_effect = self._run_batch_locally
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        # Killing the shell running the batch is like the connection dropping.
+        with self.assertRaises(workflow.NonZeroExitCode) as context:
+            test_workflow.run_commands(
+                [['echo', 'done'], 'kill -9 $$', ['echo', 'not run']],
+                host='fake_host')
+
+        self.assertEqual(context.exception.results, [('done\n', '', 0)])
+
+    def testRunCommands_remoteBatchOutputOutOfOrder_raisesException(self):
+        def run_batch_out_of_order(args, shell):
+            stdout, stderr, exitcode = self._run_batch_locally(args, shell)
+            # Numbers the commands from 1 instead of 0 on stdout only.
+            stdout = re.sub(
+                r'(begin|end) (\d+)',
+                lambda match: '{} {}'.format(
+                    match.group(1), int(match.group(2)) + 1),
+                stdout)
+            return stdout, stderr, exitcode
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.side_effect = run_batch_out_of_order
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        with self.assertRaises(workflow.NonZeroExitCode):
+            test_workflow.run_commands(
+                [['echo', 'first'], ['echo', 'second']], host='fake_host')
+
+    @flagsaver.flagsaver
+    def testRunCommand_streamedOutputLongerThanTail_returnsTail(self):
+        FLAGS.command_output_tail_lines = 2
+        FLAGS.stream_command_output = True
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None, argv=['fake_program'])
+        test_workflow.logger = mock.MagicMock()
+
+        stdout, _ = test_workflow.run_command('seq 1 500')
+
+        self.assertEqual(stdout.split(), ['499', '500'])
+
+    @flagsaver.flagsaver
+    def testRunQuery_streamedOutputLongerThanTail_returnedWhole(self):
+        FLAGS.command_output_tail_lines = 2
+        FLAGS.stream_command_output = True
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None, argv=['fake_program'])
+        test_workflow.logger = mock.MagicMock()
+        test_workflow.query_cache_ttl = 0
+
+        stdout, _ = test_workflow.run_query('seq 1 500')
+
+        self.assertEqual(stdout.split(), [str(i) for i in range(1, 501)])
+
+    @flagsaver.flagsaver
+    def testRunCommands_streamedOutputLongerThanTail_returnedWhole(self):
+        FLAGS.command_output_tail_lines = 2
+        streaming_command_runner = workflow.StreamingCommandRunner(
+            mock.MagicMock())
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.logs_output = True
+
+        def run_batch_locally_streamed(args, shell):
+            script = shlex.split(args[args.index('sh') + 2])[0]
+            return streaming_command_runner.run(['sh', '-c', script], False)
+
+        mock_command_runner.run.side_effect = run_batch_locally_streamed
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        results = test_workflow.run_commands(
+            ['seq 1 500', 'seq 501 1000'], host='fake_host')
+
+        self.assertLen(results, 2)
+        self.assertEqual(results[0].stdout.split(),
+                         [str(i) for i in range(1, 501)])
+        self.assertEqual(results[1].stdout.split(),
+                         [str(i) for i in range(501, 1001)])
+
+    @flagsaver.flagsaver
+    def testRunCommand_streamedCommandFails_logsOnlyTailAsError(self):
+        FLAGS.command_output_tail_lines = 2
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.logs_output = True
+        mock_command_runner.run.return_value = ('1\n2\n3\n', '', 1)
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+        test_workflow.logger = mock.MagicMock()
+
+        with self.assertRaises(workflow.NonZeroExitCode):
+            test_workflow.run_command('test_command')
+
+        test_workflow.logger.error.assert_called_once_with('2\n3')
+
+    @flagsaver.flagsaver
+    def testRunCommands_dryRun_returnsSuccessForEachCommand(self):
+        FLAGS.dry_run = True
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        results = test_workflow.run_commands(
+            [['test_command1'], ['test_command2']], host='fake_host')
+
+        self.assertFalse(mock_command_runner.run.called)
+        self.assertEqual(results, [('', '', 0), ('', '', 0)])
+
+    def _get_mock_async_command_runner(self, return_value=('', '', 0)):
+        mock_async_command_runner = mock.MagicMock()
+        mock_async_command_runner.run_async = mock.AsyncMock(
+            return_value=return_value)
+        mock_async_command_runner.logs_output = False
+        return mock_async_command_runner
+
+    def _create_query_workflows(self, mock_command_runner, count=1):
+        cache = query_cache.QueryCache()
+        workflows = list()
+        for _ in range(count):
+            test_workflow = workflow.BaseWorkflow(
+                label='unused', settings_path=None,
+                command_runner=mock_command_runner, argv=['fake_program'])
+            test_workflow._query_cache = cache
+            workflows.append(test_workflow)
+        return workflows
+
+    def _create_compression_workflow(self, sample_output, transfer_output):
+        def run(args, shell):
+            if 'sample_bytes' in args[-1]:
+                return sample_output, str(), 0
+            return transfer_output, str(), 0
+
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.side_effect = run
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+        test_workflow.auto_ssh_compression = True
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        test_workflow.ssh_compression_cache_path = os.path.join(
+            cache_dir, 'ssh-compression.json')
+        return test_workflow
+
+    def testGetSshCompression_slowLink_compressesAndCachesDecision(self):
+        # The sample compresses to a fifth at 1 GB/s, the link carries
+        # 770 kB/s.
+        test_workflow = self._create_compression_workflow(
+            'sample_bytes 1000000\ncompressed_bytes 200000\n'
+            'compress_nanoseconds 1000000\n',
+            'baseline_nanoseconds 0\ntransfer_nanoseconds 5460000000\n')
+
+        self.assertTrue(test_workflow.get_ssh_compression(
+            'fake-host', ['/home']))
+        self.assertTrue(test_workflow.get_ssh_compression(
+            'fake-host', ['/home']))
+
+        # The second decision came from the cache.
+        self.assertEqual(test_workflow._command_runner.run.call_count, 2)
+
+    def testGetSshCompression_remoteDestination_probedFromSource(self):
+        test_workflow = self._create_compression_workflow(
+            'sample_bytes 1000000\ncompressed_bytes 200000\n'
+            'compress_nanoseconds 1000000000\n',
+            'baseline_nanoseconds 0\ntransfer_nanoseconds 1000000\n')
+
+        self.assertFalse(test_workflow.get_ssh_compression(
+            'fake-host', ['/home'], 'zfs-host'))
+
+        transfer_args = test_workflow._command_runner.run.call_args.args[0]
+        self.assertIn('fake-host', transfer_args[-4])
+        self.assertEqual(transfer_args[-3:-1], ['sh', '-c'])
+        self.assertIn("ssh -o BatchMode=yes zfs-host 'cat > /dev/null'",
+                      shlex.split(transfer_args[-1])[0])
+
+    def testGetSshCompression_probeFails_returnsNone(self):
+        test_workflow = self._create_compression_workflow(
+            'sample_bytes 1000000\n', str())
+        test_workflow.logger = mock.MagicMock()
+
+        self.assertIsNone(test_workflow.get_ssh_compression(
+            'fake-host', ['/home']))
+        test_workflow.logger.warning.assert_called_once()
+
+    def testGetSshCompression_autoSshCompressionNotSet_returnsNone(self):
+        test_workflow = self._create_compression_workflow(str(), str())
+        test_workflow.auto_ssh_compression = False
+
+        self.assertIsNone(test_workflow.get_ssh_compression(
+            'fake-host', ['/home']))
+        test_workflow._command_runner.run.assert_not_called()
+
+    def testRunQuery_sameQueryFromAnotherWorkflow_answeredFromCache(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.return_value = ('fake_stdout', '', 0)
+        workflow1, workflow2 = self._create_query_workflows(
+            mock_command_runner, count=2)
+
+        workflow1.run_query(['zfs', 'list'], 'fake-host')
+        stdout, unused_stderr = workflow2.run_query(
+            ['zfs', 'list'], 'fake-host')
+
+        self.assertEqual(stdout, 'fake_stdout')
+        mock_command_runner.run.assert_called_once()
+
+    def testRunQuery_mutatingCommandOnHost_queryRunAgain(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow, = self._create_query_workflows(mock_command_runner)
+        test_workflow.run_query(['zfs', 'list'], 'fake-host')
+        test_workflow.run_query(['zfs', 'list'], 'other-host')
+
+        test_workflow.run_command(
+            ['zfs', 'snapshot', 'tank@now'], 'fake-host')
+        test_workflow.run_query(['zfs', 'list'], 'fake-host')
+        test_workflow.run_query(['zfs', 'list'], 'other-host')
+
+        # Two queries, the snapshot, and the query run again.
+        self.assertEqual(mock_command_runner.run.call_count, 4)
+
+    def testRunQuery_queryFails_notCached(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.return_value = ('', 'fake_error', 1)
+        test_workflow, = self._create_query_workflows(mock_command_runner)
+
+        for _ in range(2):
+            with self.assertRaises(workflow.NonZeroExitCode):
+                test_workflow.run_query(['zfs', 'list'])
+
+        self.assertEqual(mock_command_runner.run.call_count, 2)
+
+    def testRunQuery_ttlIsZero_alwaysRuns(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow, = self._create_query_workflows(mock_command_runner)
+        test_workflow.query_cache_ttl = 0
+
+        test_workflow.run_query(['zfs', 'list'])
+        test_workflow.run_query(['zfs', 'list'])
+
+        self.assertEqual(mock_command_runner.run.call_count, 2)
+
+    @flagsaver.flagsaver
+    def testRunCommandAsync_hostIsNotLocalhost_sshArgumentsAdded(self):
+        FLAGS.remote_user = 'test_user'
+        FLAGS.ssh_path = '/fake/ssh'
+        FLAGS.ssh_port = 1234
+        mock_async_command_runner = self._get_mock_async_command_runner()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            async_command_runner=mock_async_command_runner,
+            argv=['fake_program'])
+
+        asyncio.run(test_workflow.run_command_async(
+            ['test_command'], host='fake_host'))
+
+        mock_async_command_runner.run_async.assert_awaited_once_with(
+            ['/fake/ssh', '-p', '1234', 'test_user@fake_host',
+             'test_command'], False)
+
+    def testRunCommandAsync_commandHasNonZeroExitCode_raisesException(self):
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            async_command_runner=self._get_mock_async_command_runner(
+                ('', '', 1)),
+            argv=['fake_program'])
+
+        with self.assertRaises(workflow.NonZeroExitCode):
+            asyncio.run(test_workflow.run_command_async('test_command'))
+
+    @flagsaver.flagsaver
+    def testRunCommandAsync_streamCommandOutput_logsOutput(self):
+        FLAGS.stream_command_output = True
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            async_command_runner=self._get_mock_async_command_runner(
+                ('fake_stdout', 'fake_stderr', 0)),
+            argv=['fake_program'])
+        test_workflow.logger = mock.MagicMock()
+
+        asyncio.run(test_workflow.run_command_async('test_command'))
+
+        test_workflow.logger.debug.assert_any_call('fake_stdout')
+        test_workflow.logger.warning.assert_called_once_with('fake_stderr')
+
+    def testRunCommandAsync_commandKilledBySignal_raisesException(self):
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+        test_workflow.logger = mock.MagicMock()
+
+        with self.assertRaises(workflow.NonZeroExitCode) as context:
+            asyncio.run(test_workflow.run_command_async(
+                ['sh', '-c', 'kill -TERM $$']))
+
+        self.assertEqual(context.exception.exitcode, -signal.SIGTERM)
+
+    def testRunAsync_awaitsCoroutineHooksInOrder(self):
+        calls = list()
+
+        async def pre_hook():
+            calls.append('pre_hook')
+
+        def sync_pre_hook():
+            calls.append('sync_pre_hook')
+
+        async def post_hook(error_case):
+            calls.append(('post_hook', error_case))
+
+        async def run_custom_workflow_async():
+            calls.append('workflow')
+
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None, argv=['fake_program'])
+        test_workflow._run_custom_workflow_async = run_custom_workflow_async
+        test_workflow.add_pre_hook(pre_hook)
+        test_workflow.add_pre_hook(sync_pre_hook)
+        test_workflow.add_post_hook(post_hook)
+
+        self.assertTrue(asyncio.run(test_workflow.run_async()))
+        self.assertEqual(
+            calls,
+            ['pre_hook', 'sync_pre_hook', 'workflow', ('post_hook', False)])
+
+    def testRunAsync_workflowRaises_postHooksRunForErrorCase(self):
+        mock_post_hook = mock.MagicMock()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None, argv=['fake_program'])
+        test_workflow._run_custom_workflow_async = mock.AsyncMock(
+            side_effect=Exception('fake_error'))
+        test_workflow.add_post_hook(mock_post_hook)
+
+        self.assertFalse(asyncio.run(test_workflow.run_async()))
+        mock_post_hook.assert_called_once_with(error_case=True)
+
+    def testRunAsync_cancelledDuringSyncPreHook_stopsItBeforePostHooks(self):
+        calls = list()
+        started = threading.Event()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=workflow.CommandRunner(kill_grace_period=0.2),
+            argv=['fake_program'])
+        test_workflow.logger = mock.MagicMock()
+
+        def sync_pre_hook():
+            started.set()
+            try:
+                test_workflow.run_command(['sleep', '60'])
+            finally:
+                calls.append('pre_hook finished')
+
+        def post_hook(error_case):
+            calls.append(('post_hook', error_case))
+
+        test_workflow.add_pre_hook(sync_pre_hook)
+        test_workflow.add_post_hook(post_hook)
+
+        async def run():
+            task = asyncio.ensure_future(test_workflow.run_async())
+            await asyncio.to_thread(started.wait, 10)
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await task
+
+        start = time.monotonic()
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(run())
+        self.assertEqual(calls, ['pre_hook finished', ('post_hook', True)])
+        self.assertLess(time.monotonic() - start, 30)
+
+    def testRunConcurrently_returnsResultOfEachWorkflow(self):
+        test_workflows = list()
+        for succeeds in (True, False):
+            test_workflow = workflow.BaseWorkflow(
+                label='unused', settings_path=None, argv=['fake_program'])
+            test_workflow._run_custom_workflow_async = mock.AsyncMock(
+                side_effect=None if succeeds else Exception('fake_error'))
+            test_workflows.append(test_workflow)
+
+        self.assertEqual(workflow.run_concurrently(test_workflows),
+                         [True, False])
+
+    @mock.patch.object(time, 'sleep')
+    def testRunCommandWithRetries_firstTrySucceeds_commandNotRetried(
+            self, unused_mock_sleep):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        # Return empty strings for stdout and stderr and 0 (success) for the
+        # exit code.
+        mock_command_runner.run.return_value = (str(), str(), 0)
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        test_workflow.run_command_with_retries('test_command')
+
+        self.assertEqual(mock_command_runner.run.call_count, 1)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(time, 'sleep')
+    def testRunCommandWithRetries_firstTryFails_commandRetried(
+            self, unused_mock_sleep):
+        FLAGS.max_retries = 1
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        return1 = (str(), 'target is busy', 32)  # command failed
+        return2 = (str(), str(), 0)  # command succeeded
+        mock_command_runner.run.side_effect = [return1, return2]
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        test_workflow.run_command_with_retries('test_command')
+
+        self.assertEqual(mock_command_runner.run.call_count, 2)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(time, 'sleep')
+    def testRunCommandWithRetries_maxRetriesReached_raisesException(
+            self, unused_mock_sleep):
+        FLAGS.max_retries = 1
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        return1 = (str(), 'target is busy', 32)  # command failed
+        return2 = (str(), 'target is busy', 32)  # command failed
+        return3 = (str(), str(), 0)  # command succeeded
+        mock_command_runner.run.side_effect = [return1, return2, return3]
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        with self.assertRaises(workflow.NonZeroExitCode):
+            test_workflow.run_command_with_retries('test_command')
+        self.assertEqual(mock_command_runner.run.call_count, 2)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(time, 'sleep')
+    def testRunCommandWithRetries_firstTryFails_sleepsBetweenRetries(
+            self, mock_sleep):
+        FLAGS.max_retries = 1
+        FLAGS.retry_interval = 7
+        FLAGS.retry_jitter = 0
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        return1 = (str(), 'target is busy', 32)  # command failed
         return2 = (str(), str(), 0)  # command succeeded
         mock_command_runner.run.side_effect = [return1, return2]
         test_workflow = workflow.BaseWorkflow(
@@ -440,6 +1617,458 @@ class BaseWorkflowTest(absltest.TestCase):
 
         mock_sleep.assert_called_once_with(7)
 
+    @flagsaver.flagsaver
+    @mock.patch.object(time, 'sleep')
+    def testRunCommandWithRetries_permanentFailure_commandNotRetried(
+            self, mock_sleep):
+        FLAGS.max_retries = 3
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.return_value = (str(), 'no such file', 1)
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        with self.assertRaises(workflow.NonZeroExitCode):
+            test_workflow.run_command_with_retries('test_command')
+        self.assertEqual(mock_command_runner.run.call_count, 1)
+        self.assertFalse(mock_sleep.called)
+
+    @mock.patch.object(time, 'sleep')
+    def testRunCommandWithRetries_typeError_notRetried(self, mock_sleep):
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+
+        with self.assertRaises(TypeError):
+            test_workflow.run_command_with_retries(None)
+        self.assertFalse(mock_sleep.called)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(time, 'sleep')
+    def testRunCommandWithRetries_sshFailsOnRemoteHost_commandRetried(
+            self, unused_mock_sleep):
+        FLAGS.max_retries = 1
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        return1 = (str(), 'Connection refused', 255)  # ssh failed
+        return2 = (str(), str(), 0)  # command succeeded
+        mock_command_runner.run.side_effect = [return1, return2]
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        test_workflow.run_command_with_retries(
+            'test_command', host='fake_host')
+
+        self.assertEqual(mock_command_runner.run.call_count, 2)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(time, 'sleep')
+    def testRunCommandWithRetries_multipleRetries_backsOffExponentially(
+            self, mock_sleep):
+        FLAGS.max_retries = 3
+        FLAGS.retry_interval = 2
+        FLAGS.retry_backoff_multiplier = 3
+        FLAGS.retry_jitter = 0
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        failure = (str(), 'target is busy', 32)
+        mock_command_runner.run.side_effect = [
+            failure, failure, failure, (str(), str(), 0)]
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        test_workflow.run_command_with_retries('test_command')
+
+        self.assertEqual(mock_sleep.call_args_list,
+                         [mock.call(2), mock.call(6), mock.call(18)])
+
+    @flagsaver.flagsaver
+    @mock.patch.object(time, 'sleep')
+    def testRunCommandWithRetries_maxRetryTimeExceeded_raisesException(
+            self, mock_sleep):
+        FLAGS.max_retries = 10
+        FLAGS.retry_interval = 60
+        FLAGS.max_retry_time = 30
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.return_value = (str(), 'target is busy', 32)
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        with self.assertRaises(workflow.NonZeroExitCode):
+            test_workflow.run_command_with_retries('test_command')
+        self.assertFalse(mock_sleep.called)
+
+    @flagsaver.flagsaver
+    def testRunCommand_commandTimeoutSet_timeoutPassedToRunner(self):
+        FLAGS.command_timeout = 30
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        test_workflow.run_command('test_command')
+
+        mock_command_runner.run.assert_called_once_with(
+            'test_command', True, timeout=30)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(time, 'monotonic')
+    def testRunCommand_jobDeadlineSooner_timeoutShortened(
+            self, mock_monotonic):
+        FLAGS.command_timeout = 30
+        FLAGS.job_timeout = 100
+        mock_monotonic.return_value = 1000
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+        test_workflow._start_job_deadline()
+        mock_monotonic.return_value = 1090
+
+        test_workflow.run_command('test_command')
+
+        mock_command_runner.run.assert_called_once_with(
+            'test_command', True, timeout=10)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(time, 'monotonic')
+    def testRun_jobTimeoutPassed_failsAndRunsPostJobHooks(
+            self, mock_monotonic):
+        FLAGS.job_timeout = 100
+        mock_monotonic.return_value = 1000
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+
+        def slow_pre_job_hook():
+            mock_monotonic.return_value = 1200
+
+        def backup():
+            test_workflow.run_command('backup_command')
+
+        test_workflow.add_pre_hook(slow_pre_job_hook)
+        test_workflow._run_custom_workflow = backup
+        test_workflow.add_post_hook(
+            lambda error_case: test_workflow.run_command('cleanup_command'))
+
+        self.assertFalse(test_workflow.run())
+        mock_command_runner.run.assert_called_once_with(
+            'cleanup_command', True)
+
+    def testRun_interruptedBeforeRun_failsAndRunsPostJobHooks(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+        test_workflow.add_pre_hook(
+            lambda: test_workflow.run_command('pre_command'))
+        test_workflow.add_post_hook(
+            lambda error_case: test_workflow.run_command('cleanup_command'))
+
+        test_workflow.interrupt()
+
+        self.assertFalse(test_workflow.run())
+        mock_command_runner.run.assert_called_once_with(
+            'cleanup_command', True)
+
+    def testInterruptWorkflows_commandRunning_stopsItAndCleansUp(self):
+        calls = list()
+        started = threading.Event()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=workflow.CommandRunner(kill_grace_period=0.2),
+            argv=['fake_program'])
+        test_workflow.logger = mock.MagicMock()
+
+        def pre_hook():
+            started.set()
+            test_workflow.run_command(['sleep', '60'])
+
+        def post_hook(error_case):
+            test_workflow.run_command(['true'])
+            calls.append(('post_hook', error_case))
+
+        test_workflow.add_pre_hook(pre_hook)
+        test_workflow.add_post_hook(post_hook)
+        results = list()
+        thread = threading.Thread(
+            target=lambda: results.append(test_workflow.run()))
+        start = time.monotonic()
+        thread.start()
+        started.wait(10)
+        time.sleep(0.2)
+
+        workflow.interrupt_workflows()
+        thread.join(30)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(results, [False])
+        self.assertEqual(calls, [('post_hook', True)])
+        self.assertLess(time.monotonic() - start, 30)
+
+    def testRun_recordsPhasesAndCommandsInRunReport(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+        test_workflow.add_pre_hook(
+            lambda: test_workflow.run_command('pre_command'),
+            name='test_pre_hook')
+        test_workflow._run_custom_workflow = lambda: test_workflow.run_command(
+            ['backup_command'], host='fake_host')
+        test_workflow.add_post_hook(lambda error_case: None,
+                                    name='test_post_hook')
+
+        self.assertTrue(test_workflow.run())
+
+        run_report = test_workflow.run_report
+        self.assertTrue(run_report.succeeded)
+        self.assertEqual(
+            [(p.name, p.kind, p.succeeded) for p in run_report.phases],
+            [('test_pre_hook', 'pre_hook', True),
+             ('workflow', 'workflow', True),
+             ('test_post_hook', 'post_hook', True)])
+        self.assertEqual(
+            [(c.command, c.host, c.exitcode, c.phase)
+             for c in run_report.commands],
+            [('pre_command', 'localhost', 0, 'test_pre_hook'),
+             ('backup_command', 'fake_host', 0, 'workflow')])
+
+    @flagsaver.flagsaver
+    @mock.patch.object(time, 'sleep')
+    def testRunCommandWithRetries_recordsRetryNumberInRunReport(
+            self, unused_mock_sleep):
+        FLAGS.max_retries = 3
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.side_effect = [
+            (str(), 'target is busy', 32), (str(), str(), 0)]
+        test_workflow = workflow.BaseWorkflow(
+            label='unused', settings_path=None,
+            command_runner=mock_command_runner, argv=['fake_program'])
+        test_workflow._run_custom_workflow = (
+            lambda: test_workflow.run_command_with_retries('test_command'))
+
+        test_workflow.run()
+
+        self.assertEqual(
+            [(c.exitcode, c.retries)
+             for c in test_workflow.run_report.commands],
+            [(32, 0), (0, 1)])
+
+    @flagsaver.flagsaver
+    def testRun_runReportDirSet_writesJsonReport(self):
+        run_report_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, run_report_dir)
+        FLAGS.run_report_dir = run_report_dir
+        test_workflow = workflow.BaseWorkflow(
+            label='test_label', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+        test_workflow._run_custom_workflow = lambda: None
+
+        test_workflow.run()
+
+        with open(os.path.join(run_report_dir, 'test_label.json')) as f:
+            self.assertTrue(json.load(f)['succeeded'])
+
+    @flagsaver.flagsaver
+    def testRun_metricsTextfileDirSet_writesRecordedMetrics(self):
+        textfile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, textfile_dir)
+        FLAGS.metrics_textfile_dir = textfile_dir
+        test_workflow = workflow.BaseWorkflow(
+            label='test_label', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+        test_workflow._run_custom_workflow = (
+            lambda: test_workflow.record_metric('transferred_bytes', 42))
+
+        test_workflow.run()
+
+        with open(os.path.join(textfile_dir, 'test_label.prom')) as f:
+            self.assertIn(
+                'ari_backup_transferred_bytes{backup_job="test_label"} 42.0\n',
+                f.read())
+
+    @flagsaver.flagsaver
+    def testRun_historyPathSet_recordsRun(self):
+        history_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, history_dir)
+        FLAGS.history_path = os.path.join(history_dir, 'history.sqlite')
+        test_workflow = workflow.BaseWorkflow(
+            label='test_label', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+        test_workflow._run_custom_workflow = (
+            lambda: test_workflow.record_metric('transferred_bytes', 42))
+
+        test_workflow.run()
+
+        with history.open_history(FLAGS.history_path) as store:
+            run, = store.get_runs('test_label')
+        self.assertTrue(run.succeeded)
+        self.assertEqual(run.transferred_bytes, 42)
+
+    @flagsaver.flagsaver
+    def testRun_historyPathSetInDryRun_recordsNothing(self):
+        history_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, history_dir)
+        FLAGS.history_path = os.path.join(history_dir, 'history.sqlite')
+        FLAGS.dry_run = True
+        test_workflow = workflow.BaseWorkflow(
+            label='test_label', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+        test_workflow._run_custom_workflow = lambda: None
+
+        test_workflow.run()
+
+        self.assertFalse(os.path.exists(FLAGS.history_path))
+
+    @flagsaver.flagsaver
+    def testRun_labelLockedByAnotherRun_failsWithoutRunningHooks(self):
+        FLAGS.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, FLAGS.lock_dir)
+        first_workflow = workflow.BaseWorkflow(
+            label='test_label', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+        second_workflow = workflow.BaseWorkflow(
+            label='test_label', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+        mock_hook = mock.MagicMock()
+        second_workflow.add_post_hook(mock_hook)
+        second_workflow._run_custom_workflow = mock.MagicMock()
+        results = list()
+        first_workflow._run_custom_workflow = (
+            lambda: results.append(second_workflow.run()))
+
+        self.assertTrue(first_workflow.run())
+
+        self.assertEqual(results, [False])
+        second_workflow._run_custom_workflow.assert_not_called()
+        mock_hook.assert_not_called()
+        # The lock is free again once the first run is over.
+        self.assertTrue(second_workflow.run())
+
+    @flagsaver.flagsaver
+    def testRun_lockDirUnusable_runsWithoutLocks(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        FLAGS.lock_dir = os.path.join(lock_dir, 'not-a-directory')
+        open(FLAGS.lock_dir, 'w').close()
+        test_workflow = workflow.BaseWorkflow(
+            label='test_label', settings_path=None,
+            command_runner=test_lib.GetMockCommandRunner(),
+            argv=['fake_program'])
+        test_workflow._run_custom_workflow = lambda: None
+
+        self.assertTrue(test_workflow.run())
+
+
+class RetryPolicyTest(absltest.TestCase):
+
+    @mock.patch.object(random, 'random')
+    def testGetDelay_appliesJitter(self, mock_random):
+        mock_random.return_value = 0.5
+        retry_policy = workflow.RetryPolicy(initial_interval=10, jitter=0.4)
+
+        self.assertAlmostEqual(retry_policy.get_delay(1), 8)
+
+    def testGetDelay_cappedAtMaxInterval(self):
+        retry_policy = workflow.RetryPolicy(
+            initial_interval=10, multiplier=10, max_interval=50, jitter=0)
+
+        self.assertEqual(retry_policy.get_delay(3), 50)
+
+    def testIsTransient_sshExitCodeOnLocalhost_isNotTransient(self):
+        retry_policy = workflow.RetryPolicy()
+        error = workflow.NonZeroExitCode(
+            'unused', host='localhost', exitcode=255, stderr='')
+
+        self.assertFalse(retry_policy.is_transient(error))
+
+    def testIsTransient_customPatterns_matchesStderr(self):
+        retry_policy = workflow.RetryPolicy(
+            transient_error_patterns=(r'fake flake',))
+        error = workflow.NonZeroExitCode(
+            'unused', host='localhost', exitcode=1, stderr='a FAKE FLAKE')
+
+        self.assertTrue(retry_policy.is_transient(error))
+
+
+class LoadWorkflowsTest(absltest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.marker_path = os.path.join(self.temp_dir, 'ran')
+        if not FLAGS.is_parsed():
+            FLAGS(['fake_program'])
+
+    def _write_job(self, body):
+        path = os.path.join(self.temp_dir, 'job')
+        with open(path, 'w') as job_file:
+            job_file.write(
+                '#!/usr/bin/env python3\n'
+                'import sys\n'
+                'from ari_backup import workflow\n'
+                'backup = workflow.BaseWorkflow(label="fake_backup",\n'
+                '                               settings_path=None)\n'
+                'backup._run_custom_workflow = (\n'
+                '    lambda: open({!r}, "w").close())\n'.format(
+                    self.marker_path))
+            job_file.write(body)
+        return path
+
+    def testLoadWorkflows_runNotCarriedOutUntilCalled(self):
+        path = self._write_job('sys.exit(0 if backup.run() else 1)\n')
+
+        runs = workflow.load_workflows(path)
+
+        self.assertLen(runs, 1)
+        self.assertFalse(os.path.exists(self.marker_path))
+        self.assertTrue(runs[0]())
+        self.assertTrue(os.path.exists(self.marker_path))
+
+    def testLoadWorkflows_runConcurrently_collectedAsOneRun(self):
+        path = self._write_job(
+            'other = workflow.BaseWorkflow(label="other_backup",\n'
+            '                              settings_path=None)\n'
+            'other._run_custom_workflow = lambda: None\n'
+            'workflow.run_concurrently([backup, other])\n')
+
+        runs = workflow.load_workflows(path)
+
+        self.assertLen(runs, 1)
+        self.assertTrue(runs[0]())
+        self.assertTrue(os.path.exists(self.marker_path))
+
+    def testLoadWorkflows_mainGuard_runCollected(self):
+        path = self._write_job('if __name__ == "__main__":\n'
+                               '    backup.run()\n')
+
+        self.assertLen(workflow.load_workflows(path), 1)
+
+    @flagsaver.flagsaver
+    @mock.patch.object(workflow.BaseWorkflow, '_get_settings_from_file')
+    def testLoadWorkflows_settingsAppliedToWorkflowOnly(
+            self, mock_get_settings_from_file):
+        FLAGS.set_default('remote_user', 'process_user')
+        mock_get_settings_from_file.return_value = settings.Settings(
+            {'remote_user': 'job_user'}, [], from_cache=False)
+        path = self._write_job('backup.run()\n')
+
+        run, = workflow.load_workflows(path)
+
+        self.assertEqual(run.__self__.remote_user, 'job_user')
+        self.assertEqual(FLAGS.remote_user, 'process_user')
+
 
 if __name__ == '__main__':
     absltest.main()
@@ -7,10 +7,14 @@ from absl import flags
 from ari_backup import lvm
 from ari_backup import workflow
 
+# Like workflow.py, this imports asyncio, compression and metrics where
+# they're used, so that they're only loaded once a job gets to them.
+
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('rsync_options',
-                    '--archive --acls --numeric-ids --delete --inplace',
+                    '--archive --acls --numeric-ids --delete --inplace '
+                    '--stats',
                     'rsync command options')
 flags.DEFINE_string('rsync_path', '/usr/bin/rsync', 'path to rsync binary')
 flags.DEFINE_string('zfs_snapshot_prefix', 'ari-backup-',
@@ -83,15 +87,24 @@ class ZFSLVMBackup(lvm.LVMSourceMixIn, workflow.BaseWorkflow):
 
         # Assign flags to instance vars so they might be easily overridden in
         # workflow configs.
-        self.rsync_options = FLAGS.rsync_options
-        self.rsync_path = FLAGS.rsync_path
-        self.zfs_snapshot_prefix = FLAGS.zfs_snapshot_prefix
+        self.rsync_options = self._flags.rsync_options
+        self.rsync_path = self._flags.rsync_path
+        self.zfs_snapshot_prefix = self._flags.zfs_snapshot_prefix
         self.zfs_snapshot_timestamp_format = \
-            FLAGS.zfs_snapshot_timestamp_format
+            self._flags.zfs_snapshot_timestamp_format
 
-        self.add_post_hook(self._create_zfs_snapshot)
+        self.add_post_hook(self._create_zfs_snapshot,
+                           name='create_zfs_snapshot')
         self.add_post_hook(self._destroy_expired_zfs_snapshots,
-                           {'days': snapshot_expiration_days})
+                           {'days': snapshot_expiration_days},
+                           name='destroy_expired_zfs_snapshots')
+        if self.metrics_textfile_dir:
+            self.add_post_hook(self._record_zfs_space,
+                               name='record_zfs_space')
+
+    def _get_lock_destination(self) -> str:
+        """Returns the ZFS dataset the job writes to."""
+        return '{}:{}'.format(self.zfs_hostname, self.dataset_name)
 
     def _get_current_datetime(self) -> datetime.datetime:
         """Returns datetime object with the current date and time.
@@ -105,21 +118,77 @@ class ZFSLVMBackup(lvm.LVMSourceMixIn, workflow.BaseWorkflow):
         # TODO(jpwoodbu) Consider throwing an exception if we see things in the
         # include or exclude lists since we don't use them in this class.
         self.logger.debug('ZFSLVMBackup._run_custom_workflow started.')
+        rsync_args = self._get_rsync_args(
+            self._get_rsync_compression(), progress=True)
+        with self.monitor_progress('rsync'):
+            stdout, unused_stderr = self.run_command(
+                rsync_args, self.source_hostname)
+        self._record_transferred_bytes(stdout)
+        self.logger.debug('ZFSLVMBackup._run_custom_workflow completed.')
+
+    async def _run_custom_workflow_async(self) -> None:
+        """Run rsync backup of LVM snapshot without blocking the event loop.
+        """
+        import asyncio
+
+        compress = await asyncio.to_thread(self._get_rsync_compression)
+        with self.monitor_progress('rsync'):
+            stdout, unused_stderr = await self.run_command_async(
+                self._get_rsync_args(compress, progress=True),
+                self.source_hostname)
+        self._record_transferred_bytes(stdout)
+
+    def _record_transferred_bytes(self, stdout: str) -> None:
+        """Records the bytes transferred according to rsync's --stats."""
+        from ari_backup import metrics
+
+        transferred_bytes = metrics.parse_rsync_transferred_bytes(stdout)
+        if transferred_bytes is not None:
+            self.record_metric('transferred_bytes', transferred_bytes)
+
+    def _get_rsync_compression(self) -> bool:
+        """Returns whether rsync should compress the data it sends.
+
+        This is only ever the case when auto_ssh_compression is set and a
+        probe of the link from the source host to the rsync destination finds
+        it pays off. See BaseWorkflow.get_ssh_compression().
+        """
+        from ari_backup import compression
 
+        destination = compression.get_rsync_host(self.rsync_dst)
+        if destination is None:
+            return False
+        return bool(self.get_ssh_compression(
+            self.source_hostname, [self._snapshot_mount_point_base_path],
+            destination))
+
+    def _get_rsync_args(self,
+                        compress: bool = False,
+                        progress: bool = False) -> list[str]:
+        """Returns the rsync command line used to copy the snapshots.
+
+        Args:
+            compress: whether rsync should compress the data it sends.
+            progress: whether the command runs within monitor_progress(), in
+                which case rsync reports its progress when progress_interval
+                is set.
+        """
         # Since we're dealing with ZFS datasets, let's always exclude the .zfs
         # directory in our rsync options.
         rsync_options = shlex.split(self.rsync_options) + \
             ['--exclude', '/.zfs']
+        # Reports the overall progress, which needs rsync 3.1 or later.
+        if progress and self.progress_interval:
+            rsync_options.append('--info=progress2')
+        if compress:
+            rsync_options.append('--compress')
 
         # We add a trailing slash to the src path otherwise rsync will make a
         # subdirectory at the destination, even if the destination is already a
         # directory.
         rsync_src = self._snapshot_mount_point_base_path + '/'
 
-        command = [self.rsync_path] + rsync_options + \
-            [rsync_src, self.rsync_dst]
-        self.run_command(command, self.source_hostname)
-        self.logger.debug('ZFSLVMBackup._run_custom_workflow completed.')
+        return [self.rsync_path] + rsync_options + [rsync_src, self.rsync_dst]
 
     def _create_zfs_snapshot(self, error_case: bool) -> None:
         """Creates a new ZFS snapshot of our destination dataset.
@@ -164,7 +233,7 @@ class ZFSLVMBackup(lvm.LVMSourceMixIn, workflow.BaseWorkflow):
         # Let's find all the snapshots for this dataset.
         command = ['zfs', 'get', '-rH', '-o', 'name,value', 'type',
                    self.dataset_name]
-        stdout, unused_stderr = self.run_command(command, self.zfs_hostname)
+        stdout, unused_stderr = self.run_query(command, self.zfs_hostname)
 
         snapshots = list()
         # Sometimes we get extra lines which are empty, so we'll strip the
@@ -182,6 +251,9 @@ class ZFSLVMBackup(lvm.LVMSourceMixIn, workflow.BaseWorkflow):
             if creation_time <= expiration:
                 expired_snapshots.append(snapshot)
 
+        # The expired snapshots are about to be destroyed.
+        self.record_metric(
+            'zfs_snapshots', len(snapshots) - len(expired_snapshots))
         return expired_snapshots
 
     def _get_snapshot_creation_time(self, snapshot: str) -> datetime.datetime:
@@ -194,7 +266,7 @@ class ZFSLVMBackup(lvm.LVMSourceMixIn, workflow.BaseWorkflow):
             The creation time of the snapshot.
         """
         command = ['zfs', 'get', '-H', '-o', 'value', 'creation', snapshot]
-        stdout, unused_stderr = self.run_command(command, self.zfs_hostname)
+        stdout, unused_stderr = self.run_query(command, self.zfs_hostname)
         return datetime.datetime.strptime(stdout.strip(), '%a %b %d %H:%M %Y')
 
     def _destroy_expired_zfs_snapshots(
@@ -228,3 +300,34 @@ class ZFSLVMBackup(lvm.LVMSourceMixIn, workflow.BaseWorkflow):
 
             if not snapshots_destroyed:
                 self.logger.info('Found no expired ZFS snapshots.')
+
+    def _record_zfs_space(self, error_case: bool) -> None:
+        """Records the space used by and available to our dataset.
+
+        This post-job hook is only added when metrics are exported. It does
+        nothing if error_case is True. As the metrics are not worth failing
+        the backup over, the space is only logged as missing when it can't be
+        read.
+
+        Args:
+            error_case: whether an error has occurred during the backup.
+        """
+        if error_case:
+            return
+        command = ['zfs', 'get', '-Hp', '-o', 'property,value',
+                   'used,available', self.dataset_name]
+        try:
+            stdout, unused_stderr = self.run_command(
+                command, self.zfs_hostname)
+            space = dict()
+            for line in stdout.strip().splitlines():
+                name, value = line.split('\t')
+                space['zfs_{}_bytes'.format(name)] = int(value)
+        except (workflow.CommandNotFound, workflow.NonZeroExitCode,
+                ValueError) as e:
+            self.logger.warning(
+                'Could not read the space of {}: {}'.format(
+                    self.dataset_name, e))
+            return
+        for name, value in space.items():
+            self.record_metric(name, value)
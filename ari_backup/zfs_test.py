@@ -7,16 +7,25 @@ from absl.testing import absltest
 from absl.testing import flagsaver
 
 from ari_backup import test_lib
+from ari_backup import workflow
 from ari_backup import zfs
 
 
 FLAGS = flags.FLAGS
 # Disable logging to stderr when running tests.
 FLAGS.stderr_logging = False
+# Keep test runs out of the system lock directory.
+FLAGS.lock_dir = None
 
 
 class ZFSLVMBackupTest(absltest.TestCase):
 
+    def setUp(self):
+        super().setUp()
+        # Queries are cached across workflows, so across tests too.
+        workflow._QUERY_CACHE.clear()
+        self.addCleanup(workflow._QUERY_CACHE.clear)
+
     @mock.patch.object(zfs.ZFSLVMBackup, '_destroy_expired_zfs_snapshots')
     @mock.patch.object(zfs.ZFSLVMBackup, '_create_zfs_snapshot')
     def testWorkflowRunsInCorrectOrder(
@@ -25,7 +34,7 @@ class ZFSLVMBackupTest(absltest.TestCase):
         mock_command_runner = test_lib.GetMockCommandRunner()
         mock_run_custom_workflow = mock.MagicMock()
         backup = zfs.ZFSLVMBackup(
-            label='unused', source_hostname='unused',
+            label='unused', source_hostname='localhost',
             rsync_dst='unused_dst_host:/unused_dst',
             zfs_hostname='unused_zfs_host',
             dataset_name='unused_pool/unused_dataset',
@@ -83,6 +92,33 @@ class ZFSLVMBackupTest(absltest.TestCase):
             ['/fake/rsync', '--fake-options', '--exclude', '/.zfs',
              '/fake_root/fake_label/', 'fake_dst_host:/fake_dst'], False)
 
+    @flagsaver.flagsaver
+    @mock.patch.object(workflow.BaseWorkflow, 'get_ssh_compression',
+                       return_value=True)
+    def testRunCustomWorkflow_compressionPaysOff_rsyncCompresses(
+            self, mock_get_ssh_compression):
+        FLAGS.rsync_path = '/fake/rsync'
+        FLAGS.rsync_options = '--fake-options'
+        FLAGS.snapshot_mount_root = '/fake_root'
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        backup = zfs.ZFSLVMBackup(
+            label='fake_label', source_hostname='localhost',
+            rsync_dst='fake_dst_host:/fake_dst',
+            zfs_hostname='unused_zfs_host',
+            dataset_name='unused_pool/unused_dataset',
+            snapshot_expiration_days=30,
+            settings_path=None, command_runner=mock_command_runner,
+            argv=['fake_program'])
+
+        backup._run_custom_workflow()
+
+        mock_get_ssh_compression.assert_called_once_with(
+            'localhost', ['/fake_root/fake_label'], 'fake_dst_host')
+        mock_command_runner.run.assert_called_once_with(
+            ['/fake/rsync', '--fake-options', '--exclude', '/.zfs',
+             '--compress', '/fake_root/fake_label/',
+             'fake_dst_host:/fake_dst'], False)
+
     @flagsaver.flagsaver
     @mock.patch.object(zfs.ZFSLVMBackup, '_get_current_datetime')
     def testCreateZFSSnapshot_errorCaseIsFalse_createsSnapshot(
@@ -281,6 +317,26 @@ class ZFSLVMBackupTest(absltest.TestCase):
              'fake_pool/fake_snapshot'],
             False)
 
+    def testGetSnapshotCreationTime_askedTwice_queriesHostOnce(self):
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.return_value = ('Sat Jan  3  6:48 2015', str(),
+                                                0)
+        backup = zfs.ZFSLVMBackup(
+            label='unused_label', source_hostname='unused',
+            rsync_dst='unused_dst_host:/unused_dst',
+            zfs_hostname='fake_zfs_host',
+            dataset_name='unused_pool/unused_dataset',
+            snapshot_expiration_days=30,
+            settings_path=None, command_runner=mock_command_runner,
+            argv=['fake_program'])
+
+        backup._get_snapshot_creation_time('fake_pool/fake_snapshot')
+        creation_time = backup._get_snapshot_creation_time(
+            'fake_pool/fake_snapshot')
+
+        self.assertEqual(creation_time, datetime.datetime(2015, 1, 3, 6, 48))
+        mock_command_runner.run.assert_called_once()
+
     @flagsaver.flagsaver
     @mock.patch.object(zfs.ZFSLVMBackup, '_get_current_datetime')
     @mock.patch.object(zfs.ZFSLVMBackup, '_find_snapshots_older_than')
@@ -330,6 +386,55 @@ class ZFSLVMBackupTest(absltest.TestCase):
 
         self.assertFalse(mock_command_runner.run.called)
 
+    @flagsaver.flagsaver
+    def testRecordZFSSpace_metricsEnabled_recordsUsedAndAvailable(self):
+        FLAGS.metrics_textfile_dir = '/unused_metrics_dir'
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.return_value = (
+            'used\t1000\navailable\t2000\n', str(), 0)
+        backup = zfs.ZFSLVMBackup(
+            label='unused_label', source_hostname='unused',
+            rsync_dst='unused_dst_host:/unused_dst',
+            zfs_hostname='fake_zfs_host',
+            dataset_name='fake_pool/fake_dataset',
+            snapshot_expiration_days=30,
+            settings_path=None, command_runner=mock_command_runner,
+            argv=['fake_program'])
+        backup._start_run_report()
+
+        backup._record_zfs_space(error_case=False)
+
+        self.assertIn('record_zfs_space',
+                      [hook.name for hook in backup._post_job_hooks])
+        self.assertEqual(backup.run_report.metrics,
+                         {'zfs_used_bytes': 1000, 'zfs_available_bytes': 2000})
+        mock_command_runner.run.assert_called_once_with(
+            ['/usr/bin/ssh', '-p', '22', 'root@fake_zfs_host', 'zfs', 'get',
+             '-Hp', '-o', 'property,value', 'used,available',
+             'fake_pool/fake_dataset'], False)
+
+    @flagsaver.flagsaver
+    def testRecordZFSSpace_unparsableOutput_recordsNothing(self):
+        FLAGS.metrics_textfile_dir = '/unused_metrics_dir'
+        mock_command_runner = test_lib.GetMockCommandRunner()
+        mock_command_runner.run.return_value = (
+            'used\t1000\navailable\t-\n', str(), 0)
+        backup = zfs.ZFSLVMBackup(
+            label='unused_label', source_hostname='unused',
+            rsync_dst='unused_dst_host:/unused_dst',
+            zfs_hostname='fake_zfs_host',
+            dataset_name='fake_pool/fake_dataset',
+            snapshot_expiration_days=30,
+            settings_path=None, command_runner=mock_command_runner,
+            argv=['fake_program'])
+        backup.logger = mock.MagicMock()
+        backup._start_run_report()
+
+        backup._record_zfs_space(error_case=False)
+
+        self.assertEqual(backup.run_report.metrics, {})
+        self.assertTrue(backup.logger.warning.called)
+
 
 if __name__ == '__main__':
     absltest.main()
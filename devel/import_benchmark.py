@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Measures the cold-start cost of the ari_backup entry points.
+
+Every job script starts a new interpreter and imports ari_backup, so import
+time is paid once per job. Each entry point is timed in fresh interpreters,
+and the time of an interpreter which imports nothing is reported alongside as
+the baseline. The run fails if an entry point loads any of the modules which
+are deferred until a job uses them.
+
+Example:
+    python3 devel/import_benchmark.py --runs 20
+    python3 devel/import_benchmark.py --json > import_times.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# The statements job scripts use to get at each workflow class.
+ENTRY_POINTS = {
+    'baseline': 'pass',
+    'ari_backup': 'import ari_backup',
+    'RdiffBackup': 'import ari_backup; ari_backup.RdiffBackup',
+    'RdiffLVMBackup': 'import ari_backup; ari_backup.RdiffLVMBackup',
+    'ShardedRdiffBackup': 'import ari_backup; ari_backup.ShardedRdiffBackup',
+    'ZFSLVMBackup': 'import ari_backup; ari_backup.ZFSLVMBackup',
+}
+
+# Modules the entry points import where they're used rather than up front.
+DEFERRED_MODULES = ('asyncio', 'ari_backup.compression', 'ari_backup.metrics')
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_statement(statement: str, runs: int) -> list[float]:
+    """Returns the wall time, in ms, of running statement in new interpreters.
+    """
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    # Don't let a stale or missing bytecode cache skew the first run.
+    subprocess.run([sys.executable, '-c', statement], env=env, check=True)
+    times = list()
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], env=env, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def find_deferred_imports(statement: str) -> list[str]:
+    """Returns the deferred modules loaded by running statement."""
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    check = ('{}\n'
+             'import sys\n'
+             'print(*(m for m in {!r} if m in sys.modules))').format(
+                 statement, DEFERRED_MODULES)
+    output = subprocess.run([sys.executable, '-c', check], env=env,
+                            check=True, stdout=subprocess.PIPE,
+                            text=True).stdout
+    return output.split()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='interpreters started per entry point')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    for name, statement in ENTRY_POINTS.items():
+        loaded = find_deferred_imports(statement)
+        if loaded:
+            sys.exit('{} imports {}, which should be deferred.'.format(
+                name, ', '.join(loaded)))
+    results = dict()
+    for name, statement in ENTRY_POINTS.items():
+        times = time_statement(statement, args.runs)
+        results[name] = {'min_ms': min(times),
+                         'median_ms': statistics.median(times)}
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    baseline = results['baseline']['median_ms']
+    print('{:<20} {:>10} {:>10} {:>14}'.format(
+        'entry point', 'min ms', 'median ms', 'over baseline'))
+    for name, result in results.items():
+        print('{:<20} {:>10.1f} {:>10.1f} {:>14.1f}'.format(
+            name, result['min_ms'], result['median_ms'],
+            result['median_ms'] - baseline))
+
+
+if __name__ == '__main__':
+    main()
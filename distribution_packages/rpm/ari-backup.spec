@@ -58,6 +58,7 @@ rm -rf %{buildroot}
 %defattr(-,root,root,-)
 %{python_sitelib}/ari_backup
 %{python_sitelib}/*.egg-info
+%{_bindir}/ari-backup-run
 %defattr(0600,root,root,0700)
 %{_sysconfdir}/%{name}
 %{_sysconfdir}/%{name}/jobs.d
@@ -8,6 +8,7 @@ setup(
     version='2.0.0',
     license='BSD',
     packages=['ari_backup'],
+    scripts=['include/bin/ari-backup-run'],
     author='ari-backup team',
     install_requires=[
         'absl-py>=1.3.0',